@@ -116,6 +116,18 @@ LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
 NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
 SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 """
+import sys
+
+#################
+# headless commands : python -m bLUe batch|watch|serve ...
+# The GUI modules must not be imported. The command module is run
+# as the main module, so worker processes do not import this file.
+#################
+headlessCommands = {'batch': 'bLUeTop.batch', 'watch': 'bLUeTop.hotFolder', 'serve': 'bLUeTop.renderServer'}
+if __name__ == '__main__' and sys.argv[1:2] and sys.argv[1] in headlessCommands:
+    import runpy
+    runpy.run_module(headlessCommands[sys.argv.pop(1)], run_name='__main__', alter_sys=True)
+
 import os
 from os import path, walk, remove
 from os.path import basename, isfile
@@ -145,7 +157,7 @@ from PySide2.QtGui import QPixmap, QCursor, QKeySequence, QDesktopServices, QFon
     QTransform, QColor, QImage, QIcon
 from PySide2.QtWidgets import QApplication, QAction, \
     QDockWidget, QSizePolicy, QSplashScreen, QWidget, \
-    QTabWidget, QToolBar, QComboBox, QTabBar
+    QTabWidget, QToolBar, QComboBox, QTabBar, QFileDialog
 from bLUeTop.QtGui1 import app, window, splitWin
 from bLUeTop import exiftool
 from bLUeTop.graphicsBlendFilter import blendFilterForm
@@ -156,8 +168,10 @@ from bLUeTop.graphicsNoise import noiseForm
 from bLUeTop.graphicsRaw import rawForm
 from bLUeTop.graphicsTransform import transForm, imageForm
 from bLUeGui.bLUeImage import QImageBuffer, QImageFormats
+from bLUeGui.dialog import dlgInfo, dlgWarn
+from bLUeTop.pipeline import LUT3DParams, saveStack
 from bLUeTop.presetReader import aParser
-from bLUeTop.rawProcessing import rawRead
+from bLUeTop.rawStages import rawRead
 from bLUeTop.versatileImg import vImage, metadataBag
 from bLUeTop.MarkedImg import imImage, QRawLayer, QCloningLayer
 from bLUeTop.graphicsRGBLUT import graphicsForm
@@ -168,7 +182,8 @@ from bLUeTop.colorManagement import icc
 from bLUeTop.graphicsCoBrSat import CoBrSatForm
 from bLUeTop.graphicsExp import ExpForm
 from bLUeTop.graphicsPatch import patchForm
-from bLUeTop.settings import USE_POOL, POOL_SIZE, THEME, TABBING, BRUSHES_PATH, COLOR_MANAGE_OPT
+from bLUeTop.settings import USE_POOL, POOL_SIZE, THEME, TABBING, BRUSHES_PATH, COLOR_MANAGE_OPT, LUT_CACHE_DIR
+from bLUeTop.stackWorker import isStackPending
 from bLUeTop.utils import UDict, stateAwareQDockWidget
 from bLUeGui.tool import cropTool, rotatingTool
 from bLUeTop.graphicsTemp import temperatureForm
@@ -528,6 +543,10 @@ def setDocumentImage(img, window=window):
 
     # image changed event handler
     def f(hist=True):
+        # the stack worker calls the handler when the
+        # pending evaluation of the stack is completed
+        if isStackPending(img):
+            return
         # refresh windows (use repaint for faster update)
         window.label.repaint()
         window.label_3.repaint()
@@ -697,7 +716,9 @@ def menuFile(name, window=window):
     # saving dialog
     elif name == 'actionSave' or name == 'actionSave_As':
         saveAs = (name=='actionSave_As')
-        if window.label.img.useThumb:
+        # progressive rendering : get the full resolution image
+        window.label.img.refine()
+        if window.label.img.useThumb and not window.label.img.canRenderTiled():
             dlgWarn("Uncheck Preview mode before saving")
         else:
             img = window.label.img
@@ -985,11 +1006,14 @@ def menuLayer(name, window=window):
         grWindow = form.getNewWindow(axeSize=axeSize, targetImage=window.label.img, layer=layer, parent=window)
         # wrapper for the right applyXXX method
         if name == 'actionCurves_RGB':
-            layer.execute = lambda l=layer, pool=None: l.tLayer.apply1DLUT(grWindow.scene().cubicItem.getStackedLUTXY())
+            layer.execute = lambda l=layer, pool=None: l.tLayer.apply1DLUT(l.getFormParams().getStackedLUTXY())
         elif name == 'actionCurves_HSpB':  # displayed as HSV in the layer menu !!
-            layer.execute = lambda l=layer, pool=None: l.tLayer.applyHSV1DLUT(grWindow.scene().cubicItem.getStackedLUTXY(), pool=pool)
+            layer.execute = lambda l=layer, pool=None: l.tLayer.applyHSV1DLUT(l.getFormParams().getStackedLUTXY(), pool=pool)
         elif name == 'actionCurves_Lab':
-            layer.execute = lambda l=layer, pool=None: l.tLayer.applyLab1DLUT(grWindow.scene().cubicItem.getStackedLUTXY())
+            layer.execute = lambda l=layer, pool=None: l.tLayer.applyLab1DLUT(l.getFormParams().getStackedLUTXY())
+        layer.colorOnly = True
+        # curves compute the dirty region only (cf. vImage.getDirtySlices())
+        layer.haloRadius, layer.dirtyRectAware = 0, True
     # 3D LUT
     elif name in ['action3D_LUT', 'action3D_LUT_HSB']:
         # color model
@@ -1000,10 +1024,12 @@ def menuLayer(name, window=window):
                                                   LUTSize=LUTSIZE, layer=layer, parent=window, mainForm=window)  # mainForm mandatory here
         # init pool only once
         pool = getPool()
-        sc = grWindow.scene()
-        layer.execute = lambda l=layer, pool=pool: l.tLayer.apply3DLUT(sc.lut,
-                                                                       options=sc.options,
+        layer.execute = lambda l=layer, pool=pool: l.tLayer.apply3DLUT(l.getFormParams().getLUT(),
+                                                                       options=l.getFormParams().getSceneOptions(),
                                                                        pool=pool)
+        # an interpolated alpha channel is used as mask
+        layer.colorOnly = lambda l=layer: l.getFormParams().getSceneOptions()['keep alpha']
+        layer.haloRadius, layer.dirtyRectAware = 0, True
     elif name == 'action2D_LUT_HV':
         layerName = '3D LUT HV Shift'
         layer = window.label.img.addAdjustmentLayer(name=layerName, role='2DLUT')
@@ -1011,8 +1037,10 @@ def menuLayer(name, window=window):
                                                   layer=layer, parent=window)
         # init pool only once
         pool = getPool()
-        sc = grWindow.scene()
-        layer.execute = lambda l=layer, pool=pool: l.tLayer.applyHVLUT2D(grWindow.LUT, options=sc.options, pool=pool)
+        layer.execute = lambda l=layer, pool=pool: l.tLayer.applyHVLUT2D(l.getFormParams().LUT,
+                                                                         options=l.getFormParams().getSceneOptions(),
+                                                                         pool=pool)
+        layer.haloRadius = 0
     # cloning
     elif name == 'actionNew_Cloning_Layer':
         lname = 'Cloning'
@@ -1024,7 +1052,7 @@ def menuLayer(name, window=window):
         lname = 'Segmentation'
         layer = window.label.img.addSegmentationLayer(name=lname)
         grWindow = segmentForm.getNewWindow(targetImage=window.label.img, layer=layer)
-        layer.execute = lambda l=layer, pool=None: l.tLayer.applyGrabcut(nbIter=grWindow.nbIter)
+        layer.execute = lambda l=layer, pool=None: l.tLayer.applyGrabcut(nbIter=l.getFormParams().nbIter)
     # load an image from file
     elif name == 'actionLoad_Image_from_File':
         filenames = openDlg(window, ask=False, multiple=True)
@@ -1057,7 +1085,7 @@ def menuLayer(name, window=window):
             tool = rotatingTool(parent=window.label)  # , layer=l, form=grWindow)
             layer.addTool(tool)
             tool.showTool()
-            layer.execute = lambda l=layer, pool=None: l.tLayer.applyImage(grWindow.options)
+            layer.execute = lambda l=layer, pool=None: l.tLayer.applyImage(l.getFormParams().options)
             layer.actioname = name
             layer.filename = filename
             post(layer)
@@ -1075,7 +1103,7 @@ def menuLayer(name, window=window):
         tool = rotatingTool(parent=window.label)  # , layer=l, form=grWindow)
         layer.addTool(tool)
         tool.showTool()
-        layer.execute = lambda l=layer, pool=None: l.tLayer.applyImage(grWindow.options)
+        layer.execute = lambda l=layer, pool=None: l.tLayer.applyImage(l.getFormParams().options)
         layer.actioname = name
     elif name == 'actionNew_Drawing_Layer':
         processedImg = window.label.img
@@ -1087,6 +1115,7 @@ def menuLayer(name, window=window):
         layer = window.label.img.addAdjustmentLayer(name=lname, sourceImg=imgNew, role='DRW')
         grWindow = drawForm.getNewWindow(axeSize=axeSize, targetImage=window.label.img, layer=layer, parent=window)
         layer.execute = lambda l=layer, pool=None: l.tLayer.applyNone()
+        layer.haloRadius, layer.dirtyRectAware = 0, True
         layer.actioname = name
     # Color filter
     elif name == 'actionColor_Temperature':
@@ -1095,6 +1124,10 @@ def menuLayer(name, window=window):
         grWindow = temperatureForm.getNewWindow(axeSize=axeSize, targetImage=window.label.img, layer=layer, parent=window)
         # wrapper for the right apply method
         layer.execute = lambda l=layer, pool=None: l.tLayer.applyTemperature()
+        # chromatic adaptation normalizes output by the image max
+        layer.colorOnly = lambda l=layer: not l.getFormParams().options['Chromatic Adaptation']
+        layer.globalStats = lambda l=layer: l.getFormParams().options['Chromatic Adaptation']
+        layer.linearLight = lambda l=layer: l.getFormParams().options['Chromatic Adaptation']
     elif name == 'actionContrast_Correction':
         layer = window.label.img.addAdjustmentLayer(name=CoBrSatForm.layerTitle, role='CONTRAST')
         grWindow = CoBrSatForm.getNewWindow(axeSize=axeSize, targetImage=window.label.img, layer=layer, parent=window)
@@ -1107,18 +1140,24 @@ def menuLayer(name, window=window):
         grWindow.onUpdateContrast = h
         # wrapper for the right apply method
         layer.execute = lambda l=layer, pool=None: l.tLayer.applyContrast()
+        # CLAHE is detected when the run is compiled
+        layer.colorOnly = True
+        # CLAHE and histogram warping
+        layer.globalStats = lambda l=layer: (l.getFormParams().contrastCorrection or 0) > 0
     elif name == 'actionExposure_Correction':
         lname = 'Exposure'
         layer = window.label.img.addAdjustmentLayer(name=lname)
         layer.clipLimit = ExpForm.defaultExpCorrection
         grWindow = ExpForm.getNewWindow(axeSize=axeSize, targetImage=window.label.img, layer=layer, parent=window)
-        layer.execute = lambda l=layer,  pool=None: l.tLayer.applyExposure(grWindow.options)
+        layer.execute = lambda l=layer,  pool=None: l.tLayer.applyExposure(l.getFormParams().options)
+        layer.colorOnly = True
+        layer.linearLight = True
     elif name == 'actionHDR_Merge':
         lname = 'Merge'
         layer = window.label.img.addAdjustmentLayer(name=lname, role='MERGING')
         layer.clipLimit = ExpForm.defaultExpCorrection
         grWindow = HDRMergeForm.getNewWindow(axeSize=axeSize, targetImage=window.label.img, layer=layer, parent=window)
-        layer.execute = lambda l=layer,  pool=None: l.tLayer.applyHDRMerge(grWindow.options)
+        layer.execute = lambda l=layer,  pool=None: l.tLayer.applyHDRMerge(l.getFormParams().options)
     elif name == 'actionGeom_Transformation':
         lname = 'Transformation'
         layer = window.label.img.addAdjustmentLayer(name=lname, role='GEOMETRY')
@@ -1127,13 +1166,14 @@ def menuLayer(name, window=window):
         tool = rotatingTool(parent=window.label)
         layer.addTool(tool)
         tool.showTool()
-        layer.execute = lambda l=layer, pool=None: l.tLayer.applyTransForm(grWindow.options)
+        layer.execute = lambda l=layer, pool=None: l.tLayer.applyTransForm(l.getFormParams().options)
     elif name == 'actionFilter':
         lname = 'Filter'
         layer = window.label.img.addAdjustmentLayer(name=lname)
         grWindow = filterForm.getNewWindow(axeSize=axeSize, targetImage=window.label.img, layer=layer)
         # wrapper for the right apply method
         layer.execute = lambda l=layer, pool=None: l.tLayer.applyFilter2D()
+        layer.haloRadius, layer.dirtyRectAware = lambda l=layer: l.getFormParams().radius + 1, True
     elif name == 'actionGradual_Filter':
         lname = 'Gradual Filter'
         layer = window.label.img.addAdjustmentLayer(name=lname)
@@ -1160,7 +1200,10 @@ def menuLayer(name, window=window):
         layer = window.label.img.addAdjustmentLayer(name=lname)
         grWindow = mixerForm.getNewWindow(axeSize=260, targetImage=window.label.img,
                                            layer=layer, parent=window)
-        layer.execute = lambda l=layer: l.tLayer.applyMixer(grWindow.options)
+        layer.execute = lambda l=layer: l.tLayer.applyMixer(l.getFormParams().options)
+        layer.colorOnly = True
+        # luminosity blending is done in sRGB
+        layer.linearLight = lambda l=layer: not l.getFormParams().options['Luminosity']
     # load 3D LUT from .cube file
     elif name == 'actionLoad_3D_LUT':
         lastDir = window.settings.value('paths/dlg3DLUTdir', '.')
@@ -1173,16 +1216,20 @@ def menuLayer(name, window=window):
             filenames = dlg.selectedFiles()
             name = filenames[0]
             try:
-                lut = LUT3D.readFromTextFile(name)
+                lut = LUT3D.readFromTextFile(name, cacheDir=LUT_CACHE_DIR)
             except (ValueError, IOError) as e:
                 dlgWarn('Unable to load 3D LUT : ', info=str(e))
                 return
             lname = path.basename(name)
             layer = window.label.img.addAdjustmentLayer(name=lname)
+            # the layer has no form
+            layer.getParams = lambda lutPath=name: LUT3DParams(path=lutPath)
             pool = getPool()
             layer.execute = lambda l=layer, pool=pool: l.tLayer.apply3DLUT(lut,
                                                                            UDict(({'use selection': False, 'keep alpha': True},)),
                                                                            pool=pool)
+            layer.colorOnly = True
+            layer.haloRadius, layer.dirtyRectAware = 0, True
             window.tableView.setLayers(window.label.img)
             layer.applyToStack()
             # The resulting image is modified,
@@ -1247,6 +1294,28 @@ def menuLayer(name, window=window):
             img.prLayer.update()
             window.label.repaint()
             return
+    # save the stack for headless processing (cf. bLUeTop.batch)
+    elif name == 'actionSave_Layer_Stack':
+        try:
+            stack = window.label.img.getStackParams()
+        except ValueError as e:
+            dlgWarn('Cannot save the layer stack', info=str(e))
+            return
+        lastDir = str(window.settings.value('paths/dlgStackdir', '.'))
+        dlg = QFileDialog(window, "Save Layer Stack", lastDir)
+        dlg.setAcceptMode(QFileDialog.AcceptSave)
+        dlg.setNameFilter('*.json')
+        dlg.setDefaultSuffix('json')
+        if dlg.exec_():
+            window.settings.setValue('paths/dlgStackdir', dlg.directory().absolutePath())
+            filename = dlg.selectedFiles()[0]
+            try:
+                saveStack(filename, stack)
+            except IOError as e:
+                dlgWarn('Cannot save the layer stack', info=str(e))
+                return
+            dlgInfo('Layer stack written')
+        return
     # unknown action
     else:
         return
@@ -1314,7 +1383,8 @@ def canClose(index=None, window=window):
                 # save/discard dialog
                 ret = saveChangeDialog(img)
                 if ret == QMessageBox.Save:
-                    if img.useThumb:
+                    img.refine()
+                    if img.useThumb and not img.canRenderTiled():
                         dlgWarn("Uncheck Preview Mode before saving")
                         return False
                     # save dialog
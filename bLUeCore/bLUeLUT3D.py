@@ -15,7 +15,12 @@ Lesser General Lesser Public License for more details.
 You should have received a copy of the GNU Lesser General Public License
 along with this program. If not, see <http://www.gnu.org/licenses/>.
 """
+import copy
+import hashlib
+import os
+
 from .cartesian import cartesianProduct
+from .preparedLUT import PreparedLUT
 import numpy as np
 
 
@@ -92,58 +97,62 @@ class LUT3D (object):
         Values read should be between 0 and 1. They are
         multiplied by 255 and converted to int.
         The channels of the LUT and the axes of the cube are both in BGR order.
+        Header lines are keyword lines (TITLE, LUT_3D_SIZE, DOMAIN_MIN, DOMAIN_MAX)
+        or a title line. The legacy keyword Size, written by previous
+        versions of bLUe, is recognized as LUT_3D_SIZE. The data section starts
+        at the first line beginning with a number, and it is
+        parsed in a single call.
         Raises a ValueError exception if the method fails.
         @param inStream:
         @type inStream: TextIoWrapper
         @return: 3D LUT
         @rtype: LUT3D object
         """
+        lines = inStream.read().splitlines()
         ##########
         # read header
         #########
-        # We expect exactly 2 uncommented lines
-        # where the second is LUT_3D_SIZE xxx
+        size, dMin, dMax = None, [0.0] * 3, [1.0] * 3
         i = 0
-        for line in inStream:
+        for i, line in enumerate(lines):
+            token = line.split()
             # skip comments
-            if line.startswith('#') or (len(line.lstrip()) == 0):
-                continue
-            i += 1
-            if i < 2:
+            if not token or token[0].startswith('#'):
                 continue
-            # get LUT size (second line format should be : Size xx)
-            token = line.split()
-            if len(token) >= 2:
-                _, size = token
+            key = token[0].upper()
+            if key[0] in '+-.0123456789':
                 break
-            else:
-                raise ValueError('Cannot find LUT size')
-        # LUT size
-        size = int(size)
-        bufsize = (size ** 3) * 3
-        buf = np.zeros(bufsize, dtype=float)
+            if key in ('LUT_3D_SIZE', 'SIZE') and len(token) >= 2:
+                size = int(token[1])
+            elif key in ('DOMAIN_MIN', 'DOMAIN_MAX') and len(token) >= 4:
+                domain = [float(t) for t in token[1:4]]
+                if key == 'DOMAIN_MIN':
+                    dMin = domain
+                else:
+                    dMax = domain
+            elif key == 'LUT_1D_SIZE':
+                raise ValueError('1D LUTs are not supported')
+        else:
+            i = len(lines)
+        if size is None:
+            raise ValueError('Cannot find LUT size')
+        if dMin != [0.0] * 3 or dMax != [1.0] * 3:
+            raise ValueError('Unsupported LUT domain %s %s' % (dMin, dMax))
         #######
         # LUT
         ######
-        i = 0
-        # restarting from current position
-        for line in inStream:
-            if line.startswith('#') or (len(line.lstrip()) == 0):
-                continue
-            token = line.split()
-            if len(token) >= 3:
-                a, b, c = token
-            else:
-                raise ValueError('Wrong file format')
-            # BGR order for channels
-            buf[i:i+3] = float(c), float(b), float(a)
-            i += 3
+        data = lines[i:]
+        # skip comments
+        if any('#' in line for line in data):
+            data = [line.split('#', 1)[0] for line in data]
+        buf = np.array(' '.join(data).split(), dtype=float)
         # sanity check
-        if i != bufsize:
+        bufsize = (size ** 3) * 3
+        if buf.size != bufsize:
             raise ValueError('LUT size does not match line count')
-        buf *= 255.0
-        buf = buf.astype(int)
-        buf = buf.reshape(size, size, size, 3)
+        # BGR order for channels
+        buf = buf.reshape(size, size, size, 3)[..., ::-1]
+        buf = (buf * 255.0).astype(int)
         # the specification of the .cube format
         # gives BGR order for the cube axes (R-axis changing most rapidly)
         # So, no transposition is needed.
@@ -151,20 +160,46 @@ class LUT3D (object):
         return LUT3D(buf, size=size)
 
     @classmethod
-    def readFromTextFile(cls, filename):
+    def readFromTextFile(cls, filename, cacheDir=None):
         """
         Read a 3D LUT from a file in format .cube.
         Values read should be between 0 and 1. They are
         multiplied by 255 and converted to int.
         The channels of the LUT and the axes of the cube are both in order BGR.
+        If cacheDir is not None, the parsed LUT array is saved to
+        a binary .npy file in cacheDir, keyed by the path, size and
+        modification time of the .cube file, and subsequent reads
+        load the binary file. Cache errors are ignored.
         Raise a IOError exception.
         @param filename: path to file
         @type filename: str
+        @param cacheDir: binary cache directory
+        @type cacheDir: str
         @return: LUT3D
         @rtype: LUT3D class instance
         """
+        cachePath = None
+        if cacheDir is not None:
+            st = os.stat(filename)
+            key = '%s|%d|%d' % (os.path.abspath(filename), st.st_size, st.st_mtime_ns)
+            cachePath = os.path.join(cacheDir, hashlib.sha1(key.encode()).hexdigest() + '.npy')
+            try:
+                buf = np.load(cachePath)
+                return cls(buf, size=buf.shape[0])
+            except (IOError, OSError, ValueError):
+                pass
         with open(filename) as textStream:
             lut = cls.readFromTextStream(textStream)
+        if cachePath is not None:
+            try:
+                os.makedirs(cacheDir, exist_ok=True)
+                # write to a temporary file first, to never leave a partial cache entry
+                tmpPath = cachePath + '.%d.tmp' % os.getpid()
+                with open(tmpPath, 'wb') as f:
+                    np.save(f, lut.LUT3DArray)
+                os.replace(tmpPath, cachePath)
+            except (IOError, OSError):
+                pass
         return lut
 
     def __init__(self, LUT3DArray, size=defaultSize, maxrange=standardMaxRange, dtype=np.int16, alpha=False):
@@ -226,6 +261,54 @@ class LUT3D (object):
                                      axis=-1)
         super().__init__()
 
+    @property
+    def LUT3DArray(self):
+        """
+        Array of LUT values. Setting it invalidates
+        the cached prepared LUTs.
+        @return:
+        @rtype: ndarray, shape (size, size, size, d)
+        """
+        return self.__LUT3DArray
+
+    @LUT3DArray.setter
+    def LUT3DArray(self, value):
+        self.__LUT3DArray = value
+        self.invalidate()
+
+    def invalidate(self):
+        """
+        Discard the cached prepared LUTs. It must
+        be called after each in place modification of LUT3DArray.
+        """
+        self.__prepared = {}
+
+    def snapshot(self):
+        """
+        Return a copy of the LUT. The copy shares the cached
+        prepared LUTs, until one of the LUTs is invalidated.
+        @return:
+        @rtype: LUT3D
+        """
+        lut = copy.copy(self)
+        lut.__LUT3DArray = self.__LUT3DArray.copy()
+        return lut
+
+    def getPreparedLUT(self, channels=None):
+        """
+        Return a (cached) interpolation ready version of the LUT,
+        using the first channels of LUT3DArray.
+        @param channels: count of channels, all channels if None
+        @type channels: int
+        @return:
+        @rtype: PreparedLUT
+        """
+        pLUT = self.__prepared.get(channels)
+        if pLUT is None:
+            pLUT = PreparedLUT(self.LUT3DArray[..., :channels], self.step)
+            self.__prepared[channels] = pLUT
+        return pLUT
+
     def toHaldArray(self, w, h):
         """
         Convert a LUT3D object to a haldArray object with shape (w,h,3).
@@ -260,13 +343,14 @@ class LUT3D (object):
         LUT = self.LUT3DArray
         outStream.write('bLUe 3D LUT\n')
         outStream.write('Size %d\n' % self.size)
-        coeff = 255.0
-        for b in range(self.size):
-            for g in range(self.size):
-                for r in range(self.size):
-                    # r1, g1, b1 = LUT[r, g, b]  # order RGB
-                    b1, g1, r1 = LUT[b, g, r][:3]  # order BGR; BGRA values are allowed, so [:3] is mandatory
-                    outStream.write("%.7f %.7f %.7f\n" % (r1 / coeff, g1 / coeff, b1 / coeff))
+        # C-order ravel of the cube (R-axis changing most rapidly), RGB order for values.
+        # BGRA values are allowed, so [:3] is mandatory
+        buf = LUT[..., 2::-1].reshape(-1, 3) / 255.0
+        # format by chunks of lines, to limit memory usage
+        chunk = 2 ** 16
+        for start in range(0, buf.shape[0], chunk):
+            rows = buf[start:start + chunk]
+            outStream.write(("%.7f %.7f %.7f\n" * rows.shape[0]) % tuple(rows.ravel().tolist()))
 
     def writeToTextFile(self, filename):
         """
@@ -297,6 +381,7 @@ class DeltaLUT3D(object):
         """
         self.__divs = divs
         self.__data = np.zeros((divs[0] + 2, divs[1] + 1, divs[2] + 1, 3), dtype=np.float) + (0, 1, 1)
+        self.__prepared = {}
 
     @property
     def divs(self):
@@ -318,3 +403,36 @@ class DeltaLUT3D(object):
         @rtype: ndarray shape=(divs[0] + 2, divs[1] + 1, divs[2] + 1, 3), dtype=float
         """
         return self.__data
+
+    def invalidate(self):
+        """
+        Discard the cached prepared LUTs. It must
+        be called after each in place modification of data.
+        """
+        self.__prepared = {}
+
+    def snapshot(self):
+        """
+        Return a copy of the LUT. The copy shares the cached
+        prepared LUTs, until one of the LUTs is invalidated.
+        @return:
+        @rtype: DeltaLUT3D
+        """
+        lut = copy.copy(self)
+        lut.__data = self.__data.copy()
+        return lut
+
+    def getPreparedLUT(self, steps):
+        """
+        Return a (cached) interpolation ready version of data.
+        @param steps: interpolation steps
+        @type steps: 3-uple of numbers
+        @return:
+        @rtype: PreparedLUT
+        """
+        steps = tuple(steps)
+        pLUT = self.__prepared.get(steps)
+        if pLUT is None:
+            pLUT = PreparedLUT(self.__data, steps)
+            self.__prepared[steps] = pLUT
+        return pLUT
@@ -0,0 +1,226 @@
+"""
+This File is part of bLUe software.
+
+Copyright (C) 2017  Bernard Virot <bernard.virot@libertysurf.fr>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Lesser General Public License as
+published by the Free Software Foundation, version 3.
+
+This program is distributed in the hope that it will be useful, but
+WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+Lesser General Lesser Public License for more details.
+
+You should have received a copy of the GNU Lesser General Public License
+along with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from bLUeCore.cartesian import cartesianProduct
+from bLUeCore.preparedLUT import PreparedLUT
+from bLUeCore.trilinear import interpTriLinear
+from bLUeCore.uniqueColors import packColors, unpackColors
+
+
+class BakedLUT(object):
+    """
+    Dense lookup table baked from a 3D LUT, for 8 bits images.
+    With bits = 8, the table holds the (uint8) interpolated values
+    of all 2**24 colors, and applying it is a single gather.
+    With bits < 8, the LUT is resampled on a regular grid with 2**bits
+    intervals per axis. The base value is read from the grid and corrected
+    by the first order residual along each axis (4 gathers instead of 8).
+    """
+    @staticmethod
+    def tableSize(bits, d):
+        """
+        Size (in bytes) of the table baked from a LUT
+        with d channels.
+        @param bits: bits per channel
+        @type bits: int
+        @param d: count of LUT channels
+        @type d: int
+        @return:
+        @rtype: int
+        """
+        if bits == 8:
+            return (1 << 24) * d
+        return ((1 << bits) + 1) ** 3 * d * 4
+
+    @staticmethod
+    def bakeCost(bits):
+        """
+        Count of points interpolated to bake a table.
+        @param bits: bits per channel
+        @type bits: int
+        @return:
+        @rtype: int
+        """
+        if bits == 8:
+            return 1 << 24
+        return ((1 << bits) + 1) ** 3
+
+    def __init__(self, pLUT, bits=8, interp=interpTriLinear, bandSize=2 ** 20):
+        """
+        @param pLUT: prepared 3D LUT
+        @type pLUT: PreparedLUT
+        @param bits: bits per channel, 7 <= bits <= 8
+        @type bits: int
+        @param interp: interpolation function used to bake the table
+        @type interp: function
+        @param bandSize: count of colors interpolated at once
+        @type bandSize: int
+        """
+        self.bits = bits
+        d = pLUT.shape[-1]
+        if bits == 8:
+            table = np.empty((1 << 24, d), dtype=np.uint8)
+            # interpolate by bands, to limit memory usage
+            for start in range(0, 1 << 24, bandSize):
+                keys = np.arange(start, min(start + bandSize, 1 << 24), dtype=np.uint32)
+                table[start:start + keys.size] = interp(pLUT, None, unpackColors(keys))[:, 0]
+            self.table = table
+        else:
+            n, q = 1 << bits, 256 >> bits
+            # grid vertices span the whole LUT range [0, 256]
+            grid = np.arange(n + 1, dtype=np.float32) * q
+            pts = cartesianProduct((grid, grid, grid)).reshape(-1, 1, 3)
+            T = interp(pLUT, None, pts, convert=False).reshape((n + 1,) * 3 + (d,))
+            self.table = PreparedLUT(T, q)
+        self.nbytes = BakedLUT.tableSize(bits, d)
+
+    def apply(self, ndImg):
+        """
+        Convert an 8 bits image.
+        @param ndImg: input array
+        @type ndImg: ndarray, dtype np.uint8, shape (h, w, d), d >= 3
+        @return: converted array
+        @rtype: ndarray, dtype np.uint8, shape (h, w, dOut)
+        """
+        if self.bits == 8:
+            return np.take(self.table, packColors(ndImg), axis=0)
+        T = self.table
+        flatIndex, fracs = T.vertexIndex(ndImg)
+        v0 = T.gather(flatIndex, 0)
+        out = v0.copy()
+        # first order residual correction
+        for k, f in zip((1, 2, 4), fracs):
+            tmp = T.gather(flatIndex, k)
+            tmp -= v0
+            tmp *= f[..., np.newaxis]
+            out += tmp
+        np.clip(out, 0, 255, out=out)
+        return out.astype(np.uint8)
+
+
+class BakedLUTCache(object):
+    """
+    LRU cache of baked LUTs, keyed by the content hashes of prepared LUTs.
+    A LUT is baked only when the expected reuse justifies it : the count of
+    lookups and of pixels converted by the LUT while it was not baked are recorded,
+    and the table is baked as soon as the LUT is used at least minUses times
+    and the count of pixels reaches the count of points interpolated by the bake.
+    Thus, a single conversion of a large image never bakes the LUT.
+    The total size of the cached tables never exceeds maxBytes.
+    The cache is shared by the GUI thread and the stack worker.
+    """
+    # max count of not baked LUTs whose usage is recorded
+    maxPending = 32
+    # min count of lookups before baking
+    minUses = 2
+
+    def __init__(self, maxBytes, interp=interpTriLinear):
+        """
+        @param maxBytes: memory ceiling (bytes)
+        @type maxBytes: int
+        @param interp: interpolation function used to bake tables
+        @type interp: function
+        """
+        self.maxBytes = maxBytes
+        self.interp = interp
+        self.hits, self.misses, self.bakes = 0, 0, 0
+        self.__cache = OrderedDict()
+        self.__pending = OrderedDict()
+        self.__size = 0
+        self.__lock = threading.Lock()
+
+    @property
+    def size(self):
+        """
+        Total size of the cached tables (bytes)
+        @return:
+        @rtype: int
+        """
+        return self.__size
+
+    def chooseBits(self, d):
+        """
+        Return the max resolution of the tables with d channels
+        fitting into the cache, or None.
+        @param d: count of LUT channels
+        @type d: int
+        @return:
+        @rtype: int or None
+        """
+        for bits in (8, 7):
+            if BakedLUT.tableSize(bits, d) <= self.maxBytes:
+                return bits
+        return None
+
+    def lookup(self, pLUT, pixels):
+        """
+        Return the baked table for pLUT, or None if the LUT
+        is not (yet) worth baking.
+        @param pLUT: prepared 3D LUT
+        @type pLUT: PreparedLUT
+        @param pixels: count of pixels to convert
+        @type pixels: int
+        @return:
+        @rtype: BakedLUT or None
+        """
+        key = pLUT.contentKey
+        bits = self.chooseBits(pLUT.shape[-1])
+        with self.__lock:
+            baked = self.__cache.get(key)
+            if baked is not None:
+                self.__cache.move_to_end(key)
+                self.hits += 1
+                return baked
+            self.misses += 1
+            uses, pending = self.__pending.pop(key, (0, 0))
+            uses, pending = uses + 1, pending + pixels
+            if bits is None or uses < self.minUses or pending < BakedLUT.bakeCost(bits):
+                self.__pending[key] = (uses, pending)
+                if len(self.__pending) > self.maxPending:
+                    self.__pending.popitem(last=False)
+                return None
+        # bake without holding the lock : concurrent lookups
+        # of other LUTs are not delayed.
+        baked = BakedLUT(pLUT, bits=bits, interp=self.interp)
+        with self.__lock:
+            self.bakes += 1
+            old = self.__cache.pop(key, None)
+            if old is not None:
+                # baked meanwhile by another thread
+                self.__size -= old.nbytes
+            # evict least recently used tables
+            while self.__cache and self.__size + baked.nbytes > self.maxBytes:
+                _, old = self.__cache.popitem(last=False)
+                self.__size -= old.nbytes
+            self.__cache[key] = baked
+            self.__size += baked.nbytes
+        return baked
+
+    def clear(self):
+        """
+        Empty the cache and reset counters.
+        """
+        with self.__lock:
+            self.__cache.clear()
+            self.__pending.clear()
+            self.__size = 0
+            self.hits, self.misses, self.bakes = 0, 0, 0
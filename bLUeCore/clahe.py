@@ -0,0 +1,102 @@
+"""
+This File is part of bLUe software.
+
+Copyright (C) 2017  Bernard Virot <bernard.virot@libertysurf.fr>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Lesser General Public License as
+published by the Free Software Foundation, version 3.
+
+This program is distributed in the hope that it will be useful, but
+WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+Lesser General Lesser Public License for more details.
+
+You should have received a copy of the GNU Lesser General Public License
+along with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+import numpy as np
+
+###################################################################################
+# Contrast Limited Adaptive Histogram Equalization, split into its
+# two steps, following the OpenCV implementation (8 bits images) :
+#    - the equalization LUTs of a grid of cells are computed from the whole image,
+#    - each pixel is mapped by bilinear interpolation of the LUTs of the 4 nearest cells.
+# Thus, the LUTs can be computed once, from a downsampled image, and
+# next applied to each tile of a large image (cf. bLUeTop.tiledLayers).
+###################################################################################
+
+
+def claheLUTs(channel, clipLimit, tiles=(8, 8)):
+    """
+    Compute the clipped equalization LUTs of a grid of cells.
+    The channel is extended by reflection to a multiple of the grid size.
+    @param channel: single channel image
+    @type channel: ndarray, dtype np.uint8, shape (h, w)
+    @param clipLimit: relative clip limit (cf. cv2.createCLAHE())
+    @type clipLimit: float
+    @param tiles: grid size (columns, rows)
+    @type tiles: 2-uple of int
+    @return: LUTs
+    @rtype: ndarray, dtype np.uint8, shape (rows, columns, 256)
+    """
+    tx, ty = tiles
+    h, w = channel.shape
+    padY, padX = (-h) % ty, (-w) % tx
+    if padX or padY:
+        channel = np.pad(channel, ((0, padY), (0, padX)), mode='reflect')
+    ch, cw = channel.shape[0] // ty, channel.shape[1] // tx
+    area = ch * cw
+    # cell histograms
+    cells = channel.reshape(ty, ch, tx, cw).transpose(0, 2, 1, 3).reshape(ty * tx, area)
+    offsets = (np.arange(ty * tx) * 256)[:, np.newaxis]
+    hist = np.bincount((cells + offsets).ravel(), minlength=ty * tx * 256).reshape(ty * tx, 256)
+    if clipLimit > 0:
+        clip = max(int(clipLimit * area / 256), 1)
+        excess = np.maximum(hist - clip, 0).sum(axis=1)
+        np.minimum(hist, clip, out=hist)
+        # uniform redistribution of the excess
+        hist += (excess // 256)[:, np.newaxis]
+        residual = excess % 256
+        # the residual is spread with a regular step
+        for i in np.flatnonzero(residual):
+            step = max(256 // residual[i], 1)
+            hist[i, :residual[i] * step:step] += 1
+    lut = np.cumsum(hist, axis=1) * (255.0 / area)
+    return np.clip(np.round(lut), 0, 255).astype(np.uint8).reshape(ty, tx, 256)
+
+
+def claheApply(channel, luts, origin=(0, 0), fullSize=None):
+    """
+    Map a single channel image, or a tile of it, through the
+    LUTs returned by claheLUTs().
+    @param channel: single channel image or tile
+    @type channel: ndarray, dtype np.uint8, shape (h, w)
+    @param luts: cell LUTs
+    @type luts: ndarray, dtype np.uint8, shape (rows, columns, 256)
+    @param origin: position (x, y) of the tile in the whole image
+    @type origin: 2-uple of int
+    @param fullSize: size (w, h) of the whole image, default channel size
+    @type fullSize: 2-uple of int
+    @return: mapped channel
+    @rtype: ndarray, dtype np.uint8, shape (h, w)
+    """
+    ty, tx = luts.shape[:2]
+    h, w = channel.shape
+    W, H = (w, h) if fullSize is None else fullSize
+
+    def axis(n, start, full, cells):
+        # cell size of the extended image
+        size = (full + (-full) % cells) // cells
+        f = (np.arange(start, start + n) + 0.0) / size - 0.5
+        i1 = np.floor(f).astype(np.int32)
+        a = f - i1
+        return np.maximum(i1, 0), np.minimum(i1 + 1, cells - 1), a
+
+    x1, x2, xa = axis(w, origin[0], W, tx)
+    y1, y2, ya = axis(h, origin[1], H, ty)
+    y1, y2, ya = y1[:, np.newaxis], y2[:, np.newaxis], ya[:, np.newaxis]
+    top = luts[y1, x1, channel] * (1.0 - xa) + luts[y1, x2, channel] * xa
+    bottom = luts[y2, x1, channel] * (1.0 - xa) + luts[y2, x2, channel] * xa
+    res = top * (1.0 - ya) + bottom * ya
+    return np.clip(np.round(res), 0, 255).astype(np.uint8)
@@ -70,7 +70,7 @@ def dwtDenoiseChan(image, chan=0, thr=1.0, thrmode='hard', wavelet='haar', level
     @param level: max level of decomposition, automatic if level is None (default)
     @type level: int or None
     @return: the denoised channel
-    @rtype: ndarray, same shape as the image channel, dtype= np.float
+    @rtype: ndarray, same shape as the image channel, float type of image (np.float for int types)
 
     """
     imArray = image[:, :, chan]
@@ -111,7 +111,7 @@ def dwtDenoiseChan(image, chan=0, thr=1.0, thrmode='hard', wavelet='haar', level
         win_sizes = (3, 5, 7, 9)
         # skip approximation level and scan other levels
         for all_coeff in DWT_coeffs[1:]:
-            nY2_est = np.empty(all_coeff['ad'].shape, dtype=float)
+            nY2_est = np.empty(all_coeff['ad'].shape, dtype=all_coeff['ad'].dtype)
             nY2_est.fill(np.inf)
             # walk through H,V,D coefficients (2D arrays) at level i,
             for coeff in all_coeff.values():
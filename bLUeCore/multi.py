@@ -15,12 +15,284 @@ Lesser General Lesser Public License for more details.
 You should have received a copy of the GNU Lesser General Public License
 along with this program. If not, see <http://www.gnu.org/licenses/>.
 """
+import atexit
+import hashlib
+import os
+import threading
+import weakref
+from collections import OrderedDict
 from functools import partial
 import numpy as np
 
+from bLUeCore.preparedLUT import PreparedLUT
 from bLUeCore.tetrahedral import interpTetra
 from bLUeCore.trilinear import interpTriLinear
-from bLUeTop.settings import USE_TETRA
+from bLUeCore.uniqueColors import interpUnique
+from bLUeTop.settings import USE_TETRA, USE_UNIQUE_COLORS
+
+try:
+    from multiprocessing import shared_memory, resource_tracker
+except ImportError:
+    # python < 3.8 : fallback to pool.map
+    shared_memory = None
+
+# minimum image size for parallel interpolation (cf. chosenInterp())
+MULTI_MIN_SIZE = 3000000
+
+#####################################################################
+# Shared memory blocks.
+# Arrays allocated by sharedArray(), and all their views, are passed
+# by name to pool workers, without copy. LUT blocks are cached,
+# keyed by the LUT content, and reused by successive calls.
+#####################################################################
+
+_sharedLock = threading.Lock()
+# id of array allocated by sharedArray() --> shared memory block
+_sharedArrays = {}
+# LUT content key --> [shared memory block, count of running interpolations]
+_lutBlocks = OrderedDict()
+# max count of cached LUT blocks
+MAX_LUT_BLOCKS = 4
+
+
+def _attachArray(name, shape, dtype, offset, strides):
+    """
+    Attach to an existing shared memory block
+    and return it, with an array view of its buffer.
+    @param name: shared memory block name
+    @type name: str
+    @param shape:
+    @type shape: tuple of int
+    @param dtype:
+    @type dtype: numpy dtype
+    @param offset: offset of the array in the block (bytes)
+    @type offset: int
+    @param strides:
+    @type strides: tuple of int
+    @return: shared memory block, array
+    @rtype: 2-uple SharedMemory, ndarray
+    """
+    shm = shared_memory.SharedMemory(name=name)
+    if os.name == 'posix':
+        # The block is owned by the calling process. Prevent the resource
+        # tracker of the worker from unlinking it (cf. https://bugs.python.org/issue39959)
+        resource_tracker.unregister(shm._name, 'shared_memory')
+    return shm, np.ndarray(shape, dtype=dtype, buffer=shm.buf, offset=offset, strides=strides)
+
+
+def _releaseBlock(shm):
+    """
+    Close and unlink a shared memory block created by
+    the calling process.
+    @param shm:
+    @type shm: SharedMemory
+    """
+    shm.close()
+    shm.unlink()
+
+
+def _releaseSharedArray(key):
+    """
+    Finalizer of the arrays allocated by sharedArray().
+    @param key:
+    @type key: int
+    """
+    with _sharedLock:
+        shm = _sharedArrays.pop(key)
+    _releaseBlock(shm)
+
+
+def sharedArray(shape, dtype):
+    """
+    Return a new (uninitialized) array allocated in a shared memory block.
+    The array and its views are passed to pool workers by name, without
+    copy (cf. interpMultiShm()). The block is released when the array
+    and all its views are garbage collected.
+    @param shape:
+    @type shape: tuple of int
+    @param dtype:
+    @type dtype: numpy dtype
+    @return:
+    @rtype: ndarray
+    """
+    size = max(int(np.prod(shape)) * np.dtype(dtype).itemsize, 1)
+    shm = shared_memory.SharedMemory(create=True, size=size)
+    arr = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+    key = id(arr)
+    with _sharedLock:
+        _sharedArrays[key] = shm
+    # views of arr reference it (arr.base), so the block
+    # is released only when no view of its buffer remains.
+    weakref.finalize(arr, _releaseSharedArray, key)
+    return arr
+
+
+def interpArray(shape, dtype, pool=None):
+    """
+    Return a new (uninitialized) array, to be used as input of
+    the interpolation function returned by chosenInterp(pool, size).
+    If the interpolation is parallel, the array is allocated in shared
+    memory (cf. sharedArray()), so it is not copied for the workers.
+    @param shape: (h, w, d)
+    @type shape: tuple of int
+    @param dtype:
+    @type dtype: numpy dtype
+    @param pool:
+    @type pool: multiprocessing.Pool
+    @return:
+    @rtype: ndarray
+    """
+    if pool is not None and shared_memory is not None and shape[0] * shape[1] > MULTI_MIN_SIZE:
+        return sharedArray(shape, dtype)
+    return np.empty(shape, dtype=dtype)
+
+
+def _sharedDesc(arr):
+    """
+    Return the descriptor (name, shape, dtype, offset, strides) of
+    an array allocated by sharedArray(), or of a view of such an array,
+    and None otherwise.
+    @param arr:
+    @type arr: ndarray
+    @return:
+    @rtype: tuple or None
+    """
+    root = arr
+    while isinstance(root.base, np.ndarray):
+        root = root.base
+    with _sharedLock:
+        shm = _sharedArrays.get(id(root))
+    if shm is None:
+        return None
+    offset = arr.__array_interface__['data'][0] - root.__array_interface__['data'][0]
+    return shm.name, arr.shape, arr.dtype, offset, arr.strides
+
+
+def _acquireLUTBlock(LUT):
+    """
+    Return the key and the descriptor of the shared memory block
+    holding a float32 copy of LUT. Blocks are cached, keyed by the
+    LUT content, so a LUT is copied once for all calls. The block must
+    be released by _releaseLUTBlock(key).
+    @param LUT:
+    @type LUT: ndarray or PreparedLUT
+    @return:
+    @rtype: 2-uple str, tuple
+    """
+    if isinstance(LUT, PreparedLUT):
+        key, LUT = LUT.contentKey, LUT.LUT
+    else:
+        LUT = np.ascontiguousarray(LUT, dtype=np.float32)
+        h = hashlib.sha1(LUT.tobytes())
+        h.update(str(LUT.shape).encode())
+        key = h.hexdigest()
+    with _sharedLock:
+        entry = _lutBlocks.get(key)
+        if entry is None:
+            shm = shared_memory.SharedMemory(create=True, size=max(LUT.nbytes, 1))
+            np.ndarray(LUT.shape, dtype=np.float32, buffer=shm.buf)[...] = LUT
+            entry = _lutBlocks[key] = [shm, 0]
+        _lutBlocks.move_to_end(key)
+        entry[1] += 1
+        # evict the least recently used blocks not in use
+        for k in [k for k, e in _lutBlocks.items() if e[1] == 0][:max(len(_lutBlocks) - MAX_LUT_BLOCKS, 0)]:
+            _releaseBlock(_lutBlocks.pop(k)[0])
+    return key, (entry[0].name, LUT.shape, np.float32, 0, LUT.strides)
+
+
+def _releaseLUTBlock(key):
+    """
+    Release a block acquired by _acquireLUTBlock(). It
+    stays cached for the next calls.
+    @param key:
+    @type key: str
+    """
+    with _sharedLock:
+        _lutBlocks[key][1] -= 1
+
+
+@atexit.register
+def _releaseLUTBlocks():
+    """
+    Unlink the cached LUT blocks at exit.
+    """
+    with _sharedLock:
+        while _lutBlocks:
+            _releaseBlock(_lutBlocks.popitem()[1][0])
+
+
+def _interpTile(args):
+    """
+    Pool worker : interpolate a horizontal band of the shared input array
+    and write the result in place into the shared output array.
+    @param args: shared memory descriptors, interpolation parameters and band bounds
+    @type args: tuple
+    """
+    lutDesc, inDesc, outDesc, LUTSTEP, use_tetra, convert, start, stop = args
+    blocks, arrays = [], []
+    try:
+        for desc in (lutDesc, inDesc, outDesc):
+            shm, arr = _attachArray(*desc)
+            blocks.append(shm)
+            arrays.append(arr)
+        LUT, inArr, outArr = arrays
+        interp = interpTetra if use_tetra else interpTriLinear
+        outArr[start:stop] = interp(LUT, LUTSTEP, inArr[start:stop], convert=convert)
+    finally:
+        # drop the views before closing the blocks
+        LUT = inArr = outArr = arr = None
+        arrays.clear()
+        for shm in blocks:
+            shm.close()
+
+
+def interpMultiShm(LUT, LUTSTEP, ndImg, pool, use_tetra=False, convert=True, bands=16):
+    """
+    Parallel trilinear/tetrahedral interpolation, using a pool of workers
+    and shared memory blocks for the LUT, the input and the output arrays.
+    Workers receive the names of the blocks only (no pickling of arrays),
+    and each of them writes its band of the final output in place.
+    The LUT block is cached and reused by the next calls with the same LUT.
+    The input is not copied if it was allocated in shared memory by the caller
+    (cf. interpArray()). The output is not copied out of its shared block : the returned
+    array is allocated by sharedArray().
+    The parameters and the result are those of interpMulti().
+    @param LUT: 3D LUT array or prepared LUT
+    @type LUT: ndarray, dtype float or int, shape(s1, s2, s3, 3), or PreparedLUT
+    @param LUTSTEP: interpolation step
+    @type LUTSTEP: number or 3-uple of numbers
+    @param ndImg: input array
+    @type ndImg: ndarray dtype float or int, shape (h, w, 3)
+    @param pool: multiprocessing pool
+    @type pool: multiprocessing.Pool
+    @param use_tetra: use tetrahedral interpolation
+    @type use_tetra : boolean
+    @param convert: convert the output to dtype=np.uint8
+    @type convert: boolean
+    @param bands: count of horizontal bands
+    @type bands: int
+    @return: interpolated array
+    @rtype: ndarray, same shape as the input image, dtype np.uint8 if convert else np.float32
+    """
+    if isinstance(LUT, PreparedLUT):
+        LUTSTEP = tuple(LUT.step)
+    h = ndImg.shape[0]
+    key, lutDesc = _acquireLUTBlock(LUT)
+    try:
+        inDesc = _sharedDesc(ndImg)
+        if inDesc is None:
+            # the input was not allocated in shared memory : copy it
+            buf = sharedArray(ndImg.shape, ndImg.dtype)
+            buf[...] = ndImg
+            ndImg = buf
+            inDesc = _sharedDesc(ndImg)
+        outImg = sharedArray(ndImg.shape, np.uint8 if convert else np.float32)
+        tasks = [(lutDesc, inDesc, _sharedDesc(outImg), LUTSTEP, use_tetra, convert, (h * i) // bands, (h * (i + 1)) // bands)
+                 for i in range(bands)]
+        pool.map(_interpTile, tasks)
+    finally:
+        _releaseLUTBlock(key)
+    return outImg
 
 
 def interpMulti(LUT, LUTSTEP, ndImg, pool=None, use_tetra=False, convert=True):
@@ -28,12 +300,15 @@ def interpMulti(LUT, LUTSTEP, ndImg, pool=None, use_tetra=False, convert=True):
     Parallel trilinear/tetrahedral interpolation, using
     a pool of workers.
     Convert an input array using a 3D LUT.
+    When available (python >= 3.8), shared memory is used to
+    exchange arrays with workers (cf. interpMultiShm()). Otherwise,
+    image slices are pickled to workers.
     The roles (R or G or B) of the three first LUT channels
     must follow the ordering of the color channels.
     The output image is interpolated from the LUT.
     It has the same type as the input image.
-    @param LUT: 3D LUT array
-    @type LUT: ndarray, dtype float or int, shape(s1, s2, s3, 3)
+    @param LUT: 3D LUT array or prepared LUT
+    @type LUT: ndarray, dtype float or int, shape(s1, s2, s3, 3), or PreparedLUT
     @param LUTSTEP: interpolation step
     @type LUTSTEP: number or 3-uple of numbers
     @param ndImg: input array
@@ -45,8 +320,13 @@ def interpMulti(LUT, LUTSTEP, ndImg, pool=None, use_tetra=False, convert=True):
     @param convert: convert the output to dtype=np.uint8
     @type convert: boolean
     @return: interpolated array
-    @rtype: ndarray, same shape as the input image
+    @rtype: ndarray, same shape as the input image, dtype np.uint8 if convert else np.float32
     """
+    if pool is None:
+        raise ValueError('interpMulti: no processing pool')
+    if shared_memory is not None:
+        return interpMultiShm(LUT, LUTSTEP, ndImg, pool, use_tetra=use_tetra, convert=convert)
+    # fallback : pickle slices to workers
     w, h = ndImg.shape[1], ndImg.shape[0]
     SLF = 4
     sl_w = [slice((w * i) // SLF, (w * (i+1)) // SLF) for i in range(SLF)]
@@ -54,13 +334,11 @@ def interpMulti(LUT, LUTSTEP, ndImg, pool=None, use_tetra=False, convert=True):
 
     slices = [(s1, s2) for s1 in sl_w for s2 in sl_h]
     imgList = [ndImg[s2, s1] for s1, s2 in slices]
-    if pool is None:
-        raise ValueError('interpMulti: no processing pool')
     # get vectorized interpolation as partial function
     partial_f = partial(interpTetra if use_tetra else interpTriLinear, LUT, LUTSTEP, convert=convert)
     # parallel interpolation
     res = pool.map(partial_f, imgList)
-    outImg = np.empty(ndImg.shape)
+    outImg = np.empty(ndImg.shape, dtype=np.uint8 if convert else np.float32)
     # collect results
     for i, (s1, s2) in enumerate(slices):
         outImg[s2, s1] = res[i]
@@ -70,7 +348,10 @@ def interpMulti(LUT, LUTSTEP, ndImg, pool=None, use_tetra=False, convert=True):
 
 def chosenInterp(pool, size):
     """
-    Return the right interpolation method, depending on settings, pool and image size
+    Return the right interpolation method, depending on settings, pool and image size.
+    If USE_UNIQUE_COLORS is True, 8 bits images are converted by interpolating
+    their distinct colors only (cf. uniqueColors.interpUnique()). The method
+    chosen from pool and size is used as fallback.
     @param pool:
     @type pool: multiprocessing pool
     @param size: image size
@@ -78,7 +359,7 @@ def chosenInterp(pool, size):
     @return:
     @rtype: interpolation function
     """
-    if (pool is not None) and size > 3000000:
+    if (pool is not None) and size > MULTI_MIN_SIZE:
         def f(x, y, z, convert=True):
             return interpMulti(x, y, z, pool=pool, use_tetra=USE_TETRA, convert=convert)
         interp = f  # lambda x, y, z, convert=True: interpMulti(x, y, z, pool=pool, use_tetra=USE_TETRA, convert=convert)
@@ -86,5 +367,9 @@ def chosenInterp(pool, size):
         interp = interpTetra
     else:
         interp = interpTriLinear
+    if USE_UNIQUE_COLORS:
+        def g(x, y, z, convert=True, fallback=interp):
+            return interpUnique(x, y, z, convert=convert,
+                                interp=interpTetra if USE_TETRA else interpTriLinear, fallback=fallback)
+        interp = g
     return interp
-
@@ -0,0 +1,148 @@
+"""
+This File is part of bLUe software.
+
+Copyright (C) 2017  Bernard Virot <bernard.virot@libertysurf.fr>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Lesser General Public License as
+published by the Free Software Foundation, version 3.
+
+This program is distributed in the hope that it will be useful, but
+WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+Lesser General Lesser Public License for more details.
+
+You should have received a copy of the GNU Lesser General Public License
+along with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+import dataclasses
+import hashlib
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from bLUeTop.settings import LAYER_CACHE_MB
+
+
+def paramDigest(value):
+    """
+    Return a content hash of value. Value is built from
+    numbers, strings, ndarrays, and (nested) lists, tuples and dicts.
+    Objects with a method toDict() (e.g. UDict) are hashed as dicts, and
+    dataclasses (e.g. layer parameters, cf. bLUeTop.pipeline) are hashed
+    as their class name and fields.
+    Other objects are hashed through their repr().
+    @param value:
+    @type value: object
+    @return:
+    @rtype: str
+    """
+    h = hashlib.sha1()
+
+    def feed(v):
+        if isinstance(v, np.ndarray):
+            h.update(b'a%s%s' % (str(v.dtype).encode(), str(v.shape).encode()))
+            h.update(np.ascontiguousarray(v).tobytes())
+        elif dataclasses.is_dataclass(v) and not isinstance(v, type):
+            h.update(b'c%s;' % type(v).__name__.encode())
+            feed({f.name: getattr(v, f.name) for f in dataclasses.fields(v)})
+        elif hasattr(v, 'toDict'):
+            feed(v.toDict())
+        elif isinstance(v, dict):
+            h.update(b'd%d' % len(v))
+            for k in sorted(v, key=str):
+                feed(k)
+                feed(v[k])
+        elif isinstance(v, (list, tuple)):
+            h.update(b't%d' % len(v))
+            for item in v:
+                feed(item)
+        else:
+            h.update(b'r%s;' % repr(v).encode())
+
+    feed(value)
+    return h.hexdigest()
+
+
+class OutputCache(object):
+    """
+    LRU cache of layer outputs (cf. QLayer.evaluateStack()). Keys
+    identify the input of the layer and the parameters of its
+    transformation, so the content of an entry never changes and
+    identical evaluations share the same entry.
+    The total size of the cached buffers never exceeds maxBytes.
+    The cache is shared by the GUI thread and the stack worker.
+    """
+    def __init__(self, maxBytes):
+        """
+        @param maxBytes: memory ceiling (bytes)
+        @type maxBytes: int
+        """
+        self.maxBytes = maxBytes
+        self.hits, self.misses = 0, 0
+        self.__cache = OrderedDict()
+        self.__size = 0
+        self.__lock = threading.Lock()
+
+    @property
+    def size(self):
+        """
+        Total size of the cached buffers (bytes)
+        @return:
+        @rtype: int
+        """
+        return self.__size
+
+    def lookup(self, key):
+        """
+        Return the buffer cached for key, or None.
+        The returned buffer must not be modified.
+        @param key:
+        @type key: hashable
+        @return:
+        @rtype: ndarray or None
+        """
+        with self.__lock:
+            buf = self.__cache.get(key)
+            if buf is None:
+                self.misses += 1
+                return None
+            self.__cache.move_to_end(key)
+            self.hits += 1
+            return buf
+
+    def store(self, key, buf):
+        """
+        Cache a copy of buf. Buffers larger than
+        the memory ceiling are not cached.
+        @param key:
+        @type key: hashable
+        @param buf:
+        @type buf: ndarray
+        """
+        if buf.nbytes > self.maxBytes:
+            return
+        buf = buf.copy()
+        with self.__lock:
+            old = self.__cache.pop(key, None)
+            if old is not None:
+                self.__size -= old.nbytes
+            # evict least recently used buffers
+            while self.__cache and self.__size + buf.nbytes > self.maxBytes:
+                _, old = self.__cache.popitem(last=False)
+                self.__size -= old.nbytes
+            self.__cache[key] = buf
+            self.__size += buf.nbytes
+
+    def clear(self):
+        """
+        Empty the cache and reset counters.
+        """
+        with self.__lock:
+            self.__cache.clear()
+            self.__size = 0
+            self.hits, self.misses = 0, 0
+
+
+outputCache = OutputCache(LAYER_CACHE_MB * 2 ** 20)
@@ -0,0 +1,122 @@
+"""
+This File is part of bLUe software.
+
+Copyright (C) 2017  Bernard Virot <bernard.virot@libertysurf.fr>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Lesser General Public License as
+published by the Free Software Foundation, version 3.
+
+This program is distributed in the hope that it will be useful, but
+WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+Lesser General Lesser Public License for more details.
+
+You should have received a copy of the GNU Lesser General Public License
+along with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+import hashlib
+
+import numpy as np
+
+
+class PreparedLUT(object):
+    """
+    Interpolation ready 3D LUT.
+    The LUT array is converted once to a contiguous float32 array,
+    viewed as a 2D array of vertices with shape (s1 * s2 * s3, d).
+    The offsets of the 8 vertices of the unit cube are precomputed.
+    When all input values of type uint8 can be interpolated, 256-entry tables
+    of base vertex index and fractional weight are also precomputed for each axis,
+    so 8 bits inputs are interpolated using table lookups and gathers only.
+    Prepared LUTs are built and cached by the classes LUT3D and DeltaLUT3D.
+    """
+    def __init__(self, LUT, LUTSTEP):
+        """
+        @param LUT: 3D LUT array
+        @type LUT: ndarray, dtype float or int, shape (s1, s2, s3, d)
+        @param LUTSTEP: interpolation step
+        @type LUTSTEP: number or 3-uple of numbers
+        """
+        self.LUT = np.ascontiguousarray(LUT, dtype=np.float32)
+        self.__contentKey = None
+        s = self.LUT.shape
+        self.shape = s
+        self.step = np.broadcast_to(np.asarray(LUTSTEP, dtype=np.float32), (3,))
+        # flattened LUT : one row for each vertex
+        self.vertices = self.LUT.reshape((-1, s[-1]))
+        # vertex strides for the 3 first axes
+        self.strides = np.array((s[1] * s[2], s[2], 1), dtype=np.int32)
+        # max index of the base vertex for each axis
+        self.maxBase = np.array(s[:3], dtype=np.int32) - 2
+        # offsets of the vertices of the unit cube :
+        # vertex k is (r0 + (k & 1), g0 + ((k >> 1) & 1), b0 + ((k >> 2) & 1))
+        st = self.strides
+        self.cornerOffsets = np.array([(k & 1) * st[0] + ((k >> 1) & 1) * st[1] + ((k >> 2) & 1) * st[2]
+                                       for k in range(8)], dtype=np.int32)
+        # per axis tables for 8 bits inputs
+        self.indexTables, self.weightTables = None, None
+        if np.all((np.array(s[:3]) - 1) * self.step > 255):
+            v = np.arange(256, dtype=np.float32)
+            self.indexTables, self.weightTables = [], []
+            for i in range(3):
+                q = v / self.step[i]
+                base = q.astype(np.int32)
+                self.indexTables.append(base * st[i])
+                self.weightTables.append(q - base)
+
+    @property
+    def contentKey(self):
+        """
+        Hash of the LUT values and steps, computed once.
+        @return:
+        @rtype: str
+        """
+        if self.__contentKey is None:
+            h = hashlib.sha1(self.LUT.tobytes())
+            h.update(str(self.shape).encode())
+            h.update(np.ascontiguousarray(self.step).tobytes())
+            self.__contentKey = h.hexdigest()
+        return self.__contentKey
+
+    def vertexIndex(self, ndImg):
+        """
+        Return the indices of the base vertices (closest to the origin) of the
+        bounding unit cubes around input points, and the fractional parts
+        of the input coordinates (relative to the base vertices). Only
+        the 3 first channels of ndImg are used.
+        @param ndImg: input array
+        @type ndImg: ndarray, dtype float or int, shape (h, w, d), d >=3
+        @return: vertex indices and fractional parts (r, g, b)
+        @rtype: ndarray, shape (h, w), dtype int32 and 3-uple of ndarray shape (h, w) dtype float32
+        """
+        if ndImg.dtype == np.uint8 and self.indexTables is not None:
+            r, g, b = ndImg[..., 0], ndImg[..., 1], ndImg[..., 2]
+            it, wt = self.indexTables, self.weightTables
+            flatIndex = it[0][r] + it[1][g]
+            flatIndex += it[2][b]
+            return flatIndex, (wt[0][r], wt[1][g], wt[2][b])
+        ndImgF = (ndImg[..., :3] / self.step).astype(np.float32, copy=False)
+        a = ndImgF.astype(np.int32)
+        # the upper vertices of the cube must stay within the LUT
+        np.clip(a, 0, self.maxBase, out=a)
+        st = self.strides
+        flatIndex = a[..., 0] * st[0] + a[..., 1] * st[1]
+        flatIndex += a[..., 2]
+        ndImgF -= a
+        return flatIndex, (ndImgF[..., 0], ndImgF[..., 1], ndImgF[..., 2])
+
+    def gather(self, flatIndex, k):
+        """
+        Return the values of vertex k of the unit cubes with
+        base vertices flatIndex.
+        @param flatIndex: indices of base vertices
+        @type flatIndex: ndarray, dtype int
+        @param k: vertex number (cf. cornerOffsets) in range 0..7, or array of vertex numbers
+        @type k: int or ndarray, dtype int, same shape as flatIndex
+        @return: vertex values
+        @rtype: ndarray, shape flatIndex.shape + (d,), dtype float32
+        """
+        if isinstance(k, int) and k == 0:
+            return np.take(self.vertices, flatIndex, axis=0)
+        return np.take(self.vertices, flatIndex + self.cornerOffsets[k], axis=0)
@@ -18,6 +18,8 @@ along with this program. If not, see <http://www.gnu.org/licenses/>.
 
 import numpy as np
 
+from bLUeCore.preparedLUT import PreparedLUT
+
 
 def interpTetra(LUT, LUTSTEP, ndImg, convert=True):
     """
@@ -39,10 +41,15 @@ def interpTetra(LUT, LUTSTEP, ndImg, convert=True):
     to dtype=np.uint8, otherwise the output array has the same shape as ndImg and
     dtype= np.float32.
 
-    It turns out that tetrahedral interpolation is 2 times slower
-    than trilinear.
-    @param LUT: 3D LUT array
-    @type LUT: ndarray, dtype float or int, shape(s1, s2, s3, 3)
+    The unit cube around each point is split into 6 tetrahedra, sharing the
+    diagonal from the vertex closest to the origin to the opposite vertex.
+    The tetrahedron containing the point is given by the ordering of its
+    fractional coordinates : only its 4 vertices are gathered from the LUT.
+
+    LUT can be a PreparedLUT instance : the cached float32 LUT and the index
+    tables are used, and LUTSTEP is ignored.
+    @param LUT: 3D LUT array or prepared LUT
+    @type LUT: ndarray, dtype float or int, shape(s1, s2, s3, 3), or PreparedLUT
     @param LUTSTEP: interpolation step
     @type LUTSTEP: number or 3-uple of numbers
     @param ndImg: input array
@@ -52,78 +59,59 @@ def interpTetra(LUT, LUTSTEP, ndImg, convert=True):
     @return: interpolatd array
     @rtype: ndarray, same shape as the input image
     """
-    # Probably due to a numpy bug, ravel_multi_index sometimes returns wrong indices
-    # for non contiguous arrays.
-    if not LUT.flags['C_CONTIGUOUS']:
-        raise ValueError('interpTetra : LUT array must be contiguous')
-    # As interpolation computes differences, we switch to a signed type,
-    # minimizing memory usage and implicit conversions.
-    LUT = LUT.astype(np.float32)
+    if not isinstance(LUT, PreparedLUT):
+        # Probably due to a numpy bug, ravel_multi_index sometimes returns wrong indices
+        # for non contiguous arrays.
+        if not LUT.flags['C_CONTIGUOUS']:
+            raise ValueError('interpTetra : LUT array must be contiguous')
+        # convert the LUT to float32 and build index tables.
+        LUT = PreparedLUT(LUT, LUTSTEP)
     # We will use the bounding unit cube around each point (r, g, b)/LUTSTEP :
-    # get its vertex closest to the origin and the corresponding channel colors.
-    ndImgF = ndImg / LUTSTEP
-    a = ndImgF.astype(np.int16)
-    # RGB channels
-    r0, g0, b0 = a[:, :, 0], a[:, :, 1], a[:, :, 2]
-
-    # get indices of vertex channels in the flattened LUT
-    s = LUT.shape
-    st = np.array(LUT.strides)
-    st = st // st[-1]  # we count items instead of bytes
-    flatIndex = np.ravel_multi_index((r0[..., np.newaxis],
-                                      g0[..., np.newaxis],
-                                      b0[..., np.newaxis],
-                                      np.arange(s[-1])),
-                                      s)  # broadcasted to shape (w,h,3)
-
-    # apply LUT to the vertices of the bounding cube
-    # np.take uses the the flattened LUT, but keeps the shape of flatIndex
-    ndImg00 = np.take(LUT, flatIndex)                            # = LUT[r0, g0, b0] but faster
-    ndImg01 = np.take(LUT, flatIndex + st[0])                    # = LUT[r1, g0, b0] where r1 = r0 + 1
-    ndImg02 = np.take(LUT, flatIndex + st[1])                    # = LUT[r0, g1, b0]
-    ndImg03 = np.take(LUT, flatIndex + (st[0] + st[1]))          # = LUT[r1, g1, b0]
-    ndImg10 = np.take(LUT, flatIndex + st[2])                    # = LUT[r0, g0, b1]
-    ndImg11 = np.take(LUT, flatIndex + (st[0] + st[2]))          # = LUT[r1, g0, b1]
-    ndImg12 = np.take(LUT, flatIndex + (st[1] + st[2]))          # = LUT[r0, g1, b1]
-    ndImg13 = np.take(LUT, flatIndex + (st[0] + st[1] + st[2]))  # = LUT[r1, g1, b1]
-
-    fR = ndImgF[:, :, 0] - a[:, :, 0]
-    fG = ndImgF[:, :, 1] - a[:, :, 1]
-    fB = ndImgF[:, :, 2] - a[:, :, 2]
-    oneMinusFR = (1 - fR)[..., np.newaxis] * ndImg00
-    oneMinusFG = (1 - fG)[..., np.newaxis] * ndImg00
-    oneMinusFB = (1 - fB)[..., np.newaxis] * ndImg00
-
-    fRG = (fR - fG)[..., np.newaxis]
-    fGB = (fG - fB)[..., np.newaxis]
-    fBR = (fB - fR)[..., np.newaxis]
-    fR = fR[..., np.newaxis]
-    fG = fG[..., np.newaxis]
-    fB = fB[..., np.newaxis]
-
-    # regions
-    C1 = fR > fG
-    C2 = fG > fB
-    C3 = fB > fR
-
-    fR = fR * ndImg13
-    fG = fG * ndImg13
-    fB = fB * ndImg13
-
-    X0 = oneMinusFG + fGB * ndImg02 + fBR * ndImg12 + fR  # fG > fB > fR
-    X1 = oneMinusFB + fBR * ndImg10 + fRG * ndImg11 + fG  # fB > fR > fG
-    X2 = oneMinusFB - fGB * ndImg10 - fRG * ndImg12 + fR  # fB >=fG >=fR
-    X3 = oneMinusFR + fRG * ndImg01 + fGB * ndImg03 + fB  # fR > fG > fB
-    X4 = oneMinusFG - fRG * ndImg02 - fBR * ndImg03 + fB  # fG >=fR >=fB
-    X5 = oneMinusFR - fBR * ndImg01 - fGB * ndImg11 + fG  # fR >=fB >=fG
-
-    Y1 = np.select(
-                [C2 * C3, C3 * C1, np.logical_not(np.logical_or(C1, C2)), C1 * C2, np.logical_not(np.logical_or(C1, C3))],
-                [X0, X1, X2, X3, X4],  # clockwise ordering: X3, X5, X1, X2, X0, X4
-                default=X5
-                )
+    # get its vertex closest to the origin and the fractional parts of the point coordinates.
+    flatIndex, (fR, fG, fB) = LUT.vertexIndex(ndImg)
+
+    # Orderings of the fractional parts.
+    # Ties are broken consistently, so the axes of max and min are always distinct.
+    cRG = fR >= fG
+    cGB = fG >= fB
+    cRB = fR >= fB
+    # vertex numbers (cf. PreparedLUT.cornerOffsets) have bit 0 for r, bit 1 for g and bit 2 for b.
+    # The tetrahedron is (v0, v1, v2, v7), with v1 = bit of the axis of the max fractional part
+    # and v2 = v1 + bit of the axis of the median fractional part = 7 - bit of the axis of the min.
+    isMaxR = cRG & cRB
+    isMaxG = ~cRG & cGB
+    v1 = np.where(isMaxR, 1, np.where(isMaxG, 2, 4)).astype(np.int8)
+    isMinB = cRB & cGB
+    isMinG = ~isMinB & cRG
+    v2 = np.where(isMinB, 3, np.where(isMinG, 5, 6)).astype(np.int8)
+    del cRG, cGB, cRB, isMaxR, isMaxG, isMinB, isMinG
+
+    # barycentric coordinates
+    fMax = np.maximum(np.maximum(fR, fG), fB)
+    fMin = np.minimum(np.minimum(fR, fG), fB)
+    fMed = fR + fG
+    fMed += fB
+    fMed -= fMax
+    fMed -= fMin
+    w0 = 1 - fMax
+    w1 = fMax - fMed
+    w2 = fMed - fMin
+
+    # apply LUT to the vertices of the tetrahedron and interpolate
+    out = LUT.gather(flatIndex, 0)
+    out *= w0[..., np.newaxis]
+    tmp = LUT.gather(flatIndex, v1)
+    tmp *= w1[..., np.newaxis]
+    out += tmp
+    tmp = LUT.gather(flatIndex, v2)
+    tmp *= w2[..., np.newaxis]
+    out += tmp
+    tmp = LUT.gather(flatIndex, 7)
+    tmp *= fMin[..., np.newaxis]
+    out += tmp
+    del tmp
 
     if convert:
-        np.clip(Y1, 0, 255, out=Y1)
-        Y1 = Y1.astype(np.uint8)
-    return Y1
+        np.clip(out, 0, 255, out=out)
+        out = out.astype(np.uint8)
+    return out
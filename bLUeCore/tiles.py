@@ -0,0 +1,127 @@
+"""
+This File is part of bLUe software.
+
+Copyright (C) 2017  Bernard Virot <bernard.virot@libertysurf.fr>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Lesser General Public License as
+published by the Free Software Foundation, version 3.
+
+This program is distributed in the hope that it will be useful, but
+WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+Lesser General Lesser Public License for more details.
+
+You should have received a copy of the GNU Lesser General Public License
+along with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from bLUeTop.settings import TILE_THREADS, TILE_BAND_KB
+
+
+class TileEngine(object):
+    """
+    Tile-parallel execution of image kernels.
+    Buffers are split into horizontal bands, and a kernel is run
+    on each band by a pool of threads. Kernels work on views
+    of the input and output buffers (no copy), so they should spend
+    most of their time in NumPy or OpenCV functions releasing the GIL.
+    Bands of neighbourhood filters are extended by halo rows taken from
+    the adjacent bands.
+    A kernel called from a worker thread of the engine runs
+    sequentially, to avoid deadlocks.
+    """
+    def __init__(self, maxWorkers=None, bandBytes=512 * 1024):
+        """
+        @param maxWorkers: count of threads, default os.cpu_count()
+        @type maxWorkers: int
+        @param bandBytes: target size (bytes) of input bands
+        @type bandBytes: int
+        """
+        self.maxWorkers = maxWorkers if maxWorkers else (os.cpu_count() or 1)
+        self.bandBytes = bandBytes
+        self.__executor = None
+        self.__local = threading.local()
+
+    def bands(self, h, rowBytes):
+        """
+        Return the list of bands (start, stop) covering the range 0..h.
+        @param h: row count
+        @type h: int
+        @param rowBytes: size (bytes) of a row
+        @type rowBytes: int
+        @return:
+        @rtype: list of 2-uples of int
+        """
+        bh = max(1, self.bandBytes // max(1, rowBytes))
+        # provide at least one band per worker
+        bh = min(bh, -(-h // self.maxWorkers))
+        return [(start, min(start + bh, h)) for start in range(0, h, bh)]
+
+    def __runBand(self, kernel, args):
+        self.__local.inWorker = True
+        try:
+            kernel(*args)
+        finally:
+            self.__local.inWorker = False
+
+    def run(self, kernel, src, dst, halo=0, aux=()):
+        """
+        Run kernel on all bands of src and dst. The two buffers must have
+        the same height. For each band, kernel(srcBand, dstBand) is called, where
+        srcBand and dstBand are views of src and dst rows. The kernel should
+        write its result into dstBand.
+        If halo > 0, srcBand is extended by (at most) halo rows above and below,
+        and the kernel is called as kernel(srcBand, dstBand, top), top being
+        the index of the first row of dstBand in srcBand.
+        The bands of the auxiliary buffers aux (same height, or None) are passed
+        as additional arguments, in the same order, without halo.
+        Exceptions raised by the kernel are propagated.
+        @param kernel: band kernel
+        @type kernel: function
+        @param src: input buffer
+        @type src: ndarray, shape (h, ...)
+        @param dst: output buffer
+        @type dst: ndarray, shape (h, ...)
+        @param halo: count of halo rows
+        @type halo: int
+        @param aux: auxiliary input or output buffers
+        @type aux: tuple of ndarray or None, shape (h, ...)
+        """
+        h = src.shape[0]
+        if dst.shape[0] != h or any(b is not None and b.shape[0] != h for b in aux):
+            raise ValueError('TileEngine.run : buffer heights differ')
+        if h == 0:
+            return
+        argList = []
+        for start, stop in self.bands(h, src[0].nbytes):
+            if halo > 0:
+                top = max(0, start - halo)
+                args = (src[top:min(h, stop + halo)], dst[start:stop], start - top)
+            else:
+                args = (src[start:stop], dst[start:stop])
+            argList.append(args + tuple(None if b is None else b[start:stop] for b in aux))
+        if len(argList) == 1 or self.maxWorkers == 1 or getattr(self.__local, 'inWorker', False):
+            for args in argList:
+                kernel(*args)
+            return
+        if self.__executor is None:
+            self.__executor = ThreadPoolExecutor(max_workers=self.maxWorkers)
+        futures = [self.__executor.submit(self.__runBand, kernel, args) for args in argList]
+        for f in futures:
+            f.result()
+
+    def shutdown(self):
+        """
+        Terminate the worker threads. The engine stays usable : threads
+        are restarted by the next call to run().
+        """
+        if self.__executor is not None:
+            self.__executor.shutdown()
+            self.__executor = None
+
+
+tileEngine = TileEngine(maxWorkers=TILE_THREADS, bandBytes=TILE_BAND_KB * 1024)
@@ -17,6 +17,8 @@ along with this program. If not, see <http://www.gnu.org/licenses/>.
 """
 import numpy as np
 
+from bLUeCore.preparedLUT import PreparedLUT
+
 
 def interpTriLinear(LUT, LUTSTEP, ndImg, convert=True):
     """
@@ -37,8 +39,11 @@ def interpTriLinear(LUT, LUTSTEP, ndImg, convert=True):
     if convert is True (default), the output array is clipped to (0, 255) and converted
     to dtype=np.uint8, otherwise the output array has dtype= np.float32.
 
-    @param LUT: 3D LUT array
-    @type LUT: ndarray, dtype float or int, shape(s1, s2, s3, dIn), dIn >= 3
+    LUT can be a PreparedLUT instance : the cached float32 LUT and the index
+    tables are used, and LUTSTEP is ignored.
+
+    @param LUT: 3D LUT array or prepared LUT
+    @type LUT: ndarray, dtype float or int, shape(s1, s2, s3, dIn), dIn >= 3, or PreparedLUT
     @param LUTSTEP: interpolation step
     @type LUTSTEP: number or 3-uple of numbers
     @param ndImg: input array
@@ -48,45 +53,30 @@ def interpTriLinear(LUT, LUTSTEP, ndImg, convert=True):
     @return: interpolated array
     @rtype: ndarray, shape (h, w, dOut)
     """
-    # Probably due to a numpy bug, ravel_multi_index sometimes returns wrong indices
-    # for non contiguous arrays.
-    if not LUT.flags['C_CONTIGUOUS']:
-        raise ValueError('interpTriLinear : LUT array must be contiguous')
-    # As interpolation computes differences, we switch to a signed type,
-    # minimizing memory usage and implicit conversions.
-    # LUT = LUT.astype(np.int16)
-    LUT = LUT.astype(np.float32)
+    if not isinstance(LUT, PreparedLUT):
+        # Probably due to a numpy bug, ravel_multi_index sometimes returns wrong indices
+        # for non contiguous arrays.
+        if not LUT.flags['C_CONTIGUOUS']:
+            raise ValueError('interpTriLinear : LUT array must be contiguous')
+        # convert the LUT to float32 and build index tables.
+        LUT = PreparedLUT(LUT, LUTSTEP)
     # We will use the bounding unit cube around each point (r, g, b)/LUTSTEP :
-    # get its vertex closest to the origin and the corresponding channel colors.
-    ndImgF = ndImg / LUTSTEP
-    a = ndImgF.astype(np.int16)
-    r0, g0, b0 = a[:, :, 0], a[:, :, 1], a[:, :, 2]
-
-    # get indices of the vertex channels in the flattened LUT
-    s = LUT.shape
-    st = np.array(LUT.strides)
-    st = st // st[-1]  # we count items instead of bytes
-    flatIndex = np.ravel_multi_index((r0[..., np.newaxis],
-                                      g0[..., np.newaxis],
-                                      b0[..., np.newaxis],
-                                      np.arange(s[-1])),
-                                      s)  # broadcasted to shape (w,h,3)
+    # get its vertex closest to the origin and the fractional parts of the point coordinates.
+    flatIndex, (fR, fG, fB) = LUT.vertexIndex(ndImg)
 
     # apply LUT to the vertices of the bounding cube.
-    # np.take uses the the flattened LUT, but keeps the shape of flatIndex
-    ndImg00 = np.take(LUT, flatIndex)                            # = LUT[r0, g0, b0] but faster
-    ndImg01 = np.take(LUT, flatIndex + st[0])                    # = LUT[r1, g0, b0] where r1 = r0 + 1
-    ndImg02 = np.take(LUT, flatIndex + st[1])                    # = LUT[r0, g1, b0]
-    ndImg03 = np.take(LUT, flatIndex + (st[0] + st[1]))          # = LUT[r1, g1, b0]
-    ndImg10 = np.take(LUT, flatIndex + st[2])                    # = LUT[r0, g0, b1]
-    ndImg11 = np.take(LUT, flatIndex + (st[0] + st[2]))          # = LUT[r1, g0, b1]
-    ndImg12 = np.take(LUT, flatIndex + (st[1] + st[2]))          # = LUT[r0, g1, b1]
-    ndImg13 = np.take(LUT, flatIndex + (st[0] + st[1] + st[2]))  # = LUT[r1, g1, b1]
+    # gather uses the flattened LUT, but keeps the shape of flatIndex
+    ndImg00 = LUT.gather(flatIndex, 0)  # = LUT[r0, g0, b0] but faster
+    ndImg01 = LUT.gather(flatIndex, 1)  # = LUT[r1, g0, b0] where r1 = r0 + 1
+    ndImg02 = LUT.gather(flatIndex, 2)  # = LUT[r0, g1, b0]
+    ndImg03 = LUT.gather(flatIndex, 3)  # = LUT[r1, g1, b0]
+    ndImg10 = LUT.gather(flatIndex, 4)  # = LUT[r0, g0, b1]
+    ndImg11 = LUT.gather(flatIndex, 5)  # = LUT[r1, g0, b1]
+    ndImg12 = LUT.gather(flatIndex, 6)  # = LUT[r0, g1, b1]
+    ndImg13 = LUT.gather(flatIndex, 7)  # = LUT[r1, g1, b1]
 
     # interpolation
-    alpha = ndImgF[:, :, 1] - g0
-    # alpha=np.dstack((alpha, alpha, alpha))
-    alpha = alpha[:, :, np.newaxis]  # broadcasting tested slower
+    alpha = fG[..., np.newaxis]  # broadcasting tested slower
 
     # I11Value = ndImg11 + alpha * (ndImg13 - ndImg11)  # oneMinusAlpha * ndImg11 + alpha * ndImg13
     # I12Value = ndImg10 + alpha * (ndImg12 - ndImg10)  # oneMinusAlpha * ndImg10 + alpha * ndImg12
@@ -110,9 +100,7 @@ def interpTriLinear(LUT, LUTSTEP, ndImg, convert=True):
     # allowing to free memory
     del ndImg02, ndImg03, ndImg12, ndImg13
 
-    beta = ndImgF[:, :, 0] - r0
-    # beta = np.dstack((beta, beta, beta))
-    beta = beta[..., np.newaxis]
+    beta = fR[..., np.newaxis]
 
     # I1Value = I12Value + beta * (I11Value - I12Value)  # oneMinusBeta * I12Value + beta * I11Value
     # I2Value = I22Value + beta * (I21Value - I22Value)  # oneMinusBeta * I22Value + beta * I21Value
@@ -122,9 +110,7 @@ def interpTriLinear(LUT, LUTSTEP, ndImg, convert=True):
     # allowing to free memory
     del I11Value, I21Value
 
-    gamma = ndImgF[:, :, 2] - b0
-    # gamma = np.dstack((gamma, gamma, gamma))
-    gamma = gamma[..., np.newaxis]
+    gamma = fB[..., np.newaxis]
 
     # IValue = I2Value + gamma * (I1Value - I2Value)  # (1 - gamma) * I2Value + gamma * I1Value
     IValue = add(I2Value, gamma, I1Value, I2Value)
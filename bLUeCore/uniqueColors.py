@@ -0,0 +1,110 @@
+"""
+This File is part of bLUe software.
+
+Copyright (C) 2017  Bernard Virot <bernard.virot@libertysurf.fr>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Lesser General Public License as
+published by the Free Software Foundation, version 3.
+
+This program is distributed in the hope that it will be useful, but
+WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+Lesser General Lesser Public License for more details.
+
+You should have received a copy of the GNU Lesser General Public License
+along with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+import numpy as np
+
+from bLUeCore.trilinear import interpTriLinear
+
+#######################################
+# Default max count of distinct colors
+# interpolated by interpUnique()
+UNIQUE_MAX_COLORS = 2 ** 22
+#######################################
+
+
+def packColors(ndImg):
+    """
+    Pack the three first channels of an 8 bits image
+    into 24 bits keys : (c0 << 16) | (c1 << 8) | c2
+    @param ndImg: input array
+    @type ndImg: ndarray, dtype np.uint8, shape (h, w, d), d >= 3
+    @return: keys
+    @rtype: ndarray, dtype np.uint32, shape (h, w)
+    """
+    keys = ndImg[..., 0].astype(np.uint32)
+    keys <<= 8
+    keys |= ndImg[..., 1]
+    keys <<= 8
+    keys |= ndImg[..., 2]
+    return keys
+
+
+def unpackColors(keys):
+    """
+    Inverse of packColors().
+    @param keys: 24 bits keys
+    @type keys: ndarray, dtype int, shape (n,)
+    @return: colors
+    @rtype: ndarray, dtype np.uint8, shape (n, 1, 3)
+    """
+    colors = np.empty((keys.size, 1, 3), dtype=np.uint8)
+    colors[:, 0, 0] = keys >> 16
+    colors[:, 0, 1] = (keys >> 8) & 255
+    colors[:, 0, 2] = keys & 255
+    return colors
+
+
+def interpUnique(LUT, LUTSTEP, ndImg, convert=True, interp=interpTriLinear, fallback=None, maxColors=UNIQUE_MAX_COLORS):
+    """
+    Convert an 8 bits image using a 3D LUT, interpolating only the
+    colors actually present in the image.
+
+    Pixels are packed into 24 bits keys, the set of used colors is
+    marked in a table of size 2**24, and the distinct colors are interpolated
+    by interp() as a (n, 1, 3) image. The result is scattered back to
+    the pixels with a single gather.
+
+    The image is converted by fallback() (default interp()) when it is
+    not an 8 bits image, or when its count of distinct colors exceeds maxColors
+    or a quarter of its pixel count.
+
+    The parameters LUT, LUTSTEP, ndImg and convert, and the result
+    are those of interpTriLinear().
+    @param LUT: 3D LUT array or prepared LUT
+    @type LUT: ndarray, dtype float or int, shape(s1, s2, s3, dIn), dIn >= 3, or PreparedLUT
+    @param LUTSTEP: interpolation step
+    @type LUTSTEP: number or 3-uple of numbers
+    @param ndImg: input array
+    @type ndImg: ndarray dtype np.uint8, shape (h, w, dOut), dOut >= 3
+    @param convert: convert the output to dtype=np.uint8
+    @type convert: boolean
+    @param interp: interpolation function for distinct colors
+    @type interp: function
+    @param fallback: interpolation function for the whole image
+    @type fallback: function
+    @param maxColors: max count of distinct colors
+    @type maxColors: int
+    @return: interpolated array
+    @rtype: ndarray, shape (h, w, dOut)
+    """
+    if fallback is None:
+        fallback = interp
+    if ndImg.dtype != np.uint8 or ndImg.ndim != 3 or ndImg.shape[2] < 3:
+        return fallback(LUT, LUTSTEP, ndImg, convert=convert)
+    keys = packColors(ndImg)
+    used = np.zeros(1 << 24, dtype=np.bool_)
+    used[keys] = True
+    colorKeys = np.flatnonzero(used)
+    del used
+    n = colorKeys.size
+    if n > maxColors or 4 * n > keys.size:
+        return fallback(LUT, LUTSTEP, ndImg, convert=convert)
+    colors = interp(LUT, LUTSTEP, unpackColors(colorKeys), convert=convert)[:, 0]
+    # inverse table : key --> index of the color in colorKeys
+    inv = np.empty(1 << 24, dtype=np.uint16 if n <= 1 << 16 else np.int32)
+    inv[colorKeys] = np.arange(n)
+    return np.take(colors, inv[keys], axis=0)
@@ -25,6 +25,7 @@ from PySide2.QtGui import QImage, QPixmap, QColor, QPainter, QPainterPath, QBrus
 from bLUeGui.colorCIE import sRGB2LabVec
 from bLUeGui.colorCube import rgb2hspVec
 from bLUeGui.const import channelValues
+from bLUeGui.memory import memoryManager
 
 
 class bImage(QImage):
@@ -48,9 +49,8 @@ class bImage(QImage):
         super().__init__(*args, **kwargs)
         self.__filename = ''
         self.__rPixmap = None
-        self.__hspbBuffer = None
-        self.__LabBuffer = None
-        self.__HSVBuffer = None
+        # color space buffers : name --> (content version, buffer)
+        self.__colorBuffers = {'hspbBuffer': (None, None), 'LabBuffer': (None, None), 'HSVBuffer': (None, None)}
         self.maskedImageContainer = None
         self.maskedThumbContainer = None
         self._mask = None  # double underscore mangling conflicts with overriding
@@ -85,27 +85,89 @@ class bImage(QImage):
 
     @property
     def hspbBuffer(self):
-        return self.__hspbBuffer
+        return self.__colorBuffers['hspbBuffer'][1]
 
     @hspbBuffer.setter
     def hspbBuffer(self, buffer):
-        self.__hspbBuffer = buffer
+        self.setColorBuffer('hspbBuffer', buffer)
 
     @property
     def LabBuffer(self):
-        return self.__LabBuffer
+        return self.__colorBuffers['LabBuffer'][1]
 
     @LabBuffer.setter
     def LabBuffer(self, buffer):
-        self.__LabBuffer = buffer
+        self.setColorBuffer('LabBuffer', buffer)
 
     @property
     def HSVBuffer(self):
-        return self.__HSVBuffer
+        return self.__colorBuffers['HSVBuffer'][1]
 
     @HSVBuffer.setter
     def HSVBuffer(self, buffer):
-        self.__HSVBuffer = buffer
+        self.setColorBuffer('HSVBuffer', buffer)
+
+    def setColorBuffer(self, name, buffer, version=None):
+        """
+        Cache a color space buffer, computed from the content
+        of the image identified by version (cf. getVersion()).
+        A buffer without version is never reused by getColorBuffer().
+        @param name: 'hspbBuffer', 'LabBuffer' or 'HSVBuffer'
+        @type name: str
+        @param buffer:
+        @type buffer: ndarray or None
+        @param version:
+        @type version: hashable
+        """
+        # version and buffer are replaced at once : readers
+        # running in another thread never see a mismatched pair
+        self.__colorBuffers[name] = (version, buffer)
+        memoryManager.register(self, name, buffer)
+
+    def getVersion(self):
+        """
+        Return a token identifying the current content of
+        the image, or None if the content is not versioned.
+        Running composites (cf. QLayer.getCurrentMaskedImage())
+        are versioned by their stamp.
+        @return:
+        @rtype: hashable
+        """
+        return getattr(self, 'compositeStamp', None)
+
+    def getColorImage(self):
+        """
+        Return the image converted by the color
+        space getters. Overridden in subclasses.
+        @return:
+        @rtype: QImage
+        """
+        return self
+
+    def getColorBuffer(self, name, convert):
+        """
+        Return the color space buffer name. The cached buffer is
+        returned if it was computed from the current content of the image
+        (cf. getVersion()). Otherwise, the buffer is computed by convert()
+        and cached. Thus, each conversion of a given content is done once and the buffer
+        is shared by all readers : it is read only, and it must be copied before
+        any modification.
+        @param name: 'hspbBuffer', 'LabBuffer' or 'HSVBuffer'
+        @type name: str
+        @param convert: color space conversion of BGR buffers
+        @type convert: function
+        @return:
+        @rtype: ndarray
+        """
+        version = self.getVersion()
+        bufVersion, buf = self.__colorBuffers[name]
+        if buf is not None and version is not None and bufVersion == version:
+            memoryManager.touch(self, name)
+            return buf
+        buf = convert(QImageBuffer(self.getColorImage())[:, :, :3])
+        buf.flags.writeable = False
+        self.setColorBuffer(name, buf, version=version)
+        return buf
 
     #################################
     # convenience comparison operators,
@@ -120,28 +182,30 @@ class bImage(QImage):
     def getHspbBuffer(self):
         """
         return the image buffer in color mode HSpB.
-        Override to enable buffering
-        @return: HSPB buffer
-        @rtype: ndarray
+        The buffer is cached and shared (cf. getColorBuffer()).
+        @return: HSPB buffer, H range is 0..360, S and pB ranges are 0..1
+        @rtype: ndarray, dtype np.float32, read only
         """
-        self.hspbBuffer = rgb2hspVec(QImageBuffer(self)[:, :, :3][:, :, ::-1])
-        return self.hspbBuffer
+        return self.getColorBuffer('hspbBuffer', lambda buf: rgb2hspVec(buf[:, :, ::-1], dtype=np.float32))
 
     def getLabBuffer(self):
         """
         return the image buffer in color mode Lab.
-        Override to enable buffering
-       """
-        self.LabBuffer = sRGB2LabVec(QImageBuffer(self)[:, :, :3][:, :, ::-1])
-        return self.LabBuffer
+        The buffer is cached and shared (cf. getColorBuffer()).
+        @return: Lab buffer, L range is 0..1, a, b ranges are -128..+128
+        @rtype: ndarray, dtype np.float32, read only
+        """
+        return self.getColorBuffer('LabBuffer', lambda buf: sRGB2LabVec(buf[:, :, ::-1], dtype=np.float32))
 
     def getHSVBuffer(self):
         """
         return the image buffer in color mode HSV.
-        Override to enable buffering
+        The buffer is cached and shared (cf. getColorBuffer()).
+        H,S,V ranges are 0..180, 0..255, 0..255 (opencv convention for 8 bits images)
+        @return: HSV buffer
+        @rtype: ndarray, dtype np.uint8, read only
         """
-        self.HSVBuffer = cv2.cvtColor(QImageBuffer(self)[:, :, :3], cv2.COLOR_BGR2HSV)
-        return self.HSVBuffer
+        return self.getColorBuffer('HSVBuffer', lambda buf: cv2.cvtColor(buf, cv2.COLOR_BGR2HSV))
 
     def cacheInvalidate(self):
         """
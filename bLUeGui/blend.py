@@ -17,34 +17,8 @@ along with this program. If not, see <http://www.gnu.org/licenses/>.
 """
 from PySide2.QtGui import QImage
 
-from bLUeGui.colorCube import rgb2hlsVec, hls2rgbVec
 from bLUeGui.bLUeImage import QImageBuffer
-
-def blendLuminosityBuf(destBuf, sourceBuf):
-    """
-    Important : Buffer channels should be in r,g,b order.
-    The method implements blending in luminosity mode,
-    which is missing in Qt.
-    The blended image retains the hue and saturation of dest,
-    with the luminosity of source.
-    We use the HLS color model:
-    see https://docs.opencv.org/3.3.0/de/d25/imgproc_color_conversions.html
-    Note blendColor and blendLuminosity are commuted versions of each other:
-    blendLuminosity(img1, img2) = blendColor(img2, img1)
-    @param destBuf: destination r,g,b image buffer
-    @type destBuf: ndarray
-    @param sourceBuf: source r,g,b image buffer
-    @type sourceBuf: ndarray
-    @return: the blended buffer
-    @rtype: ndarray
-    """
-    hlsSourceBuf = rgb2hlsVec(sourceBuf)
-    hlsDestBuf = rgb2hlsVec(destBuf)
-    # copy source luminosity to dest
-    hlsDestBuf[:, :, 1] = hlsSourceBuf[:, :, 1]
-    blendBuf = hls2rgbVec(hlsDestBuf)
-    return blendBuf
-
+from bLUeGui.blendBuf import blendLuminosityBuf
 
 def blendLuminosity(dest, source):
     """
@@ -74,26 +48,6 @@ def blendLuminosity(dest, source):
     return img
 
 
-def blendColorBuf(destBuf, sourceBuf):
-    """
-    Important : Buffer channels should be in r,g,b order.
-    The method implements blending in color mode, which is missing
-    in Qt. We use the HLS color model as intermediate color space.
-    The blended image retains the hue and saturation of source, with the
-    luminosity of dest. We use the HLS color model:
-    see https://docs.opencv.org/3.3.0/de/d25/imgproc_color_conversions.html
-    Note blendColor and blendLuminosity are commuted versions of each other:
-    blendLuminosity(img1, img2) = blendColor(img2, img1)
-    @param destBuf: destination r,g,b image buffer
-    @type destBuf: ndarray
-    @param sourceBuf: source r,g,b image buffer
-    @type sourceBuf: ndarray
-    @return: the blended buffer
-    @rtype: ndarray
-    """
-    return blendLuminosityBuf(sourceBuf, destBuf)
-
-
 def blendColor(dest, source):
     """
     Implements blending in color mode, which is missing
@@ -0,0 +1,70 @@
+"""
+This File is part of bLUe software.
+
+Copyright (C) 2017  Bernard Virot <bernard.virot@libertysurf.fr>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Lesser General Public License as
+published by the Free Software Foundation, version 3.
+
+This program is distributed in the hope that it will be useful, but
+WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+Lesser General Lesser Public License for more details.
+
+You should have received a copy of the GNU Lesser General Public License
+along with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+from bLUeGui.colorCube import rgb2hlsVec, hls2rgbVec
+from bLUeTop.settings import WORKING_DTYPE
+
+#####################################################################
+# Blending of r,g,b image buffers (numpy only, no Qt dependency).
+# The QImage versions are in bLUeGui.blend.
+#####################################################################
+
+
+def blendLuminosityBuf(destBuf, sourceBuf):
+    """
+    Important : Buffer channels should be in r,g,b order.
+    The method implements blending in luminosity mode,
+    which is missing in Qt.
+    The blended image retains the hue and saturation of dest,
+    with the luminosity of source.
+    We use the HLS color model:
+    see https://docs.opencv.org/3.3.0/de/d25/imgproc_color_conversions.html
+    Note blendColor and blendLuminosity are commuted versions of each other:
+    blendLuminosity(img1, img2) = blendColor(img2, img1)
+    @param destBuf: destination r,g,b image buffer
+    @type destBuf: ndarray
+    @param sourceBuf: source r,g,b image buffer
+    @type sourceBuf: ndarray
+    @return: the blended buffer
+    @rtype: ndarray
+    """
+    hlsSourceBuf = rgb2hlsVec(sourceBuf, dtype=WORKING_DTYPE)
+    hlsDestBuf = rgb2hlsVec(destBuf, dtype=WORKING_DTYPE)
+    # copy source luminosity to dest
+    hlsDestBuf[:, :, 1] = hlsSourceBuf[:, :, 1]
+    blendBuf = hls2rgbVec(hlsDestBuf)
+    return blendBuf
+
+
+def blendColorBuf(destBuf, sourceBuf):
+    """
+    Important : Buffer channels should be in r,g,b order.
+    The method implements blending in color mode, which is missing
+    in Qt. We use the HLS color model as intermediate color space.
+    The blended image retains the hue and saturation of source, with the
+    luminosity of dest. We use the HLS color model:
+    see https://docs.opencv.org/3.3.0/de/d25/imgproc_color_conversions.html
+    Note blendColor and blendLuminosity are commuted versions of each other:
+    blendLuminosity(img1, img2) = blendColor(img2, img1)
+    @param destBuf: destination r,g,b image buffer
+    @type destBuf: ndarray
+    @param sourceBuf: source r,g,b image buffer
+    @type sourceBuf: ndarray
+    @return: the blended buffer
+    @rtype: ndarray
+    """
+    return blendLuminosityBuf(sourceBuf, destBuf)
@@ -18,6 +18,8 @@ along with this program. If not, see <http://www.gnu.org/licenses/>.
 import cv2
 import numpy as np
 
+from bLUeTop.settings import WORKING_DTYPE
+
 #############################################################################
 # Profile dependent conversion functions are located in this module:        #
 # sRGB2LabVec, lab2sRGBVec, XYZ2sRGB, sRGB2XYZ, XYZ2sRGBLinear.             #
@@ -138,6 +140,9 @@ class gammaTables:
         trh = int(self.gammaLinearTreshold1 * self.tableSize)
         self.__table5[0: trh + 1] = np.arange(trh + 1) * self.d / self.tableSize
         self.__table5 *= 255
+        # lookups return arrays of the working float type
+        self.__table3 = self.__table3.astype(WORKING_DTYPE)
+        self.__table5 = self.__table5.astype(WORKING_DTYPE)
 
     @property
     def table3(self):
@@ -301,7 +306,7 @@ def XYZ2RGB(XYZColors, RGB_lin2XYZInverse=sRGB_lin2XYZInverse):
     return c2
 
 
-def sRGB2LabVec(bufsRGB, RGB_lin2XYZ=sRGB_lin2XYZ, useOpencv=True):
+def sRGB2LabVec(bufsRGB, RGB_lin2XYZ=sRGB_lin2XYZ, useOpencv=True, dtype=np.float64):
     """
     Vectorized sRGB to Lab conversion for 8 bits images only. No clipping
     is performed. If useOpencv is True (default, faster),
@@ -314,12 +319,14 @@ def sRGB2LabVec(bufsRGB, RGB_lin2XYZ=sRGB_lin2XYZ, useOpencv=True):
     @type bufsRGB: ndarray, dtype=np.uint8
     @param useOpencv:
     @type useOpencv: boolean
+    @param dtype: float type of the output (opencv only)
+    @type dtype: numpy dtype
     @return: bufLab Image buffer, mode Lab
-    @rtype: ndarray, dtype numpy float64
+    @rtype: ndarray, dtype numpy float64 or dtype
     """
     if useOpencv:
         bufLab = cv2.cvtColor(bufsRGB, cv2.COLOR_RGB2Lab)
-        bufLab = bufLab.astype(np.float)
+        bufLab = bufLab.astype(dtype)
         # for 8 bits per channel images opencv uses L,a,b range 0..255
         bufLab[:, :, 0] /= 255.0
         bufLab[:, :, 1:] -= 128
@@ -353,7 +360,7 @@ def Lab2sRGBVec(bufLab, RGB_lin2XYZInverse=sRGB_lin2XYZInverse, useOpencv=True):
     """
     if useOpencv:
         # for 8 bits per channel images opencv uses L,a,b range 0..255
-        tmp = bufLab + [0.0, 128.0, 128.0]
+        tmp = bufLab + np.array([0.0, 128.0, 128.0], dtype=bufLab.dtype)
         tmp[:, :, 0] *= 255.0
         bufsRGB = cv2.cvtColor(tmp.astype(np.uint8), cv2.COLOR_Lab2RGB)
     else:
@@ -37,8 +37,8 @@ def rgb2hsp(r, g, b):
     return rgb2hsB(r, g, b, perceptual=True)
 
 
-def rgb2hspVec(rgbImg):
-    return rgb2hsBVec(rgbImg, perceptual=True)
+def rgb2hspVec(rgbImg, dtype=np.float64):
+    return rgb2hsBVec(rgbImg, perceptual=True, dtype=dtype)
 
 
 def rgb2hsB(r, g, b, perceptual=False):
@@ -84,7 +84,7 @@ def rgb2hsB(r, g, b, perceptual=False):
     return H, S, V
 
 
-def rgb2hsBVec(rgbImg, perceptual=False):
+def rgb2hsBVec(rgbImg, perceptual=False, dtype=np.float64):
     """
     Vectorized version of rgb2hsB.
     RGB-->HSV color space transformation
@@ -94,14 +94,16 @@ def rgb2hsBVec(rgbImg, perceptual=False):
     @type rgbImg: (n,m,3) array, , dtype=uint8 or dtype=int or dtype=float
     @param perceptual:
     @type perceptual: boolean
+    @param dtype: float type of the output
+    @type dtype: numpy dtype
     @return: identical shape array of hue,sat,brightness values (0<=h<=360, 0<=s<=1, 0<=v<=1)
-    @rtype: (n,m,3) array, dtype=float
+    @rtype: (n,m,3) array, dtype=dtype
     """
     buf = cv2.cvtColor(rgbImg.astype(np.uint8), cv2.COLOR_RGB2HSV)
-    buf = buf.astype(np.float)
-    buf *= [2, 1.0 / 255.0, 1.0 / 255.0]  # scale to 0..360, 0..1, 0..1
+    buf = buf.astype(dtype)
+    buf *= np.array([2, 1.0 / 255.0, 1.0 / 255.0], dtype=dtype)  # scale to 0..360, 0..1, 0..1
     if perceptual:
-        rgbImg2 = rgbImg.astype(float)
+        rgbImg2 = rgbImg.astype(dtype)
         rgbImg2 *= rgbImg2
         pB = np.tensordot(rgbImg2, [Perc_R, Perc_G, Perc_B], axes=(-1, -1))
         pB /= 255.0 * 255
@@ -111,7 +113,7 @@ def rgb2hsBVec(rgbImg, perceptual=False):
     return buf
 
 
-def rgb2hlsVec(rgbImg):
+def rgb2hlsVec(rgbImg, dtype=np.float64):
     """
     Converts RGB color space to HLS.
     With M = max(r,g,b) and m = min(r,g,b) the HLS color space uses
@@ -120,12 +122,14 @@ def rgb2hlsVec(rgbImg):
     We do not follow the opencv convention for HLS value ranges.
     @param rgbImg: rgbImg: array of r,g, b values
     @type rgbImg: rgbImg: (n,m,3) array, , dtype=uint8 or dtype=int or dtype=float
+    @param dtype: float type of the output
+    @type dtype: numpy dtype
     @return: identical shape array of hue,luma, chroma values (0<=h<=360, 0<=l<=1, 0<=s<=1)
-    @rtype: (n,m,3) array, dtype=float
+    @rtype: (n,m,3) array, dtype=dtype
     """
     buf = cv2.cvtColor(rgbImg.astype(np.uint8), cv2.COLOR_RGB2HLS)
-    buf = buf.astype(np.float)
-    buf *= [2, 1.0 / 255.0, 1.0 / 255.0]  # scale to 0..360, 0..1, 0..1
+    buf = buf.astype(dtype)
+    buf *= np.array([2, 1.0 / 255.0, 1.0 / 255.0], dtype=dtype)  # scale to 0..360, 0..1, 0..1
     return buf
 
 
@@ -145,11 +149,12 @@ def hls2rgbVec(hlsImg, cvRange=False):
     """
     # scale to 0..180, 0..255, 0..255 (opencv convention)
     if not cvRange:
-        buf = hlsImg * [1.0 / 2.0, 255.0, 255.0]
+        buf = hlsImg * np.array([1.0 / 2.0, 255.0, 255.0], dtype=hlsImg.dtype)
     else:
         buf = hlsImg  # TODO added 21/01/20 validate
-    # convert to rgb
-    buf = cv2.cvtColor(buf.astype(np.uint8), cv2.COLOR_HLS2RGB)
+    # convert to rgb. Values are rounded : truncation would turn
+    # rounding errors of the float type (e.g. 254.99998) into 8 bits errors
+    buf = cv2.cvtColor(np.rint(buf).astype(np.uint8), cv2.COLOR_HLS2RGB)
     return buf
 
 
@@ -21,13 +21,14 @@ from PySide2.QtCore import Qt, QDir, QSize
 
 from PySide2.QtWidgets import QMessageBox, QPushButton, QFileDialog, QDialog, QSlider, QVBoxLayout, QHBoxLayout, QLabel, \
     QCheckBox, QFormLayout, QLineEdit, QDialogButtonBox, QScrollArea
+from bLUeTop.settings import IMAGE_FILE_EXTENSIONS, RAW_FILE_EXTENSIONS
+from bLUeTop.stackWorker import deferToGui
 from bLUeTop.utils import QbLUeSlider
 
 ##################
 # file extension constants
+# (IMAGE_FILE_EXTENSIONS and RAW_FILE_EXTENSIONS : cf. bLUeTop.settings)
 
-IMAGE_FILE_EXTENSIONS = (".jpg", ".JPG", ".png", ".PNG", ".tif", ".TIF", ".bmp", ".BMP")
-RAW_FILE_EXTENSIONS = (".nef", ".NEF", ".dng", ".DNG", ".cr2", ".CR2")
 IMAGE_FILE_NAME_FILTER = ['Image Files (*.jpg *.png *.tif *.JPG *.PNG *.TIF)']
 #################
 
@@ -118,6 +119,9 @@ def dlgInfo(text, info='', parent=None):
     @param info:
     @type info: str
     """
+    # dialogs are shown by the GUI thread
+    if deferToGui(('dlgInfo', text, info), dlgInfo, text, info, parent):
+        return
     msg = QMessageBox(parent=parent)
     msg.setWindowTitle('Information')
     msg.setIcon(QMessageBox.Information)
@@ -136,6 +140,9 @@ def dlgWarn(text, info='', parent=None):
     @param info:
     @type info: str
     """
+    # dialogs are shown by the GUI thread
+    if deferToGui(('dlgWarn', text, info), dlgWarn, text, info, parent):
+        return
     msg = QMessageBox(parent=parent)
     msg.setWindowTitle('Warning')
     msg.setIcon(QMessageBox.Warning)
@@ -15,13 +15,18 @@ Lesser General Lesser Public License for more details.
 You should have received a copy of the GNU Lesser General Public License
 along with this program. If not, see <http://www.gnu.org/licenses/>.
 """
+from dataclasses import fields, is_dataclass, replace
+
+import numpy as np
+
 from PySide2 import QtCore
 from PySide2.QtCore import QPoint
 from PySide2.QtWidgets import QGraphicsView, QGraphicsScene, QSizePolicy, QGraphicsPathItem, QWidget, QVBoxLayout
 from PySide2.QtGui import QColor, QPen, QPainterPath, QBrush
 from PySide2.QtCore import Qt
+from bLUeCore.bLUeLUT3D import LUT3D, DeltaLUT3D
 from bLUeGui.memory import weakProxy
-from bLUeTop.utils import stateAwareQDockWidget
+from bLUeTop.utils import stateAwareQDockWidget, UDict
 
 
 class bottomWidget(QWidget):
@@ -42,6 +47,106 @@ class bottomWidget(QWidget):
         self.setStyleSheet(ss)
 
 
+# marker for the values which are not recorded by form parameters
+NOT_RECORDED = object()
+
+
+def paramValue(value):
+    """
+    Return a read only copy of value, independent of later modifications
+    of the form, or NOT_RECORDED if value is not a plain data value
+    (widgets, graphics items,...). Containers and dataclasses are copied
+    recursively. Their items which are not plain data values are not copied.
+    @param value:
+    @type value: object
+    @return:
+    @rtype: object
+    """
+    def item(v):
+        c = paramValue(v)
+        return v if c is NOT_RECORDED else c
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    if isinstance(value, np.ndarray):
+        value = value.copy()
+        value.flags.writeable = False
+        return value
+    if isinstance(value, tuple):
+        items = [item(v) for v in value]
+        # named tuples
+        return value._make(items) if hasattr(value, '_make') else tuple(items)
+    if isinstance(value, list):
+        return [item(v) for v in value]
+    if isinstance(value, dict):
+        return {k: item(v) for k, v in value.items()}
+    if isinstance(value, UDict):
+        return UDict((item(value.toDict()),))
+    if isinstance(value, (LUT3D, DeltaLUT3D)):
+        return value.snapshot()
+    if is_dataclass(value) and not isinstance(value, type):
+        return replace(value, **{f.name: item(getattr(value, f.name)) for f in fields(value) if f.init})
+    return NOT_RECORDED
+
+
+class FormParamsError(RuntimeError):
+    """
+    Raised when the stack worker thread reads a form
+    attribute which is not recorded by the form parameters, or
+    reads the form itself (cf. QLayer.getGraphicsForm()).
+    """
+    pass
+
+
+class FormParams:
+    """
+    Immutable record of the parameters of a graphic form, taken in the GUI thread
+    (cf. abstractForm.getFormParams()) and read by the stack worker thread in place
+    of the form (cf. QLayer.getFormParams()) : sliders, option lists and graphics
+    items must not be read while the user is modifying them.
+    The record holds the plain data attributes of the form and the results of the
+    methods listed in form.paramMethods, which are called with no argument.
+    Arrays are read only. Reading any other attribute raises FormParamsError, and
+    attributes cannot be set.
+    """
+    __slots__ = ('formClass', '_FormParams__values')
+
+    def __init__(self, form):
+        """
+        @param form:
+        @type form: abstractForm
+        """
+        values = {}
+        for name, value in vars(form).items():
+            value = paramValue(value)
+            if value is not NOT_RECORDED:
+                values[name] = value
+        for name in form.paramMethods:
+            try:
+                value = paramValue(getattr(form, name)())
+            except Exception:
+                # reading the result raises FormParamsError
+                continue
+            if value is not NOT_RECORDED:
+                values[name] = (lambda v: lambda: v)(value)
+        object.__setattr__(self, 'formClass', type(form))
+        object.__setattr__(self, '_FormParams__values', values)
+
+    def __getattr__(self, name):
+        try:
+            return self.__values[name]
+        except KeyError:
+            if name.startswith('__'):
+                raise AttributeError(name) from None
+            raise FormParamsError('%s.%s is not a recorded parameter (cf. abstractForm.paramMethods)'
+                                  % (self.formClass.__name__, name)) from None
+
+    def __setattr__(self, name, value):
+        raise FormParamsError('form parameters are read only')
+
+    def __delattr__(self, name):
+        raise FormParamsError('form parameters are read only')
+
+
 class abstractForm:
     """
     Base properties and methods
@@ -49,6 +154,10 @@ class abstractForm:
     This container is designed for multiple
     inheritance only and should never be instantiated.
     """
+    # names of the methods whose results are recorded by
+    # the form parameters (cf. FormParams). These methods
+    # take no argument and must not modify the form.
+    paramMethods = ('getParamState', 'getParams', 'getLinearMatrix', 'getContrastCurve')
 
     @classmethod
     def getNewWindow(cls, targetImage=None, axeSize=200, layer=None, parent=None):
@@ -123,6 +232,66 @@ class abstractForm:
         """
         pass
 
+    def getParamState(self):
+        """
+        Return the values of all form parameters used by the layer
+        transformation, as a structure of numbers, strings, ndarrays, lists, tuples
+        and dicts, or None if the form cannot provide them. The output
+        of the layer is memoized only if its form provides its
+        parameters (cf. QLayer.getParamKey()). Should be overridden
+        in subclasses.
+        @return:
+        @rtype: object
+        """
+        return None
+
+    def getParams(self):
+        """
+        Return the parameters of the layer transformation as
+        a plain dataclass, to be applied by the headless
+        functions of bLUeTop.pipeline, or None if the layer type
+        is not supported by the pipeline. Should be overridden in subclasses.
+        @return:
+        @rtype: dataclass or None
+        """
+        return None
+
+    def getLinearMatrix(self):
+        """
+        Return the 3x3 matrix M of the layer transformation, if
+        the transformation multiplies the linear RGB values v of each
+        pixel by M (out = M @ v), and None otherwise. Runs of adjacent
+        layers with a linear matrix are folded into a single matrix
+        (cf. mImage.getFusedMatrix()). Should be overridden in subclasses.
+        @return:
+        @rtype: ndarray, shape (3, 3) or None
+        """
+        return None
+
+    def getContrastCurve(self):
+        """
+        Return the parameters a, b, d, T of the manual contrast curve
+        (cf. bLUeGui.histogramWarping.warpHistogram()), or None if the
+        curve form is not initialized.
+        @return:
+        @rtype: 4-uple or None
+        """
+        form = getattr(self, 'contrastForm', None)
+        if form is None:
+            return None
+        spline = form.scene().cubicItem
+        return [p.x() for p in spline.fixedPoints], [p.y() for p in spline.fixedPoints], \
+            list(spline.fixedTangents), spline.LUTXY / 256
+
+    def getFormParams(self):
+        """
+        Return a record of the form parameters, to be
+        used by the stack worker thread.
+        @return:
+        @rtype: FormParams
+        """
+        return FormParams(self)
+
 
 #################################################
 # Base graphic forms.
@@ -166,6 +335,7 @@ class baseGraphicsForm(QGraphicsView, abstractForm):
     """
     Base class for graphic forms using a scene.
     """
+    paramMethods = abstractForm.paramMethods + ('getSceneOptions',)
     # Form state changed signal
     # Subclasses may redefine it with a different signature.
     # In that case, they must override abstractForm.reset() accordingly.
@@ -192,6 +362,14 @@ class baseGraphicsForm(QGraphicsView, abstractForm):
         if layer is not None:
             layer.colorPicked.sig.connect(self.colorPickedSlot)
 
+    def getSceneOptions(self):
+        """
+        Return the options of the scene.
+        @return:
+        @rtype: dict or UDict
+        """
+        return self.graphicsScene.options
+
     def wheelEvent(self, e):
         """
         Overrides QGraphicsView wheelEvent.
@@ -234,6 +412,8 @@ class graphicsCurveForm(baseGraphicsForm):
     """
     Base class for interactive curve forms
     """
+    paramMethods = baseGraphicsForm.paramMethods + ('getStackedLUTXY',)
+
     @staticmethod
     def drawPlotGrid(axeSize, gradient=None):
         """
@@ -305,4 +485,24 @@ class graphicsCurveForm(baseGraphicsForm):
     def baseCurve(self, points):
         self.__baseCurve = points
 
+    def getStackedLUTXY(self):
+        """
+        Return the stacked LUTs of the current curve.
+        @return:
+        @rtype: ndarray, shape (3, 256)
+        """
+        return self.graphicsScene.cubicItem.getStackedLUTXY()
+
+    def getParamState(self):
+        """
+        Curve layers depend on the stacked LUT of the
+        current curve and on the scene options only.
+        @return:
+        @rtype: tuple or None
+        """
+        cubicItem = getattr(self.graphicsScene, 'cubicItem', None)
+        if cubicItem is None:
+            return None
+        return cubicItem.getStackedLUTXY(), self.graphicsScene.options
+
 
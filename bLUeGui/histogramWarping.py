@@ -30,6 +30,7 @@ along with this program. If not, see <http://www.gnu.org/licenses/>.
 #########################################################################################################################
 import numpy as np
 from .spline import interpolationQuadSpline
+from bLUeTop.settings import WORKING_DTYPE
 
 
 class dstb(object):
@@ -153,7 +154,7 @@ class dstb(object):
         """
         s = self.maxVal
         xs = x * s
-        k1 = xs.astype(np.int)
+        k1 = xs.astype(int)
         v1 = self.CDFTable[k1]
         if self.interpolateCDF:
             k2 = np.minimum(k1+1, s)
@@ -215,7 +216,7 @@ class dstb(object):
         """
         if not np.isscalar(x):
             raise ValueError('dstb.FInv : argument is not a scalar')
-        return np.asscalar(self.FInvVec(np.array([x])))
+        return self.FInvVec(np.array([x])).item()
 
 
 def gaussianDistribution(x, hist, bins, h):
@@ -235,7 +236,7 @@ def gaussianDistribution(x, hist, bins, h):
     @rtype: float
     """
     dist = dstb(hist, bins)
-    values = np.arange(256, dtype=np.float)/256
+    values = np.arange(256, dtype=np.float64)/256
     valuesx = x/256 - values
     valuesx = - valuesx*valuesx/(2*h*h)
     expx = np.exp(valuesx) / (h*np.sqrt(2*np.pi)) * dist
@@ -304,7 +305,7 @@ def valleys(imgBuf, delta):
         if np.all([(DTable[l] > DTable[k]) for l in range(k+j, k)]) and \
                     np.all([(DTable[l] > DTable[k]) for l in range(k+1, k+i+1)]):
             V.append(k)
-    V = np.fromiter(V, dtype=np.float, count=len(V))
+    V = np.fromiter(V, dtype=WORKING_DTYPE, count=len(V))
     return V, dist
 
 
@@ -350,7 +351,7 @@ def autoQuadSpline(imgBuf, valleyAperture=0.05, warp=1.0, preserveHigh=True):
     V0 = np.concatenate(([dist.FInv(0)], V0, [dist.FInv(1)]))
     modeCenters = (V0[1:] + V0[:-1]) / 2
     # init the array of data points
-    a = np.zeros(len(V0)+3, dtype=np.float)                      # len(a) = K+2
+    a = np.zeros(len(V0)+3, dtype=np.float64)                      # len(a) = K+2
     # put modeCenters into a[2:K-1], and count
     # valleys from V[1] to get a[k] = (V[k-1] + V[k])/2, k>=2
     a[2:-2] = modeCenters
@@ -397,12 +398,12 @@ def autoQuadSpline(imgBuf, valleyAperture=0.05, warp=1.0, preserveHigh=True):
         alpha = np.concatenate(([0], alpha))                       # alpha[k] = (F(a[k]) - F(a[k-1])/(F(a[k+1]) - F(a[k-1]), K-1>=k>=1
         beta = (dist.FVec(a[2:]) - dist.FVec(a[1:-1])) / (dist.FVec(a[2:]) - dist.FVec(a[:-2]))
         beta = np.concatenate(([0], beta))                         # beta[k] = (F(a[k+1] - F(a[k])/(F(a[k+1]) - F([a[k-1])), K-1>=k>=1
-        r1 = np.zeros(len(a), dtype=np.float)
-        r2 = np.zeros(len(a), dtype=np.float)
+        r1 = np.zeros(len(a), dtype=np.float64)
+        r2 = np.zeros(len(a), dtype=np.float64)
         r1[1:-1] = (b[1:-1] - bMinus[1:-1]) / (a[1:-1] - aMinus[1:-1])  # r1[k] = (b[k] - bMinus[k])/((a[k] - aMinus[k]), k>=1
         r2[1:-1] = (bPlus[1:-1] - b[1:-1]) / (aPlus[1:-1] - a[1:-1])    # r2[k] = (bPlus[k] - b[k])/((aPlus[k] - a[k]), k>=1
         # array of slopes
-        d = np.zeros(len(a), dtype=np.float)                          # len(a) = len(b) = len(d) = K+2
+        d = np.zeros(len(a), dtype=np.float64)                          # len(a) = len(b) = len(d) = K+2
         d[1:-1] = np.power(r1[1:-1], alpha[1:]) * np.power(r2[1:-1], beta[1:])
         d[0] = bPlus[0] / aPlus[0]
         d[-1] = (1-bMinus[-1]) / (1 - aMinus[-1])                 # d[K+1] = (1 - bMinus[K+1]) / ((1-aMinus[K+1])
@@ -423,11 +424,12 @@ def autoQuadSpline(imgBuf, valleyAperture=0.05, warp=1.0, preserveHigh=True):
     return a, b, d, T
 
 
-def warpHistogram(imgBuf, valleyAperture=0.05, warp=1.0, preserveHigh=True, spline=None):
+def warpHistogram(imgBuf, valleyAperture=0.05, warp=1.0, preserveHigh=True, spline=None, quadSpline=None):
     """
     Stretches and warps the distribution of imgBuf to enhance the contrast.
     If a spline is given, it is applied to imgBuf, otherwise an "automatic"
-    spline is deduced from the image histogram.
+    spline is deduced from the image histogram, unless quadSpline,
+    returned by a previous call, is given.
     We mainly use the algorithm proposed by Grundland and Dodgson,
     Cf. U{https://link.springer.com/chapter/10.1007/1-4020-4179-9_42},
     with a supplementary correction for highlights.
@@ -445,23 +447,34 @@ def warpHistogram(imgBuf, valleyAperture=0.05, warp=1.0, preserveHigh=True, spli
     @type preserveHigh: boolean
     @param spline: spline, range 0..256 --> 0..1
     @type spline: activeSpline
+    @param quadSpline: parameters a, b, d, T of a quadratic spline
+    @type quadSpline: 4-uple
     @return: the transformed image channel, range 0..1 and the quadratic spline
-    @rtype: image ndarray same shape as imgBuf, dtype=np.float, a, b, T are in range 0..1
+    @rtype: image ndarray same shape as imgBuf, float type of imgBuf or WORKING_DTYPE, a, b, T are in range 0..1
     """
-    if spline is None:
+    if quadSpline is not None:
+        a, b, d, T = quadSpline
+    elif spline is None:
         a, b, d, T = autoQuadSpline(imgBuf, valleyAperture=valleyAperture, warp=warp, preserveHigh=preserveHigh)
     else:
         a, b, d, T = [p.x() for p in spline.fixedPoints], \
                       [p.y() for p in spline.fixedPoints], spline.fixedTangents, spline.LUTXY/256
-    im = imgBuf*255
-    im1 = im.astype(np.int)
+    # interpolate in the float type of imgBuf, or in the working float type
+    dtype = imgBuf.dtype if np.issubdtype(imgBuf.dtype, np.floating) else np.dtype(WORKING_DTYPE)
+    im = imgBuf * dtype.type(255)
+    im1 = im.astype(int)
     im2 = im1+1
-    B1 = T[im1]
+    TW = np.asarray(T, dtype=dtype)
+    B1 = TW[im1]
     # extrapolate T to handle eventual value 256 in im2
-    T1 = np.hstack((T, [T[-1]]))
+    T1 = np.hstack((TW, TW[-1:]))
     B2 = T1[im2]  # clearer but slower : T[np.minimum(im2, 255)]
-    # interpolate B1, B2
-    B = (im2 - im) * B1 + (im - im1) * B2
+    # interpolate B1, B2. Operations are done in place : mixing
+    # the int arrays im1, im2 with im would promote the result to float64
+    im -= im1
+    B = B2 - B1
+    B *= im
+    B += B1
     return np.clip(B, 0, 1, out=B), a, b, d, T
 
 
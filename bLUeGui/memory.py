@@ -15,7 +15,15 @@ Lesser General Lesser Public License for more details.
 You should have received a copy of the GNU Lesser General Public License
 along with this program. If not, see <http://www.gnu.org/licenses/>.
 """
+import os
+import tempfile
+import threading
 import weakref
+from collections import OrderedDict
+
+import numpy as np
+
+from bLUeTop.settings import MEMORY_BUDGET_MB, SCRATCH_DIR
 
 
 def weakProxy(ref):
@@ -34,3 +42,183 @@ def weakProxy(ref):
         return ref
     else:
         return weakref.proxy(ref)
+
+
+class MemoryManager(object):
+    """
+    Registry of the large buffers of the open documents, with a global memory budget.
+    Each buffer is an attribute of an owner object, registered with
+    a policy :
+        - RELEASE : the buffer is a cache, rebuilt on demand by its owner. It is
+          evicted by setting the attribute to None.
+        - SPILL : the buffer (ndarray) cannot be rebuilt. It is evicted by moving it to a
+          disk backed array (np.memmap) in the scratch directory. The attribute is
+          replaced by the memmap, which behaves as the original array.
+        - KEEP : the buffer is accounted, but never evicted.
+    Owners are not referenced : the entries of an owner are removed when
+    it is garbage collected.
+    When the size of the resident buffers exceeds the budget, enforce() evicts buffers
+    in least recently used order (cf. touch()). Evictions modify attributes used by the
+    stack evaluation, thus enforce() must be called from the GUI thread, while the
+    stack worker is idle (cf. StackWorker.publish()).
+    """
+    RELEASE, SPILL, KEEP = 'release', 'spill', 'keep'
+
+    def __init__(self, budget, scratchDir):
+        """
+        @param budget: memory budget (bytes), 0 for no limit
+        @type budget: int
+        @param scratchDir: directory of spilled buffers
+        @type scratchDir: str
+        """
+        self.budget = budget
+        self.scratchDir = scratchDir
+        self.releases, self.spills = 0, 0
+        # (id(owner), name) --> [weak ref. to owner, nbytes, policy, spilled]
+        self.__entries = OrderedDict()
+        self.__lock = threading.RLock()
+
+    @staticmethod
+    def sizeOf(buf):
+        """
+        Return the size (bytes) of an ndarray or QImage.
+        @param buf:
+        @type buf: ndarray or QImage
+        @return:
+        @rtype: int
+        """
+        if hasattr(buf, 'nbytes'):
+            return buf.nbytes
+        return buf.bytesPerLine() * buf.height()
+
+    @property
+    def resident(self):
+        """
+        Total size (bytes) of the registered buffers held in memory.
+        @return:
+        @rtype: int
+        """
+        with self.__lock:
+            return sum(e[1] for e in self.__entries.values() if not e[3])
+
+    def register(self, owner, name, buf, policy=RELEASE):
+        """
+        Record (or update) the buffer owner.name. The entry
+        becomes the most recently used one.
+        @param owner:
+        @type owner: object
+        @param name: attribute name
+        @type name: str
+        @param buf: value of the attribute
+        @type buf: ndarray or QImage
+        @param policy: RELEASE, SPILL or KEEP
+        @type policy: str
+        """
+        if buf is None:
+            self.unregister(owner, name)
+            return
+        key = (id(owner), name)
+        entries = self.__entries
+
+        def dead(ref):
+            with self.__lock:
+                if key in entries and entries[key][0] is ref:
+                    del entries[key]
+
+        with self.__lock:
+            entry = entries.pop(key, None)
+            ref = entry[0] if entry is not None and entry[0]() is owner else weakref.ref(owner, dead)
+            entries[key] = [ref, self.sizeOf(buf), policy, isinstance(buf, np.memmap)]
+
+    def unregister(self, owner, name):
+        """
+        Remove the entry of owner.name, if any.
+        @param owner:
+        @type owner: object
+        @param name:
+        @type name: str
+        """
+        with self.__lock:
+            self.__entries.pop((id(owner), name), None)
+
+    def touch(self, owner, name):
+        """
+        Mark the buffer owner.name as the most recently used.
+        @param owner:
+        @type owner: object
+        @param name:
+        @type name: str
+        """
+        with self.__lock:
+            key = (id(owner), name)
+            if key in self.__entries:
+                self.__entries.move_to_end(key)
+
+    def __spill(self, owner, name):
+        """
+        Move the array owner.name to a disk backed array.
+        @param owner:
+        @type owner: object
+        @param name:
+        @type name: str
+        """
+        buf = getattr(owner, name)
+        os.makedirs(self.scratchDir, exist_ok=True)
+        # the (anonymous) file is deleted when the array is released
+        with tempfile.TemporaryFile(dir=self.scratchDir) as f:
+            mm = np.memmap(f, dtype=buf.dtype, mode='w+', shape=buf.shape)
+        mm[...] = buf
+        mm.flush()
+        setattr(owner, name, mm)
+
+    def enforce(self):
+        """
+        Evict least recently used buffers until the size
+        of the resident buffers fits into the budget.
+        Must be called from the GUI thread, while the stack worker is idle.
+        """
+        if self.budget <= 0:
+            return
+        with self.__lock:
+            excess = self.resident - self.budget
+            for key, (ref, nbytes, policy, spilled) in list(self.__entries.items()):
+                if excess <= 0:
+                    break
+                owner = ref()
+                if owner is None or spilled or policy == MemoryManager.KEEP:
+                    continue
+                if policy == MemoryManager.RELEASE:
+                    self.__entries.pop(key, None)
+                    setattr(owner, key[1], None)
+                    self.releases += 1
+                else:
+                    try:
+                        self.__spill(owner, key[1])
+                    except OSError:
+                        continue
+                    self.spills += 1
+                    # setattr() may have updated the entry
+                    if key in self.__entries:
+                        self.__entries[key][3] = True
+                excess -= nbytes
+
+    def report(self):
+        """
+        Return the list of registered buffers, most recently used first, as
+        tuples (owner description, attribute name, size in bytes, policy, state),
+        state being 'resident' or 'spilled'.
+        @return:
+        @rtype: list of 5-uples
+        """
+        result = []
+        with self.__lock:
+            for (_, name), (ref, nbytes, policy, spilled) in reversed(self.__entries.items()):
+                owner = ref()
+                if owner is None:
+                    continue
+                desc = '%s %s' % (type(owner).__name__, getattr(owner, 'name', '') or '')
+                result.append((desc.strip(), name, nbytes, policy, 'spilled' if spilled else 'resident'))
+        return result
+
+
+memoryManager = MemoryManager(MEMORY_BUDGET_MB * 2 ** 20, SCRATCH_DIR)
@@ -17,7 +17,6 @@ along with this program. If not, see <http://www.gnu.org/licenses/>.
 """
 
 import numpy as np
-from PySide2.QtCore import QPointF
 
 #####################
 # displacement spline
@@ -88,7 +87,7 @@ def interpolationQuadSpline(a, b, d):
     if np.min(a[1:] - a[:-1]) <= 0:
         raise ValueError('histogram.InterpolationSpline : a must be strictly increasing')
     # x-coordinate range
-    x = np.arange(256, dtype=np.float)/255
+    x = np.arange(256, dtype=np.float64)/255
     x = np.clip(x, a[0], a[-1])
     # find  node intervals containing x : for each i, get smallest j s.t. a[j] > x[i]
     tmp = np.fromiter(((a[j] > x[i]) for j in range(len(a)) for i in range(len(x))), dtype=bool)
@@ -202,4 +201,6 @@ def interpolationCubSpline(X, Y, clippingInterval=None):
     if clippingInterval is not None:
         minY, maxY = clippingInterval[0], clippingInterval[1]
         yValues = np.clip(yValues, minY, maxY)
+    # the other functions of the module do not need Qt (cf. bLUeTop.rawStages)
+    from PySide2.QtCore import QPointF
     return [QPointF(x, y) for x, y in zip(xValues, yValues)]
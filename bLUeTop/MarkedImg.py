@@ -20,6 +20,8 @@ from os import path
 
 import numpy as np
 import gc
+import threading
+from itertools import count
 
 from PIL.ImageCms import ImageCmsProfile
 from PySide2.QtCore import Qt, QSize, QPoint, QPointF, QFileInfo
@@ -32,10 +34,13 @@ from PySide2.QtWidgets import QApplication
 from PySide2.QtGui import QPixmap, QImage, QPainter
 from PySide2.QtCore import QRect
 
+from bLUeCore.bLUeLUT3D import LUT3D, HaldArray
 from bLUeCore.demosaicing import demosaic
-from bLUeGui.blend import blendLuminosityBuf, blendColorBuf
+from bLUeCore.outputCache import outputCache, paramDigest
+from bLUeGui.blendBuf import blendLuminosityBuf, blendColorBuf
 from bLUeTop import exiftool
-from bLUeGui.memory import weakProxy
+from bLUeGui.graphicsForm import FormParamsError
+from bLUeGui.memory import weakProxy, memoryManager, MemoryManager
 from bLUeTop.cloning import contours, moments, seamlessClone
 
 from bLUeTop.colorManagement import icc, cmsConvertQImage
@@ -45,9 +50,11 @@ from time import time
 
 from bLUeTop.lutUtils import LUT3DIdentity
 from bLUeGui.baseSignal import baseSignal_bool, baseSignal_Int2, baseSignal_No
-from bLUeTop.rawProcessing import rawRead
-from bLUeTop.settings import COLOR_MANAGE_OPT
-from bLUeTop.utils import qColorToRGB, historyList
+from bLUeTop.rawStages import rawRead
+from bLUeTop.settings import COLOR_MANAGE_OPT, USE_LAYER_FUSION, USE_ASYNC_STACK, USE_DIRTY_RECTS, \
+    USE_PREVIEW_PYRAMID, USE_PROGRESSIVE_RENDER, USE_LINEAR_LIGHT
+from bLUeTop.stackWorker import getStackWorker, waitStackWorker, deferToGui, isStackWorkerIdle, isStackWorkerThread
+from bLUeTop.utils import qColorToRGB, historyList, UDict
 
 from bLUeTop.versatileImg import vImage
 
@@ -66,6 +73,12 @@ class mImage(vImage):
     To correctly render a mImage, widgets should override their
     paint event handler.
     """
+    ################
+    # min preview size :
+    # max(width, height) of the coarsest pyramid level
+    minPreviewSize = 512
+    ################
+
     @staticmethod
     def restoreMeta(srcFile, destFile, defaultorientation=True, thumbfile=None):
         """
@@ -93,9 +106,41 @@ class mImage(vImage):
         # as updatePixmap() uses layersStack, the latter must be initialized
         # before the call to super(). __init__()
         self.layersStack = []
+        # offscreen images (tiles and statistics images of tiled rendering)
+        # build neither pixmaps nor histograms (cf. bLUeTop.tiledLayers)
+        self.offscreen = kwargs.pop('offscreen', False)
+        # global statistics of layers : None, 'record' (layers record them
+        # in QLayer.stats) or 'use' (layers use the recorded values)
+        self.statsMode = None
+        # position of the image in the whole image and size of the
+        # whole image, for tiles (cf. bLUeTop.tiledLayers)
+        self.tileOrigin, self.fullSize = (0, 0), None
+        # resolution pyramid of the background layer : level k is
+        # scaled by 1/2**k. Previews are evaluated at level previewLevel (cf. getPyramidLevel())
+        self.pyramid = []
+        self.previewLevel = 0
+        # visible region (full size image coordinates) and region where the
+        # previews are up to date, or None for the whole image (cf. updatePreview())
+        self.viewport, self.validRect = None, None
+        # progressive rendering (cf. useThumb and StackWorker) :
+        # previewMode is the preview flag set by the user, refined is True when the full
+        # resolution image is up to date and shown instead of the preview, refineFrom is the lowest
+        # layer modified since the last refinement, and renderStamp identifies the last modification.
+        self.previewMode, self.refined = False, False
+        self.refineFrom, self.renderStamp = None, 0
+        # thread evaluating the stack at full resolution
+        self.refiningThread = None
+        # parameters of the layer forms used by the stack worker,
+        # keyed by the ids of the layer views (cf. QLayer.getFormParams())
+        self.formParams = {}
+        # 3D LUTs compiled from runs of color only layers (None if the run
+        # cannot be fused), keyed by the ids and the parameter stamps of
+        # the layers of the run (cf. getFusedLUT())
+        self.fusedLUTs = {}
         # link to QLayerView instance
         self.layerView = None
         super().__init__(*args, **kwargs)  # must be done before prLayer init.
+        self.previewLevel = self.defaultPreviewLevel()
         self.onActiveLayerChanged = lambda: 0
         # background layer
         bgLayer = QLayer.fromImage(self, parentImage=self)
@@ -112,6 +157,23 @@ class mImage(vImage):
         # link to rawpy instance
         self.rawImage = None
 
+    @property
+    def useThumb(self):
+        """
+        Preview flag, as seen by the current thread. It is False
+        when the preview was replaced by the full resolution image, and for
+        the thread computing the latter (cf. StackWorker).
+        @return:
+        @rtype: boolean
+        """
+        if not self.previewMode or self.refined:
+            return False
+        return threading.current_thread() is not self.refiningThread
+
+    @useThumb.setter
+    def useThumb(self, value):
+        self.previewMode, self.refined = value, False
+
     @property
     def colorTransformation(self):
         """
@@ -281,6 +343,179 @@ class mImage(vImage):
         # recalculate the whole stack
         self.layerStack[0].apply()
 
+    def initThumb(self):
+        """
+        Overrides vImage.initThumb : the thumbnail is the
+        current level of the resolution pyramid. At level 0,
+        the thumbnail aliases the image (no copy).
+        """
+        self.thumb = self if self.previewLevel == 0 else self.getPyramidLevel(self.previewLevel).copy()
+
+    def getPyramidLevel(self, level):
+        """
+        Returns the background layer scaled by 1/2**level.
+        Levels are built on demand, each one from the next finer level.
+        @param level:
+        @type level: int
+        @return:
+        @rtype: QImage
+        """
+        if not self.pyramid:
+            self.pyramid.append(self.layersStack[0])
+        while len(self.pyramid) <= level:
+            finer = self.pyramid[-1]
+            w, h = (finer.width() + 1) // 2, (finer.height() + 1) // 2
+            buf = cv2.resize(QImageBuffer(finer), (w, h), interpolation=cv2.INTER_AREA)
+            self.pyramid.append(ndarrayToQImage(buf, format=QImage.Format_ARGB32))
+        return self.pyramid[level]
+
+    def previewLevelFor(self, r):
+        """
+        Returns the coarsest pyramid level covering the display
+        resolution, for a display scale r. The max size of
+        levels is bounded below by minPreviewSize.
+        @param r: display scale (cf. resize_coeff())
+        @type r: float
+        @return:
+        @rtype: int
+        """
+        s0 = max(self.width(), self.height())
+        s, level = s0, 0
+        while (s + 1) // 2 >= max(s0 * r, self.minPreviewSize):
+            s = (s + 1) // 2
+            level += 1
+        return level
+
+    def defaultPreviewLevel(self):
+        """
+        Returns the finest pyramid level fitting into thumbSize.
+        It is used until the display scale is known.
+        @return:
+        @rtype: int
+        """
+        s, level = max(self.width(), self.height()), 0
+        while s > self.thumbSize:
+            s = (s + 1) // 2
+            level += 1
+        return level
+
+    def hasScaledPreview(self):
+        """
+        Returns True if the current images are scaled previews.
+        In preview mode, at level 0 of the pyramid, the
+        previews have the size of the full image.
+        @return:
+        @rtype: boolean
+        """
+        return self.useThumb and self.previewLevel > 0
+
+    def getViewport(self):
+        """
+        Returns the region of the full resolution preview to evaluate, or None if the
+        whole preview must be evaluated. The evaluation is restricted to the
+        visible region if all visible layers compute their output by regions
+        (cf. QLayer.dirtyRectAware), without selection or offset.
+        @return:
+        @rtype: QRect or None
+        """
+        if (not (USE_PREVIEW_PYRAMID and USE_DIRTY_RECTS) or self.hasScaledPreview() or not self.useThumb
+                or self.viewport is None):
+            return None
+        for layer in self.layersStack[1:]:
+            if layer.visible and not (layer.dirtyRectAware and layer.getTileHaloRadius() is not None):
+                return None
+        return self.viewport
+
+    def getRefineStart(self):
+        """
+        Progressive rendering : returns the lowest layer whose full resolution
+        output is out of date, or None if there is no need to refine the preview.
+        @return:
+        @rtype: QLayer or None
+        """
+        if (not (USE_PROGRESSIVE_RENDER and USE_ASYNC_STACK) or not self.previewMode or self.refined
+                or self.refineFrom is None or self.offscreen or self.useHald):
+            return None
+        start = self.refineFrom
+        if not any(layer is start for layer in self.layersStack):
+            # removed layer
+            start = self.layersStack[0]
+        return start
+
+    def refine(self):
+        """
+        Progressive rendering : waits for the running refinement, if any,
+        and brings the full resolution image up to date, evaluating the
+        stack in the calling (GUI) thread if needed.
+        """
+        waitStackWorker(cancelRefine=False)
+        start = self.getRefineStart()
+        if start is None:
+            return
+        try:
+            QApplication.setOverrideCursor(Qt.WaitCursor)
+            QApplication.processEvents()
+            self.refined = True
+            start.evaluateStack()
+            self.refineFrom = None
+        except Exception:
+            self.refined = False
+            raise
+        finally:
+            QApplication.restoreOverrideCursor()
+            QApplication.processEvents()
+        self.onImageChanged()
+
+    def purgeThumbs(self):
+        """
+        Resets the thumbnails of the stack. They are rebuilt
+        at the current preview level by the next evaluation.
+        """
+        waitStackWorker()
+        self.thumb = None
+        for layer in self.layersStack + [self.prLayer]:
+            layer.thumb = None
+            layer.maskedThumbContainer = None
+            memoryManager.unregister(layer, 'maskedThumbContainer')
+            layer.inputAlias.pop(True, None)
+            layer.rPixmap = None
+
+    def updatePreview(self, r, visible):
+        """
+        Selects the preview level matching the display scale r and,
+        in preview mode, updates the preview if needed. At level 0, the evaluation is restricted
+        to a neighbourhood of the visible region, when possible (cf. getViewport()),
+        and the stack is evaluated again when the visible region leaves the region
+        already evaluated. Called by the image label when zooming or panning.
+        @param r: display scale (cf. resize_coeff())
+        @type r: float
+        @param visible: visible region (full size image coordinates)
+        @type visible: QRect
+        """
+        if not USE_PREVIEW_PYRAMID:
+            return
+        # evaluate a margin around the visible region, to limit the
+        # count of evaluations while panning
+        mx, my = visible.width() // 4, visible.height() // 4
+        self.viewport = visible.adjusted(-mx, -my, mx, my).intersected(QRect(0, 0, self.width(), self.height()))
+        level = self.previewLevelFor(r)
+        if level != self.previewLevel:
+            self.purgeThumbs()
+            self.previewLevel = level
+            self.validRect = None
+            if self.useThumb:
+                # the full resolution image is not modified (cf. progressive rendering)
+                refineFrom = self.refineFrom
+                self.layersStack[0].applyToStack()
+                self.refineFrom = refineFrom
+        elif self.useThumb and self.validRect is not None and not self.validRect.contains(visible):
+            viewport = self.getViewport()
+            if viewport is not None:
+                self.validRect = QRect(viewport)
+                refineFrom = self.refineFrom
+                self.layersStack[0].applyToStack(rect=viewport)
+                self.refineFrom = refineFrom
+
     def updatePixmap(self):
         """
         Update the presentation layer only.
@@ -309,6 +544,7 @@ class mImage(vImage):
         @return: the layer added
         @rtype: QLayer
         """
+        waitStackWorker()
         # build a unique name
         usedNames = [l.name for l in self.layersStack]
         a = 1
@@ -337,8 +573,94 @@ class mImage(vImage):
     def removeLayer(self, index=None):
         if index is None:
             return
+        waitStackWorker()
         self.layersStack.pop(index)
 
+    def getFusedLUT(self, run):
+        """
+        Compile a run of color only layers (cf. QLayer.getFusedRun())
+        into a single 3D LUT, by pushing an identity hald through the run.
+        The LUT is cached until the parameters (QLayer.paramStamp)
+        or the members of the run change.
+        Return None if a layer of the run cannot be applied to a hald
+        (e.g. contrast correction using CLAHE). Failures are cached too,
+        so the fusion is tried again only when the parameters change.
+        @param run: adjacent visible layers, bottom to top
+        @type run: list of QLayer
+        @return: 3D LUT
+        @rtype: LUT3D or None
+        """
+        key = tuple((id(layer), layer.paramStamp) for layer in run)
+        if key in self.fusedLUTs:
+            return self.fusedLUTs[key]
+        lower = self.layersStack[run[0].getLowerVisibleStackIndex()]
+        lut = None
+        useHald, isHald = self.useHald, self.isHald
+        try:
+            self.useHald, self.isHald = True, True
+            # reset the input hald to identity
+            lower.initHald()
+            for layer in run:
+                layer.execute(l=layer)
+            hArray = HaldArray(QImageBuffer(run[-1].getHald()), LUT3DIdentity.size)
+            lut = LUT3D.HaldBuffer2LUT3D(hArray)
+        except ValueError:
+            pass
+        finally:
+            self.useHald, self.isHald = useHald, isHald
+            # pixmaps were built from halds
+            for layer in run:
+                layer.rPixmap, layer.rImage = None, None
+        # drop the LUTs of the run for previous parameters
+        members = tuple(k[0] for k in key)
+        for k in [k for k in self.fusedLUTs if tuple(i for i, _ in k) == members]:
+            del self.fusedLUTs[k]
+        self.fusedLUTs[key] = lut
+        return lut
+
+    def getFusedMatrix(self, run):
+        """
+        Fold a run of linear light layers (cf. QLayer.getFusedRun()) into
+        a single 3x3 matrix, the product of the matrices of the layers (cf. QLayer.getLinearMatrix()).
+        Each layer clips its linear output to 0..1. Hence, the run is folded only
+        if the intermediate values cannot leave this range : the product of the
+        matrices of the lower layers must have non negative coefficients and row sums <= 1.
+        Otherwise, or if a layer of the run has no matrix, None is returned, and the
+        run is fused into a 3D LUT (cf. getFusedLUT()).
+        @param run: adjacent visible layers, bottom to top
+        @type run: list of QLayer
+        @return:
+        @rtype: ndarray, shape (3, 3) or None
+        """
+        M = np.identity(3)
+        for i, layer in enumerate(run):
+            m = layer.getLinearMatrix()
+            if m is None:
+                return None
+            if i > 0 and (np.any(M < 0) or np.any(M.sum(axis=1) > 1.0 + 1e-6)):
+                return None
+            M = m @ M
+        return M
+
+    def getStackParams(self):
+        """
+        Return the parameters of the visible adjustment layers, from
+        bottom to top, for headless processing (cf. bLUeTop.pipeline.saveStack()).
+        Raise ValueError if a visible layer is not supported by the pipeline,
+        or is masked, blended or translated.
+        @return:
+        @rtype: list of dataclass
+        """
+        stack = []
+        for layer in self.layersStack[1:]:
+            if not layer.visible:
+                continue
+            params = layer.getParams()
+            if params is None or not layer.outputIsComposite():
+                raise ValueError('Layer %s cannot be processed headless' % layer.name)
+            stack.append(params)
+        return stack
+
     def addAdjustmentLayer(self, layerType=None, name='', role='', index=None, sourceImg=None):
         """
         Adds an adjustment layer to the layer stack, at
@@ -377,7 +699,8 @@ class mImage(vImage):
         self.addLayer(layer, name=name, index=index + 1)
         # init thumb
         if layer.parentImage.useThumb:
-            layer.thumb = layer.inputImg().copy()
+            # at level 0, the thumbnail aliases the layer (cf. QLayer.initThumb())
+            layer.thumb = layer.inputImg().copy() if layer.parentImage.hasScaledPreview() else layer
         """
         group = self.layersStack[index].group
         if group:
@@ -433,6 +756,7 @@ class mImage(vImage):
         @return: image
         @rtype: QImage
         """
+        waitStackWorker()
         # init a new image
         img = QImage(self.width(), self.height(), self.format())
         # Image may contain transparent pixels, hence we
@@ -462,9 +786,11 @@ class mImage(vImage):
         def transparencyCheck(buf):
             if np.any(buf[:, :, 3] < 255):
                 dlgWarn('Transparency will be lost. Use PNG format instead')
-        # don't save thumbnails
+        # progressive rendering : get the full resolution image
+        self.refine()
+        # in preview mode, the full size image is rendered by tiles
         if self.useThumb:
-            return None
+            return self.__saveTiled(filename, transparencyCheck, quality=quality, compression=compression)
         # get the final image from the presentation layer.
         # This image is NOT color managed (prLayer.qPixmap
         # only is color managed)
@@ -507,6 +833,102 @@ class mImage(vImage):
             raise IOError("Cannot write file %s " % filename)
         return thumb
 
+    def canRenderTiled(self):
+        """
+        Return True if the visible layers of the stack can be
+        evaluated by tiles (cf. bLUeTop.tiledRender), to save
+        the image in preview mode.
+        @return:
+        @rtype: boolean
+        """
+        return self.__getTiledStack() is not None or \
+            all(layer.getTileHaloRadius() is not None for layer in self.layersStack[1:] if layer.visible)
+
+    def __getTiledStack(self):
+        """
+        Return the parameters of the visible layers if the stack
+        can be run tile by tile by the pipeline (cf. bLUeTop.tiledRender.StackRenderer), or None.
+        @return:
+        @rtype: list of dataclass or None
+        """
+        from bLUeTop.pipeline import getHaloRadius
+        try:
+            stack = self.getStackParams()
+        except ValueError:
+            return None
+        if any(getHaloRadius(params) is None for params in stack):
+            return None
+        return stack
+
+    def __saveTiled(self, filename, transparencyCheck, quality=-1, compression=-1):
+        """
+        Evaluates the stack tile by tile at full size, and writes the
+        result to a file, without evaluating the stack at full size.
+        When the pipeline supports all visible layers, tiles are
+        read from the background image and no layer image is used : memory
+        is bounded by the tile size (cf. StackRenderer). Otherwise, tiles are
+        evaluated with copies of the full size layers (cf. bLUeTop.tiledLayers).
+        Returns a thumbnail with standard size.
+        Raises IOError if the stack cannot be rendered by tiles or if the saving fails.
+        @param filename:
+        @type filename: str
+        @param transparencyCheck:
+        @type transparencyCheck: function
+        @param quality: integer value in range 0..100, or -1
+        @type quality: int
+        @param compression: integer value in range 0..9, or -1
+        @type compression: int
+        @return: thumbnail of the saved image
+        @rtype: QImage
+        """
+        from bLUeTop.pipeline import ApplyContext
+        from bLUeTop.tiledRender import StackRenderer, getWriter
+        from bLUeTop.tiledLayers import LayerTiledRenderer
+        fileFormat = filename[-3:].upper()
+        if fileFormat not in ['JPG', 'PNG', 'TIF']:
+            raise IOError("Invalid File Format\nValid formats are jpg, png, tif ")
+        w, h = self.width(), self.height()
+        x, y = 0, 0
+        if self.isCropped:
+            x, y = int(self.cropLeft), int(self.cropTop)
+            w, h = w - x - int(self.cropRight), h - y - int(self.cropBottom)
+        stack = self.__getTiledStack()
+        try:
+            if stack is not None:
+                ctx = ApplyContext(RGB_lin2XYZ=self.RGB_lin2XYZ, RGB_lin2XYZInverse=self.RGB_lin2XYZInverse)
+                renderer = StackRenderer(stack, QImageBuffer(self.layersStack[0]), ctx=ctx)
+                rect = (x, y, w, h)
+            else:
+                renderer = LayerTiledRenderer(self)
+                rect = QRect(x, y, w, h)
+        except ValueError as e:
+            raise IOError('%s\nUncheck Preview mode before saving' % str(e))
+        # global statistics and downsampled image
+        renderer.computeStats()
+        preview = renderer.preview
+        if stack is None:
+            preview = QImageBuffer(preview)
+        # crop rectangle in preview coordinates
+        r = preview.shape[1] / self.width()
+        px, py = int(x * r), int(y * r)
+        preview = preview[py:py + max(int(h * r), 1), px:px + max(int(w * r), 1)]
+        if fileFormat != 'PNG':
+            transparencyCheck(preview)
+        writer = getWriter(filename, w, h, quality=compression if fileFormat == 'PNG' else quality)
+        try:
+            renderer.render(writer, rect=rect)
+        except Exception:
+            writer.abort()
+            raise
+        writer.close()
+        # build thumbnail from the downsampled image
+        if w > h:
+            wt, ht = 160, 120
+        else:
+            wt, ht = 120, 160
+        return ndarrayToQImage(np.ascontiguousarray(preview[:, :, :3][:, :, ::-1]),
+                               format=QImage.Format_RGB888).scaled(wt, ht, Qt.KeepAspectRatio)
+
 
 class imImage(mImage):
     """
@@ -623,6 +1045,9 @@ class imImage(mImage):
             elif orientation == 8:  # 270°
                 img.demosaic = np.swapaxes(img.demosaic, 0, 1)
                 img.demosaic = img.demosaic[:, ::-1, :]
+            # rawBuf holds the image data : it is accounted only
+            memoryManager.register(img, 'rawBuf', rawBuf, policy=MemoryManager.KEEP)
+            memoryManager.register(img, 'demosaic', img.demosaic, policy=MemoryManager.SPILL)
         else:
             raise ValueError("Cannot read file %s" % f)
         if img.isNull():
@@ -715,6 +1140,10 @@ class QLayer(vImage):
     """
     Base class for image layers
     """
+    # source of unique stamps, used to version
+    # layer outputs and running composites
+    stamps = count()
+
     @classmethod
     def fromImage(cls, mImg, role='', parentImage=None):
         """
@@ -751,6 +1180,55 @@ class QLayer(vImage):
         ###########################################################
         self.tLayer = self
         self.parentLayer = self
+        # output version, updated by each call to updatePixmap()
+        self.outputStamp = next(QLayer.stamps)
+        # content tokens of the full size (key False) and preview (key True) outputs :
+        # the memoization key of the output, if it was computed or restored by a
+        # memoized evaluation (cf. evaluateStack()), otherwise outputStamp (cf. getOutputToken())
+        self.outputTokens = {}
+        # True if the full size output was skipped by a fused run (cf. getFusedRun()) :
+        # it is recomputed by the next call to getCurrentMaskedImage()
+        self.outputIsStale = False
+        # parameters version, updated by each call to applyToStack()
+        self.paramStamp = next(QLayer.stamps)
+        # (paramStamp, form parameters) or (None, None) (cf. getFormParams())
+        self.formParamsCache = (None, None)
+        # source image of rPixmap, set when the pixmap
+        # is deferred to the GUI thread (cf. updatePixmap())
+        self.rImage = None
+        # (previous outputStamp, rect) if the last call to updatePixmap() modified
+        # the output inside rect only, otherwise None
+        self.outputDirty = None
+        # Locality of the layer transformation : None if the output depends on the
+        # whole input image, otherwise the max distance between an output pixel and the
+        # input pixels it depends on (0 for pointwise transformations). Color only
+        # layers are pointwise. haloRadius is None, an int or a function returning an int.
+        self.haloRadius = None
+        # True if execute() restricts its computation to dirtyRect
+        self.dirtyRectAware = False
+        # selection rectangle used by the last evaluation
+        self.evalSelection = None
+        # True if the transformation depends on statistics of the whole
+        # input image (histogram, max...). globalStats is a boolean or a function returning
+        # a boolean. Once their statistics are imposed, these layers are
+        # pointwise (cf. getTileHaloRadius()).
+        self.globalStats = False
+        # global statistics recorded or imposed by tiled rendering (cf. mImage.statsMode)
+        self.stats = None
+        # Color only layers apply a pointwise color transformation, independent
+        # of image contents, so they can be fused into a 3D LUT (cf. getFusedRun()).
+        # colorOnly is a boolean or a function returning a boolean.
+        self.colorOnly = False
+        # Linear light layers transform the linear RGB values of their input. Adjacent
+        # linear light layers share a float buffer of linear values (cf. getLinearInput()), and
+        # runs of linear light layers with a matrix are folded (cf. mImage.getFusedMatrix()).
+        # linearLight is a boolean or a function returning a boolean.
+        self.linearLight = False
+        # (outputStamp, linear RGB values of the output) or None (cf. setLinearOutput())
+        self.linearOutput = None
+        # input images aliased by the output of the layer at its neutral point,
+        # for full size images (key False) and previews (key True) (cf. forwardInput())
+        self.inputAlias = {}
         self.modified = False
         self.name = 'noname'
         self.visible = True
@@ -795,24 +1273,56 @@ class QLayer(vImage):
     def mask(self):  # the setter is inherited from bImage
         if self._mask is None:
             if type(self) not in [QPresentationLayer]:
-                self._mask = QImage(self.width(), self.height(), QImage.Format_ARGB32)
+                mask = QImage(self.width(), self.height(), QImage.Format_ARGB32)
                 # default : unmask all
-                self._mask.fill(self.defaultColor_UnMasked)
+                mask.fill(self.defaultColor_UnMasked)
+                self.mask = mask
         return self._mask
 
     @mask.setter
     def mask(self, m):
         self._mask = m
+        # accounted only, as layer images (cf. vImage.__init__())
+        memoryManager.register(self, 'mask', m, policy=MemoryManager.KEEP)
 
-    def getGraphicsForm(self):
+    def getGraphicsForm(self, live=False):
         """
-        Return the graphics form associated with the layer
+        Return the graphics form associated with the layer.
+        The stack worker thread reads the form parameters (cf. getFormParams()) :
+        it gets the form only if live is True, and the form must then be used
+        for deferred GUI calls only (cf. deferToGui()). Otherwise, FormParamsError is raised.
+        @param live:
+        @type live: boolean
         @return:
         @rtype: QWidget
         """
-        if self.view is not None:
-            return self.view.widget()
-        return None
+        if not live and isStackWorkerThread():
+            raise FormParamsError('layer %s : the stack worker must read the form parameters' % self.name)
+        if self.view is None:
+            return None
+        return self.view.widget()
+
+    def getFormParams(self):
+        """
+        Return the parameters of the graphics form associated with the layer
+        (cf. FormParams), or None. In the GUI thread, they are recorded again
+        if the layer parameters were modified (cf. paramStamp). The stack worker thread
+        reads the parameters recorded when the evaluation was requested (cf. StackWorker.request()).
+        @return:
+        @rtype: FormParams
+        """
+        if self.view is None:
+            return None
+        if isStackWorkerThread():
+            return self.parentImage.formParams.get(id(self.view))
+        form = self.view.widget()
+        if form is None:
+            return None
+        stamp, params = self.formParamsCache
+        if stamp != self.paramStamp:
+            params = form.getFormParams()
+            self.formParamsCache = (self.paramStamp, params)
+        return params
 
     def closeView(self, delete=False):
         """
@@ -858,17 +1368,14 @@ class QLayer(vImage):
 
     def getMmcSpline(self):
         """
-        Returns the spline used for multimode contrast
+        Returns the parameters a, b, d, T of the spline used for multimode contrast
         correction if it is initialized, and None otherwise.
         @return:
-        @rtype: activeSpline
+        @rtype: 4-uple or None
         """
-        # get layer graphic form
-        grf = self.getGraphicsForm()
-        # manual curve form
-        if grf.contrastForm is not None:
-            return grf.contrastForm.scene().cubicItem
-        return None
+        # get layer graphic form parameters
+        grf = self.getFormParams()
+        return grf.getContrastCurve()
 
     def addTool(self, tool):
         """
@@ -924,17 +1431,78 @@ class QLayer(vImage):
         tLayer.view = self.view
         tLayer.visible = self.visible
         tLayer.execute = self.execute
+        tLayer.colorOnly = self.colorOnly
+        tLayer.linearLight = self.linearLight
         tLayer.mask = self.mask.transformed(transformation)
         tLayer.maskIsEnabled, tLayer.maskIsSelected = self.maskIsEnabled, self.maskIsSelected
         return tLayer
 
-    def initThumb(self):
+    def bCropped(self, rect, parentImage, size=None):
         """
-        Override vImage.initThumb, to set the parentImage attribute
+        Return a copy of the region rect of the layer, scaled to size, for the
+        offscreen image parentImage (cf. bLUeTop.tiledLayers). The copy shares the
+        graphic form and the execute() method of the layer.
+        @param rect: region (full size image coordinates)
+        @type rect: QRect
+        @param parentImage:
+        @type parentImage: mImage
+        @param size: default rect.size()
+        @type size: QSize
+        @return:
+        @rtype: QLayer
+        """
+        if size is None:
+            size = rect.size()
+        cLayer = type(self)(QImg=self.copy(rect).scaled(size), role=self.role, parentImage=parentImage)
+        cLayer.parentImage = parentImage
+        # copy dynamic attributes, as bTransformed() does
+        for a in self.__dict__.keys():
+            if a not in cLayer.__dict__.keys():
+                cLayer.__dict__[a] = self.__dict__[a]
+        for a in ('name', 'actionName', 'view', 'visible', 'execute', 'colorOnly', 'linearLight', 'haloRadius',
+                  'dirtyRectAware', 'globalStats', 'opacity', 'compositionMode', 'isClipping', 'maskIsEnabled', 'maskIsSelected',
+                  'colorMaskOpacity'):
+            setattr(cLayer, a, getattr(self, a))
+        if hasattr(self, 'autoSpline'):
+            cLayer.autoSpline = self.autoSpline
+        if self.mask is not None:
+            cLayer.mask = self.mask.copy(rect).scaled(size)
+        return cLayer
+
+    def initThumb(self):
         """
-        super().initThumb()
+        Override vImage.initThumb. The thumbnail is sized as
+        the current level of the resolution pyramid of parentImage.
+        The thumbnail of the background layer is a copy of this level.
+        At level 0, previews have the size of the full image : the thumbnail
+        aliases the layer itself, so that no full size copy is allocated.
+        Previews are then evaluated in place, and the full resolution
+        output is brought up to date by the next refinement (cf. mImage.refine()).
+        """
+        img = self.parentImage
+        if img.previewLevel == 0:
+            self.thumb = self
+            return
+        level = img.getPyramidLevel(img.previewLevel)
+        if img.layersStack[0] is self:
+            self.thumb = level.copy()
+        else:
+            scImg = self.scaled(level.size(), Qt.IgnoreAspectRatio, Qt.SmoothTransformation)
+            # With the Qt.SmoothTransformation flag, the output image format is premultiplied
+            self.thumb = scImg.convertToFormat(QImage.Format_ARGB32, Qt.DiffuseDither | Qt.DiffuseAlphaDither)
         self.thumb.parentImage = self.parentImage
 
+    def setImage(self, qimg):
+        """
+        Override vImage.setImage : the resolution pyramid
+        is reset when the background layer is modified.
+        @param qimg: image
+        @type qimg: QImage
+        """
+        if self.parentImage.layersStack and self.parentImage.layersStack[0] is self:
+            self.parentImage.pyramid = []
+        super().setImage(qimg)
+
     def initHald(self):
         """
         Build a hald image (as a QImage) from identity 3D LUT.
@@ -944,7 +1512,8 @@ class QLayer(vImage):
         s = int(LUT3DIdentity.size ** (3.0 / 2.0)) + 1
         buf0 = LUT3DIdentity.toHaldArray(s, s).haldBuffer
         # self.hald = QLayer(QImg=QImage(QSize(190,190), QImage.Format_ARGB32))
-        self.hald = QImage(QSize(s, s), QImage.Format_ARGB32)
+        # bImage provides the color space buffers used by layers
+        self.hald = bImage(QSize(s, s), QImage.Format_ARGB32)
         buf1 = QImageBuffer(self.hald)
         buf1[:, :, :3] = buf0
         buf1[:, :, 3] = 255
@@ -955,7 +1524,7 @@ class QLayer(vImage):
             s = int(LUT3DIdentity.size ** (3.0 / 2.0)) + 1
             buf0 = LUT3DIdentity.toHaldArray(s, s).haldBuffer
             # self.hald = QLayer(QImg=QImage(QSize(190,190), QImage.Format_ARGB32))
-            hald = QImage(QSize(s, s), QImage.Format_ARGB32)
+            hald = bImage(QSize(s, s), QImage.Format_ARGB32)
             buf1 = QImageBuffer(hald)
             buf1[:, :, :3] = buf0
             buf1[:, :, 3] = 255
@@ -978,11 +1547,70 @@ class QLayer(vImage):
         """
         if self.parentImage.useHald:
             return self.getHald()
+        alias = self.getInputAlias()
+        if alias is not None:
+            return alias
         if self.parentImage.useThumb:
             return self.getThumb()
         else:
             return self
 
+    def getInputAlias(self):
+        """
+        Return the input image aliased by the output of
+        the layer (cf. forwardInput()), or None.
+        @return:
+        @rtype: bImage or None
+        """
+        img = self.parentImage
+        if img.useHald or img.isHald:
+            return None
+        useThumb = img.useThumb
+        alias = self.inputAlias.get(useThumb)
+        if alias is None:
+            return None
+        own = self.getThumb() if useThumb else self
+        if alias.width() != own.width() or alias.height() != own.height():
+            return None
+        return alias
+
+    def forwardInput(self, inputImage=None):
+        """
+        Neutral point : set the output of the layer to its input image.
+        The input image is not copied : the output of the layer aliases
+        it (cf. getCurrentImage()), and the layer is skipped when composites
+        are built (cf. getCurrentMaskedImage()). The alias is removed before the
+        next modification of the output (copy on write, cf. endPassThrough()).
+        Halds are copied.
+        @param inputImage: default self.inputImg()
+        @type inputImage: bImage
+        """
+        img = self.parentImage
+        if inputImage is None:
+            inputImage = self.inputImg()
+        if img.useHald or img.isHald:
+            QImageBuffer(self.getCurrentImage())[...] = QImageBuffer(inputImage)
+        else:
+            self.inputAlias[img.useThumb] = inputImage
+        self.updatePixmap()
+
+    def endPassThrough(self, rect=None):
+        """
+        Copy on write : remove the alias of the input image, if any (cf. forwardInput()).
+        Must be called before modifying the output of the layer. If rect
+        is not None, only this region of the output is going to be
+        modified : the input image is copied to the output first.
+        @param rect: modified region (full size image coordinates)
+        @type rect: QRect
+        """
+        img = self.parentImage
+        if img.useHald or img.isHald:
+            return
+        alias = self.getInputAlias()
+        self.inputAlias.pop(img.useThumb, None)
+        if alias is not None and rect is not None:
+            QImageBuffer(self.getCurrentImage())[...] = QImageBuffer(alias)
+
     def inputImg(self, redo=True):
         """
         return maskedImageContainer/maskedThumbContainer.
@@ -1050,78 +1678,343 @@ class QLayer(vImage):
         For convenience, mainly to be able to use its color space buffers,
         the built image is of type bImage. It is drawn on a container image,
         instantiated only once.
+        The container holds a running composite : it is built by blending
+        self over the composite of the next lower visible layer. It is
+        stamped, and it is redrawn only if the stamp of the lower composite,
+        the output stamp of self, or the blending parameters of self have changed
+        since the last call. Thus, a modification of a layer forces the rebuilding
+        of the composites at or above it only.
+        If the lower composite and the output of self have changed inside
+        known rectangles only (cf. compositeDirty and outputDirty), the
+        container is redrawn inside the union of these rectangles.
+        Hidden layers and layers at their neutral point have no container : the
+        composite of the lower stack is returned.
         @return: masked image
         @rtype: bImage
         """
-        # init containers if needed. They are instantiated only
-        # once and updated by drawing.
         if self.parentImage.useHald:
             return self.getHald()
+        if self.outputIsStale and not self.parentImage.useThumb:
+            # skipped by a fused run : recompute the output
+            # from the (recursively refreshed) lower stack
+            self.outputIsStale = False
+            self.execute(l=self)
+        # get the (recursively updated) composite of the lower stack
+        ind = self.getLowerVisibleStackIndex()
+        lower = self.parentImage.layersStack[ind].getCurrentMaskedImage() if ind >= 0 else None
+        if self.parentImage.useThumb:
+            name = 'maskedThumbContainer'
+        else:
+            name = 'maskedImageContainer'
+        if lower is not None and (not self.visible
+                                  or (self.getInputAlias() is lower and self.outputIsComposite())):
+            # hidden layer, or layer at its neutral point (cf. forwardInput()) :
+            # the composite is the lower composite, and the container is released
+            if getattr(self, name) is not None:
+                setattr(self, name, None)
+                memoryManager.unregister(self, name)
+            return lower
+        # init containers if needed. They are instantiated only
+        # once and updated by drawing.
         if self.maskedThumbContainer is None:
             self.maskedThumbContainer = bImage.fromImage(self.getThumb(), parentImage=self.parentImage)
+            self.maskedThumbContainer.compositeKey, self.maskedThumbContainer.compositeStamp = None, None
+            self.maskedThumbContainer.compositeDirty, self.maskedThumbContainer.compositeToken = None, None
         if self.maskedImageContainer is None:
             self.maskedImageContainer = bImage.fromImage(self, parentImage=self.parentImage)
-        if self.parentImage.useThumb:
-            img = self.maskedThumbContainer
-        else:
-            img = self.maskedImageContainer
-        # reset the container
-        img.fill(QColor(0,0,0,0))  # TODO added 10/04/20 : needed for (semi-)transparent background - validate
-        # blend lower stack
+            self.maskedImageContainer.compositeKey, self.maskedImageContainer.compositeStamp = None, None
+            self.maskedImageContainer.compositeDirty, self.maskedImageContainer.compositeToken = None, None
+        img = getattr(self, name)
+        key = (None if lower is None else lower.compositeStamp, self.visible, self.outputStamp, self.opacity,
+               self.compositionMode, self.isClipping, self.maskIsEnabled, self.maskIsSelected)
+        if img.compositeKey == key:
+            memoryManager.touch(self, name)
+            return img
+        clip = self.__compositeClip(img.compositeKey, key, lower)
         qp = QPainter(img)
-        top = self.parentImage.getStackIndex(self)
-        bottom = 0
-        for i, layer in enumerate(self.parentImage.layersStack[bottom:top+1]):
-            if layer.visible:
-                if i == 0:
-                    qp.setCompositionMode(QPainter.CompositionMode_Source)
-                    qp.setOpacity(layer.opacity)  # TODO added 10/04/20 : enables semi transparent background layer - validate
-                else:
-                    qp.setOpacity(layer.opacity)
-                    if type(layer.compositionMode) is QPainter.CompositionMode:
-                        qp.setCompositionMode(layer.compositionMode)
-                if layer.rPixmap is None:
-                    layer.rPixmap = QPixmap.fromImage(layer.getCurrentImage())
-                # blend layer
-                if type(layer.compositionMode) is QPainter.CompositionMode:
-                    qp.drawPixmap(QRect(0, 0, img.width(), img.height()), layer.rPixmap)
+        if clip is not None:
+            qp.setClipRect(clip)
+        if lower is None:
+            # reset the container
+            if clip is None:
+                img.fill(QColor(0, 0, 0, 0))  # TODO added 10/04/20 : needed for (semi-)transparent background - validate
+            else:
+                qp.setCompositionMode(QPainter.CompositionMode_Source)
+                qp.fillRect(clip, QColor(0, 0, 0, 0))
+        else:
+            # start from the composite of the lower stack
+            qp.setCompositionMode(QPainter.CompositionMode_Source)
+            qp.drawImage(QRect(0, 0, img.width(), img.height()), lower)
+        if self.visible:
+            if self.getStackIndex() == 0:
+                qp.setCompositionMode(QPainter.CompositionMode_Source)
+                qp.setOpacity(self.opacity)  # TODO added 10/04/20 : enables semi transparent background layer - validate
+            else:
+                qp.setOpacity(self.opacity)
+                if type(self.compositionMode) is QPainter.CompositionMode:
+                    qp.setCompositionMode(self.compositionMode)
+            # blend layer
+            if type(self.compositionMode) is QPainter.CompositionMode:
+                if self.rImage is not None or threading.current_thread() is not threading.main_thread():
+                    # pixmap not yet built by the GUI thread (cf. updatePixmap())
+                    qp.drawImage(QRect(0, 0, img.width(), img.height()),
+                                 self.rImage if self.rImage is not None else self.getCurrentImage())
                 else:
-                    buf = QImageBuffer(img)[..., :3][..., ::-1]
-                    buf0 = QImageBuffer(layer.getCurrentImage())[..., :3][..., ::-1]
-                    if layer.compositionMode == -1:
-                        buf[...] = blendLuminosityBuf(buf, buf0) * layer.opacity + buf * (1.0 - layer.opacity)
-                    elif layer.compositionMode == -2:
-                        buf[...] = blendColorBuf(buf, buf0)  * layer.opacity + buf * (1.0 - layer.opacity)
-                # clipping
-                if layer.isClipping and layer.maskIsEnabled:
-                    # draw mask as opacity mask
-                    # mode DestinationIn (set dest opacity to source opacity)
-                    qp.setCompositionMode(QPainter.CompositionMode_DestinationIn)
-                    omask = vImage.color2OpacityMask(layer.mask)
-                    qp.drawImage(QRect(0, 0, img.width(), img.height()), omask)
+                    if self.rPixmap is None:
+                        self.rPixmap = QPixmap.fromImage(self.getCurrentImage())
+                    qp.drawPixmap(QRect(0, 0, img.width(), img.height()), self.rPixmap)
+            else:
+                buf = QImageBuffer(img)[..., :3][..., ::-1]
+                buf0 = QImageBuffer(self.getCurrentImage())[..., :3][..., ::-1]
+                if self.compositionMode == -1:
+                    buf[...] = blendLuminosityBuf(buf, buf0) * self.opacity + buf * (1.0 - self.opacity)
+                elif self.compositionMode == -2:
+                    buf[...] = blendColorBuf(buf, buf0) * self.opacity + buf * (1.0 - self.opacity)
+            # clipping
+            if self.isClipping and self.maskIsEnabled:
+                # draw mask as opacity mask
+                # mode DestinationIn (set dest opacity to source opacity)
+                qp.setCompositionMode(QPainter.CompositionMode_DestinationIn)
+                omask = vImage.color2OpacityMask(self.mask)
+                qp.drawImage(QRect(0, 0, img.width(), img.height()), omask)
         qp.end()
+        # the container content has changed : invalidate its color space buffers
+        img.cacheInvalidate()
+        img.compositeDirty = None if clip is None else (img.compositeStamp, clip)
+        img.compositeKey, img.compositeStamp = key, next(QLayer.stamps)
+        # content token : a composite rebuilt from the same lower composite and the
+        # same output gets back its previous token, so that memoized outputs of the upper layers
+        # still match (cf. evaluateStack()). Masks are not versioned : masked composites are unique.
+        lowerToken = None if lower is None else getattr(lower, 'compositeToken', None)
+        if self.maskIsEnabled or (lower is not None and lowerToken is None):
+            img.compositeToken = img.compositeStamp
+        else:
+            img.compositeToken = paramDigest((lowerToken, self.getOutputToken(), self.visible, self.opacity,
+                                              self.compositionMode, self.xOffset, self.yOffset, self.Zoom_coeff,
+                                              img.width(), img.height()))
+        # a released container is rebuilt by the next call
+        memoryManager.register(self, name, img)
         return img
 
-    def applyToStack(self):
+    def __compositeClip(self, oldKey, key, lower):
+        """
+        Return the rectangle to redraw to update a composite built with
+        key oldKey, or None if the whole composite must be redrawn.
+        Stamps are the only parts of the keys that may differ, and
+        each modified stamp must come with a known dirty rectangle.
+        @param oldKey: composite key of the last drawing
+        @type oldKey: tuple
+        @param key: current composite key
+        @type key: tuple
+        @param lower: lower composite
+        @type lower: bImage
+        @return:
+        @rtype: QRect or None
         """
-        Apply new layer parameters and propagate changes to upper layers.
+        if (not USE_DIRTY_RECTS or oldKey is None or self.parentImage.hasScaledPreview()
+                or type(self.compositionMode) is not QPainter.CompositionMode
+                or oldKey[1] != key[1] or oldKey[3:] != key[3:]):
+            return None
+        clip = QRect()
+        for i, dirty in ((0, getattr(lower, 'compositeDirty', None)), (2, self.outputDirty)):
+            if oldKey[i] == key[i]:
+                continue
+            if dirty is None or dirty[0] != oldKey[i]:
+                return None
+            clip = clip.united(dirty[1])
+        return clip
+
+    def applyToStack(self, rect=None):
         """
+        Apply new layer parameters and propagate changes to upper layers.
+        If USE_ASYNC_STACK is set, the evaluation is requested from the stack
+        worker, running in a background thread, and the method returns
+        immediately (cf. StackWorker). Stacks containing cloning layers are
+        evaluated synchronously.
+        If rect is not None, the modification of the layer is known to be local : only
+        the parts of the upper layers and composites depending on rect are recomputed
+        (cf. evaluateStack()). A move of the selection rectangle of a 3D LUT layer is
+        handled the same way.
+        In preview mode, at full resolution, only a neighbourhood of the visible
+        region is evaluated, when possible (cf. mImage.getViewport()).
+        With progressive rendering, the preview is shown again, and the full resolution
+        image is computed later, in the background (cf. StackWorker).
+        @param rect: modified region (full size image coordinates)
+        @type rect: QRect
+        """
+        # layer parameters may have changed
+        self.paramStamp = next(QLayer.stamps)
+        img = self.parentImage
+        wasRefined, img.refined = img.refined, False
+        img.renderStamp = next(QLayer.stamps)
+        if (rect is None and USE_DIRTY_RECTS and (self.is3DLUTLayer() or self.is2DLUTLayer())
+                and self.rect is not None and self.rect == self.evalSelection):
+            # same selection : the modification is confined to it
+            rect = self.rect.adjusted(-1, -1, 1, 1)
+        self.evalSelection = None if self.rect is None else QRect(self.rect)
+        if not USE_DIRTY_RECTS or img.hasScaledPreview():
+            rect = None
+        start = self
+        if wasRefined and img.validRect is not None:
+            # the visible region may have moved while the full resolution image was shown
+            start, img.validRect = img.layersStack[0], None
+        if img.useThumb:
+            viewport = img.getViewport()
+            if viewport is None:
+                if img.validRect is not None:
+                    # previews are up to date inside validRect only : evaluate the whole stack
+                    start, rect = img.layersStack[0], None
+                img.validRect = None
+            elif rect is None:
+                # evaluate the region already up to date in lower layers
+                if img.validRect is None:
+                    img.validRect = QRect(viewport)
+                rect = QRect(img.validRect)
+        else:
+            # previews are not updated
+            img.validRect = None
+        if img.previewMode and (img.refineFrom is None or start.getStackIndex() < img.refineFrom.getStackIndex()):
+            img.refineFrom = start
+        if USE_ASYNC_STACK and threading.current_thread() is threading.main_thread():
+            stack = img.layersStack
+            if not any(l.isCloningLayer() for l in stack[start.getStackIndex():]):
+                getStackWorker().request(start, rect=rect)
+                return
+            waitStackWorker()
+        try:
+            QApplication.setOverrideCursor(Qt.WaitCursor)
+            QApplication.processEvents()
+            start.evaluateStack(rect=rect)
+        finally:
+            self.parentImage.setModified(True)
+            QApplication.restoreOverrideCursor()
+            QApplication.processEvents()
+        if threading.current_thread() is threading.main_thread() and isStackWorkerIdle():
+            memoryManager.enforce()
+
+    def evaluateStack(self, checkpoint=None, rect=None):
+        """
+        Apply the layer and all upper visible layers, and
+        update the presentation layer.
+        Runs of adjacent color only layers are applied as a single
+        3D LUT (cf. getFusedRun()), or, for runs of linear light layers, as a
+        single matrix (cf. mImage.getFusedMatrix()).
+        If checkpoint is not None, checkpoint() is called before
+        each layer. It may raise an exception to cancel the evaluation.
+        If rect is not None, the output of self has changed inside rect only. The
+        region is grown by the halo radius of each upper layer (cf. getHaloRadius()) and
+        upper layers recompute this region only, when possible. A layer depending
+        on the whole input image stops the propagation of the region.
+        Whole image outputs are memoized (cf. outputCache) : the key of an output
+        is made of the content token of the input composite (cf. getCurrentMaskedImage()) and
+        of the parameters of the layer (cf. getParamKey()). On a hit, the cached output
+        is copied, and the layer is not executed. The key becomes the content token of the output
+        (cf. getOutputToken()), so the composites rebuilt from a restored output get back their
+        previous tokens, and the upper layers hit the cache too. Thus, showing again a hidden layer, or
+        restoring previous parameters, only redraws the composites.
+        @param checkpoint:
+        @type checkpoint: function
+        @param rect: modified region (full size image coordinates)
+        @type rect: QRect
+        """
+        img = self.parentImage
+        imgRect = QRect(0, 0, img.width(), img.height())
+        useCache = outputCache.maxBytes > 0 and not (img.offscreen or img.useHald or img.isHald)
+
+        def memoKey(run, rect):
+            # key of the output of run[-1] : content token of the
+            # input composite, input size and parameters of the run
+            if not useCache or rect is not None or run[0].getStackIndex() == 0:
+                return None
+            params = tuple(l.getParamKey() for l in run)
+            if None in params:
+                return None
+            inputImg = run[0].inputImg()
+            token = getattr(inputImg, 'compositeToken', None)
+            if token is None:
+                return None
+            return token, inputImg.width(), inputImg.height(), params
+
+        def restoreOutput(layer, key):
+            buf = outputCache.lookup(key)
+            out = QImageBuffer(layer.getCurrentImage())
+            if buf is None or buf.shape != out.shape:
+                return False
+            out[...] = buf
+            layer.updatePixmap()
+            return True
+
         # recursive function
-        def applyToStack_(layer, pool=None):
+        def applyToStack_(layer, pool=None, rect=None):
+            if checkpoint is not None:
+                checkpoint()
+            run = layer.getFusedRun()
+            if rect is not None and layer is not self:
+                for l in run:
+                    halo = l.getHaloRadius()
+                    if halo is None or l.tLayer is not l:
+                        rect = None
+                        break
+                    rect = rect.adjusted(-halo, -halo, halo, halo).intersected(imgRect)
+            M = layer.parentImage.getFusedMatrix(run) if len(run) > 1 else None
+            lut = layer.parentImage.getFusedLUT(run) if len(run) > 1 and M is None else None
+            if M is not None or lut is not None:
+                # apply the whole run at once
+                start = time()
+                key = memoKey(run, rect)
+                layer = run[-1]
+                layer.dirtyRect = rect
+                layer.endPassThrough(rect if M is None else None)
+                if key is not None and restoreOutput(layer, key):
+                    print("%s (%d fused layers, cached) %.2f" % (layer.name, len(run), time() - start))
+                else:
+                    if M is not None:
+                        layer.applyLinearMatrix(M, inputLayer=run[0])
+                    else:
+                        layer.apply3DLUT(lut, options=UDict(({'keep alpha': True},)), inputImage=run[0].inputImg())
+                    if key is not None:
+                        outputCache.store(key, QImageBuffer(layer.getCurrentImage()))
+                    print("%s (%d fused layers) %.2f" % (layer.name, len(run), time() - start))
+                if key is not None:
+                    layer.setOutputToken(key)
+                layer.cacheInvalidate()
+                # intermediate outputs are recomputed on access only
+                for l in run[:-1]:
+                    l.outputIsStale = True
             # apply transformation
-            if layer.visible:
+            elif layer.visible:
                 start = time()
-                layer.execute(l=layer)
+                if rect is not None and layer is not self and not layer.dirtyRectAware:
+                    # the layer computes its whole output
+                    rect = None
+                layer.dirtyRect = rect
+                layer.endPassThrough(rect if layer.dirtyRectAware else None)
+                key = memoKey(run, rect)
+                cached = key is not None and restoreOutput(layer, key)
+                if cached:
+                    layer.setOutputToken(key)
+                else:
+                    stamp = layer.outputStamp
+                    layer.execute(l=layer)
+                    # execute() may give up without updating the output.
+                    # Neutral layers alias their input (cf. forwardInput())
+                    if key is not None and layer.outputStamp != stamp and layer.getInputAlias() is None:
+                        outputCache.store(key, QImageBuffer(layer.getCurrentImage()))
+                        layer.setOutputToken(key)
                 layer.cacheInvalidate()
-                print("%s %.2f" % (layer.name, time()-start))
+                print("%s%s %.2f" % (layer.name, ' (cached)' if cached else '', time()-start))
+            layer.dirtyRect = None
+            if layer.xOffset != 0 or layer.yOffset != 0:
+                # translated output
+                rect = None
             stack = layer.parentImage.layersStack
             lg = len(stack)
             ind = layer.getStackIndex() + 1
             # update histograms displayed
             # on the layer form, if any
-            if ind < lg:
-                grForm = stack[ind].getGraphicsForm()
-                if grForm is not None:
+            if ind < lg and not layer.parentImage.offscreen:
+                grForm = stack[ind].getGraphicsForm(live=True)
+                if grForm is not None and not deferToGui((id(grForm), 'updateHists'), grForm.updateHists):
                     grForm.updateHists()
             # get next upper visible layer
             while ind < lg:
@@ -1130,17 +2023,18 @@ class QLayer(vImage):
                 ind += 1
             if ind < lg:
                 layer1 = stack[ind]
-                applyToStack_(layer1, pool=pool)
-        try:
-            QApplication.setOverrideCursor(Qt.WaitCursor)
-            QApplication.processEvents()
-            applyToStack_(self, pool=None)
-            # update the presentation layer
-            self.parentImage.prLayer.execute(l=None, pool=None)
-        finally:
-            self.parentImage.setModified(True)
-            QApplication.restoreOverrideCursor()
-            QApplication.processEvents()
+                applyToStack_(layer1, pool=pool, rect=rect)
+            elif not layer.parentImage.offscreen:
+                # update the presentation layer
+                prLayer = layer.parentImage.prLayer
+                if checkpoint is not None:
+                    checkpoint()
+                prLayer.dirtyRect = rect
+                try:
+                    prLayer.execute(l=None, pool=None)
+                finally:
+                    prLayer.dirtyRect = None
+        applyToStack_(self, pool=None, rect=rect)
     """
     def applyToStackIter(self):
         #iterative version of applyToStack
@@ -1175,6 +2069,9 @@ class QLayer(vImage):
     def is3DLUTLayer(self):
         return '3DLUT' in self.role
 
+    def is2DLUTLayer(self):
+        return '2DLUT' in self.role
+
     def isRawLayer(self):
         return 'RAW' in self.role
 
@@ -1187,6 +2084,216 @@ class QLayer(vImage):
     def isMergingLayer(self):
         return 'MERGING' in self.role
 
+    def isColorOnlyLayer(self):
+        return self.colorOnly() if callable(self.colorOnly) else self.colorOnly
+
+    def needsGlobalStats(self):
+        return self.globalStats() if callable(self.globalStats) else self.globalStats
+
+    def isLinearLightLayer(self):
+        return self.linearLight() if callable(self.linearLight) else self.linearLight
+
+    def getLinearMatrix(self):
+        """
+        Return the matrix of the transformation of linear RGB
+        values (cf. abstractForm.getLinearMatrix()), or None.
+        @return:
+        @rtype: ndarray, shape (3, 3) or None
+        """
+        form = self.getFormParams()
+        if form is None or not self.isLinearLightLayer():
+            return None
+        return form.getLinearMatrix()
+
+    def getParams(self):
+        """
+        Return the parameters of the layer transformation
+        (cf. abstractForm.getParams()), or None.
+        @return:
+        @rtype: dataclass or None
+        """
+        form = self.getFormParams()
+        return None if form is None else form.getParams()
+
+    def outputIsComposite(self):
+        """
+        Return True if the layer output is the composite image of the
+        layer and of all lower layers (cf. getCurrentMaskedImage()) : the layer must be
+        a visible, unmasked, opaque layer, with normal blending mode and no selection or offset.
+        @return:
+        @rtype: boolean
+        """
+        return (self.visible and not self.maskIsEnabled and not self.isClipping and self.opacity == 1.0
+                and self.compositionMode == QPainter.CompositionMode_SourceOver
+                and self.rect is None and self.xOffset == 0 and self.yOffset == 0 and self.tLayer is self)
+
+    def keepsLinearOutput(self):
+        """
+        Return True if the layer should keep the linear RGB values of
+        its output (cf. setLinearOutput()) : the upper visible layer
+        is a linear light layer, reading the output of the layer as input.
+        @return:
+        @rtype: boolean
+        """
+        img = self.parentImage
+        if not USE_LINEAR_LIGHT or img.useHald or img.isHald or not self.outputIsComposite():
+            return False
+        ind = self.getUpperVisibleStackIndex()
+        return ind >= 0 and img.layersStack[ind].isLinearLightLayer()
+
+    def getLinearInput(self, inputImage):
+        """
+        Return the linear RGB values of inputImage, the input image of the layer,
+        if they were kept by the lower visible layer, and None otherwise.
+        The buffer is shared : it is read only.
+        @param inputImage:
+        @type inputImage: QImage
+        @return:
+        @rtype: ndarray, shape (h, w, 3), RGB order, range 0..1
+        """
+        img = self.parentImage
+        ind = self.getLowerVisibleStackIndex()
+        if not USE_LINEAR_LIGHT or img.useHald or img.isHald or ind < 0:
+            return None
+        lower = img.layersStack[ind]
+        linear = lower.linearOutput
+        if linear is None or linear[0] != lower.outputStamp or not lower.outputIsComposite():
+            return None
+        if linear[1].shape[:2] != (inputImage.height(), inputImage.width()):
+            return None
+        return linear[1]
+
+    def setLinearOutput(self, buf):
+        """
+        Record the linear RGB values of the current output
+        of the layer. The buffer is made read only.
+        Must be called after updatePixmap().
+        @param buf:
+        @type buf: ndarray, shape (h, w, 3), RGB order, range 0..1, or None
+        """
+        if buf is not None:
+            buf.flags.writeable = False
+        self.linearOutput = None if buf is None else (self.outputStamp, buf)
+        memoryManager.register(self, 'linearOutput', buf)
+
+    def getTileHaloRadius(self):
+        """
+        Return the halo radius needed to evaluate the layer
+        tile by tile, global statistics being imposed, or None if
+        the layer cannot be evaluated by tiles (cf. bLUeTop.tiledLayers).
+        Selections and layer offsets are not supported.
+        @return:
+        @rtype: int or None
+        """
+        if self.rect is not None or self.xOffset != 0 or self.yOffset != 0 or self.tLayer is not self:
+            return None
+        halo = self.getHaloRadius()
+        if halo is None and self.needsGlobalStats():
+            halo = 0
+        return halo
+
+    def getHaloRadius(self):
+        """
+        Return the locality of the layer transformation (cf. haloRadius) :
+        None if the output depends on the whole input image, otherwise the
+        max distance between an output pixel and the input pixels it depends on.
+        @return:
+        @rtype: int or None
+        """
+        if self.isColorOnlyLayer():
+            return 0
+        return self.haloRadius() if callable(self.haloRadius) else self.haloRadius
+
+    def getVersion(self):
+        """
+        Overrides vImage.getVersion() : the color space
+        buffers of the layer follow its output stamp.
+        @return:
+        @rtype: hashable
+        """
+        version = super().getVersion()
+        return None if version is None else (self.outputStamp,) + version
+
+    def getOutputToken(self):
+        """
+        Return a token identifying the content of the current (full size
+        or preview) output : the memoization key of the output (cf. evaluateStack()), or,
+        if the output was not memoized, its (unique) stamp.
+        @return:
+        @rtype: hashable
+        """
+        return self.outputTokens.get(self.parentImage.useThumb, self.outputStamp)
+
+    def setOutputToken(self, token):
+        """
+        Record the content token of the current output. Must be
+        called after the last call to updatePixmap().
+        @param token:
+        @type token: hashable
+        """
+        self.outputTokens[self.parentImage.useThumb] = token
+
+    def getParamKey(self):
+        """
+        Return a digest of the parameters of the layer transformation, or
+        None if the output of the layer cannot be memoized (cf. evaluateStack()).
+        The parameters are provided by the graphic form of the
+        layer (cf. abstractForm.getParamState()).
+        @return:
+        @rtype: str or None
+        """
+        form = self.getFormParams()
+        if form is None or self.tLayer is not self or self.isCloningLayer():
+            return None
+        state = form.getParamState()
+        if state is None:
+            return None
+        return paramDigest((form.formClass.__name__, state, None if self.rect is None else self.rect.getRect()))
+
+    def isFusable(self):
+        """
+        Return True if the layer can be fused with its
+        neighbours into a 3D LUT : the layer must be a visible,
+        unmasked, opaque, color only layer, with normal blending mode
+        and no selection or offset. The active layer is never fused,
+        as its input is displayed by its graphic form.
+        @return:
+        @rtype: boolean
+        """
+        return (self.visible and self.isColorOnlyLayer() and not self.maskIsEnabled and not self.isClipping
+                and self.opacity == 1.0 and self.compositionMode == QPainter.CompositionMode_SourceOver
+                and self.rect is None and self.xOffset == 0 and self.yOffset == 0 and self.tLayer is self
+                and self.cachesEnabled and self.getStackIndex() != self.parentImage.activeLayerIndex)
+
+    def getFusedRun(self):
+        """
+        Return the maximal run of adjacent visible fusable
+        layers containing self, bottom to top, or [self]
+        if fusion is disabled or not possible.
+        Fusion is done for full size images only : the outputs of
+        intermediate layers of a run are not updated. They are marked
+        stale (cf. outputIsStale) and recomputed on access.
+        @return:
+        @rtype: list of QLayer
+        """
+        img = self.parentImage
+        if not USE_LAYER_FUSION or img.useThumb or img.useHald or img.isHald or not self.isFusable():
+            return [self]
+        stack = img.layersStack
+        run = [self]
+        ind = self.getLowerVisibleStackIndex()
+        while ind > 0 and stack[ind].isFusable():
+            run.insert(0, stack[ind])
+            ind = stack[ind].getLowerVisibleStackIndex()
+        if ind < 0:
+            # no input image
+            return [self]
+        ind = self.getUpperVisibleStackIndex()
+        while ind >= 0 and stack[ind].isFusable():
+            run.append(stack[ind])
+            ind = stack[ind].getUpperVisibleStackIndex()
+        return run
+
     def updatePixmap(self, maskOnly=False):
         """
         Synchronize rPixmap with the layer image and mask.
@@ -1207,6 +2314,43 @@ class QLayer(vImage):
             rImg = rImg.copy(QRect(-x, -y, rImg.width()*self.Zoom_coeff, rImg.height()*self.Zoom_coeff))
         if self.maskIsEnabled:
             rImg = vImage.visualizeMask(rImg, self.mask, color=self.maskIsSelected)
+        # invalidate the composites built from the layer
+        prevStamp, self.outputStamp = self.outputStamp, next(QLayer.stamps)
+        if not self.parentImage.useHald:
+            # the content token falls back to outputStamp. At
+            # pyramid level 0, the preview aliases the full size output
+            if self.thumb is self:
+                self.outputTokens.clear()
+            else:
+                self.outputTokens.pop(self.parentImage.useThumb, None)
+        if not (self.parentImage.useThumb or self.parentImage.useHald):
+            self.outputIsStale = False
+        # the linear output, if any, is set after the update (cf. setLinearOutput())
+        if self.linearOutput is not None:
+            self.setLinearOutput(None)
+        if self.getInputAlias() is not None and self.outputIsComposite():
+            # neutral point : the layer is skipped by compositing (cf. getCurrentMaskedImage()),
+            # and its pixmap is built on demand
+            self.rImage, self.rPixmap = None, None
+            return
+        if self.dirtyRect is None or self.xOffset != 0 or self.yOffset != 0:
+            self.outputDirty = None
+        else:
+            self.outputDirty = (prevStamp, QRect(self.dirtyRect))
+        # pixmaps are built by the GUI thread. Meanwhile,
+        # composites are built from rImage (cf. getCurrentMaskedImage())
+        if self.parentImage.offscreen or deferToGui((id(self), 'updatePixmap'), self.__setPixmap, rImg):
+            self.rImage = rImg
+            return
+        self.__setPixmap(rImg)
+
+    def __setPixmap(self, rImg):
+        """
+        Build rPixmap from rImg.
+        @param rImg:
+        @type rImg: QImage
+        """
+        self.rImage = None
         self.rPixmap = QPixmap.fromImage(rImg)
         self.setModified(True)
 
@@ -1392,6 +2536,8 @@ class QLayer(vImage):
         grForm = self.getGraphicsForm()
         if grForm is not None:
             grForm.readFromStream(dataStream)
+            # the form parameters have changed (cf. getFormParams())
+            self.paramStamp = next(QLayer.stamps)
         return dataStream
 
 
@@ -1426,6 +2572,9 @@ class QPresentationLayer(QLayer):
         @param maskOnly: default False
         @type maskOnly: boolean
         """
+        # pixmaps are built by the GUI thread
+        if self.parentImage.offscreen or deferToGui((id(self), 'updatePixmap'), self.updatePixmap, maskOnly):
+            return
         currentImage = self.getCurrentImage()
         # color manage
         if icc.COLOR_MANAGE and self.parentImage is not None and getattr(self, 'role', None) == 'presentation':
@@ -1444,10 +2593,16 @@ class QPresentationLayer(QLayer):
         self.setModified(True)
 
     def applyNone(self):
-        super().applyNone()
+        self.forwardInput()
         self.parentImage.setModified(True)
 
     def update(self):
+        """
+        Update the layer from the stack. In the GUI thread, the
+        running and pending evaluations of the stack are completed first
+        (cf. waitStackWorker()).
+        """
+        waitStackWorker()
         self.applyNone()
 
 
@@ -1497,6 +2652,9 @@ class QCloningLayer(QLayer):
             qp.drawPixmap(QPointF(currentAltX, currentAltY), adjustForm.sourcePixmap)
         else:
             qp.drawImage(QPointF(currentAltX, currentAltY), img1.copy())
+        qp.end()
+        # img1 is the composite of the lower stack : it was modified, so we invalidate it
+        img1.compositeKey = None
         return img1
 
     def updateCloningMask(self):
@@ -1643,6 +2801,8 @@ class QLayerImage(QLayer):
                 buf[...] = blendLuminosityBuf(buf, buf0.astype(np.uint8))
             elif self.compositionMode == -2:
                 buf[...] = blendColorBuf(buf,  buf0.astype(np.uint8))
+        # img1 is the composite of the lower stack : it was modified, so we invalidate it
+        img1.compositeKey = None
         return img1
 
     def bTransformed(self, transformation, parentImage):
@@ -1661,6 +2821,26 @@ class QLayerImage(QLayer):
             tLayer.tool.img = tLayer.parentImage
         return tLayer
 
+    def bCropped(self, rect, parentImage, size=None):
+        """
+        Overrides QLayer.bCropped() : the source image is cropped too.
+        @param rect: region (full size image coordinates)
+        @type rect: QRect
+        @param parentImage:
+        @type parentImage: mImage
+        @param size: default rect.size()
+        @type size: QSize
+        @return:
+        @rtype: QLayerImage
+        """
+        cLayer = super().bCropped(rect, parentImage, size=size)
+        if self.sourceImg is not None:
+            # the source image is drawn scaled to the layer size
+            rx, ry = self.sourceImg.width() / self.width(), self.sourceImg.height() / self.height()
+            sRect = QRect(int(rect.left() * rx), int(rect.top() * ry), int(rect.width() * rx), int(rect.height() * ry))
+            cLayer.sourceImg = self.sourceImg.copy(sRect).scaled(cLayer.size())
+        return cLayer
+
 
 class QRawLayer(QLayer):
     """
@@ -1686,7 +2866,45 @@ class QRawLayer(QLayer):
         super().__init__(*args, **kwargs)
         self.postProcessCache = None
         self.bufCache_HSV_CV32 = None
+        self.bufCameraRGB = None
+        # demosaiced buffers (cf. rawStages.demosaicRaw()) for
+        # half and full size, and their (denoise, highlight mode) keys
+        self.linearHalf, self.linearFull = None, None
+        self.linearKeys = {}
+
+    def getLinearBuffer(self, half, key):
+        """
+        Return the demosaiced buffer for half or full size, if it
+        was built with the parameters key, and None otherwise.
+        @param half:
+        @type half: boolean
+        @param key: denoise and highlight mode
+        @type key: tuple
+        @return:
+        @rtype: ndarray or None
+        """
+        buf = self.linearHalf if half else self.linearFull
+        return buf if buf is not None and self.linearKeys.get(half) == key else None
+
+    def setLinearBuffer(self, half, key, buf):
+        """
+        Cache the demosaiced buffer for half or full size.
+        @param half:
+        @type half: boolean
+        @param key: denoise and highlight mode
+        @type key: tuple
+        @param buf:
+        @type buf: ndarray
+        """
+        if half:
+            self.linearHalf = buf
+        else:
+            self.linearFull = buf
+        self.linearKeys[half] = key
 
+    # Raw buffers are registered to the memory manager : the caches are
+    # rebuilt by the next development (cf. rawPostProcess()), and the
+    # demosaiced buffers, which are expensive to rebuild, are moved to disk when needed.
     @property
     def postProcessCache(self):
         return self.__postProcessCache
@@ -1694,6 +2912,7 @@ class QRawLayer(QLayer):
     @postProcessCache.setter
     def postProcessCache(self, buf):
         self.__postProcessCache = buf
+        memoryManager.register(self, 'postProcessCache', buf)
 
     @property
     def bufCache_HSV_CV32(self):
@@ -1702,6 +2921,34 @@ class QRawLayer(QLayer):
     @bufCache_HSV_CV32.setter
     def bufCache_HSV_CV32(self, buffer):
         self.__bufCache_HSV_CV32 = buffer
+        memoryManager.register(self, 'bufCache_HSV_CV32', buffer)
+
+    @property
+    def bufCameraRGB(self):
+        return self.__bufCameraRGB
+
+    @bufCameraRGB.setter
+    def bufCameraRGB(self, buffer):
+        self.__bufCameraRGB = buffer
+        memoryManager.register(self, 'bufCameraRGB', buffer)
+
+    @property
+    def linearHalf(self):
+        return self.__linearHalf
+
+    @linearHalf.setter
+    def linearHalf(self, buffer):
+        self.__linearHalf = buffer
+        memoryManager.register(self, 'linearHalf', buffer, policy=MemoryManager.SPILL)
+
+    @property
+    def linearFull(self):
+        return self.__linearFull
+
+    @linearFull.setter
+    def linearFull(self, buffer):
+        self.__linearFull = buffer
+        memoryManager.register(self, 'linearFull', buffer, policy=MemoryManager.SPILL)
 
 
 
@@ -0,0 +1,458 @@
+"""
+This File is part of bLUe software.
+
+Copyright (C) 2017  Bernard Virot <bernard.virot@libertysurf.fr>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Lesser General Public License as
+published by the Free Software Foundation, version 3.
+
+This program is distributed in the hope that it will be useful, but
+WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+Lesser General Lesser Public License for more details.
+
+You should have received a copy of the GNU Lesser General Public License
+along with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+import argparse
+import multiprocessing
+import os
+import shutil
+import sys
+import threading
+from glob import glob
+from multiprocessing.util import Finalize
+from time import perf_counter
+
+import cv2
+import numpy as np
+
+from bLUeCore.tiles import tileEngine
+from bLUeTop import pipeline
+from bLUeTop.rawStages import rawRead, developRaw, getProfileDict
+from bLUeTop.settings import EXIFTOOL_PATH, RAW_FILE_EXTENSIONS, TILED_RENDER_SIZE
+from bLUeTop.tiledRender import StackRenderer, getWriter
+
+#####################################################################
+# Batch processing : a saved layer stack (cf. bLUeTop.pipeline.saveStack())
+# or a .cube 3D LUT is applied to a set of image files by a pool
+# of worker processes. Raw files are developed with the raw
+# parameters of the stack, if any. Each worker keeps its own exiftool
+# process to copy metadata. Output names keep the source extension
+# (cf. outputPath()). Outputs are written atomically, so
+# an interrupted run can be resumed by skipping existing outputs.
+# With option --tiled, the stack is run tile by tile and the output
+# is streamed to the file (cf. bLUeTop.tiledRender), thus memory
+# does not grow with the count and the size of layer buffers.
+#
+# usage : python -m bLUe batch LOOK INPUT [INPUT ...] -o OUTDIR [options]
+#####################################################################
+
+# output format --> cv2 quality flag, quality range
+outputFormats = {'jpg': (cv2.IMWRITE_JPEG_QUALITY, 100),
+                 'png': (cv2.IMWRITE_PNG_COMPRESSION, 9),
+                 'tif': (None, None)}
+
+
+_profiles = {}
+
+
+def getProfile(rawFilename, profile):
+    """
+    Return the camera profile dict for a raw file (cf. RawParams.profile).
+    Profiles read from profile files are cached.
+    @param rawFilename:
+    @type rawFilename: str
+    @param profile:
+    @type profile: str
+    @return:
+    @rtype: dict
+    """
+    if not profile:
+        return getProfileDict(rawFilename, profile)
+    d = _profiles.get(profile)
+    if d is None:
+        d = _profiles[profile] = getProfileDict(rawFilename, profile)
+    return d
+
+
+def readImage(filename, rawParams=None):
+    """
+    Read an image file and return a BGRA buffer. Raw files
+    are developed with rawParams (default RawParams()). The
+    EXIF orientation is not applied (it is kept in metadata).
+    Raise IOError, ValueError or LibRaw errors.
+    @param filename:
+    @type filename: str
+    @param rawParams:
+    @type rawParams: RawParams
+    @return:
+    @rtype: ndarray, dtype uint8, shape (h, w, 4)
+    """
+    if filename.endswith(RAW_FILE_EXTENSIONS):
+        if rawParams is None:
+            rawParams = pipeline.RawParams()
+        buf = developRaw(rawRead(filename, warn=False), rawParams, dngDict=getProfile(filename, rawParams.profile))
+        return cv2.cvtColor(buf, cv2.COLOR_RGB2BGRA)
+    buf = cv2.imread(filename, cv2.IMREAD_COLOR | cv2.IMREAD_IGNORE_ORIENTATION)
+    if buf is None:
+        raise IOError('Cannot read %s' % filename)
+    return cv2.cvtColor(buf, cv2.COLOR_BGR2BGRA)
+
+
+def encodeImage(buf, fmt, quality=-1):
+    """
+    Encode the color channels of a BGRA buffer.
+    quality is the jpeg quality (0..100) or the png
+    compression level (0..9), -1 for default.
+    Raise IOError.
+    @param buf:
+    @type buf: ndarray, dtype uint8, shape (h, w, 4)
+    @param fmt: 'jpg', 'png' or 'tif'
+    @type fmt: str
+    @param quality:
+    @type quality: int
+    @return:
+    @rtype: bytes
+    """
+    flag, maxQuality = outputFormats[fmt]
+    params = [flag, min(quality, maxQuality)] if (flag is not None and quality >= 0) else []
+    ok, data = cv2.imencode('.' + fmt, np.ascontiguousarray(buf[:, :, :3]), params)
+    if not ok:
+        raise IOError('Cannot encode image as %s' % fmt)
+    return data.tobytes()
+
+
+def writeImage(buf, filename, fmt, quality=-1, exifTool=None, metadataSource=None):
+    """
+    Write a BGRA buffer to filename. If exifTool is not None, metadata
+    are copied from the file metadataSource (cf. writeAtomic()).
+    Raise IOError.
+    @param buf:
+    @type buf: ndarray, dtype uint8, shape (h, w, 4)
+    @param filename:
+    @type filename: str
+    @param fmt: 'jpg', 'png' or 'tif'
+    @type fmt: str
+    @param quality: cf. encodeImage()
+    @type quality: int
+    @param exifTool:
+    @type exifTool: ExifTool
+    @param metadataSource:
+    @type metadataSource: str
+    """
+    def write(tmpName):
+        with open(tmpName, 'wb') as f:
+            f.write(encodeImage(buf, fmt, quality=quality))
+    writeAtomic(write, filename, exifTool=exifTool, metadataSource=metadataSource)
+
+
+def writeTiled(renderer, filename, fmt, quality=-1, exifTool=None, metadataSource=None):
+    """
+    Run a stack by tiles (cf. StackRenderer.render()) and stream
+    the result to filename. If exifTool is not None, metadata are copied from
+    the file metadataSource (cf. writeAtomic()).
+    Raise IOError.
+    @param renderer:
+    @type renderer: StackRenderer
+    @param filename: name with extension fmt
+    @type filename: str
+    @param fmt: 'jpg', 'png' or 'tif'
+    @type fmt: str
+    @param quality: cf. encodeImage()
+    @type quality: int
+    @param exifTool:
+    @type exifTool: ExifTool
+    @param metadataSource:
+    @type metadataSource: str
+    """
+    maxQuality = outputFormats[fmt][1]
+    quality = -1 if maxQuality is None else min(quality, maxQuality)
+
+    def write(tmpName):
+        h, w = renderer.buf.shape[:2]
+        writer = getWriter(tmpName, w, h, quality=quality, alpha=False)
+        try:
+            renderer.render(writer)
+        except Exception:
+            writer.abort()
+            raise
+        writer.close()
+    writeAtomic(write, filename, exifTool=exifTool, metadataSource=metadataSource)
+
+
+def writeAtomic(write, filename, exifTool=None, metadataSource=None):
+    """
+    Call write(tmpName) to write a temporary file, copy metadata from
+    the file metadataSource, if exifTool is not None, and rename the
+    temporary file to filename, thus an existing file is always complete.
+    Raise IOError.
+    @param write:
+    @type write: function
+    @param filename:
+    @type filename: str
+    @param exifTool:
+    @type exifTool: ExifTool
+    @param metadataSource:
+    @type metadataSource: str
+    """
+    folder, name = os.path.split(filename)
+    tmpName = os.path.join(folder, '.%d.%s' % (os.getpid(), name))
+    try:
+        write(tmpName)
+        # exiftool commands are ascii only (cf. ExifTool.execute())
+        if exifTool is not None and (metadataSource + tmpName).isascii():
+            exifTool.copyMetadata(metadataSource, tmpName)
+        os.replace(tmpName, filename)
+    finally:
+        if os.path.exists(tmpName):
+            os.remove(tmpName)
+
+
+def makeThumbnail(buf, size):
+    """
+    Return a copy of buf reduced to fit in a size x size square.
+    @param buf:
+    @type buf: ndarray, dtype uint8, shape (h, w, 4)
+    @param size:
+    @type size: int
+    @return:
+    @rtype: ndarray, dtype uint8, shape (h', w', 4)
+    """
+    h, w = buf.shape[:2]
+    r = min(1.0, size / max(h, w))
+    return cv2.resize(buf, (max(1, round(w * r)), max(1, round(h * r))), interpolation=cv2.INTER_AREA)
+
+
+#################
+# worker processes
+#################
+
+_rawParams, _stack, _fmt, _quality, _exifTool, _thumbSize, _tileSize = None, None, None, -1, None, 256, 0
+
+
+def initWorker(stack, fmt, quality, metadata, threads, thumbSize=256, tileSize=0):
+    """
+    Worker initializer.
+    @param stack: layer parameters
+    @type stack: list of dataclass
+    @param fmt:
+    @type fmt: str
+    @param quality:
+    @type quality: int
+    @param metadata: copy metadata
+    @type metadata: boolean
+    @param threads: count of threads of the worker
+    @type threads: int
+    @param thumbSize: size of thumbnails
+    @type thumbSize: int
+    @param tileSize: tile size, 0 to run the stack on whole images
+    @type tileSize: int
+    """
+    global _rawParams, _stack, _fmt, _quality, _exifTool, _thumbSize, _tileSize
+    _rawParams, _stack = pipeline.splitRaw(stack)
+    _fmt, _quality, _thumbSize, _tileSize = fmt, quality, thumbSize, tileSize
+    # share the cpus between workers
+    tileEngine.maxWorkers = threads
+    if metadata:
+        from bLUeTop.exiftool import ExifTool
+        _exifTool = ExifTool().__enter__()
+        # terminate exiftool when the worker exits
+        Finalize(None, _exifTool.__exit__, args=(None, None, None), exitpriority=10)
+
+
+def processFile(task):
+    """
+    Worker : process a single file. The optional third
+    item of task is the path of a jpeg thumbnail.
+    @param task: input and output paths
+    @type task: 2-uple or 3-uple of str
+    @return: input and output paths, time (s), size (Mpx), error message or None
+    @rtype: 5-uple
+    """
+    src, dst = task[:2]
+    thumb = task[2] if len(task) > 2 else None
+    start = perf_counter()
+    try:
+        buf = readImage(src, rawParams=_rawParams)
+        if _tileSize > 0:
+            renderer = StackRenderer(_stack, buf, tileSize=_tileSize)
+            writeTiled(renderer, dst, _fmt, quality=_quality, exifTool=_exifTool, metadataSource=src)
+            # downsampled output
+            out = renderer.preview
+        else:
+            out = pipeline.runStack(_stack, buf)
+            writeImage(out, dst, _fmt, quality=_quality, exifTool=_exifTool, metadataSource=src)
+        if thumb is not None:
+            writeImage(makeThumbnail(out, _thumbSize), thumb, 'jpg')
+        return src, dst, perf_counter() - start, buf.shape[0] * buf.shape[1] / 1e6, None
+    except Exception as e:
+        return src, dst, perf_counter() - start, 0, '%s: %s' % (type(e).__name__, e)
+
+
+#################
+# main process
+#################
+
+def outputPath(src, base, outDir, fmt):
+    """
+    Return the path of the output of src, reproducing
+    in outDir the directory tree of src relative to base.
+    The source extension is kept in the output name (a.NEF -> a.NEF.jpg),
+    thus a.jpg and a.png, or raw + jpeg pairs, never write to the same file.
+    @param src: input path
+    @type src: str
+    @param base: input root directory
+    @type base: str
+    @param outDir:
+    @type outDir: str
+    @param fmt: output extension
+    @type fmt: str
+    @return:
+    @rtype: str
+    """
+    return os.path.join(outDir, os.path.relpath(src, base) + '.' + fmt)
+
+
+def getTasks(patterns, outDir, fmt, resume=False):
+    """
+    Expand input patterns and return the list of (input, output)
+    paths and the count of skipped files. The directory
+    tree of the inputs, relative to their common directory, is
+    reproduced in outDir (cf. outputPath()). If resume is True, files with an existing output are skipped.
+    @param patterns: file names or glob patterns (** is recursive)
+    @type patterns: list of str
+    @param outDir:
+    @type outDir: str
+    @param fmt:
+    @type fmt: str
+    @param resume:
+    @type resume: boolean
+    @return:
+    @rtype: list of 2-uples of str, int
+    """
+    files = sorted({os.path.abspath(f) for p in patterns for f in glob(p, recursive=True) if os.path.isfile(f)})
+    if not files:
+        return [], 0
+    base = os.path.commonpath([os.path.dirname(f) for f in files])
+    tasks, skipped = [], 0
+    for src in files:
+        dst = outputPath(src, base, outDir, fmt)
+        if resume and os.path.isfile(dst):
+            skipped += 1
+            continue
+        tasks.append((src, dst))
+    return tasks, skipped
+
+
+def run(stack, tasks, fmt, quality=-1, jobs=None, metadata=True, inFlight=None, tileSize=0, out=sys.stdout):
+    """
+    Process tasks with a pool of jobs worker processes, printing
+    per file timings and the overall throughput to out.
+    At most inFlight files (default 2 * jobs) are queued at any time.
+    @param stack: layer parameters
+    @type stack: list of dataclass
+    @param tasks: input and output paths
+    @type tasks: list of 2-uples of str
+    @param fmt:
+    @type fmt: str
+    @param quality:
+    @type quality: int
+    @param jobs: count of worker processes, default cpu count
+    @type jobs: int
+    @param metadata: copy metadata
+    @type metadata: boolean
+    @param inFlight:
+    @type inFlight: int
+    @param tileSize: tile size, 0 to run the stack on whole images (cf. initWorker())
+    @type tileSize: int
+    @param out:
+    @type out: file
+    @return: count of failures
+    @rtype: int
+    """
+    cpus = os.cpu_count() or 1
+    jobs = max(1, min(jobs or cpus, len(tasks)))
+    slots, stop = threading.Semaphore(inFlight or 2 * jobs), threading.Event()
+    for folder in {os.path.dirname(dst) for _, dst in tasks}:
+        os.makedirs(folder, exist_ok=True)
+
+    def feed():
+        # block the task handler of the pool while all slots are in use
+        for task in tasks:
+            slots.acquire()
+            if stop.is_set():
+                return
+            yield task
+
+    failures, totalMpx = 0, 0.0
+    start = perf_counter()
+    pool = multiprocessing.Pool(jobs, initializer=initWorker,
+                                initargs=(stack, fmt, quality, metadata, max(1, cpus // jobs), 256, tileSize))
+    try:
+        for i, (src, dst, t, mpx, error) in enumerate(pool.imap_unordered(processFile, feed()), 1):
+            slots.release()
+            if error is None:
+                totalMpx += mpx
+                print('[%d/%d] %s  %.2f s  %.1f Mpx' % (i, len(tasks), dst, t, mpx), file=out, flush=True)
+            else:
+                failures += 1
+                print('[%d/%d] %s  FAILED  %s' % (i, len(tasks), src, error), file=out, flush=True)
+    except BaseException:
+        # unblock the task handler before terminating
+        stop.set()
+        slots.release()
+        pool.terminate()
+        raise
+    else:
+        pool.close()
+    finally:
+        pool.join()
+    elapsed = perf_counter() - start
+    print('%d files, %.1f Mpx in %.1f s : %.2f Mpx/s, %d failed'
+          % (len(tasks) - failures, totalMpx, elapsed, totalMpx / max(elapsed, 1e-6), failures), file=out)
+    return failures
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='bLUe batch',
+                                     description='Apply a saved layer stack or a 3D LUT to image files.')
+    parser.add_argument('look', help='layer stack (.json, cf. Layer menu) or 3D LUT (.cube)')
+    parser.add_argument('inputs', nargs='+', help='input files or glob patterns (** is recursive)')
+    parser.add_argument('-o', '--output', required=True, help='output directory')
+    parser.add_argument('-f', '--format', choices=sorted(outputFormats), default='jpg', help='output format')
+    parser.add_argument('-q', '--quality', type=int, default=-1,
+                        help='jpeg quality (0..100) or png compression (0..9)')
+    parser.add_argument('-j', '--jobs', type=int, default=0, help='worker processes, default cpu count')
+    parser.add_argument('--resume', action='store_true', help='skip files with an existing output')
+    parser.add_argument('--no-metadata', action='store_true', help='do not copy metadata')
+    parser.add_argument('--tiled', action='store_true',
+                        help='run the stack tile by tile (cf. TILED_RENDER_SIZE in config.json), bounding memory')
+    args = parser.parse_args(argv)
+    try:
+        stack = pipeline.loadLook(args.look)
+        _, layers = pipeline.splitRaw(stack)
+        if args.tiled:
+            # check the layer types
+            StackRenderer(layers, np.empty((1, 1, 4), dtype=np.uint8))
+    except (IOError, ValueError) as e:
+        print('Cannot load %s : %s' % (args.look, e), file=sys.stderr)
+        return 2
+    metadata = not args.no_metadata
+    if metadata and shutil.which(EXIFTOOL_PATH) is None:
+        print('exiftool not found (cf. EXIFTOOL_PATH in config.json) : metadata are not copied', file=sys.stderr)
+        metadata = False
+    tasks, skipped = getTasks(args.inputs, os.path.abspath(args.output), args.format, resume=args.resume)
+    if skipped:
+        print('%d files skipped' % skipped)
+    if not tasks:
+        print('Nothing to do')
+        return 0
+    failures = run(stack, tasks, args.format, quality=args.quality, jobs=args.jobs, metadata=metadata,
+                   tileSize=TILED_RENDER_SIZE if args.tiled else 0)
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
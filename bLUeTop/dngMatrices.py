@@ -0,0 +1,230 @@
+"""
+This File is part of bLUe software.
+
+Copyright (C) 2017  Bernard Virot <bernard.virot@libertysurf.fr>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Lesser General Public License as
+published by the Free Software Foundation, version 3.
+
+This program is distributed in the hope that it will be useful, but
+WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+Lesser General Lesser Public License for more details.
+
+You should have received a copy of the GNU Lesser General Public License
+along with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+import numpy as np
+
+#########################################################################################
+# Dual illuminant calibration of dng/dcp profiles : color and forward
+# matrices, interpolated for a temperature (numpy only, no Qt dependency).
+# Compliant with the Adobe DNG specification.
+# cf. https://www.adobe.com/content/dam/acom/en/products/photoshop/pdfs/dng_spec_1.4.0.0.pdf
+########################################################################################
+
+
+class dngProfileIlluminants:
+    """
+    Wrapper for the two illuminant temperatures
+    """
+    ExifTemperatureDict = {                                     # TODO 16/11/18 some conversions from EXIF to temperatures need review
+                        0  : 0,    # Unknown
+                        1  : 5600, # Daylight
+                        2  : 3600, # Fluorescent
+                        3  : 3200, # Tungsten(incandescent light)
+                        4  : 6000, # Flash
+                        9  : 5600, # Fine weather
+                        10 : 6500, # Cloudy weather
+                        11 : 8000, # Shade
+                        12 : 5700, # Daylight fluorescent(D 5700 - 7100K)
+                        13 : 4600, # Day white fluorescent(N 4600 - 5400K)
+                        14 : 3900, # Cool white fluorescent(W 3900 - 4500K)
+                        15 : 3200, # White fluorescent(WW3200 - 3700K)
+                        17 : 2856, # Standard light A
+                        18 : 4874, # Standard light B
+                        19 : 6774, # Standard light C
+                        20 : 5500, # D55
+                        21 : 6500, # D65
+                        22 : 7500, # D75
+                        23 : 5000, # D50
+                        24 : 3200, # ISO studio tungsten
+                       255 : 6500  # Other light source
+                     }
+
+    def __init__(self, dngDict):
+        try:
+            illuminant1, illuminant2 = int(dngDict['CalibrationIlluminant1']),  int(dngDict['CalibrationIlluminant2'])
+            self.temperature1, self.temperature2 = self.ExifTemperatureDict[illuminant1], self.ExifTemperatureDict[illuminant2]
+        except (ValueError, KeyError) as e:
+            print('dngProfileIlluminants : ', str(e))
+            raise e
+
+
+class dngProfileColorMatrices:
+    """
+    Wrapper for the two color matrices
+    """
+    def __init__(self, dngDict):
+        try:
+            for tag in ['ColorMatrix1', 'ColorMatrix2']:
+                M = dngDict.get(tag, None)
+                M = np.array([float(x) for x in M.split(' ')]).reshape(3, 3)
+                setattr(self, '_' + tag, M)  # a single _ , as setattr does no mangling
+
+        except (ValueError, KeyError) as e:
+            print('dngProfileColorMatrices : ', str(e))
+            raise e
+
+    @property
+    def colorMatrix1(self):
+        return self._ColorMatrix1
+
+    @property
+    def colorMatrix2(self):
+        return self._ColorMatrix2
+
+
+class dngProfileForwardMatrices:
+    """
+    Wrapper for the two color matrices
+    """
+    def __init__(self, dngDict):
+        try:
+            for tag in ['ForwardMatrix1', 'ForwardMatrix2']:
+                M = dngDict.get(tag, None)
+                M = np.array([float(x) for x in M.split(' ')]).reshape(3, 3)
+                setattr(self, '_' + tag, M) # a single _ , as setattr does no mangling
+        except (ValueError, KeyError) as e:
+            print('dngProfileForwardMatrices : ', str(e))
+            raise e
+
+    @property
+    def forwardMatrix1(self):
+        return self._ForwardMatrix1
+
+    @property
+    def forwardMatrix2(self):
+        return self._ForwardMatrix2
+
+
+class dngProfileDual:
+    """
+    Main class for dual illuminant profile.
+    An invalid or missing profile dictionary sets the
+    property dngProfileDual.isValid to False.
+    """
+    def __init__(self, dngDict):
+        self.__isValid = False
+        try:
+            illuminants = dngProfileIlluminants(dngDict)
+            self.__T1, self.__T2 = illuminants.temperature1, illuminants.temperature2
+            matrices = dngProfileColorMatrices(dngDict)
+            self.__colorMatrix1, self.__colorMatrix2 = matrices.colorMatrix1, matrices.colorMatrix2
+            matrices = dngProfileForwardMatrices(dngDict)
+            self.__forwardMatrix1, self.__forwardMatrix2 = matrices.forwardMatrix1, matrices.forwardMatrix2
+            self.__isValid = True
+        except (ValueError, KeyError, AttributeError) as e:
+            print('dngProfileDual : ', str(e))
+
+    @property
+    def isValid(self):
+        return self.__isValid
+
+    @property
+    def colorMatrix1(self):
+        return self.__colorMatrix1
+
+    @property
+    def colorMatrix2(self):
+        return self.__colorMatrix2
+
+    @property
+    def forwardMatrix1(self):
+        return self.__forwardMatrix1
+
+    @property
+    def forwardMatrix2(self):
+        return self.__forwardMatrix2
+
+    @property
+    def T1(self):
+        return self.__T1
+
+    @property
+    def T2(self):
+        return self.__T2
+
+
+def interpolate(T, M1, M2, T1, T2):
+    """
+    Return the interpolated color matrix
+    for temperature T, using the two calibration
+    illuminants (M1, T1) and (M2, T2).
+    Following the Adobe dng spec.(p. 79), we apply
+    linear interpolation to the inverse of the temperatures.
+    @param T: temperature of interpolation
+    @type T: float
+    @param M1: ColorMatrix1
+    @type M1: ndarray
+    @param M2: ColorMatrix2
+    @type M2: ndArray
+    @param T1: 1st illuminant temperature
+    @type T1: float
+    @param T2: 2nd illuminant temperature
+    @type T2: float
+    @return: interpolated matrix
+    @rtype: ndarray
+    """
+    T, T1, T2 = 1/T, 1/T1, 1/T2
+    # now T2 < T1
+    if T >= T1:
+        return M1
+    if T <= T2:
+        return M2
+    return (M1 * (T2 - T) + M2 * (T - T1)) / (T2 - T1)
+
+
+def interpolatedColorMatrix(T, dngDict):
+    """
+    Return the interpolated matrix for temperature T, using the
+    two illuminants from dngDict.
+    Raise a ValueError exception if dngDict is not a valid
+    dual illuminant profile.
+    @param T: temperature
+    @type T: float
+    @param dngDict: dng profile tag values dict
+    @type dngDict: dict
+    @return: interpolated matrix
+    @rtype: ndarray, shape=(3,3)
+    """
+    calibration = dngProfileDual(dngDict)
+    if calibration.isValid:
+        T1, T2 = calibration.T1, calibration.T2
+        colorMatrix1, colorMatrix2 = calibration.colorMatrix1, calibration.colorMatrix2
+        return interpolate(T, colorMatrix1, colorMatrix2, T1, T2)
+    else:
+        raise ValueError("interpolatedColorMatrix : invalid profile")
+
+
+def interpolatedForwardMatrix(T, dngDict):
+    """
+    Return the interpolated matrix for temperature T, using the
+    two illuminants from dngDict.
+    Raise a ValueError exception if dngDict is not a valid
+    dual illuminant profile.
+    @param T: temperature
+    @type T: float
+    @param dngDict: dng profile tag values dict
+    @type dngDict: dict
+    @return: interpolated matrix
+    @rtype: ndarray, shape=(3,3)
+    """
+    calibration = dngProfileDual(dngDict)
+    if calibration.isValid:
+        T1, T2 = calibration.T1, calibration.T2
+        forwardMatrix1, forwardMatrix2 = calibration.forwardMatrix1, calibration.forwardMatrix2
+        return interpolate(T, forwardMatrix1, forwardMatrix2, T1, T2)
+    else:
+        raise ValueError("interpolatedForwardMatrix : invalid profile")
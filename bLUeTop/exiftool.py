@@ -29,11 +29,11 @@ import os
 import json
 from sys import platform
 
-from PySide2.QtCore import QByteArray
-from PySide2.QtGui import QTransform, QImage
 from os.path import isfile
 from bLUeTop.settings import EXIFTOOL_PATH
-from bLUeGui.dialog import dlgWarn
+
+# Qt is imported by the methods returning Qt objects or showing dialogs
+# only : the headless tools (cf. bLUeTop.batch) copy metadata without PySide2.
 
 
 class ExifTool(object):
@@ -74,6 +74,7 @@ class ExifTool(object):
                                        )
 
         except (AttributeError, OSError):
+            from bLUeGui.dialog import dlgWarn
             dlgWarn("cannot execute exiftool :\nset EXIFTOOL_PATH in config.json")
             # exit program
             exit()
@@ -118,6 +119,7 @@ class ExifTool(object):
         try:
             stdin.write(bytearray(str.join("\n", args), 'ascii'))
         except UnicodeEncodeError as e:
+            from bLUeGui.dialog import dlgWarn
             dlgWarn(str.join("\n", args), str(e))
         # flush and sync stdin : both are mandatory on Windows
         stdin.flush()
@@ -184,6 +186,18 @@ class ExifTool(object):
             os.remove(sidecar)
         return True
 
+    def copyMetadata(self, source, dest):
+        """
+        Copy all metadata and icc profile from an image
+        file to another one.
+        @param source: path to source image file
+        @type source: str
+        @param dest: path to destination image file
+        @type dest: str
+        """
+        command = ["-tagsFromFile", source, "-all", "-icc_profile", "-overwrite_original", dest]
+        self.execute(*command)
+
     def readBinaryData(self, f, tagname='xx'):
         """
         Read binary metadata value of tagname from an image file or
@@ -234,6 +248,8 @@ class ExifTool(object):
         @rtype: QImage
         """
         thumbnail = self.readBinaryData(f, tagname=thumbname)
+        from PySide2.QtCore import QByteArray
+        from PySide2.QtGui import QImage
         return QImage.fromData(QByteArray.fromRawData(thumbnail), 'JPG')  # Pyside2 fromRawData takes 1 arg only
 
     def writeThumbnail(self, filename, thumbfile):
@@ -361,6 +377,7 @@ def decodeExifOrientation(value):
     @return: Qtransform object
     @rtype: QTransform
     """
+    from PySide2.QtGui import QTransform
     # identity transformation
     tr = QTransform()
     if value == 0:
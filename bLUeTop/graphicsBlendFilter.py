@@ -19,13 +19,10 @@ from PySide2.QtWidgets import QVBoxLayout, QLabel, QHBoxLayout
 
 from bLUeGui.graphicsForm import baseForm
 from bLUeGui.qrangeslider import QRangeSlider
+from bLUeTop.pipeline import GradualFilterParams, blendFilterIndex
 from bLUeTop.utils import optionsWidget
 
 
-class blendFilterIndex:
-    GRADUALBT, GRADUALTB, GRADUALNONE = range(3)
-
-
 class blendFilterForm (baseForm):
     @classmethod
     def getNewWindow(cls, targetImage=None, axeSize=500, layer=None, parent=None):
@@ -109,6 +106,12 @@ class blendFilterForm (baseForm):
         self.listWidget1.checkOption(name1)
         self.dataChanged.connect(self.updateLayer)
 
+    def getParams(self):
+        return GradualFilterParams(category=self.kernelCategory, start=self.filterStart, end=self.filterEnd)
+
+    def getParamState(self):
+        return self.kernelCategory, self.filterStart, self.filterEnd
+
     def updateLayer(self):
         """
         datachanged slot
@@ -16,11 +16,13 @@ You should have received a copy of the GNU Lesser General Public License
 along with this program. If not, see <http://www.gnu.org/licenses/>.
 """
 
+import numpy as np
 from PySide2.QtCore import Qt
 from PySide2.QtGui import QFontMetrics
 from PySide2.QtWidgets import QVBoxLayout, QHBoxLayout
 
 from bLUeGui.graphicsForm import baseForm
+from bLUeTop.pipeline import ExposureParams
 from bLUeTop.utils import QbLUeSlider, QbLUeLabel
 
 
@@ -108,6 +110,18 @@ class ExpForm (baseForm):
         self.expValue.setText(str("{:+.1f}".format(self.defaultExpCorrection)))
         self.expCorrection = self.defaultExpCorrection * self.defaultStep
         self.dataChanged.connect(self.updateLayer)
+
+    def getParams(self):
+        return ExposureParams(correction=self.expCorrection)
+
+    def getParamState(self):
+        return self.getParams()
+
+    def getLinearMatrix(self):
+        # neutral point (cf. vImage.applyExposure())
+        if self.getParams().isNeutral():
+            return np.identity(3)
+        return 2 ** self.expCorrection * np.identity(3)
     """
     def writeToStream(self, outStream):
         layer = self.layer
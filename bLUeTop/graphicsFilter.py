@@ -22,6 +22,7 @@ from PySide2.QtGui import QFontMetrics
 
 from bLUeGui.graphicsForm import baseForm
 from bLUeCore.kernel import filterIndex
+from bLUeTop.pipeline import Filter2DParams
 from bLUeTop.utils import optionsWidget, QbLUeSlider
 
 
@@ -167,6 +168,12 @@ class filterForm (baseForm):
         self.sliderTone.setValue(self.defaultTone)
         self.dataChanged.connect(self.updateLayer)
 
+    def getParams(self):
+        return Filter2DParams(category=self.kernelCategory, radius=self.radius, amount=self.amount, tone=self.tone)
+
+    def getParamState(self):
+        return self.kernelCategory, self.radius, self.amount, self.tone
+
     def updateLayer(self):
         """
         dataChanged Slot
@@ -185,6 +185,8 @@ class HVLUT2DForm(graphicsCurveForm):
         for i in range(hdivs):
             pt = sp[int(i * hstep * axeSize / 360)]
             data[i, sThr:, :, 0] = - (pt.y() - d) / 5
+        # data was modified in place
+        self.LUT.invalidate()
 
     def updateLayer(self):
         self.updateLUT()
@@ -21,6 +21,7 @@ from PySide2.QtCore import Qt, QRectF
 
 from bLUeGui.const import channelValues
 from bLUeGui.graphicsSpline import activeCubicSpline, graphicsCurveForm
+from bLUeTop.pipeline import HSVCurvesParams
 from bLUeTop.utils import optionsWidget
 
 
@@ -120,6 +121,9 @@ class graphicsHspbForm(graphicsCurveForm):
         self.scene().cubicG.curveChanged.sig.connect(f)
         self.scene().cubicB.curveChanged.sig.connect(f)
 
+    def getParams(self):
+        return HSVCurvesParams(lut=self.getStackedLUTXY())
+
     def drawBackground(self, qp, qrF):
         graphicsScene = self.scene()
         s = graphicsScene.axeSize
@@ -19,6 +19,7 @@ from PySide2.QtCore import Qt
 from PySide2.QtWidgets import QVBoxLayout
 
 from bLUeGui.graphicsForm import baseForm
+from bLUeTop.pipeline import InvertParams
 from bLUeTop.utils import optionsWidget
 
 
@@ -62,6 +63,9 @@ class invertForm(baseForm):
     def setDefaults(self):
         self.Rmask, self.Gmask, self.Bmask = (128,) * 3
 
+    def getParams(self):
+        return InvertParams(auto=self.options['Auto'], mask=(self.Rmask, self.Gmask, self.Bmask))
+
     def colorPickedSlot(self, x, y, modifiers):
         """
         Overriding method.
@@ -557,6 +557,8 @@ class activeNode(QGraphicsPathItem):
                 nbghd1[..., 3] = 0
             else:
                 nbghd1[..., 3] = 255
+        # LUT3DArray was modified in place
+        self.scene().lut.invalidate()
 
     def gridPos(self):
         """
@@ -1106,6 +1108,7 @@ class graphicsForm3DLUT(baseGraphicsForm):
     unselectBrush = QBrush()
     # default brightness
     defaultColorWheelBr = 0.60
+    paramMethods = baseGraphicsForm.paramMethods + ('getLUT',)
 
     @classmethod
     def getNewWindow(cls, cModel, targetImage=None, axeSize=500, LUTSize=LUTSIZE, layer=None, parent=None, mainForm=None):
@@ -1405,6 +1408,14 @@ class graphicsForm3DLUT(baseGraphicsForm):
                         """
                           )  # end of setWhatsThis
 
+    def getLUT(self):
+        """
+        Return the edited 3D LUT.
+        @return:
+        @rtype: LUT3D
+        """
+        return self.graphicsScene.lut
+
     def selectGridNode(self, r, g, b):
         """
         selects the nearest grid nodes corresponding to r,g,b values.
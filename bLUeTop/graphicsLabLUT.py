@@ -25,6 +25,7 @@ from PySide2.QtCore import Qt, QRectF
 from bLUeGui.colorCIE import sRGB2LabVec
 from bLUeGui.const import channelValues
 from bLUeGui.graphicsSpline import activeCubicSpline, graphicsCurveForm, activeSplinePoint
+from bLUeTop.pipeline import LabCurvesParams
 from bLUeTop.utils import optionsWidget
 
 
@@ -149,6 +150,9 @@ class graphicsLabForm(graphicsCurveForm):
         container.adjustSize()
         self.setViewportMargins(0, 0, 0, container.height() + 15)
 
+    def getParams(self):
+        return LabCurvesParams(lut=self.getStackedLUTXY())
+
     def colorPickedSlot(self, x, y, modifiers):
         """
         sets black/white points
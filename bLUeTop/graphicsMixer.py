@@ -23,6 +23,7 @@ from PySide2.QtWidgets import QGraphicsPixmapItem, QLabel, QVBoxLayout, QSizePol
 from bLUeGui.bLUeImage import QImageBuffer
 from bLUeGui.graphicsForm import baseGraphicsForm
 from bLUeGui.graphicsSpline import activePoint
+from bLUeTop.pipeline import MixerParams
 from bLUeTop.utils import optionsWidget
 
 
@@ -149,6 +150,18 @@ class mixerForm(baseGraphicsForm):
             self.values.setText(self.getChannelValues())
         self.dataChanged.connect(self.updateLayer)
 
+    def getParams(self):
+        return MixerParams(matrix=self.mixerMatrix, luminosity=self.options['Luminosity'])
+
+    def getParamState(self):
+        return self.getParams()
+
+    def getLinearMatrix(self):
+        # luminosity blending is not linear
+        if self.options['Luminosity']:
+            return None
+        return self.mixerMatrix
+
     def setBackgroundImage(self):
         img = QImage(QSize(256, 256), QImage.Format_ARGB32)
         img.fill(QColor(100, 100, 100))
@@ -22,6 +22,7 @@ from PySide2.QtWidgets import QGraphicsScene, QGridLayout
 
 from bLUeGui.const import channelValues
 from bLUeGui.graphicsSpline import activeCubicSpline, graphicsCurveForm, activeSplinePoint
+from bLUeTop.pipeline import RGBCurvesParams
 from bLUeTop.utils import optionsWidget, QbLUePushButton, UDict
 
 
@@ -148,6 +149,13 @@ class graphicsForm(graphicsCurveForm):
         self.scene().cubicG.curveChanged.sig.connect(f)
         self.scene().cubicB.curveChanged.sig.connect(f)
 
+    def getParams(self):
+        return RGBCurvesParams(lut=self.scene().cubicItem.getStackedLUTXY(),
+                               luminosity=self.graphicsScene.options['Luminosity'])
+
+    def getParamState(self):
+        return self.getParams()
+
     def colorPickedSlot(self, x, y, modifiers):
         """
         sets black/white points
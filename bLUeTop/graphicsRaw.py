@@ -22,6 +22,8 @@ from collections import OrderedDict
 from math import log
 from os.path import basename
 
+import numpy as np
+
 from PySide2 import QtCore
 from PySide2.QtCore import Qt, QPointF
 from PySide2.QtGui import QFontMetrics, QBrush, QPolygonF
@@ -31,6 +33,7 @@ from PySide2.QtWidgets import QVBoxLayout, QLabel, QHBoxLayout, QFrame, QGroupBo
 from bLUeGui.graphicsSpline import graphicsSplineForm
 from bLUeGui.graphicsForm import baseForm
 from bLUeTop.dng import getDngProfileList, getDngProfileDict, dngProfileToneCurve
+from bLUeTop.pipeline import RawParams
 from bLUeTop.utils import optionsWidget, UDict, QbLUeSlider, stateAwareQDockWidget
 from bLUeGui.multiplier import *
 
@@ -78,6 +81,7 @@ class rawForm (baseForm):
     Postprocessing of raw files.
     """
     dataChanged = QtCore.Signal(int)
+    paramMethods = baseForm.paramMethods + ('getToneCurveLUT',)
 
     @classmethod
     def getNewWindow(cls, targetImage=None, axeSize=500, layer=None, parent=None):
@@ -734,7 +738,9 @@ class rawForm (baseForm):
     def updateLayer(self, level):
         """
         data changed event handler.
-        @param level: 3: redo contrast and saturation, 2: previous + camera profile stuff, 1: all
+        @param level: 3: redo contrast and saturation, 2: previous + camera profile stuff,
+                      1: previous + exposure and white balance (LibRaw demosaic is redone only if the
+                      denoising or the highlight mode changed, cf. QRawLayer.getLinearBuffer())
         @type level: int
         """
         if level == 1:
@@ -814,16 +820,55 @@ class rawForm (baseForm):
         self.sliderSat.setValue(self.sat2Slider(self.satCorrection))
         self.dataChanged.connect(self.updateLayer)
 
+    def getToneCurveLUT(self):
+        """
+        Return the LUT of the user tone curve if the tone curve
+        form is visible, and None otherwise.
+        @return:
+        @rtype: ndarray or None
+        """
+        toneForm = self.toneForm
+        if toneForm is None or not toneForm.isVisible():
+            return None
+        return toneForm.scene().quadricB.LUTXY
+
+    def getParams(self):
+        """
+        Return the development parameters, for headless development
+        (cf. rawStages.developRaw()). A manual contrast curve is not exported.
+        @return:
+        @rtype: RawParams
+        """
+        toneForm = self.toneForm
+        return RawParams(whiteBalance=next(n for n in self.listWidget2.intNames if self.listWidget2.options[n]),
+                         temperature=self.tempCorrection,
+                         tint=self.tintCorrection,
+                         autoBrightness=self.options['Auto Brightness'],
+                         exposure=self.expCorrection,
+                         brightness=self.brCorrection,
+                         preserveHighlights=self.options['Preserve Highlights'],
+                         highlightMode=self.overexpValue,
+                         denoise=self.denoiseValue,
+                         profile=self.profileFiles.get(self.cameraProfilesCombo.currentText()),
+                         lookTable=self.options['cpLookTable'],
+                         toneCurve=None if toneForm is None or not toneForm.isVisible()
+                                   else np.asarray(toneForm.scene().quadricB.LUTXY).tolist(),
+                         contrast=self.contCorrection,
+                         saturation=self.satCorrection)
+
     def setCameraProfilesCombo(self):
         """
         Populates the camera profile Combo box.
         for each item, text is the filename and data is the corresponding dict.
+        Profile files are recorded in self.profileFiles (cf. getParams()).
         The function returns as soon as a first item is loaded. Remainning profiles are
         loaded asynchronously.
         @return: the currently selected item data
         @rtype: dict
         """
         self.cameraProfilesCombo = QComboBox()
+        # text --> profile file ('' for the embedded profile)
+        self.profileFiles = {}
         files = [self.targetImage.filename]
         files.extend(getDngProfileList(self.targetImage.cameraModel()))
         if not files:
@@ -839,6 +884,7 @@ class rawForm (baseForm):
             d = {k: d[k] for k in d if d[k] != ''}
             if d:
                 self.cameraProfilesCombo.addItem(key, d)
+                self.profileFiles[key] = f if nextInd > 0 else ''
                 found = True
             nextInd += 1
 
@@ -851,6 +897,7 @@ class rawForm (baseForm):
                 d = {k: d[k] for k in d if d[k] != ''}
                 if d:
                     self.cameraProfilesCombo.addItem(key, d)
+                    self.profileFiles[key] = f if i + nextInd > 0 else ''
             self.cameraProfilesCombo.addItem('None', {})
 
         threading.Thread(target=load).start()
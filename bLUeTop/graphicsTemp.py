@@ -22,6 +22,7 @@ from PySide2.QtWidgets import QVBoxLayout, QLabel, QHBoxLayout
 
 from bLUeGui.colorCIE import sRGBWP
 from bLUeGui.graphicsForm import baseForm
+from bLUeTop.pipeline import TemperatureParams
 from bLUeTop.utils import optionsWidget, QbLUeSlider, QbLUeLabel, QbLUePushButton
 
 
@@ -162,6 +163,14 @@ class temperatureForm (baseForm):
         colorstr = ''.join('%02x'% i for i in self.filterColor.getRgb()[:3])
         self.colorLabel.setStyleSheet("background:#%s" % colorstr)
 
+    def getParams(self):
+        mode = next(name for name in self.listWidget1.intNames if self.options[name])
+        return TemperatureParams(mode=mode, temperature=self.tempCorrection, tint=self.tintCorrection,
+                                 filterColor=tuple(QColor(self.filterColor).getRgb()[:3]))
+
+    def getParamState(self):
+        return self.getParams()
+
     def colorUpdate(self, color):
         """
         color Changed slot
@@ -0,0 +1,384 @@
+"""
+This File is part of bLUe software.
+
+Copyright (C) 2017  Bernard Virot <bernard.virot@libertysurf.fr>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Lesser General Public License as
+published by the Free Software Foundation, version 3.
+
+This program is distributed in the hope that it will be useful, but
+WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+Lesser General Lesser Public License for more details.
+
+You should have received a copy of the GNU Lesser General Public License
+along with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import shutil
+import signal
+import sys
+import threading
+from collections import deque
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from time import monotonic, time
+
+from bLUeTop import batch, pipeline
+from bLUeTop.settings import EXIFTOOL_PATH, IMAGE_FILE_EXTENSIONS, RAW_FILE_EXTENSIONS
+
+#####################################################################
+# Hot folder : a directory tree is watched for new image files,
+# which are developed (raw files, cf. rawStages.developRaw()),
+# processed by a saved layer stack and exported with a thumbnail
+# by the worker processes of bLUeTop.batch. Each worker runs the
+# decoding, processing and encoding stages of a file, and several
+# files are in flight at any time, so all stages overlap.
+# A file is processed once its size and date are stable. Processed
+# files are recorded in a journal, so a restarted daemon only processes
+# new or modified files. A local HTTP endpoint reports the status.
+#
+# usage : python -m bLUe watch LOOK FOLDER -o OUTDIR [options]
+#####################################################################
+
+JOURNAL_NAME = '.bLUe_journal.jsonl'
+THUMBNAIL_DIR = 'thumbnails'
+
+
+class Journal:
+    """
+    Persistent record of processed files. Each
+    record is a line of JSON, appended to the journal file.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.lock = threading.Lock()
+        # src --> (size, mtime)
+        self.entries = {}
+        if os.path.isfile(filename):
+            with open(filename) as f:
+                for line in f:
+                    try:
+                        d = json.loads(line)
+                        self.entries[d['src']] = (d['size'], d['mtime'])
+                    except (ValueError, KeyError, TypeError):
+                        # truncated record
+                        continue
+        self.f = open(filename, 'a')
+
+    def isDone(self, src, stat):
+        """
+        Return True if the file src, with status
+        stat, was already processed.
+        @param src:
+        @type src: str
+        @param stat:
+        @type stat: os.stat_result
+        @return:
+        @rtype: boolean
+        """
+        with self.lock:
+            return self.entries.get(src) == (stat.st_size, stat.st_mtime_ns)
+
+    def record(self, src, stat, dst, error=None):
+        """
+        Record a processed (or failed) file.
+        @param src:
+        @type src: str
+        @param stat:
+        @type stat: os.stat_result
+        @param dst:
+        @type dst: str
+        @param error:
+        @type error: str
+        """
+        with self.lock:
+            self.entries[src] = (stat.st_size, stat.st_mtime_ns)
+            self.f.write(json.dumps({'src': src, 'size': stat.st_size, 'mtime': stat.st_mtime_ns,
+                                     'dst': dst, 'error': error, 'time': time()}) + '\n')
+            self.f.flush()
+
+    def close(self):
+        with self.lock:
+            self.f.close()
+
+
+class Watcher:
+    """
+    Polling of a directory tree. A file is ready when its size
+    and modification date did not change for settle seconds.
+    Hidden files and the directory exclude are ignored.
+    """
+    def __init__(self, folder, extensions, settle=1.0, exclude=None):
+        self.folder, self.extensions, self.settle, self.exclude = folder, extensions, settle, exclude
+        # path --> (size, mtime, time of the last change)
+        self.pending = {}
+        # path --> (size, mtime) of the reported files
+        self.reported = {}
+
+    def scan(self):
+        """
+        Yield (path, stat) for all candidate files.
+        """
+        folders = [self.folder]
+        while folders:
+            folder = folders.pop()
+            try:
+                entries = list(os.scandir(folder))
+            except OSError:
+                continue
+            for entry in entries:
+                if entry.name.startswith('.'):
+                    continue
+                try:
+                    if entry.is_dir():
+                        if entry.path != self.exclude:
+                            folders.append(entry.path)
+                    elif entry.name.endswith(self.extensions):
+                        yield entry.path, entry.stat()
+                except OSError:
+                    # deleted meanwhile
+                    continue
+
+    def poll(self):
+        """
+        Return the list of (path, stat) of files which
+        became ready since the last call.
+        @return:
+        @rtype: list of 2-uples
+        """
+        now, ready, seen = monotonic(), [], set()
+        for path, stat in self.scan():
+            seen.add(path)
+            key = (stat.st_size, stat.st_mtime_ns)
+            if self.reported.get(path) == key:
+                continue
+            p = self.pending.get(path)
+            if p is None or p[:2] != key:
+                # new or still growing
+                self.pending[path] = key + (now,)
+            elif stat.st_size > 0 and now - p[2] >= self.settle:
+                del self.pending[path]
+                self.reported[path] = key
+                ready.append((path, stat))
+        # forget deleted files
+        for d in (self.pending, self.reported):
+            for path in [p for p in d if p not in seen]:
+                del d[path]
+        return ready
+
+
+class Status:
+    """
+    Counters and recent timings of the daemon.
+    """
+    def __init__(self, folder, maxRecent=20):
+        self.lock = threading.Lock()
+        self.folder = folder
+        self.start = time()
+        self.queued, self.inFlight, self.done, self.failed, self.mpx = 0, 0, 0, 0, 0.0
+        self.recent = deque(maxlen=maxRecent)
+
+    def update(self, src, t, mpx, error):
+        with self.lock:
+            self.inFlight -= 1
+            if error is None:
+                self.done += 1
+                self.mpx += mpx
+            else:
+                self.failed += 1
+            self.recent.append({'src': src, 'time': round(t, 3), 'mpx': round(mpx, 2), 'error': error})
+
+    def toDict(self):
+        with self.lock:
+            times = [r['time'] for r in self.recent if r['error'] is None]
+            return {'folder': self.folder,
+                    'uptime': round(time() - self.start),
+                    'queued': self.queued,
+                    'inFlight': self.inFlight,
+                    'done': self.done,
+                    'failed': self.failed,
+                    'mpx': round(self.mpx, 1),
+                    'meanTime': round(sum(times) / len(times), 3) if times else None,
+                    'recent': list(self.recent)}
+
+
+def startStatusServer(status, port):
+    """
+    Serve the status as JSON on http://127.0.0.1:port/status.
+    @param status:
+    @type status: Status
+    @param port:
+    @type port: int
+    @return:
+    @rtype: ThreadingHTTPServer
+    """
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.rstrip('/') not in ('', '/status'):
+                self.send_error(404)
+                return
+            body = json.dumps(status.toDict(), indent=1).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def _initWorker(*args):
+    # interruptions are handled by the main process
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    batch.initWorker(*args)
+
+
+def watch(stack, folder, outDir, fmt, quality=-1, jobs=None, metadata=True, thumbSize=256, settle=1.0,
+          interval=0.25, statusPort=0, journalFile=None, stop=None, out=sys.stdout):
+    """
+    Process the new image files of folder until stop is set.
+    Outputs and thumbnails (in the subdirectory THUMBNAIL_DIR) are
+    written to outDir, reproducing the directory tree of folder (cf. batch.outputPath()).
+    @param stack: layer parameters
+    @type stack: list of dataclass
+    @param folder:
+    @type folder: str
+    @param outDir:
+    @type outDir: str
+    @param fmt:
+    @type fmt: str
+    @param quality:
+    @type quality: int
+    @param jobs: count of worker processes, default cpu count
+    @type jobs: int
+    @param metadata: copy metadata
+    @type metadata: boolean
+    @param thumbSize: 0 for no thumbnail
+    @type thumbSize: int
+    @param settle: delay (s) without change before a file is processed
+    @type settle: float
+    @param interval: polling interval (s)
+    @type interval: float
+    @param statusPort: port of the status endpoint, 0 for none
+    @type statusPort: int
+    @param journalFile: default outDir/JOURNAL_NAME
+    @type journalFile: str
+    @param stop:
+    @type stop: threading.Event
+    @param out:
+    @type out: file
+    """
+    folder, outDir = os.path.abspath(folder), os.path.abspath(outDir)
+    stop = stop or threading.Event()
+    cpus = os.cpu_count() or 1
+    jobs = max(1, jobs or cpus)
+    os.makedirs(outDir, exist_ok=True)
+    journal = Journal(journalFile or os.path.join(outDir, JOURNAL_NAME))
+    watcher = Watcher(folder, IMAGE_FILE_EXTENSIONS + RAW_FILE_EXTENSIONS, settle=settle, exclude=outDir)
+    status = Status(folder)
+    server = startStatusServer(status, statusPort) if statusPort else None
+    # keep the workers busy while the next files are decoded
+    slots = threading.Semaphore(2 * jobs)
+    pool = multiprocessing.Pool(jobs, initializer=_initWorker,
+                                initargs=(stack, fmt, quality, metadata, max(1, cpus // jobs), thumbSize))
+
+    def done(result, stat):
+        src, dst, t, mpx, error = result
+        slots.release()
+        journal.record(src, stat, dst, error=error)
+        status.update(src, t, mpx, error)
+        if error is None:
+            print('%s  %.2f s  %.1f Mpx' % (dst, t, mpx), file=out, flush=True)
+        else:
+            print('%s  FAILED  %s' % (src, error), file=out, flush=True)
+
+    def acquireSlot():
+        # wait for a free slot, return False if stopped
+        while not slots.acquire(timeout=interval):
+            if stop.is_set():
+                return False
+        return True
+
+    print('Watching %s' % folder + (' (status : http://127.0.0.1:%d/status)' % statusPort if server else ''),
+          file=out, flush=True)
+    try:
+        while not stop.is_set():
+            for src, stat in watcher.poll():
+                if journal.isDone(src, stat):
+                    continue
+                dst = batch.outputPath(src, folder, outDir, fmt)
+                thumb = batch.outputPath(src, folder, os.path.join(outDir, THUMBNAIL_DIR), 'jpg') if thumbSize > 0 else None
+                for f in (dst, thumb):
+                    if f is not None:
+                        os.makedirs(os.path.dirname(f), exist_ok=True)
+                if not acquireSlot():
+                    break
+                with status.lock:
+                    status.queued += 1
+                    status.inFlight += 1
+                pool.apply_async(batch.processFile, ((src, dst, thumb),),
+                                 callback=lambda result, stat=stat: done(result, stat),
+                                 error_callback=lambda e, task=(src, dst), stat=stat:
+                                 done(task + (0, 0, '%s: %s' % (type(e).__name__, e)), stat))
+            stop.wait(interval)
+    finally:
+        # finish the files in flight
+        pool.close()
+        pool.join()
+        journal.close()
+        if server is not None:
+            server.shutdown()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='bLUe watch',
+                                     description='Develop and export the new image files of a folder.')
+    parser.add_argument('look', help='layer stack (.json, cf. Layer menu) or 3D LUT (.cube)')
+    parser.add_argument('folder', help='watched folder')
+    parser.add_argument('-o', '--output', required=True, help='output directory')
+    parser.add_argument('-f', '--format', choices=sorted(batch.outputFormats), default='jpg', help='output format')
+    parser.add_argument('-q', '--quality', type=int, default=-1,
+                        help='jpeg quality (0..100) or png compression (0..9)')
+    parser.add_argument('-j', '--jobs', type=int, default=0, help='worker processes, default cpu count')
+    parser.add_argument('--thumb-size', type=int, default=256, help='thumbnail size, 0 for no thumbnail')
+    parser.add_argument('--settle', type=float, default=1.0,
+                        help='delay (s) without change before a file is processed')
+    parser.add_argument('--interval', type=float, default=0.25, help='polling interval (s)')
+    parser.add_argument('--status-port', type=int, default=0, help='port of the local status endpoint')
+    parser.add_argument('--journal', help='journal file, default OUTDIR/%s' % JOURNAL_NAME)
+    parser.add_argument('--no-metadata', action='store_true', help='do not copy metadata')
+    args = parser.parse_args(argv)
+    try:
+        stack = pipeline.loadLook(args.look)
+        pipeline.splitRaw(stack)
+    except (IOError, ValueError) as e:
+        print('Cannot load %s : %s' % (args.look, e), file=sys.stderr)
+        return 2
+    if not os.path.isdir(args.folder):
+        print('%s is not a directory' % args.folder, file=sys.stderr)
+        return 2
+    metadata = not args.no_metadata
+    if metadata and shutil.which(EXIFTOOL_PATH) is None:
+        print('exiftool not found (cf. EXIFTOOL_PATH in config.json) : metadata are not copied', file=sys.stderr)
+        metadata = False
+    # stop watching and finish the files in flight
+    stop = threading.Event()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(sig, lambda *args: stop.set())
+    watch(stack, args.folder, args.output, args.format, quality=args.quality, jobs=args.jobs,
+          metadata=metadata, thumbSize=args.thumb_size, settle=args.settle, interval=args.interval,
+          statusPort=args.status_port, journalFile=args.journal, stop=stop)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
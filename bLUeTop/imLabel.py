@@ -25,7 +25,7 @@ from PySide2.QtWidgets import QLabel, QApplication
 
 from bLUeGui.dialog import dlgWarn
 from bLUeTop.drawing import bLUeFloodFill, brushFamily
-from bLUeTop.settings import MAX_ZOOM
+from bLUeTop.settings import MAX_ZOOM, USE_DIRTY_RECTS
 from bLUeTop.utils import checkeredImage
 from bLUeTop.versatileImg import vImage
 
@@ -114,6 +114,29 @@ class imageLabel(QLabel):
         self.State = {'ix': 0, 'iy': 0, 'ix_begin': 0, 'iy_begin': 0, 'cloning': ''}
         self.img = None
 
+    def updatePreview(self):
+        """
+        Sync the preview resolution of the displayed image with
+        the zoom and the visible region of the label (cf. mImage.updatePreview()).
+        """
+        img = self.img
+        if img is None:
+            return
+        r = img.resize_coeff(self)
+        visible = QRectF(-img.xOffset / r, -img.yOffset / r, self.width() / r, self.height() / r).toAlignedRect()
+        visible = visible.intersected(QRect(0, 0, img.width(), img.height()))
+        if not visible.isEmpty():
+            img.updatePreview(r, visible)
+
+    def resizeEvent(self, e):
+        """
+        Overrides QLabel resizeEvent().
+        @param e: resize event
+        @type e: QResizeEvent
+        """
+        super().resizeEvent(e)
+        self.updatePreview()
+
     def paintEvent(self, e):
         """
         Overrides QLabel paintEvent().
@@ -228,6 +251,8 @@ class imageLabel(QLabel):
         State['ix'], State['iy'] = x, y
         State['ix_begin'], State['iy_begin'] = x, y
         State['x_imagePrecPos'], State['y_imagePrecPos'] = (x - img.xOffset) // r, (y - img.yOffset) // r
+        # region of the mask modified by the current move
+        State['maskDirtyRect'] = None
         if layer.isDrawLayer():
             layer.history.addItem(layer.sourceImg.copy())
             if window.btnValues['brushButton'] or window.btnValues['bucket']:
@@ -381,6 +406,10 @@ class imageLabel(QLabel):
                             layer.marker = QPointF((tmp_x - layer.xAltOffset) * pxmp.width() / layer.width(),
                                                    (tmp_y - layer.yAltOffset) * pxmp.height() / layer.height())
                             layer.getGraphicsForm().widgetImg.repaint()
+                    m = int(w_pen) + 2
+                    segRect = QRect(int(min(tmp_x, State['x_imagePrecPos'])) - m, int(min(tmp_y, State['y_imagePrecPos'])) - m,
+                                    int(abs(a_x)) + 2 * m + 1, int(abs(a_y)) + 2 * m + 1)
+                    State['maskDirtyRect'] = segRect if State['maskDirtyRect'] is None else State['maskDirtyRect'].united(segRect)
                     State['x_imagePrecPos'], State['y_imagePrecPos'] = tmp_x, tmp_y
                     ############################
                     # update upper stack
@@ -467,7 +496,12 @@ class imageLabel(QLabel):
             if layer.maskIsEnabled \
                     and layer.getUpperVisibleStackIndex() != -1 \
                     and (window.btnValues['drawFG'] or window.btnValues['drawBG']):
-                layer.applyToStack()
+                # the mask of cloning layers controls a global (seamless) transformation
+                dirtyRect = self.State.get('maskDirtyRect')
+                if dirtyRect is not None and not layer.isCloningLayer():
+                    layer.applyToStack(rect=dirtyRect.intersected(QRect(0, 0, img.width(), img.height())))
+                else:
+                    layer.applyToStack()
             if img.isMouseSelectable:
                 # click event
                 if self.clicked:
@@ -535,6 +569,8 @@ class imageLabel(QLabel):
                             # the virtual layer was moved : clone
                             layer.applyCloning(seamless=True, showTranslated=True, moving=True)
                             layer.vlChanged = False
+        # the visible region may have changed
+        self.updatePreview()
         # updates
         self.repaint()
         # sync split views
@@ -578,6 +614,7 @@ class imageLabel(QLabel):
             if layer.isGeomLayer():
                 # layer.view.widget().tool.moveRotatingTool()
                 layer.tool.moveRotatingTool()
+            self.updatePreview()
         elif modifiers == Qt.ControlModifier:
             layer.Zoom_coeff *= (1.0 + numSteps)
             layer.updatePixmap()
@@ -704,6 +741,12 @@ class imageLabel(QLabel):
         # get image coordinates
         x_img = (x - img.xOffset) // r
         y_img = (y - img.yOffset) // r
+        # region modified by the move : the (possibly rotated) brush
+        # pixmap is painted at positions along the segment
+        m = int(State['brush']['size']) + 2
+        x0, y0 = State['x_imagePrecPos'], State['y_imagePrecPos']
+        dirtyRect = QRect(int(min(x0, x_img)) - m, int(min(y0, y_img)) - m,
+                          int(abs(x_img - x0)) + 2 * m + 1, int(abs(y_img - y0)) + 2 * m + 1)
         # draw the stroke
         if self.window.btnValues['brushButton']:
             # drawing onto stroke intermediate layer
@@ -747,7 +790,11 @@ class imageLabel(QLabel):
                                                                                           x_img, y_img,
                                                                                           State['brush'])
             qp.end()
-        # update layer - should be layer.applyToStack() if any upper layer visible : too slow !
-        layer.execute()
-        img.prLayer.update()
+        if USE_DIRTY_RECTS:
+            # update the layer and the upper stack inside the modified region only
+            layer.applyToStack(rect=dirtyRect.intersected(QRect(0, 0, img.width(), img.height())))
+        else:
+            # update layer - should be layer.applyToStack() if any upper layer visible : too slow !
+            layer.execute()
+            img.prLayer.update()
         self.window.label.repaint()
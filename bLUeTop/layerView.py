@@ -29,6 +29,7 @@ from bLUeGui.bLUeImage import QImageBuffer
 from bLUeGui.dialog import dlgWarn
 from bLUeGui.memory import weakProxy
 from bLUeTop.settings import TABBING
+from bLUeTop.stackWorker import waitStackWorker
 from bLUeTop.utils import QbLUeSlider
 from bLUeTop.versatileImg import vImage
 
@@ -152,10 +153,15 @@ class QLayerView(QTableView):
             if self.img is None:
                 return
             useThumb = (state == Qt.Checked)
-            if useThumb == self.img.useThumb:
+            if useThumb == self.img.previewMode:
                 return
+            refined = self.img.refined
             self.img.useThumb = useThumb
             window.updateStatus()
+            if refined:
+                # progressive rendering : the full resolution image is up to date
+                self.img.onImageChanged()
+                return
             self.img.cacheInvalidate()
             try:
                 QApplication.setOverrideCursor(Qt.WaitCursor)  # TODO 18/04/18 waitcursor already called by applytostack
@@ -481,7 +487,7 @@ Note that upper visible layers slow down mask edition.<br>
         self.maskSlider.setSliderPosition(int(activeLayer.colorMaskOpacity * 100.0 / 255.0))
         ind = self.blendingModeCombo.findData(activeLayer.compositionMode)
         self.blendingModeCombo.setCurrentIndex(ind)
-        self.previewOptionBox.setChecked(activeLayer.parentImage.useThumb)
+        self.previewOptionBox.setChecked(activeLayer.parentImage.previewMode)
         #activeLayer.maskColor
         self.updateForm()
         """                                                   # TODO removed 25/01/20 useless validate
@@ -647,7 +653,7 @@ Note that upper visible layers slow down mask edition.<br>
                     layer.parentImage.layersStack[i].applyToStack()
                 else:
                     # top layer : update only the presentation layer
-                    layer.parentImage.prLayer.execute(l=None, pool=None)
+                    layer.parentImage.prLayer.update()
             self.img.onImageChanged()
         # update displayed window and active layer
         activeStackIndex = len(self.img.layersStack) - 1 - row
@@ -886,25 +892,28 @@ Note that upper visible layers slow down mask edition.<br>
                 pass
 
         def maskInvert():
+            waitStackWorker()
             layer.invertMask()
             # update mask stack
             layer.applyToStack()
             self.img.onImageChanged()
 
         def maskReset_UM():
+            waitStackWorker()
             layer.resetMask(maskAll=False)
             # update mask stack
             for l in self.img.layersStack:
                 l.updatePixmap(maskOnly=True)
-            self.img.prLayer.execute(l=None, pool=None)
+            self.img.prLayer.update()
             self.img.onImageChanged()
 
         def maskReset_M():
+            waitStackWorker()
             layer.resetMask(maskAll=True)
             # update mask stack
             for l in self.img.layersStack:
                 l.updatePixmap(maskOnly=True)
-            self.img.prLayer.execute(l=None, pool=None)
+            self.img.prLayer.update()
             self.img.onImageChanged()
 
         def maskCopy():
@@ -921,12 +930,13 @@ Note that upper visible layers slow down mask edition.<br>
             cb = QApplication.clipboard()
             if not cb.image().isNull():
                 img = cb.image()
+                waitStackWorker()
                 if img.size() == layer.mask.size():
                     layer.mask = img
                 else:
                     layer.mask = img.scaled(layer.mask.size())
+            # the stack evaluation updates the presentation layer
             layer.applyToStack()
-            self.img.prLayer.execute(l=None, pool=None)
             self.img.onImageChanged()
 
         def imagePaste():
@@ -937,6 +947,7 @@ Note that upper visible layers slow down mask edition.<br>
             cb = QApplication.clipboard()
             if not cb.image().isNull():
                 srcImg = cb.image()
+                waitStackWorker()
                 if srcImg.size() == layer.size():
                     layer.setImage(srcImg)
                 else:
@@ -948,6 +959,7 @@ Note that upper visible layers slow down mask edition.<br>
             """
             Increase the masked part of the image
             """
+            waitStackWorker()
             buf = QImageBuffer(layer.mask)
             buf[:, :, 2] = vImage.maskDilate(buf[:, :, 2])
             for l in self.img.layersStack:
@@ -959,6 +971,7 @@ Note that upper visible layers slow down mask edition.<br>
             """
             Reduce the masked part of the image
             """
+            waitStackWorker()
             buf = QImageBuffer(layer.mask)
             buf[:, :, 2] = vImage.maskErode(buf[:, :, 2])
             for l in self.img.layersStack:
@@ -970,6 +983,7 @@ Note that upper visible layers slow down mask edition.<br>
             """
             Smooth the mask boundary
             """
+            waitStackWorker()
             buf = QImageBuffer(layer.mask)
             buf[:, :, 2] = vImage.maskSmooth(buf[:, :, 2])
             for l in self.img.layersStack:
@@ -978,6 +992,7 @@ Note that upper visible layers slow down mask edition.<br>
             self.img.onImageChanged()
 
         def maskBright1():
+            waitStackWorker()
             layer.setMaskLuminosity(min=128, max=255)
             for l in self.img.layersStack:
                 l.updatePixmap(maskOnly=True)
@@ -985,6 +1000,7 @@ Note that upper visible layers slow down mask edition.<br>
             self.img.onImageChanged()
 
         def maskBright2():
+            waitStackWorker()
             layer.setMaskLuminosity(min=192, max=255)
             for l in self.img.layersStack:
                 l.updatePixmap(maskOnly=True)
@@ -992,6 +1008,7 @@ Note that upper visible layers slow down mask edition.<br>
             self.img.onImageChanged()
 
         def maskBright3():
+            waitStackWorker()
             layer.setMaskLuminosity(min=224, max=255)
             for l in self.img.layersStack:
                 l.updatePixmap(maskOnly=True)
@@ -999,9 +1016,11 @@ Note that upper visible layers slow down mask edition.<br>
             self.img.onImageChanged()
 
         def maskDark1():
+            waitStackWorker()
             layer.setMaskLuminosity(min=0, max=128)
 
         def maskDark2():
+            waitStackWorker()
             layer.setMaskLuminosity(min=0, max=64)
             for l in self.img.layersStack:
                 l.updatePixmap(maskOnly=True)
@@ -1009,6 +1028,7 @@ Note that upper visible layers slow down mask edition.<br>
             self.img.onImageChanged()
 
         def maskDark3():
+            waitStackWorker()
             layer.setMaskLuminosity(min=0, max=32)
             for l in self.img.layersStack:
                 l.updatePixmap(maskOnly=True)
@@ -1016,6 +1036,7 @@ Note that upper visible layers slow down mask edition.<br>
             self.img.onImageChanged()
 
         def maskMid1():
+            waitStackWorker()
             layer.setMaskLuminosity(min=64, max=192)
             for l in self.img.layersStack:
                 l.updatePixmap(maskOnly=True)
@@ -1023,6 +1044,7 @@ Note that upper visible layers slow down mask edition.<br>
             self.img.onImageChanged()
 
         def maskMid2():
+            waitStackWorker()
             layer.setMaskLuminosity(min=96, max=160)
             for l in self.img.layersStack:
                 l.updatePixmap(maskOnly=True)
@@ -1030,6 +1052,7 @@ Note that upper visible layers slow down mask edition.<br>
             self.img.onImageChanged()
 
         def maskMid3():
+            waitStackWorker()
             layer.setMaskLuminosity(min=112, max=144)
             for l in self.img.layersStack:
                 l.updatePixmap(maskOnly=True)
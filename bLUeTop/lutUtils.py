@@ -19,12 +19,19 @@ along with this program. If not, see <http://www.gnu.org/licenses/>.
 # Initializes LUT3D related constants
 #####################################
 
+from bLUeCore.bakedLUT import BakedLUTCache
 from bLUeCore.bLUeLUT3D import LUT3D
+from bLUeCore.tetrahedral import interpTetra
+from bLUeCore.trilinear import interpTriLinear
+from bLUeTop.settings import USE_TETRA, BAKED_LUT_CACHE_MB
 
 LUTSIZE = LUT3D.defaultSize
 LUT3DIdentity = LUT3D(None, size=LUTSIZE)
 LUTSTEP = LUT3DIdentity.step
 LUT3D_ORI = LUT3DIdentity.LUT3DArray
+
+# dense tables baked from 3D LUTs
+bakedLUTCache = BakedLUTCache(BAKED_LUT_CACHE_MB * 2 ** 20, interp=interpTetra if USE_TETRA else interpTriLinear)
 """
 __a, __b, __c, __d = LUT3D_ORI.shape
 LUT3D_SHADOW = np.zeros((__a, __b, __c, __d+1))
@@ -0,0 +1,987 @@
+"""
+This File is part of bLUe software.
+
+Copyright (C) 2017  Bernard Virot <bernard.virot@libertysurf.fr>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Lesser General Public License as
+published by the Free Software Foundation, version 3.
+
+This program is distributed in the hope that it will be useful, but
+WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+Lesser General Lesser Public License for more details.
+
+You should have received a copy of the GNU Lesser General Public License
+along with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+import json
+import os
+import threading
+from dataclasses import dataclass, field, fields, replace
+from typing import ClassVar
+
+import cv2
+import numpy as np
+
+from bLUeCore.bLUeLUT3D import LUT3D
+from bLUeCore.kernel import filterIndex, getKernel
+from bLUeCore.multi import chosenInterp
+from bLUeCore.tiles import tileEngine
+from bLUeGui.blendBuf import blendLuminosityBuf
+from bLUeGui.colorCIE import rgb2rgbLinear, rgbLinear2rgb, bbTemperature2RGB, sRGB_lin2XYZ, sRGB_lin2XYZInverse, \
+    sRGB2LabVec, Lab2sRGBVec
+from bLUeGui.colorCube import hsv2rgbVec
+from bLUeGui.multiplier import temperatureAndTint2Multipliers
+from bLUeTop.lutUtils import bakedLUTCache
+from bLUeTop.settings import WORKING_DTYPE, LUT_CACHE_DIR
+
+#####################################################################
+# Headless execution of layer transformations.
+# The parameters of each layer type are held by a plain
+# dataclass, built by the graphic form of the layer (cf. abstractForm.getParams()),
+# or loaded from a file. Transformations are pure functions
+# apply(params, inBuf, outBuf, ctx), working on BGRA
+# uint8 buffers (QImageBuffer layout). The module does not
+# use any widget, so stacks can be run without display,
+# from worker processes. The methods vImage.applyXXX() of the
+# corresponding layers delegate to these functions.
+# Layer types without parameter class (contrast, noise reduction,
+# HV 2D LUT, HDR merge, geometric transformations, cloning,
+# segmentation, drawing, images) are not run headless.
+#####################################################################
+
+
+@dataclass
+class ApplyContext:
+    """
+    Environment of a transformation.
+    RGB_lin2XYZ and RGB_lin2XYZInverse are the conversion matrices of the
+    working color space. stats holds the global statistics imposed by
+    tiled rendering, or None, and computed statistics are
+    recorded into recorded (cf. vImage.getImposedStat() and vImage.recordStat()).
+    linearIn and linearOut are optional linear RGB buffers, shared
+    by adjacent linear light layers (cf. QLayer.getLinearInput()).
+    For tiles, origin is the position of the buffer in the
+    whole image and fullSize the size (w, h) of the whole image, or None
+    if the buffer is the whole image (cf. bLUeTop.tiledRender).
+    """
+    RGB_lin2XYZ: np.ndarray = field(default_factory=lambda: np.array(sRGB_lin2XYZ))
+    RGB_lin2XYZInverse: np.ndarray = field(default_factory=lambda: np.array(sRGB_lin2XYZInverse))
+    stats: dict = None
+    recorded: dict = field(default_factory=dict)
+    linearIn: np.ndarray = None
+    linearOut: np.ndarray = None
+    pool: object = None
+    origin: tuple = (0, 0)
+    fullSize: tuple = None
+
+    def getImposedStat(self, key):
+        """
+        Return the imposed value of the statistic key, or None.
+        @param key:
+        @type key: str
+        @return:
+        @rtype: object
+        """
+        return None if self.stats is None else self.stats.get(key)
+
+    def recordStat(self, key, value):
+        """
+        Record the value of the statistic key.
+        @param key:
+        @type key: str
+        @param value:
+        @type value: object
+        """
+        self.recorded[key] = value
+
+
+@dataclass
+class ExposureParams:
+    kind: ClassVar[str] = 'exposure'
+    # diaphragm stops
+    correction: float = 0.0
+
+    def isNeutral(self):
+        return abs(self.correction) < 0.05
+
+
+@dataclass
+class MixerParams:
+    kind: ClassVar[str] = 'mixer'
+    # out = matrix @ v, v linear RGB
+    matrix: np.ndarray = field(default_factory=lambda: np.identity(3))
+    luminosity: bool = False
+
+    def isNeutral(self):
+        return not np.any(np.asarray(self.matrix) - np.identity(3))
+
+
+@dataclass
+class TemperatureParams:
+    kind: ClassVar[str] = 'temperature'
+    # 'Color Filter', 'Photo Filter' or 'Chromatic Adaptation'
+    mode: str = 'Color Filter'
+    temperature: float = 6500
+    # range -1..1
+    tint: float = 0.0
+    # r, g, b
+    filterColor: tuple = (255, 255, 255)
+
+    def isNeutral(self):
+        return self.mode != 'Color Filter' and abs(self.temperature - 6500) < 200 and self.tint == 0
+
+
+@dataclass
+class RGBCurvesParams:
+    kind: ClassVar[str] = 'rgbCurves'
+    # a row for each R, G, B channel, values 0..255
+    lut: np.ndarray = field(default_factory=lambda: np.vstack((np.arange(256),) * 3))
+    luminosity: bool = False
+
+    def isNeutral(self):
+        return not np.any(np.asarray(self.lut) - np.arange(256))
+
+
+@dataclass
+class LUT3DParams:
+    kind: ClassVar[str] = 'lut3D'
+    # .cube file
+    path: str = ''
+    keepAlpha: bool = True
+
+    def isNeutral(self):
+        return not self.path
+
+
+@dataclass
+class HSVCurvesParams:
+    kind: ClassVar[str] = 'hsvCurves'
+    # a row for each H, S, V channel, values 0..255 (H range 0..180)
+    lut: np.ndarray = field(default_factory=lambda: np.vstack((np.arange(256),) * 3))
+
+    def isNeutral(self):
+        return not np.any(np.asarray(self.lut) - np.arange(256))
+
+
+@dataclass
+class LabCurvesParams:
+    kind: ClassVar[str] = 'labCurves'
+    # a row for each L, a, b channel, values 0..255
+    lut: np.ndarray = field(default_factory=lambda: np.vstack((np.arange(256),) * 3))
+
+    def isNeutral(self):
+        return not np.any(np.asarray(self.lut) - np.arange(256))
+
+
+@dataclass
+class InvertParams:
+    kind: ClassVar[str] = 'invert'
+    # estimate the orange mask from the brightest pixel
+    auto: bool = True
+    # r, g, b orange mask, ignored if auto is True
+    mask: tuple = (128, 128, 128)
+
+    def isNeutral(self):
+        return False
+
+
+@dataclass
+class Filter2DParams:
+    kind: ClassVar[str] = 'filter2D'
+    # cf. bLUeCore.kernel.filterIndex
+    category: int = filterIndex.UNSHARP
+    # pixels
+    radius: int = 10
+    amount: float = 50.0
+    # bilateral filtering (surface blur) only
+    tone: float = 100.0
+
+    def isNeutral(self):
+        return self.category == filterIndex.IDENTITY
+
+
+class blendFilterIndex:
+    GRADUALBT, GRADUALTB, GRADUALNONE = range(3)
+
+
+@dataclass
+class GradualFilterParams:
+    kind: ClassVar[str] = 'gradualFilter'
+    # cf. blendFilterIndex
+    category: int = blendFilterIndex.GRADUALTB
+    # filter range, percent of the image height
+    start: int = 0
+    end: int = 99
+
+    def isNeutral(self):
+        return self.end <= 4
+
+
+@dataclass
+class RawParams:
+    """
+    Raw development parameters (cf. graphicsRaw.rawForm). They are
+    not a transformation of a buffer : they are applied when a raw
+    file is loaded (cf. rawStages.developRaw()), so they can only
+    be the first item of a stack.
+    """
+    kind: ClassVar[str] = 'raw'
+    # 'Auto WB', 'Camera WB' or 'User WB'
+    whiteBalance: str = 'Camera WB'
+    # user white balance
+    temperature: float = 6500
+    tint: float = 1.0
+    autoBrightness: bool = True
+    # linear exposure multiplier, ignored if autoBrightness is True
+    exposure: float = 1.0
+    brightness: float = 1.0
+    preserveHighlights: bool = True
+    # 0: clip, 1: ignore, 2: blend, 3: rebuild
+    highlightMode: int = 0
+    # 0: off, 1: light, 2: full
+    denoise: int = 0
+    # dng or dcp profile file, '' for the profile embedded in the raw file, None for no profile
+    profile: str = ''
+    lookTable: bool = True
+    # user tone curve (LUTXY, values 0..255), or None
+    toneCurve: list = None
+    # automatic contrast correction, 0 for none
+    contrast: float = 0.0
+    # range -50..50
+    saturation: float = 0.0
+
+    def isNeutral(self):
+        return False
+
+
+##########################
+# linear light
+##########################
+
+def linearLightKernel(transform):
+    """
+    Return a tile kernel applying transform to linear RGB values (cf.
+    ApplyContext.linearIn). The kernel must be run with aux=(linearIn, linearOut),
+    (cf. bLUeCore.tiles.TileEngine.run()) : input values are read from linearIn
+    if it is not None, and output values are kept in linearOut if it is not None.
+    transform(buf) must not modify buf. Its output is clipped to 0..1.
+    @param transform:
+    @type transform: function
+    @return:
+    @rtype: function
+    """
+    def kernel(bufIn, bufOut, linIn, linOut):
+        # convert to linear
+        buf = rgb2rgbLinear(bufIn[:, :, :3][:, :, ::-1]) if linIn is None else linIn
+        buf = transform(buf)
+        np.clip(buf, 0.0, 1.0, out=buf)
+        if linOut is not None:
+            linOut[...] = buf
+        # convert back to RGB
+        bufOut[:, :, :3][:, :, ::-1] = np.round(rgbLinear2rgb(buf))
+        # forward the alpha channel
+        bufOut[:, :, 3] = bufIn[:, :, 3]
+    return kernel
+
+
+def applyLinearTransform(transform, inBuf, outBuf, ctx):
+    """
+    Apply a transformation of linear RGB values (cf. linearLightKernel()).
+    @param transform:
+    @type transform: function
+    @param inBuf:
+    @type inBuf: ndarray, dtype uint8, shape (h, w, 4)
+    @param outBuf:
+    @type outBuf: ndarray, dtype uint8, shape (h, w, 4)
+    @param ctx:
+    @type ctx: ApplyContext
+    """
+    tileEngine.run(linearLightKernel(transform), inBuf, outBuf, aux=(ctx.linearIn, ctx.linearOut))
+
+
+def matrixTransform(M):
+    """
+    Return the transformation v --> M @ v of linear RGB values.
+    @param M:
+    @type M: ndarray, shape (3, 3)
+    @return:
+    @rtype: function
+    """
+    M = np.asarray(M, dtype=WORKING_DTYPE)
+    return lambda buf: np.tensordot(buf, M, axes=(-1, -1))
+
+
+##########################
+# Transformations
+##########################
+
+def applyExposure(params, inBuf, outBuf, ctx):
+    """
+    Multiply the linearized RGB channels by
+    c = 2**params.correction.
+    @param params:
+    @type params: ExposureParams
+    @param inBuf:
+    @type inBuf: ndarray, dtype uint8, shape (h, w, 4)
+    @param outBuf:
+    @type outBuf: ndarray, dtype uint8, shape (h, w, 4)
+    @param ctx:
+    @type ctx: ApplyContext
+    """
+    c = np.array(2 ** params.correction, dtype=WORKING_DTYPE)
+    applyLinearTransform(lambda buf: buf * c, inBuf, outBuf, ctx)
+
+
+def applyMixer(params, inBuf, outBuf, ctx):
+    """
+    Mix the linearized RGB channels. If params.luminosity is True,
+    the luminosity of the mix is blended with the input image.
+    @param params:
+    @type params: MixerParams
+    @param inBuf:
+    @type inBuf: ndarray, dtype uint8, shape (h, w, 4)
+    @param outBuf:
+    @type outBuf: ndarray, dtype uint8, shape (h, w, 4)
+    @param ctx:
+    @type ctx: ApplyContext
+    """
+    if not params.luminosity:
+        applyLinearTransform(matrixTransform(params.matrix), inBuf, outBuf, ctx)
+        return
+    mixerMatrix = np.asarray(params.matrix)
+
+    def kernel(bufIn, bufOut):
+        # convert to linear
+        buf = rgb2rgbLinear(bufIn[:, :, :3][:, :, ::-1])
+        # mix channels
+        buf = np.tensordot(buf, mixerMatrix, axes=(-1, -1))
+        np.clip(buf, 0, 1.0, out=buf)
+        # convert back to RGB
+        buf = rgbLinear2rgb(buf)
+        bufOut[:, :, :3][:, :, ::-1] = blendLuminosityBuf(bufIn[:, :, :3][:, :, ::-1], buf)
+        # forward the alpha channel
+        bufOut[:, :, 3] = bufIn[:, :, 3]
+
+    tileEngine.run(kernel, inBuf, outBuf)
+
+
+def chromaticAdaptationMatrix(params, ctx):
+    """
+    Return the matrix of the chromatic adaptation : conversion to XYZ,
+    back to linear RGB and RGB multipliers.
+    @param params:
+    @type params: TemperatureParams
+    @param ctx:
+    @type ctx: ApplyContext
+    @return:
+    @rtype: ndarray, shape (3, 3)
+    """
+    m1, m2, m3, _ = temperatureAndTint2Multipliers(params.temperature, 2 ** params.tint, ctx.RGB_lin2XYZInverse)
+    return np.diag([m1, m2, m3]) @ ctx.RGB_lin2XYZInverse @ ctx.RGB_lin2XYZ
+
+
+def applyTemperature(params, inBuf, outBuf, ctx):
+    """
+    Warming/cooling filter.
+    The function implements two algorithms.
+    - Photo/Color filter : Blending using mode multiply, plus correction of luminosity
+        by blending the output image with the input image, using mode luminosity.
+    - Chromatic adaptation : multipliers in linear RGB. Linear values
+        are kept in ctx.linearOut, if it is not None.
+    @param params:
+    @type params: TemperatureParams
+    @param inBuf:
+    @type inBuf: ndarray, dtype uint8, shape (h, w, 4)
+    @param outBuf:
+    @type outBuf: ndarray, dtype uint8, shape (h, w, 4)
+    @param ctx:
+    @type ctx: ApplyContext
+    """
+    ################
+    # photo filter
+    ################
+    if params.mode in ('Photo Filter', 'Color Filter'):
+        if params.mode == 'Photo Filter':
+            # get black body color
+            r, g, b = bbTemperature2RGB(params.temperature)
+        else:
+            r, g, b = params.filterColor
+        color = np.array((b, g, r), dtype=WORKING_DTYPE)
+
+        def kernel(bufIn, bufOut):
+            # multiply the (opaque) filter by the input image
+            alpha = bufIn[:, :, 3:] / np.array(255.0, dtype=WORKING_DTYPE)
+            filtered = np.round(color * (1 - alpha + alpha * (bufIn[:, :, :3] / np.array(255.0, dtype=WORKING_DTYPE))))
+            # correct the luminosity of the result, by blending
+            # it with the input image, using mode luminosity.
+            bufOut[:, :, :3][:, :, ::-1] = blendLuminosityBuf(filtered[:, :, ::-1], bufIn[:, :, :3][:, :, ::-1])
+            # forward the alpha channel
+            bufOut[:, :, 3] = bufIn[:, :, 3]
+
+        tileEngine.run(kernel, inBuf, outBuf)
+    #####################
+    # Chromatic adaptation
+    #####################
+    elif params.mode == 'Chromatic Adaptation':
+        A = chromaticAdaptationMatrix(params, ctx).astype(WORKING_DTYPE)
+        bufLinear = ctx.linearOut
+        if bufLinear is None:
+            bufLinear = np.empty(inBuf.shape[:2] + (3,), dtype=WORKING_DTYPE)
+        maxList = []
+
+        # first pass : linear values and band maxima
+        def kernel1(buf, bufLin, linIn):
+            if linIn is None:
+                linIn = rgb2rgbLinear(buf[:, :, :3][:, :, ::-1])
+            bufLin[...] = np.tensordot(linIn, A, axes=(-1, -1))
+            maxList.append(np.max(bufLin))
+
+        tileEngine.run(kernel1, inBuf, bufLinear, aux=(ctx.linearIn,))
+        # brightness correction
+        M = ctx.getImposedStat('max')
+        if M is None:
+            M = max(maxList)
+            ctx.recordStat('max', M)
+
+        # second pass : back to RGB
+        def kernel2(bufLin, bufOut):
+            bufLin /= M
+            np.clip(bufLin, 0.0, 1.0, out=bufLin)
+            bufOut[:, :, :3][:, :, ::-1] = np.round(rgbLinear2rgb(bufLin))
+
+        tileEngine.run(kernel2, bufLinear, outBuf)
+        # forward the alpha channel
+        outBuf[:, :, 3] = inBuf[:, :, 3]
+    else:
+        raise ValueError('applyTemperature : wrong mode %s' % params.mode)
+
+
+def applyRGBCurves(params, inBuf, outBuf, ctx):
+    """
+    Apply 1D LUTS to R, G, B channels (one for each channel).
+    If params.luminosity is True, the luminosity of the result
+    is blended with the input image.
+    @param params:
+    @type params: RGBCurvesParams
+    @param inBuf:
+    @type inBuf: ndarray, dtype uint8, shape (h, w, 4)
+    @param outBuf:
+    @type outBuf: ndarray, dtype uint8, shape (h, w, 4)
+    @param ctx:
+    @type ctx: ApplyContext
+    """
+    stackedLUT = np.asarray(params.lut)
+    luminosity = params.luminosity
+
+    def kernel(ndImg0a, ndImg1a):
+        ndImg0 = ndImg0a[:, :, :3]
+        ndImg1 = ndImg1a[:, :, :3]
+        # apply LUTS to channels
+        s = ndImg0[:, :, 0].shape
+        if luminosity:
+            buf = np.empty_like(ndImg1)
+            for c in range(3):  # 0.36s for 15Mpx
+                buf[:, :, c] = np.take(stackedLUT[2 - c, :], ndImg0[:, :, c].reshape((-1,))).reshape(s)
+            ndImg1[..., :: -1] = blendLuminosityBuf(ndImg0[..., ::-1], buf[..., ::-1])
+        else:
+            for c in range(3):  # 0.36s for 15Mpx
+                ndImg1[:, :, c] = np.take(stackedLUT[2 - c, :], ndImg0[:, :, c].reshape((-1,))).reshape(s)
+        # forward alpha channel
+        ndImg1a[:, :, 3] = ndImg0a[:, :, 3]
+
+    tileEngine.run(kernel, inBuf, outBuf)
+
+
+def applyHSVCurves(params, inBuf, outBuf, ctx, hsvBuf=None):
+    """
+    Apply 1D LUTS to the H, S, V channels (one for each channel).
+    @param params:
+    @type params: HSVCurvesParams
+    @param inBuf:
+    @type inBuf: ndarray, dtype uint8, shape (h, w, 4)
+    @param outBuf:
+    @type outBuf: ndarray, dtype uint8, shape (h, w, 4)
+    @param ctx:
+    @type ctx: ApplyContext
+    @param hsvBuf: HSV buffer of inBuf (opencv ranges), or None (cf. bImage.getHSVBuffer())
+    @type hsvBuf: ndarray, dtype uint8, shape (h, w, 3)
+    """
+    # convert LUT to float to speed up  buffer conversions
+    stackedLUT = np.asarray(params.lut).astype(WORKING_DTYPE)
+    if hsvBuf is None:
+        # range H: 0..180, S:0..255 V:0..255
+        hsvBuf = cv2.cvtColor(inBuf[:, :, :3], cv2.COLOR_BGR2HSV)
+
+    def kernel(HSVImg0, ndImg1a):
+        HSVImg0 = HSVImg0.astype(np.uint8)
+        # apply LUTS
+        HSVImg1 = np.zeros(HSVImg0.shape, dtype=np.uint8)
+        s = HSVImg0[:, :, 0].shape
+        for c in range(3):  # 0.43s for 15Mpx
+            HSVImg1[:, :, c] = np.take(stackedLUT[c, :], HSVImg0[:, :, c].reshape((-1,))).reshape(s)
+        # back to sRGB
+        RGBImg1 = hsv2rgbVec(HSVImg1, cvRange=True)
+        # in place clipping
+        np.clip(RGBImg1, 0, 255, out=RGBImg1)  # mandatory
+        ndImg1a[:, :, :3][:, :, ::-1] = RGBImg1
+
+    tileEngine.run(kernel, hsvBuf, outBuf)
+    # forward the alpha channel
+    outBuf[:, :, 3] = inBuf[:, :, 3]
+
+
+def applyLabCurves(params, inBuf, outBuf, ctx, labBuf=None):
+    """
+    Apply 1D LUTS to the L, a, b channels (one for each channel).
+    @param params:
+    @type params: LabCurvesParams
+    @param inBuf:
+    @type inBuf: ndarray, dtype uint8, shape (h, w, 4)
+    @param outBuf:
+    @type outBuf: ndarray, dtype uint8, shape (h, w, 4)
+    @param ctx:
+    @type ctx: ApplyContext
+    @param labBuf: Lab buffer of inBuf, or None (cf. bImage.getLabBuffer())
+    @type labBuf: ndarray, dtype float32, shape (h, w, 3)
+    """
+    # convert LUT to float to speed up  buffer conversions
+    stackedLUT = np.asarray(params.lut).astype(WORKING_DTYPE)
+    if labBuf is None:
+        labBuf = sRGB2LabVec(inBuf[:, :, :3][:, :, ::-1], dtype=np.float32)
+    # conversion functions
+    offsets = np.array([0.0, 128.0, 128.0], dtype=WORKING_DTYPE)
+
+    def scaleLabBuf(buf):
+        buf = buf + offsets  # copy is mandatory here to avoid the corruption of the cached Lab buffer
+        buf[:, :, 0] *= 255.0
+        return buf
+
+    def scaleBackLabBuf(buf):
+        buf = buf - offsets  # no copy needed here, but seems faster than in place operation!
+        buf[:, :, 0] /= 255.0
+        return buf
+
+    def kernel(ndLabImg0, ndImg1):
+        ndLImg0 = scaleLabBuf(ndLabImg0).astype(np.uint8)
+        # apply LUTS to channels
+        s = ndLImg0[:, :, 0].shape
+        ndLabImg1 = np.zeros(ndLImg0.shape, dtype=np.uint8)
+        for c in range(3):  # 0.43s for 15Mpx
+            ndLabImg1[:, :, c] = np.take(stackedLUT[c, :], ndLImg0[:, :, c].reshape((-1,))).reshape(s)
+        ndLabImg1 = scaleBackLabBuf(ndLabImg1)
+        # back sRGB conversion
+        ndsRGBImg1 = Lab2sRGBVec(ndLabImg1)
+        # in place clipping
+        np.clip(ndsRGBImg1, 0, 255, out=ndsRGBImg1)  # mandatory
+        ndImg1[:, :, :3][:, :, ::-1] = ndsRGBImg1
+
+    tileEngine.run(kernel, labBuf, outBuf)
+    # forward the alpha channel
+    outBuf[:, :, 3] = inBuf[:, :, 3]
+
+
+def applyInvert(params, inBuf, outBuf, ctx):
+    """
+    Invert a negative image, after the removal of its orange mask.
+    If params.auto is True, the mask is estimated from the
+    brightest (unexposed) pixel of the negative (global statistic 'mask').
+    @param params:
+    @type params: InvertParams
+    @param inBuf:
+    @type inBuf: ndarray, dtype uint8, shape (h, w, 4)
+    @param outBuf:
+    @type outBuf: ndarray, dtype uint8, shape (h, w, 4)
+    @param ctx:
+    @type ctx: ApplyContext
+    """
+    bufIn = inBuf[:, :, :3]
+    if params.auto:
+        mask = ctx.getImposedStat('mask')
+        if mask is None:
+            # get orange mask from negative brightest (unexposed) pixels
+            temp = np.sum(bufIn, axis=2)
+            ind = np.unravel_index(np.argmax(temp), temp.shape)
+            mask = bufIn[ind].copy()
+            ctx.recordStat('mask', mask)
+    else:
+        r, g, b = params.mask
+        mask = (b, g, r)
+    # eliminate mask
+    tmp = bufIn / np.asarray(mask, dtype=float)
+    tmp *= 255
+    np.clip(tmp, 0, 255, out=tmp)
+    # invert
+    outBuf[:, :, :3] = 255.0 - tmp
+    # forward the alpha channel
+    outBuf[:, :, 3] = inBuf[:, :, 3]
+
+
+def filter2D(params, buf):
+    """
+    Return the filtered image : convolution with the kernel of
+    params.category (cf. bLUeCore.kernel.getKernel()), or bilateral
+    filtering (surface blur).
+    @param params:
+    @type params: Filter2DParams
+    @param buf:
+    @type buf: ndarray, dtype uint8, shape (h, w, 3), BGR order
+    @return:
+    @rtype: ndarray, dtype uint8, shape (h, w, 3), BGR order
+    """
+    if params.category in [filterIndex.IDENTITY, filterIndex.UNSHARP,
+                           filterIndex.SHARPEN, filterIndex.BLUR1, filterIndex.BLUR2]:
+        kernel = getKernel(params.category, params.radius, params.amount)
+        return cv2.filter2D(buf, -1, kernel)
+    # bilateral filtering
+    sigmaColor = 2 * params.tone
+    sigmaSpace = sigmaColor
+    return cv2.bilateralFilter(buf[:, :, ::-1], params.radius, sigmaColor, sigmaSpace)[:, :, ::-1]
+
+
+def applyFilter2D(params, inBuf, outBuf, ctx):
+    """
+    Apply a 2D filter (cf. filter2D()).
+    @param params:
+    @type params: Filter2DParams
+    @param inBuf:
+    @type inBuf: ndarray, dtype uint8, shape (h, w, 4)
+    @param outBuf:
+    @type outBuf: ndarray, dtype uint8, shape (h, w, 4)
+    @param ctx:
+    @type ctx: ApplyContext
+    """
+    outBuf[:, :, :3] = filter2D(params, inBuf[:, :, :3])
+    # forward the alpha channel
+    outBuf[:, :, 3] = inBuf[:, :, 3]
+
+
+def applyGradualFilter(params, inBuf, outBuf, ctx):
+    """
+    Gradual neutral density filter.
+    We blend a neutral filter with density range 0.5*s...0.5 with the image b,
+    using blending mode overlay : f(a,b) = 2*a*b if b < 0.5 else f(a,b) = 1 - 2*(1-a)(1-b)
+    The filter range is relative to the whole image (cf. ApplyContext.fullSize).
+    @param params:
+    @type params: GradualFilterParams
+    @param inBuf:
+    @type inBuf: ndarray, dtype uint8, shape (h, w, 4)
+    @param outBuf:
+    @type outBuf: ndarray, dtype uint8, shape (h, w, 4)
+    @param ctx:
+    @type ctx: ApplyContext
+    """
+    if params.isNeutral():
+        outBuf[...] = inBuf
+        return
+    buf32Lab = cv2.cvtColor(((inBuf.astype(np.float32)) / 256).astype(np.float32), cv2.COLOR_BGR2Lab)
+    # get height of image
+    h = inBuf.shape[0] if ctx.fullSize is None else ctx.fullSize[1]
+    # build the filter as a 1D array of size h
+    s = 0  # strongest 0
+    opacity = 1 - s
+    if params.category == blendFilterIndex.GRADUALNONE:
+        start, end = 0, h - 1
+    else:
+        start = int(h * params.start / 100.0)
+        end = int(h * params.end / 100.0)
+    test = np.arange(end - start) * opacity / (2.0 * max(end - start - 1, 1)) + 0.5 * s  # range 0.5*s...0.5
+    test = np.concatenate((np.zeros(start) + 0.5 * s, test, np.zeros(h - end) + 0.5))
+    if params.category == blendFilterIndex.GRADUALBT:
+        # rotate filter 180°
+        test = test[::-1]
+    # restrict the filter to the rows of the buffer
+    top = ctx.origin[1]
+    test = test[top:top + inBuf.shape[0]]
+    # blend the filter with the image
+    Lchan = buf32Lab[:, :, 0]
+    test1 = test[:, np.newaxis] + np.zeros(Lchan.shape)
+    buf32Lab[:, :, 0] = np.where(Lchan < 50, Lchan * (test1 * 2.0),
+                                 100.0 - 2.0 * (1.0 - test1) * (100.0 - Lchan))
+    bufRGB32 = cv2.cvtColor(buf32Lab, cv2.COLOR_Lab2RGB)
+    outBuf[:, :, :3][:, :, ::-1] = (bufRGB32 * 255.0).astype(np.uint8)
+    # forward the alpha channel
+    outBuf[:, :, 3] = inBuf[:, :, 3]
+
+
+_lutLock = threading.Lock()
+_luts = {}
+
+
+def getLUT3D(path):
+    """
+    Return the 3D LUT read from the .cube file path. LUTs
+    are loaded once (cf. also settings.LUT_CACHE_DIR).
+    Raise IOError or ValueError.
+    @param path:
+    @type path: str
+    @return:
+    @rtype: LUT3D
+    """
+    with _lutLock:
+        lut = _luts.get(path)
+        if lut is None:
+            lut = LUT3D.readFromTextFile(path, cacheDir=LUT_CACHE_DIR)
+            _luts[path] = lut
+        return lut
+
+
+def interpLUT3D(lut3D, buf, pool=None):
+    """
+    Return the interpolated values of the channels of buf (3 or 4 channels,
+    in BGR(A) order). When the LUT is applied repeatedly, it is baked
+    into a dense table (cf. bLUeCore.bakedLUT) and the interpolation is skipped.
+    @param lut3D:
+    @type lut3D: LUT3D
+    @param buf:
+    @type buf: ndarray, shape (h, w, 3) or (h, w, 4)
+    @param pool:
+    @type pool: multiprocessing.Pool
+    @return:
+    @rtype: ndarray, same shape as buf
+    """
+    LUT = lut3D.getPreparedLUT(channels=3) if buf.shape[-1] == 3 else lut3D.getPreparedLUT()
+    size = buf.shape[0] * buf.shape[1]
+    # use a dense baked table when the LUT is reused enough
+    if buf.dtype == np.uint8:
+        baked = bakedLUTCache.lookup(LUT, size)
+        if baked is not None:
+            return baked.apply(buf)
+    return chosenInterp(pool, size)(LUT, lut3D.step, buf)
+
+
+def applyLUT3D(params, inBuf, outBuf, ctx):
+    """
+    Apply the 3D LUT read from the file params.path.
+    If params.keepAlpha is False, the alpha channel is interpolated too.
+    @param params:
+    @type params: LUT3DParams
+    @param inBuf:
+    @type inBuf: ndarray, dtype uint8, shape (h, w, 4)
+    @param outBuf:
+    @type outBuf: ndarray, dtype uint8, shape (h, w, 4)
+    @param ctx:
+    @type ctx: ApplyContext
+    """
+    lut3D = getLUT3D(params.path)
+    if params.keepAlpha:
+        outBuf[:, :, :3] = interpLUT3D(lut3D, inBuf[:, :, :3], pool=ctx.pool)
+        # forward the alpha channel
+        outBuf[:, :, 3] = inBuf[:, :, 3]
+    else:
+        outBuf[...] = interpLUT3D(lut3D, inBuf, pool=ctx.pool)
+
+
+##########################
+# Layer types and stacks
+##########################
+
+# kind --> (parameter class, transformation)
+layerTypes = {cls.kind: (cls, func) for cls, func in ((ExposureParams, applyExposure),
+                                                      (MixerParams, applyMixer),
+                                                      (TemperatureParams, applyTemperature),
+                                                      (RGBCurvesParams, applyRGBCurves),
+                                                      (LUT3DParams, applyLUT3D),
+                                                      (HSVCurvesParams, applyHSVCurves),
+                                                      (LabCurvesParams, applyLabCurves),
+                                                      (InvertParams, applyInvert),
+                                                      (Filter2DParams, applyFilter2D),
+                                                      (GradualFilterParams, applyGradualFilter),
+                                                      (RawParams, None))}
+
+
+def getHaloRadius(params):
+    """
+    Return the max distance between an output pixel of the transformation
+    of params and the input pixels it depends on, or None if the
+    transformation cannot be applied by tiles (cf. bLUeTop.tiledRender).
+    Global statistics are not taken into account (cf. needsGlobalStats()).
+    @param params:
+    @type params: dataclass
+    @return:
+    @rtype: int or None
+    """
+    if params.kind == RawParams.kind:
+        return None
+    if params.kind == Filter2DParams.kind and not params.isNeutral():
+        # kernel size is radius + 2 (cf. bLUeCore.kernel.getKernel()), bilateral diameter is radius
+        return int(params.radius) + 1
+    return 0
+
+
+def needsGlobalStats(params):
+    """
+    Return True if the transformation of params depends on statistics
+    of the whole image (cf. ApplyContext.getImposedStat()).
+    @param params:
+    @type params: dataclass
+    @return:
+    @rtype: boolean
+    """
+    return ((params.kind == InvertParams.kind and params.auto)
+            or (params.kind == TemperatureParams.kind and params.mode == 'Chromatic Adaptation'))
+
+
+def paramsToDict(params):
+    """
+    Return a JSON serializable dict holding
+    the kind and the fields of params.
+    @param params:
+    @type params: dataclass
+    @return:
+    @rtype: dict
+    """
+    d = {'kind': params.kind}
+    for f in fields(params):
+        v = getattr(params, f.name)
+        d[f.name] = v.tolist() if isinstance(v, np.ndarray) else v
+    return d
+
+
+def paramsFromDict(d):
+    """
+    Inverse of paramsToDict(). Missing fields
+    get their default values.
+    Raise ValueError if the kind is unknown.
+    @param d:
+    @type d: dict
+    @return:
+    @rtype: dataclass
+    """
+    d = dict(d)
+    kind = d.pop('kind', None)
+    if kind not in layerTypes:
+        raise ValueError('Unknown layer type %s' % kind)
+    cls = layerTypes[kind][0]
+    params = cls()
+    for f in fields(cls):
+        if f.name in d:
+            default = getattr(params, f.name)
+            v = d[f.name]
+            if isinstance(default, np.ndarray):
+                v = np.array(v, dtype=default.dtype)
+            elif isinstance(default, tuple):
+                v = tuple(v)
+            setattr(params, f.name, v)
+    return params
+
+
+def saveStack(filename, stack):
+    """
+    Write a list of layer parameters to a JSON file.
+    @param filename:
+    @type filename: str
+    @param stack: parameters, from bottom to top
+    @type stack: list of dataclass
+    """
+    with open(filename, 'w') as f:
+        json.dump({'version': 1, 'layers': [paramsToDict(p) for p in stack]}, f, indent=2)
+
+
+def loadStack(filename):
+    """
+    Read a list of layer parameters from a JSON
+    file (cf. saveStack()).
+    Raise IOError or ValueError.
+    @param filename:
+    @type filename: str
+    @return: parameters, from bottom to top
+    @rtype: list of dataclass
+    """
+    with open(filename) as f:
+        try:
+            d = json.load(f)
+            layers = d['layers']
+        except (KeyError, TypeError) as e:
+            raise ValueError('Invalid stack file %s' % filename) from e
+    return [paramsFromDict(l) for l in layers]
+
+
+def loadLook(filename):
+    """
+    Read a list of layer parameters from a stack
+    file (cf. saveStack()) or a .cube 3D LUT file.
+    Raise IOError or ValueError.
+    @param filename:
+    @type filename: str
+    @return: parameters, from bottom to top
+    @rtype: list of dataclass
+    """
+    if filename.lower().endswith('.cube'):
+        params = LUT3DParams(path=os.path.abspath(filename))
+        # check the file
+        getLUT3D(params.path)
+        return [params]
+    return loadStack(filename)
+
+
+def splitRaw(stack):
+    """
+    Split a stack into its raw development parameters, or None,
+    and the list of its layer transformations.
+    Raise ValueError if raw parameters are not the first item of the stack.
+    @param stack:
+    @type stack: list of dataclass
+    @return:
+    @rtype: 2-uple RawParams or None, list of dataclass
+    """
+    rawParams, stack = (stack[0], stack[1:]) if stack and stack[0].kind == RawParams.kind else (None, stack)
+    if any(params.kind == RawParams.kind for params in stack):
+        raise ValueError('Raw development must be the first layer of a stack')
+    return rawParams, stack
+
+
+def applyParams(params, inBuf, outBuf, ctx=None):
+    """
+    Apply the transformation of params.
+    @param params:
+    @type params: dataclass
+    @param inBuf:
+    @type inBuf: ndarray, dtype uint8, shape (h, w, 4)
+    @param outBuf:
+    @type outBuf: ndarray, dtype uint8, shape (h, w, 4)
+    @param ctx:
+    @type ctx: ApplyContext
+    """
+    if ctx is None:
+        ctx = ApplyContext()
+    layerTypes[params.kind][1](params, inBuf, outBuf, ctx)
+
+
+def runStack(stack, buf, ctx=None, stats=None, record=None):
+    """
+    Apply a list of layer parameters, from bottom
+    to top, to an image buffer. Neutral layers and raw
+    development parameters (cf. splitRaw()) are skipped.
+    buf is not modified. Each layer gets its own copy of ctx, without
+    shared linear buffers. The global statistics imposed to
+    stack[i] are stats[i] (cf. ApplyContext.stats), and, if record is not
+    None, the statistics recorded by stack[i] are appended to record.
+    @param stack:
+    @type stack: list of dataclass
+    @param buf: input image
+    @type buf: ndarray, dtype uint8, shape (h, w, 4), BGRA order
+    @param ctx: environment
+    @type ctx: ApplyContext
+    @param stats: imposed statistics, a dict or None for each item of stack
+    @type stats: list
+    @param record: recorded statistics, a dict for each item of stack
+    @type record: list
+    @return: output image
+    @rtype: ndarray, dtype uint8, shape (h, w, 4), BGRA order
+    """
+    if ctx is None:
+        ctx = ApplyContext()
+    bufIn, bufOut = buf, None
+    for i, params in enumerate(stack):
+        layerCtx = replace(ctx, stats=None if stats is None else stats[i], recorded={}, linearIn=None, linearOut=None)
+        if record is not None:
+            record.append(layerCtx.recorded)
+        if params.isNeutral() or params.kind == RawParams.kind:
+            continue
+        if bufOut is None or bufOut is buf:
+            bufOut = np.empty_like(buf)
+        applyParams(params, bufIn, bufOut, layerCtx)
+        bufIn, bufOut = bufOut, bufIn
+    return bufIn.copy() if bufIn is buf else bufIn
@@ -0,0 +1,416 @@
+"""
+This File is part of bLUe software.
+
+Copyright (C) 2017  Bernard Virot <bernard.virot@libertysurf.fr>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Lesser General Public License as
+published by the Free Software Foundation, version 3.
+
+This program is distributed in the hope that it will be useful, but
+WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+Lesser General Lesser Public License for more details.
+
+You should have received a copy of the GNU Lesser General Public License
+along with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import cv2
+
+import numpy as np
+import rawpy
+from rawpy._rawpy import LibRawFatalError
+
+from bLUeCore.multi import chosenInterp, interpArray
+from bLUeGui.colorCIE import rgbLinear2rgb, sRGB_lin2XYZInverse, bradfordAdaptationMatrix
+from bLUeGui.histogramWarping import warpHistogram
+from bLUeGui.multiplier import multipliers2TemperatureAndTint, temperatureAndTint2Multipliers
+from bLUeTop.dng import dngProfileLookTable, dngProfileToneCurve, getDngProfileDict
+from bLUeTop.dngMatrices import interpolatedForwardMatrix
+from bLUeTop.settings import WORKING_DTYPE
+
+#####################################################################
+# Raw file reading and development stages. The module does not
+# import Qt, so the headless tools (cf. batch, hotFolder and
+# renderServer) can develop raw files without PySide2.
+#####################################################################
+
+
+def rawRead(filename, warn=True):
+    """
+    Loads a raw image file into a RawPy instance.
+    The image file is closed after reading.
+    @param filename:
+    @tyep filename: str
+    @param warn: show a warning dialog on LibRaw errors
+    @type warn: boolean
+    @return:
+    @rtype: RawPy instance
+    """
+    rawpyInst = rawpy.RawPy()
+    with open(filename, "rb") as bufio:
+        rawpyInst.open_buffer(bufio)
+    try:
+        rawpyInst.unpack()
+    except LibRawFatalError as e:
+        if warn:
+            from bLUeGui.dialog import dlgWarn
+            dlgWarn('LibRaw Fatal Error', 'Only flat raw images are supported')
+        raise
+    return rawpyInst
+
+
+#########################################################
+# Development stages. They are shared by the raw layer
+# (cf. rawProcessing.rawPostProcess()) and by headless development (cf. developRaw()).
+#########################################################
+
+def demosaicRaw(rawImage, half_size, highlightMode, denoise):
+    """
+    First development stage : LibRaw postprocessing, without white balance,
+    exposure and brightness corrections (cf. rawExposure()).
+    Return the linear camera RGB values, in range 0..1 (1 is the sensor saturation).
+    @param rawImage:
+    @type rawImage: RawPy instance
+    @param half_size:
+    @type half_size: boolean
+    @param highlightMode: 0: clip, 1: ignore, 2: blend, 3: rebuild
+    @type highlightMode: int
+    @param denoise: 0: off, 1: light, 2: full
+    @type denoise: int
+    @return:
+    @rtype: ndarray, dtype float32, shape (h, w, 3)
+    """
+    hv, dv = highlightMode, denoise
+    buf = rawImage.postprocess(
+        half_size=half_size,
+        output_color=rawpy.ColorSpace.raw,
+        output_bps=16,
+        gamma=(1, 1),
+        no_auto_bright=True,
+        use_auto_wb=False,
+        use_camera_wb=False,
+        user_wb=[1.0, 1.0, 1.0, 1.0],
+        bright=1.0,
+        highlight_mode=rawpy.HighlightMode.Clip if hv == 0
+                       else rawpy.HighlightMode.Ignore if hv == 1
+                       else rawpy.HighlightMode.Blend if hv == 2
+                       else rawpy.HighlightMode.ReconstructDefault,
+        fbdd_noise_reduction=rawpy.FBDDNoiseReductionMode.Off if dv == 0
+                             else rawpy.FBDDNoiseReductionMode.Light if dv == 1
+                             else rawpy.FBDDNoiseReductionMode.Full,
+        median_filter_passes=1
+    )
+    bufLinear = buf.astype(np.float32)
+    bufLinear *= np.float32(1 / 65535)
+    return bufLinear
+
+
+def exposureLUT(exposure, smooth):
+    """
+    Return the exposure correction curve of LibRaw (cf. LibRaw::exp_bef()),
+    tabulated for linear values in range 0..1 (65536 entries). For exposure > 1,
+    the curve is linear up to a threshold and next, depending on the smoothness,
+    rolls off to preserve highlights.
+    @param exposure: linear multiplier, range 0.25..8
+    @type exposure: float
+    @param smooth: highlight preservation, range 0..1
+    @type smooth: float
+    @return:
+    @rtype: ndarray, dtype float32, shape (65536,)
+    """
+    shift = min(max(exposure, 0.25), 8.0)
+    X = np.arange(65536, dtype=np.float64)
+    if shift <= 1.0:
+        Y = X * shift
+    else:
+        x2 = 65535.0
+        x1 = (x2 + 1) / 2 ** (2 * np.log2(shift)) - 1
+        y1 = x1 * shift
+        y2 = x2 * (1 + (1 - smooth) * (shift - 1))
+        sq3x = np.cbrt(x1 * x1 * x2)
+        B = (y2 - y1 + shift * (3 * x1 - 3 * sq3x)) / (x2 + 2 * x1 - 3 * sq3x)
+        A = (shift - B) * 3 * np.cbrt(x1 * x1)
+        CC = y2 - A * np.cbrt(x2) - B * x2
+        Y = np.where(X < x1, X * shift, A * np.cbrt(X) + B * X + CC)
+    return (np.clip(Y, 0, 65535) / 65535).astype(np.float32)
+
+
+def autoWBMultipliers(bufLinear):
+    """
+    Return grey world white balance multipliers for a demosaiced
+    buffer (cf. demosaicRaw()). Saturated pixels are ignored.
+    @param bufLinear:
+    @type bufLinear: ndarray, shape (h, w, 3)
+    @return: R, G, B multipliers, G = 1
+    @rtype: ndarray, shape (3,)
+    """
+    sample = bufLinear[::4, ::4].reshape(-1, 3)
+    sample = sample[np.max(sample, axis=1) < 0.95]
+    if len(sample) == 0:
+        return np.ones(3)
+    means = np.maximum(np.mean(sample, axis=0, dtype=np.float64), 1e-6)
+    return means[1] / means
+
+
+def rawExposure(bufLinear, multipliers, autoWB, autoBrightness, exposure, brightness, preserveHighlights,
+                highlightMode):
+    """
+    Second development stage : exposure, white balance and brightness
+    corrections of a demosaiced buffer (cf. demosaicRaw()), in the order of
+    LibRaw postprocessing. bufLinear is not modified.
+    @param bufLinear:
+    @type bufLinear: ndarray, dtype float32, shape (h, w, 3)
+    @param multipliers: white balance multipliers
+    @type multipliers: array-like
+    @param autoWB: compute multipliers from the image
+    @type autoWB: boolean
+    @param autoBrightness: scale the image to saturate 1% of the pixels
+    @type autoBrightness: boolean
+    @param exposure: linear multiplier, ignored if autoBrightness is True
+    @type exposure: float
+    @param brightness:
+    @type brightness: float
+    @param preserveHighlights:
+    @type preserveHighlights: boolean
+    @param highlightMode: cf. demosaicRaw()
+    @type highlightMode: int
+    @return: camera RGB values, range 0..1
+    @rtype: ndarray, dtype float32, shape (h, w, 3)
+    """
+    if not autoBrightness and exposure != 1.0:
+        LUT = exposureLUT(exposure, 0.99 if preserveHighlights else 0.2)
+        buf = LUT[(np.clip(bufLinear, 0, 1) * 65535).astype(np.uint16)]
+    else:
+        buf = bufLinear.copy()
+    # white balance : for highlight mode clip, saturated pixels are clipped to white
+    m = autoWBMultipliers(buf) if autoWB else np.array(multipliers[:3], dtype=np.float64)
+    m = m / (np.min(m) if highlightMode == 0 else np.max(m))
+    buf *= m.astype(np.float32)
+    np.clip(buf, 0, 1, out=buf)
+    # brightness correction : gamma(imax) = 1, imax = white/brightness
+    white = 1.0
+    if autoBrightness:
+        sample = buf[::4, ::4].reshape(-1, 3)
+        white = max(np.max(np.percentile(sample, 99, axis=0)), 1e-6)
+    buf *= np.float32(brightness / white)
+    np.clip(buf, 0, 1, out=buf)
+    return buf
+
+
+def raw2sRGBMatrix(multipliers, temperature, XYZ2CameraInverseMatrix, dngDict, preserveHighlights, fmTemperature=None):
+    """
+    Return the conversion matrix from the raw color space to linear sRGB.
+    We follow the guidelines of Adobe dng spec. (chapter 6).
+    If we have a valid dng profile and valid ForwardMatrix1
+    and ForwardMatrix2 matrices, we first convert to XYZ_D50 using the interpolated
+    ForwardMatrix for T and next from XYZ_D50 to RGB.
+    If we have no valid dng profile, we reinit the multipliers and
+    apply a Bradford chromatic adaptation matrix.
+    @param multipliers: raw multipliers
+    @type multipliers: array-like
+    @param temperature: white balance temperature
+    @type temperature: float
+    @param XYZ2CameraInverseMatrix:
+    @type XYZ2CameraInverseMatrix: ndarray, shape (3, 3)
+    @param dngDict: camera profile
+    @type dngDict: dict
+    @param preserveHighlights:
+    @type preserveHighlights: boolean
+    @param fmTemperature: temperature used to interpolate forward matrices, default temperature
+    @type fmTemperature: float
+    @return:
+    @rtype: ndarray, shape (3, 3)
+    """
+    m1, m2, m3 = multipliers[:3]
+    D = np.diag((1/m1, 1/m2, 1/m3))
+    MM = bradfordAdaptationMatrix(6500, temperature)
+    MM1 = bradfordAdaptationMatrix(6500, 5000)
+    FM = None
+    myHighlightPreservation = 0.8 if preserveHighlights else 1.0
+    if dngDict:
+        try:
+            FM = interpolatedForwardMatrix(temperature if fmTemperature is None else fmTemperature, dngDict)
+        except ValueError:
+            pass
+    return sRGB_lin2XYZInverse @ MM1 @ FM * myHighlightPreservation if FM is not None else\
+           sRGB_lin2XYZInverse @ MM @ XYZ2CameraInverseMatrix @ D
+
+
+def rawToHSV(bufCamera, M, pool=None):
+    """
+    Convert a buffer from the raw color space to
+    linear sRGB, normalize it and return its HSV float32 values
+    (H in range 0..360, S and V in range 0..1).
+    The output is allocated for the interpolation of the
+    look table (cf. bLUeCore.multi.interpArray()).
+    @param bufCamera: camera RGB values (cf. rawExposure())
+    @type bufCamera: ndarray, shape (h, w, 3)
+    @param M: conversion matrix (cf. raw2sRGBMatrix())
+    @type M: ndarray, shape (3, 3)
+    @param pool: multi processing pool
+    @type pool: multiprocessing.pool
+    @return:
+    @rtype: ndarray, dtype float32, shape (h, w, 3)
+    """
+    # working float type : the product is not promoted to float64
+    buf = np.tensordot(bufCamera, M.astype(WORKING_DTYPE), axes=(-1, -1))
+    buf /= max(np.max(buf), 1e-6)
+    np.clip(buf, 0, 1, out=buf)
+    bufHSV = interpArray(buf.shape, np.float32, pool=pool)
+    cv2.cvtColor(buf.astype(np.float32, copy=False), cv2.COLOR_RGB2HSV, dst=bufHSV)
+    return bufHSV
+
+
+def applyLookTable(bufHSV, dngDict, pool=None):
+    """
+    Apply the profile look table, if any, to a HSV buffer, in place.
+    It must be applied to the linear buffer and
+    before tone curve (cf. Adobe dng spec. p. 65)
+    @param bufHSV:
+    @type bufHSV: ndarray, dtype float32, shape (h, w, 3)
+    @param dngDict: camera profile
+    @type dngDict: dict
+    @param pool: multi processing pool
+    @type pool: multiprocessing.pool
+    @return: True if the look table was applied
+    @rtype: boolean
+    """
+    hsvLUT = dngProfileLookTable(dngDict)
+    if not hsvLUT.isValid:
+        return False
+    divs = hsvLUT.divs
+    steps = tuple([360 / divs[0], 1.0 / (divs[1] - 1), 1.0 / (divs[2] - 1)])
+    interp = chosenInterp(pool, bufHSV.shape[0] * bufHSV.shape[1])
+    coeffs = interp(hsvLUT.data, steps, bufHSV, convert=False)
+    bufHSV[:, :, 0] = np.mod(bufHSV[:, :, 0] + coeffs[:, :, 0], 360)
+    bufHSV[:, :, 1:] = bufHSV[:, :, 1:] * coeffs[:, :, 1:]
+    np.clip(bufHSV, (0, 0, 0), (360, 1, 1), out=bufHSV)
+    return True
+
+
+def applyToneCurve(bufHSV, LUTXY):
+    """
+    Apply a tone curve to the V channel of a HSV buffer, in place.
+    @param bufHSV:
+    @type bufHSV: ndarray, dtype float32, shape (h, w, 3)
+    @param LUTXY: values 0..255
+    @type LUTXY: ndarray, shape (256,)
+    """
+    bufHSV[:, :, 2] = np.asarray(LUTXY)[(bufHSV[:, :, 2] * 255).astype(np.uint16)] / 255.0  # TODO optimize
+
+
+def applyProfileToneCurve(bufHSV, dngDict):
+    """
+    Apply the profile tone curve, if any, to a HSV buffer, in place.
+    @param bufHSV:
+    @type bufHSV: ndarray, dtype float32, shape (h, w, 3)
+    @param dngDict: camera profile
+    @type dngDict: dict
+    """
+    buf = dngDict.get('ProfileToneCurve', [])
+    if buf:  # non empty list
+        applyToneCurve(bufHSV, dngProfileToneCurve(buf).toLUTXY(maxrange=255))
+
+
+def applySaturation(bufHSV, satCorrection):
+    """
+    Saturation correction of a HSV buffer, in place.
+    @param bufHSV:
+    @type bufHSV: ndarray, dtype float32, shape (h, w, 3)
+    @param satCorrection: range -50..50
+    @type satCorrection: float
+    """
+    if satCorrection == 0:
+        return
+    satCorr = satCorrection / 100  # range -0.5..0.5
+    alpha = 1.0 / (0.501 + satCorr) - 1.0  # approx. map -0.5...0.0...0.5 --> +inf...1.0...0.0
+    # tabulate x**alpha
+    LUT = np.power(np.arange(256) / 255, alpha)
+    # convert saturation s to s**alpha
+    bufHSV[:, :, 1] = LUT[(bufHSV[:, :, 1] * 255).astype(int)]  # TODO optimize
+
+
+def hsvToRGB8(bufHSV):
+    """
+    Convert a linear HSV buffer to a (gamma corrected) 8 bits RGB buffer.
+    @param bufHSV:
+    @type bufHSV: ndarray, dtype float32, shape (h, w, 3)
+    @return:
+    @rtype: ndarray, dtype uint8, shape (h, w, 3)
+    """
+    # back to RGB
+    bufpostF32_1 = cv2.cvtColor(bufHSV, cv2.COLOR_HSV2RGB)
+    # apply gamma curve and convert to 8 bits/channel
+    return rgbLinear2rgb(bufpostF32_1).astype(np.uint8)
+
+
+def getProfileDict(rawFilename, profile):
+    """
+    Read a camera profile (cf. RawParams.profile).
+    @param rawFilename: raw file, for the embedded profile
+    @type rawFilename: str
+    @param profile: dng or dcp file, '' for the embedded profile, None for no profile
+    @type profile: str
+    @return:
+    @rtype: dict
+    """
+    if profile is None:
+        return {}
+    d = getDngProfileDict(profile or rawFilename)
+    # filter d
+    return {k: d[k] for k in d if d[k] != ''}
+
+
+def developRaw(rawImage, params, dngDict=None, half_size=False, pool=None):
+    """
+    Headless raw development, following the processing
+    order of rawProcessing.rawPostProcess(). The automatic contrast spline
+    is always used.
+    @param rawImage:
+    @type rawImage: RawPy instance
+    @param params:
+    @type params: RawParams
+    @param dngDict: camera profile (cf. getProfileDict())
+    @type dngDict: dict
+    @param half_size:
+    @type half_size: boolean
+    @param pool: multi processing pool
+    @type pool: multiprocessing.pool
+    @return:
+    @rtype: ndarray, dtype uint8, shape (h, w, 3), RGB order
+    """
+    dngDict = dngDict or {}
+    XYZ2CameraMatrix = rawImage.rgb_xyz_matrix[:3, :]
+    # as shot multipliers (normalization is mandatory : for nef files white balance is around 256)
+    m1, m2, m3, m4 = rawImage.camera_whitebalance
+    asShotMultipliers = (m1 / m2, 1.0, m3 / m2, m4 / m2)
+    if params.whiteBalance == 'User WB':
+        # temperatureAndTint2Multipliers returns the camera neutral
+        multipliers = [1 / m for m in temperatureAndTint2Multipliers(params.temperature, 1.0, XYZ2CameraMatrix,
+                                                                      dngDict=dngDict)]
+        multipliers[1] *= params.tint
+        multipliers = [m / multipliers[1] for m in multipliers]
+        temperature = params.temperature
+    else:
+        multipliers = asShotMultipliers
+        temperature, _ = multipliers2TemperatureAndTint(*1 / np.array(asShotMultipliers[:3]), XYZ2CameraMatrix,
+                                                        dngDict=dngDict)
+    bufCamera = rawExposure(demosaicRaw(rawImage, half_size, params.highlightMode, params.denoise),
+                            multipliers, params.whiteBalance == 'Auto WB', params.autoBrightness, params.exposure,
+                            params.brightness, params.preserveHighlights, params.highlightMode)
+    M = raw2sRGBMatrix(multipliers, temperature, np.linalg.inv(XYZ2CameraMatrix), dngDict, params.preserveHighlights)
+    bufHSV = rawToHSV(bufCamera, M, pool=pool)
+    del bufCamera
+    if params.lookTable:
+        applyLookTable(bufHSV, dngDict, pool=pool)
+    applyProfileToneCurve(bufHSV, dngDict)
+    if params.toneCurve is not None:
+        applyToneCurve(bufHSV, params.toneCurve)
+    if params.contrast > 0:
+        warp = max(0, (params.contrast - 1)) / 10
+        bufHSV[:, :, 2] = warpHistogram(bufHSV[:, :, 2], valleyAperture=0.05, warp=warp,
+                                        preserveHigh=params.preserveHighlights)[0]
+    applySaturation(bufHSV, params.saturation)
+    return hsvToRGB8(bufHSV)
@@ -0,0 +1,380 @@
+"""
+This File is part of bLUe software.
+
+Copyright (C) 2017  Bernard Virot <bernard.virot@libertysurf.fr>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Lesser General Public License as
+published by the Free Software Foundation, version 3.
+
+This program is distributed in the hope that it will be useful, but
+WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+Lesser General Lesser Public License for more details.
+
+You should have received a copy of the GNU Lesser General Public License
+along with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import signal
+import sys
+import tempfile
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from time import perf_counter, time
+from urllib.parse import urlsplit, parse_qs
+
+import cv2
+import numpy as np
+
+from bLUeCore.tiles import tileEngine
+from bLUeTop import batch, pipeline
+from bLUeTop.settings import RAW_FILE_EXTENSIONS
+
+#####################################################################
+# Local render server : saved layer stacks and .cube 3D LUTs
+# (looks) are applied to images posted over HTTP. Looks are loaded
+# at startup, and a pool of worker processes keeps them, with their
+# 3D LUTs and camera profiles, in memory. At most maxConcurrent
+# requests are processed at a time, and at most maxQueue requests wait
+# for a worker; further requests are rejected (503).
+#
+# usage : python -m bLUe serve LOOK|FOLDER [...] [--port PORT] [options]
+#
+# POST /render?look=ID[&format=jpg|png|tif][&quality=Q][&name=FILENAME]
+#      body : image file (raw files are identified by the extension of name)
+#      response : encoded image, with a Server-Timing header
+# GET /looks : ids of the looks
+# GET /status : counters
+#####################################################################
+
+contentTypes = {'jpg': 'image/jpeg', 'png': 'image/png', 'tif': 'image/tiff'}
+
+
+def findLooks(paths):
+    """
+    Return a dict {id: path} of the looks (.json and .cube
+    files) given by paths. Directories are searched (not recursively)
+    and the id of a look is its file name without extension.
+    Raise ValueError for duplicate ids.
+    @param paths: files or directories
+    @type paths: list of str
+    @return:
+    @rtype: dict
+    """
+    files = []
+    for p in paths:
+        if os.path.isdir(p):
+            files.extend(os.path.join(p, f) for f in sorted(os.listdir(p))
+                         if f.lower().endswith(('.json', '.cube')))
+        else:
+            files.append(p)
+    looks = {}
+    for f in files:
+        lookId = os.path.splitext(os.path.basename(f))[0]
+        if lookId in looks:
+            raise ValueError('Duplicate look id %s' % lookId)
+        looks[lookId] = os.path.abspath(f)
+    return looks
+
+
+def preload(stack):
+    """
+    Load the 3D LUTs and camera profiles used by a stack.
+    Raise IOError or ValueError.
+    @param stack:
+    @type stack: list of dataclass
+    """
+    rawParams, layers = pipeline.splitRaw(stack)
+    if rawParams is not None and rawParams.profile:
+        batch.getProfile(None, rawParams.profile)
+    for params in layers:
+        if params.kind == pipeline.LUT3DParams.kind and not params.isNeutral():
+            pipeline.getLUT3D(params.path)
+
+
+#################
+# worker processes
+#################
+
+_looks = {}
+
+
+def _initWorker(looks, threads):
+    global _looks
+    # interruptions are handled by the main process
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # share the cpus between workers
+    tileEngine.maxWorkers = threads
+    for stack in looks.values():
+        preload(stack)
+    _looks = {k: pipeline.splitRaw(stack) for k, stack in looks.items()}
+
+
+def decodeImage(data, name='', rawParams=None):
+    """
+    Decode an image file and return a BGRA buffer. Raw
+    files, identified by the extension of name, are developed
+    with rawParams (cf. batch.readImage()).
+    Raise IOError, ValueError or LibRaw errors.
+    @param data: file content
+    @type data: bytes
+    @param name: file name
+    @type name: str
+    @param rawParams:
+    @type rawParams: RawParams
+    @return:
+    @rtype: ndarray, dtype uint8, shape (h, w, 4)
+    """
+    if name.endswith(RAW_FILE_EXTENSIONS):
+        # camera profiles are read from files
+        fd, tmpName = tempfile.mkstemp(suffix=os.path.splitext(name)[1])
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            return batch.readImage(tmpName, rawParams=rawParams)
+        finally:
+            os.remove(tmpName)
+    buf = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR | cv2.IMREAD_IGNORE_ORIENTATION)
+    if buf is None:
+        raise IOError('Cannot decode image')
+    return cv2.cvtColor(buf, cv2.COLOR_BGR2BGRA)
+
+
+def render(lookId, data, name, fmt, quality):
+    """
+    Worker : decode an image, apply a look and encode the result.
+    @param lookId:
+    @type lookId: str
+    @param data: file content
+    @type data: bytes
+    @param name: file name
+    @type name: str
+    @param fmt:
+    @type fmt: str
+    @param quality:
+    @type quality: int
+    @return: encoded image, timings (s) of the decode, process and encode stages
+    @rtype: bytes, list of 2-uples (str, float)
+    """
+    rawParams, stack = _looks[lookId]
+    t0 = perf_counter()
+    buf = decodeImage(data, name=name, rawParams=rawParams)
+    t1 = perf_counter()
+    out = pipeline.runStack(stack, buf)
+    t2 = perf_counter()
+    encoded = batch.encodeImage(out, fmt, quality=quality)
+    t3 = perf_counter()
+    return encoded, [('decode', t1 - t0), ('process', t2 - t1), ('encode', t3 - t2)]
+
+
+#################
+# main process
+#################
+
+class RenderServer(ThreadingHTTPServer):
+    """
+    HTTP server dispatching render requests to a pool of workers.
+    """
+    daemon_threads = True
+
+    def __init__(self, address, looks, jobs=None, maxConcurrent=None, maxQueue=None, maxSize=200):
+        """
+        @param address: (host, port)
+        @type address: 2-uple
+        @param looks: {id : layer parameters}
+        @type looks: dict
+        @param jobs: count of worker processes, default cpu count
+        @type jobs: int
+        @param maxConcurrent: count of requests processed simultaneously, default jobs
+        @type maxConcurrent: int
+        @param maxQueue: count of waiting requests, default 4 * maxConcurrent
+        @type maxQueue: int
+        @param maxSize: max size (MB) of posted images
+        @type maxSize: int
+        """
+        super().__init__(address, RenderHandler)
+        cpus = os.cpu_count() or 1
+        self.jobs = max(1, jobs or cpus)
+        self.maxConcurrent = maxConcurrent or self.jobs
+        self.maxQueue = self.maxConcurrent * 4 if maxQueue is None else maxQueue
+        self.maxSize = maxSize * 1024 * 1024
+        self.looks = looks
+        self.slots = threading.BoundedSemaphore(self.maxConcurrent)
+        self.lock = threading.Lock()
+        self.waiting, self.inFlight, self.served, self.failed, self.rejected = 0, 0, 0, 0, 0
+        self.totalTime, self.start = 0.0, time()
+        self.pool = multiprocessing.Pool(self.jobs, initializer=_initWorker,
+                                         initargs=(looks, max(1, cpus // self.jobs)))
+
+    def render(self, lookId, data, name, fmt, quality):
+        """
+        Queue a request and wait for its result. Return None
+        if the queue is full.
+        Raise the exceptions of the worker.
+        @return: encoded image and timings, or None
+        @rtype: bytes, list of 2-uples (str, float)
+        """
+        start = perf_counter()
+        with self.lock:
+            if self.waiting >= self.maxQueue:
+                self.rejected += 1
+                return None
+            self.waiting += 1
+        self.slots.acquire()
+        with self.lock:
+            self.waiting -= 1
+            self.inFlight += 1
+        queued = perf_counter() - start
+        try:
+            encoded, timings = self.pool.apply(render, (lookId, data, name, fmt, quality))
+            with self.lock:
+                self.served += 1
+                self.totalTime += perf_counter() - start
+        except BaseException:
+            with self.lock:
+                self.failed += 1
+            raise
+        finally:
+            with self.lock:
+                self.inFlight -= 1
+            self.slots.release()
+        return encoded, [('queue', queued)] + timings + [('total', perf_counter() - start)]
+
+    def status(self):
+        with self.lock:
+            return {'uptime': round(time() - self.start),
+                    'jobs': self.jobs,
+                    'maxConcurrent': self.maxConcurrent,
+                    'maxQueue': self.maxQueue,
+                    'waiting': self.waiting,
+                    'inFlight': self.inFlight,
+                    'served': self.served,
+                    'failed': self.failed,
+                    'rejected': self.rejected,
+                    'meanTime': round(self.totalTime / self.served, 3) if self.served else None}
+
+    def server_close(self):
+        super().server_close()
+        self.pool.close()
+        self.pool.join()
+
+
+class RenderHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def sendJSON(self, obj, code=200):
+        self.sendBody(json.dumps(obj, indent=1).encode(), 'application/json', code=code)
+
+    def sendBody(self, body, contentType, code=200, headers=()):
+        self.send_response(code)
+        self.send_header('Content-Type', contentType)
+        self.send_header('Content-Length', str(len(body)))
+        for h in headers:
+            self.send_header(*h)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def sendError(self, code, message):
+        self.sendJSON({'error': message}, code=code)
+
+    def do_GET(self):
+        path = urlsplit(self.path).path.rstrip('/')
+        if path == '/looks':
+            self.sendJSON(sorted(self.server.looks))
+        elif path in ('', '/status'):
+            self.sendJSON(self.server.status())
+        else:
+            self.sendError(404, 'Not found')
+
+    def do_POST(self):
+        url = urlsplit(self.path)
+        length = int(self.headers.get('Content-Length', 0))
+        if url.path.rstrip('/') != '/render':
+            self.close_connection = True
+            self.sendError(404, 'Not found')
+            return
+        if length > self.server.maxSize:
+            self.close_connection = True
+            self.sendError(413, 'Image too large')
+            return
+        data = self.rfile.read(length)
+        query = {k: v[-1] for k, v in parse_qs(url.query).items()}
+        lookId, fmt = query.get('look'), query.get('format', 'jpg')
+        if lookId not in self.server.looks:
+            self.sendError(404, 'Unknown look %s' % lookId)
+            return
+        if fmt not in contentTypes:
+            self.sendError(400, 'Unknown format %s' % fmt)
+            return
+        try:
+            quality = int(query.get('quality', -1))
+        except ValueError:
+            self.sendError(400, 'Invalid quality')
+            return
+        if not data:
+            self.sendError(400, 'No image')
+            return
+        try:
+            result = self.server.render(lookId, data, query.get('name', ''), fmt, quality)
+        except (IOError, ValueError) as e:
+            self.sendError(400, '%s: %s' % (type(e).__name__, e))
+            return
+        except Exception as e:
+            self.sendError(500, '%s: %s' % (type(e).__name__, e))
+            return
+        if result is None:
+            self.sendBody(b'', 'text/plain', code=503, headers=[('Retry-After', '1')])
+            return
+        encoded, timings = result
+        self.sendBody(encoded, contentTypes[fmt],
+                      headers=[('Server-Timing', ', '.join('%s;dur=%.1f' % (k, t * 1000) for k, t in timings))])
+
+    def log_message(self, *args):
+        pass
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='bLUe serve',
+                                     description='Apply layer stacks and 3D LUTs to images posted over HTTP.')
+    parser.add_argument('looks', nargs='+',
+                        help='layer stacks (.json, cf. Layer menu), 3D LUTs (.cube) or folders containing them')
+    parser.add_argument('--host', default='127.0.0.1', help='listening address')
+    parser.add_argument('-p', '--port', type=int, default=8766, help='listening port')
+    parser.add_argument('-j', '--jobs', type=int, default=0, help='worker processes, default cpu count')
+    parser.add_argument('--max-concurrent', type=int, default=0,
+                        help='requests processed simultaneously, default jobs')
+    parser.add_argument('--max-queue', type=int, default=None,
+                        help='waiting requests, default 4 * max-concurrent')
+    parser.add_argument('--max-size', type=int, default=200, help='max size (MB) of posted images')
+    args = parser.parse_args(argv)
+    try:
+        looks = {}
+        for lookId, f in findLooks(args.looks).items():
+            looks[lookId] = stack = pipeline.loadLook(f)
+            # check and load 3D LUTs and profiles before forking
+            preload(stack)
+    except (IOError, ValueError) as e:
+        print('Cannot load looks : %s' % e, file=sys.stderr)
+        return 2
+    if not looks:
+        print('No look found', file=sys.stderr)
+        return 2
+    server = RenderServer((args.host, args.port), looks, jobs=args.jobs, maxConcurrent=args.max_concurrent,
+                          maxQueue=args.max_queue, maxSize=args.max_size)
+    signal.signal(signal.SIGTERM, lambda *args: threading.Thread(target=server.shutdown).start())
+    print('Serving %d looks on http://%s:%d' % (len(looks), args.host, args.port), flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
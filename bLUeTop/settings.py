@@ -55,6 +55,17 @@ else:
     DNG_PROFILES_DIR1 = expanduser(CONFIG["DNG_PROFILES"]["DIR1"])
     DNG_PROFILES_DIR2 = expanduser(CONFIG["DNG_PROFILES"]["DIR2"])
 
+##############
+# binary cache of parsed .cube files
+##############
+LUT_CACHE_DIR = expanduser(CONFIG["PATHS"]["LUT_CACHE_DIR"])  # "~/.cache/bLUe/luts"
+
+##############
+# scratch directory of buffers moved
+# out of memory (cf. bLUeGui.memory)
+##############
+SCRATCH_DIR = expanduser(CONFIG["PATHS"]["SCRATCH_DIR"])  # "~/.cache/bLUe/scratch"
+
 ADOBE_RGB_PROFILE_PATH = SYSTEM_PROFILE_DIR + CONFIG["PROFILES"]["ADOBE_RGB_PROFILE_NAME"]  # "\AdobeRGB1998.icc"
 SRGB_PROFILE_PATH = SYSTEM_PROFILE_DIR + CONFIG["PROFILES"]["SRGB_PROFILE_NAME"]  # "\sRGB Color Space Profile.icm"
 DEFAULT_MONITOR_PROFILE_PATH = SYSTEM_PROFILE_DIR + CONFIG["PROFILES"]["DEFAULT_MONITOR_PROFILE_NAME"]
@@ -62,8 +73,39 @@ DEFAULT_MONITOR_PROFILE_PATH = SYSTEM_PROFILE_DIR + CONFIG["PROFILES"]["DEFAULT_
 #############
 # 3D LUT
 ############
-# use tetrahedral interpolation instead of trilinear; trilinear is faster
+# use tetrahedral interpolation instead of trilinear
 USE_TETRA = CONFIG["ENV"]["USE_TETRA"]  # False
+# interpolate distinct colors only (8 bits images)
+USE_UNIQUE_COLORS = CONFIG["ENV"]["USE_UNIQUE_COLORS"]  # True
+# memory ceiling of the baked LUT cache (MB), 0 to disable
+BAKED_LUT_CACHE_MB = CONFIG["ENV"]["BAKED_LUT_CACHE_MB"]  # 256
+# apply runs of adjacent color only layers as a single 3D LUT
+USE_LAYER_FUSION = CONFIG["ENV"]["USE_LAYER_FUSION"]  # True
+
+######################
+# stack evaluation
+#######################
+# evaluate the layer stack in a background thread
+USE_ASYNC_STACK = CONFIG["ENV"]["USE_ASYNC_STACK"]  # True
+# after a local edit, recompute the modified regions only
+USE_DIRTY_RECTS = CONFIG["ENV"]["USE_DIRTY_RECTS"]  # True
+# preview resolution follows the display (resolution pyramid)
+USE_PREVIEW_PYRAMID = CONFIG["ENV"]["USE_PREVIEW_PYRAMID"]  # True
+# in preview mode, evaluate the full resolution image in the background
+USE_PROGRESSIVE_RENDER = CONFIG["ENV"]["USE_PROGRESSIVE_RENDER"]  # True
+# memory ceiling of the layer output cache (MB), 0 to disable
+LAYER_CACHE_MB = CONFIG["ENV"]["LAYER_CACHE_MB"]  # 512
+# memory budget of image buffers (MB), 0 for no limit
+MEMORY_BUDGET_MB = CONFIG["ENV"]["MEMORY_BUDGET_MB"]  # 4096
+
+######################
+# numeric precision
+#######################
+# float type of intermediate image buffers
+WORKING_DTYPE = CONFIG["ENV"]["WORKING_DTYPE"]  # "float32"
+# share linear light buffers between adjacent exposure, mixer
+# and temperature layers, and fold their matrices (cf. QLayer.linearLight)
+USE_LINEAR_LIGHT = CONFIG["ENV"]["USE_LINEAR_LIGHT"]  # True
 
 ######################
 # parallel interpolation
@@ -71,6 +113,26 @@ USE_TETRA = CONFIG["ENV"]["USE_TETRA"]  # False
 USE_POOL = CONFIG["ENV"]["USE_POOL"]  # True
 POOL_SIZE = CONFIG["ENV"]["POOL_SIZE"]  # 4
 
+######################
+# tile engine (threads)
+#######################
+TILE_THREADS = CONFIG["ENV"]["TILE_THREADS"]  # 0 : cpu count
+TILE_BAND_KB = CONFIG["ENV"]["TILE_BAND_KB"]  # 512
+
+######################
+# tiled rendering (cf. bLUeTop.tiledRender),
+# used to save images in preview mode
+# and by batch processing (option --tiled)
+#######################
+TILED_RENDER_SIZE = CONFIG["ENV"]["TILED_RENDER_SIZE"]  # 1024
+TILED_STATS_SIZE = CONFIG["ENV"]["TILED_STATS_SIZE"]  # 2048
+
+##################
+# file extension constants
+##################
+IMAGE_FILE_EXTENSIONS = (".jpg", ".JPG", ".png", ".PNG", ".tif", ".TIF", ".bmp", ".BMP")
+RAW_FILE_EXTENSIONS = (".nef", ".NEF", ".dng", ".DNG", ".cr2", ".CR2")
+
 ##############
 # Brush folder
 #############
@@ -0,0 +1,355 @@
+"""
+This File is part of bLUe software.
+
+Copyright (C) 2017  Bernard Virot <bernard.virot@libertysurf.fr>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Lesser General Public License as
+published by the Free Software Foundation, version 3.
+
+This program is distributed in the hope that it will be useful, but
+WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+Lesser General Lesser Public License for more details.
+
+You should have received a copy of the GNU Lesser General Public License
+along with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+import threading
+import traceback
+from collections import OrderedDict
+
+from PySide2 import QtCore
+from PySide2.QtCore import QObject
+
+from bLUeGui.memory import memoryManager
+
+
+class StackCancelled(Exception):
+    """
+    Raised between two layers when a stack
+    evaluation is superseded by a newer request.
+    """
+    pass
+
+
+class StackWorker(QObject):
+    """
+    Evaluation of layer stacks in a background thread.
+    Requests are coalesced : for each image, only the lowest
+    modified layer is recorded, and the stack is evaluated once from this layer,
+    using the current (latest) layer parameters. Modified regions (cf. QLayer.evaluateStack())
+    are merged into their bounding rectangle. A request arriving during the
+    evaluation of the same image cancels it at the next layer boundary, and the
+    evaluation restarts from the lowest of the two layers.
+    Sliders, option lists and graphics items must not be read by the worker thread : the
+    parameters of the layer forms are recorded in the GUI thread when a request is queued,
+    and the evaluation reads the parameters of the latest request (cf. QLayer.getFormParams()).
+    The parameters of a layer are recorded again only if the layer was modified.
+    Pixmaps, widgets and dialogs must not be touched by the worker thread : the
+    corresponding calls are deferred (cf. deferToGui()) and run in the GUI thread when
+    the evaluation completes, before calling the onImageChanged() handler of the image.
+    Progressive rendering : when the evaluation of a preview (mImage.useThumb) is
+    done and no other request is pending for the image, a refinement
+    is queued (cf. requestRefine()) : the stack is evaluated at full resolution,
+    from the lowest layer modified since the last refinement (mImage.refineFrom),
+    and the result replaces the preview when it completes (cf. publish()). Refinements
+    are cancelled by any new request for the same image.
+    The worker must be instantiated in the GUI thread.
+    """
+    done = QtCore.Signal(object)
+
+    def __init__(self):
+        super().__init__()
+        self.__cond = threading.Condition()
+        # pending requests : id(image) --> (image, lowest layer, modified region or None,
+        # render stamp of the image for refinements, None otherwise, form parameters or None)
+        self.__pending = OrderedDict()
+        # image being evaluated
+        self.__running = None
+        self.__refining = False
+        self.__cancelled = False
+        # image being published
+        self.__publishing = None
+        # deferred GUI calls : key --> (func, args)
+        self.__deferred = OrderedDict()
+        # the worker is living in the GUI thread : done is a queued connection
+        self.done.connect(self.publish)
+        self.thread = threading.Thread(target=self.__loop, name='stackWorker', daemon=True)
+        self.thread.start()
+
+    def __push(self, img, layer, rect, stamp=None, params=None):
+        """
+        Record a request. The caller must hold the lock.
+        A preview request supersedes a pending refinement.
+        The form parameters of the latest request are kept.
+        @param img:
+        @type img: mImage
+        @param layer:
+        @type layer: QLayer
+        @param rect:
+        @type rect: QRect or None
+        @param stamp: render stamp, for refinements
+        @type stamp: int
+        @param params: form parameters, keyed by id(layer.view), None to keep the pending
+                       or last used ones
+        @type params: dict
+        """
+        current = self.__pending.get(id(img))
+        if current is not None and current[3] is None:
+            # the whole image is recomputed as soon as a request has no region
+            if rect is not None and current[2] is not None:
+                rect = rect.united(current[2])
+            else:
+                rect = None
+            if current[1].getStackIndex() <= layer.getStackIndex():
+                layer = current[1]
+            if params is None:
+                params = current[4]
+        self.__pending[id(img)] = (img, layer, rect, stamp, params)
+
+    def request(self, layer, rect=None):
+        """
+        Request the evaluation of the stack of layer.parentImage,
+        starting from layer. The parameters of the layer forms are recorded.
+        @param layer:
+        @type layer: QLayer
+        @param rect: modified region
+        @type rect: QRect
+        """
+        img = layer.parentImage
+        params = {id(l.view): l.getFormParams() for l in img.layersStack
+                  if l.view is not None and l.view.widget() is not None}
+        with self.__cond:
+            self.__push(img, layer, rect, params=params)
+            if self.__running is img:
+                self.__cancelled = True
+            self.__cond.notify_all()
+
+    def requestRefine(self, img):
+        """
+        Request the full resolution evaluation of the stack of img (cf.
+        mImage.getRefineStart()), if no other request is pending for img.
+        @param img:
+        @type img: mImage
+        """
+        with self.__cond:
+            if id(img) in self.__pending:
+                return
+            stamp, start = img.renderStamp, img.getRefineStart()
+            # cloning layers are evaluated in the GUI thread only
+            if start is None or any(l.isCloningLayer() for l in img.layersStack[start.getStackIndex():]):
+                return
+            self.__push(img, start, None, stamp=stamp)
+            self.__cond.notify_all()
+
+    def checkpoint(self):
+        """
+        Called by the evaluation between layers.
+        Raise StackCancelled if a newer request is pending.
+        """
+        if self.__cancelled:
+            raise StackCancelled()
+
+    def wait(self, cancelRefine=True):
+        """
+        Block until all requests are evaluated. If cancelRefine is
+        True, pending and running refinements are cancelled first.
+        Must not be called from the worker thread.
+        @param cancelRefine:
+        @type cancelRefine: boolean
+        """
+        with self.__cond:
+            if cancelRefine:
+                for key in [k for k, v in self.__pending.items() if v[3] is not None]:
+                    del self.__pending[key]
+                if self.__refining:
+                    self.__cancelled = True
+            while self.__pending or self.__running is not None:
+                self.__cond.wait()
+
+    def isIdle(self):
+        """
+        Return True if no request is running or pending.
+        @return:
+        @rtype: boolean
+        """
+        with self.__cond:
+            return not self.__pending and self.__running is None
+
+    def isPending(self, img):
+        """
+        Return True if a preview evaluation of the stack of img is pending
+        or running, unless img is being published.
+        @param img:
+        @type img: mImage
+        @return:
+        @rtype: boolean
+        """
+        with self.__cond:
+            if self.__publishing is img:
+                return False
+            request = self.__pending.get(id(img))
+            return (request is not None and request[3] is None) or (self.__running is img and not self.__refining)
+
+    def defer(self, key, func, args):
+        """
+        Queue the GUI call func(*args). Calls with identical keys are
+        coalesced (the last arguments are kept).
+        @param key:
+        @type key: hashable
+        @param func:
+        @type func: function
+        @param args:
+        @type args: tuple
+        """
+        with self.__cond:
+            self.__deferred[key] = (func, args)
+
+    def __loop(self):
+        while True:
+            with self.__cond:
+                while not self.__pending:
+                    self.__cond.wait()
+                _, (img, layer, rect, stamp, params) = self.__pending.popitem(last=False)
+                self.__running, self.__cancelled = img, False
+                self.__refining = stamp is not None
+                # refinements use the parameters of the last evaluation
+                if params is not None:
+                    img.formParams = params
+            completed = False
+            try:
+                if stamp is None:
+                    layer.evaluateStack(checkpoint=self.checkpoint, rect=rect)
+                else:
+                    # full resolution, for this thread only (cf. mImage.useThumb)
+                    img.refiningThread = self.thread
+                    try:
+                        layer.evaluateStack(checkpoint=self.checkpoint)
+                    finally:
+                        img.refiningThread = None
+                completed = True
+            except StackCancelled:
+                if stamp is None:
+                    with self.__cond:
+                        # restart from the lowest layer, with
+                        # the parameters of the newer request
+                        self.__push(img, layer, rect)
+            except Exception:
+                # do not kill the worker
+                traceback.print_exc()
+                completed = True
+            finally:
+                with self.__cond:
+                    self.__running, self.__refining = None, False
+                    self.__cond.notify_all()
+            if completed:
+                self.done.emit((img, stamp))
+                if stamp is None:
+                    self.requestRefine(img)
+
+    @QtCore.Slot(object)
+    def publish(self, result):
+        """
+        GUI thread : run the deferred calls and notify the image.
+        A refinement replaces the preview if the image was not
+        modified since the refinement was requested.
+        @param result: image and render stamp (None for previews)
+        @type result: 2-uple mImage, int
+        """
+        img, stamp = result
+        if stamp is not None and stamp == img.renderStamp:
+            img.refined, img.refineFrom = True, None
+        with self.__cond:
+            deferred, self.__deferred = self.__deferred, OrderedDict()
+        for func, args in deferred.values():
+            func(*args)
+        img.setModified(True)
+        self.__publishing = img
+        try:
+            img.onImageChanged()
+        finally:
+            self.__publishing = None
+        # buffers can be evicted safely while the worker is idle
+        if self.isIdle():
+            memoryManager.enforce()
+
+
+_worker = None
+
+
+def getStackWorker():
+    """
+    Return the (unique) stack worker, starting it if needed.
+    Must be called from the GUI thread.
+    @return:
+    @rtype: StackWorker
+    """
+    global _worker
+    if _worker is None:
+        _worker = StackWorker()
+    return _worker
+
+
+def waitStackWorker(cancelRefine=True):
+    """
+    Block until the stack worker, if any, is idle. Called before
+    modifying or reading the whole stack from the GUI thread.
+    Refinements are cancelled, unless cancelRefine is False.
+    @param cancelRefine:
+    @type cancelRefine: boolean
+    """
+    if _worker is not None and threading.current_thread() is not _worker.thread:
+        _worker.wait(cancelRefine=cancelRefine)
+
+
+def isStackWorkerThread():
+    """
+    Return True if the calling thread is the stack worker thread.
+    @return:
+    @rtype: boolean
+    """
+    return _worker is not None and threading.current_thread() is _worker.thread
+
+
+def isStackWorkerIdle():
+    """
+    Return True if the stack worker is not started or idle.
+    @return:
+    @rtype: boolean
+    """
+    return _worker is None or _worker.isIdle()
+
+
+def isStackPending(img):
+    """
+    Return True if a preview evaluation of the stack of img is pending or running :
+    the buffers of img are not up to date, and the image changed handler
+    will be called by the stack worker when the evaluation completes.
+    @param img:
+    @type img: mImage
+    @return:
+    @rtype: boolean
+    """
+    return _worker is not None and _worker.isPending(img)
+
+
+def deferToGui(key, func, *args):
+    """
+    If the calling thread is the stack worker thread, queue the
+    call func(*args), to be run by the GUI thread at the end of the evaluation,
+    and return True. Otherwise, return False : the caller should
+    do the call itself.
+    @param key: coalescing key
+    @type key: hashable
+    @param func:
+    @type func: function
+    @param args:
+    @type args:
+    @return:
+    @rtype: boolean
+    """
+    if not isStackWorkerThread():
+        return False
+    _worker.defer(key, func, args)
+    return True
@@ -0,0 +1,144 @@
+"""
+This File is part of bLUe software.
+
+Copyright (C) 2017  Bernard Virot <bernard.virot@libertysurf.fr>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Lesser General Public License as
+published by the Free Software Foundation, version 3.
+
+This program is distributed in the hope that it will be useful, but
+WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+Lesser General Lesser Public License for more details.
+
+You should have received a copy of the GNU Lesser General Public License
+along with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+import numpy as np
+
+from PySide2.QtCore import QRect, QSize, Qt
+
+from bLUeGui.bLUeImage import QImageBuffer
+from bLUeTop.MarkedImg import mImage
+from bLUeTop.settings import TILED_RENDER_SIZE, TILED_STATS_SIZE
+
+#####################################################################
+# Tiled evaluation of the layers of a document, for stacks
+# which cannot be run by the pipeline (cf. bLUeTop.tiledRender).
+# Tiles are offscreen documents holding cropped copies of the layers.
+#####################################################################
+
+
+class LayerTiledRenderer(object):
+    """
+    Evaluation of the layer stack of a mImage tile by tile, at full resolution.
+    For each tile, an offscreen mImage is built from the region of the background
+    layer, extended by the sum of the halo radii of the layers (cf. QLayer.getTileHaloRadius()),
+    and a copy of each visible layer, restricted to this region (cf. QLayer.bCropped()),
+    is evaluated. The full size layers are left unchanged.
+    Memory is NOT bounded by the tile size : the layers of the document
+    hold full size images (cf. mImage.addAdjustmentLayer()). The renderer is used
+    to save, in preview mode, stacks which cannot be run by the
+    pipeline (cf. mImage.getStackParams() and bLUeTop.tiledRender.StackRenderer).
+    Global statistics (histograms, max...) are computed by a first pass over
+    a downsampled image, and imposed to the layers of all tiles (cf. mImage.statsMode).
+    Selections, layer offsets and layers depending on the whole image
+    (geometric transformations, cloning, raw development...) are not supported.
+    """
+    def __init__(self, img, tileSize=TILED_RENDER_SIZE, statsSize=TILED_STATS_SIZE):
+        """
+        Raise ValueError if a visible layer cannot be evaluated by tiles.
+        @param img:
+        @type img: mImage
+        @param tileSize: tile size, halo excluded
+        @type tileSize: int
+        @param statsSize: max size of the downsampled image
+        @type statsSize: int
+        """
+        self.img = img
+        self.tileSize, self.statsSize = tileSize, statsSize
+        stack = img.layersStack
+        self.layers = [stack[0]] + [layer for layer in stack[1:] if layer.visible]
+        self.halo = 0
+        for layer in self.layers[1:]:
+            r = layer.getTileHaloRadius()
+            if r is None:
+                raise ValueError('Layer %s cannot be rendered by tiles' % layer.name)
+            self.halo += r
+        self.stats = {}
+        # downsampled rendering, computed by computeStats()
+        self.preview = None
+
+    def __evaluate(self, rect, size, statsMode):
+        """
+        Evaluate the layers restricted to rect and scaled to size.
+        @param rect: region (full size image coordinates)
+        @type rect: QRect
+        @param size:
+        @type size: QSize
+        @param statsMode: 'record' or 'use'
+        @type statsMode: str
+        @return: the offscreen image and the output
+        @rtype: 2-uple mImage, bImage
+        """
+        img = mImage(QImg=self.layers[0].copy(rect).scaled(size), offscreen=True)
+        img.statsMode = statsMode
+        img.tileOrigin = (rect.left(), rect.top())
+        img.fullSize = (self.img.width(), self.img.height())
+        stack = [layer.bCropped(rect, img, size=size) for layer in self.layers]
+        if statsMode == 'use':
+            for layer, cLayer in zip(self.layers, stack):
+                cLayer.stats = self.stats.get(id(layer))
+        img.layersStack = stack
+        if len(stack) > 1:
+            stack[1].evaluateStack()
+        return img, stack[-1].getCurrentMaskedImage()
+
+    def computeStats(self):
+        """
+        Evaluate the stack on a downsampled image, recording
+        the global statistics of layers. The result is kept in self.preview.
+        """
+        fullRect = QRect(0, 0, self.img.width(), self.img.height())
+        size = fullRect.size().scaled(QSize(self.statsSize, self.statsSize), Qt.KeepAspectRatio)
+        size = size.boundedTo(fullRect.size())
+        img, out = self.__evaluate(fullRect, size, 'record')
+        self.stats = {id(layer): cLayer.stats for layer, cLayer in zip(self.layers, img.layersStack)}
+        self.preview = out.copy()
+
+    def renderTile(self, rect):
+        """
+        Evaluate the stack inside rect.
+        @param rect: tile (full size image coordinates)
+        @type rect: QRect
+        @return: tile, BGRA order
+        @rtype: ndarray, dtype np.uint8, shape (rect.height(), rect.width(), 4)
+        """
+        h = self.halo
+        extRect = rect.adjusted(-h, -h, h, h).intersected(QRect(0, 0, self.img.width(), self.img.height()))
+        _, out = self.__evaluate(extRect, extRect.size(), 'use')
+        top, left = rect.top() - extRect.top(), rect.left() - extRect.left()
+        return QImageBuffer(out)[top:top + rect.height(), left:left + rect.width()]
+
+    def render(self, writer, rect=None):
+        """
+        Evaluate the stack inside rect, and send the result to writer, band by band.
+        Global statistics are computed first, if needed.
+        @param writer: object with a method writeRows(buf), buf being a BGRA array
+        @type writer: PNGWriter or ArrayWriter
+        @param rect: region to render (default whole image)
+        @type rect: QRect
+        """
+        if rect is None:
+            rect = QRect(0, 0, self.img.width(), self.img.height())
+        if self.preview is None:
+            self.computeStats()
+        t = self.tileSize
+        for y in range(rect.top(), rect.top() + rect.height(), t):
+            th = min(t, rect.top() + rect.height() - y)
+            band = np.empty((th, rect.width(), 4), dtype=np.uint8)
+            for x in range(rect.left(), rect.left() + rect.width(), t):
+                tw = min(t, rect.left() + rect.width() - x)
+                band[:, x - rect.left():x - rect.left() + tw] = self.renderTile(QRect(x, y, tw, th))
+            writer.writeRows(band)
@@ -0,0 +1,299 @@
+"""
+This File is part of bLUe software.
+
+Copyright (C) 2017  Bernard Virot <bernard.virot@libertysurf.fr>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Lesser General Public License as
+published by the Free Software Foundation, version 3.
+
+This program is distributed in the hope that it will be useful, but
+WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+Lesser General Lesser Public License for more details.
+
+You should have received a copy of the GNU Lesser General Public License
+along with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+import os
+import struct
+import tempfile
+import zlib
+from dataclasses import replace
+
+import numpy as np
+import cv2
+
+from bLUeTop import pipeline
+from bLUeTop.settings import TILED_RENDER_SIZE, TILED_STATS_SIZE
+
+#####################################################################
+# Tiled evaluation of layer stacks (cf. bLUeTop.pipeline), for
+# huge images. The stack is run on tiles of the source image, grown by
+# the halo radii of the layers, and finished bands of tiles are
+# written to the output file. Besides the source image, no
+# full size buffer is held in memory (jpg and tif files go through
+# a disk backed array, cf. ArrayWriter). The module does not use Qt.
+#####################################################################
+
+
+class PNGWriter(object):
+    """
+    Streaming PNG encoder : the image is written
+    band by band, and it is never held in memory.
+    """
+    def __init__(self, filename, width, height, alpha=True, compression=-1):
+        """
+        @param filename:
+        @type filename: str
+        @param width:
+        @type width: int
+        @param height:
+        @type height: int
+        @param alpha: write the alpha channel
+        @type alpha: boolean
+        @param compression: zlib compression level 0..9, -1 for default
+        @type compression: int
+        """
+        self.filename = filename
+        self.width, self.height, self.alpha = width, height, alpha
+        self.rows = 0
+        self.__f = open(filename, 'wb')
+        self.__z = zlib.compressobj(compression if 0 <= compression <= 9 else 6)
+        self.__f.write(b'\x89PNG\r\n\x1a\n')
+        # 8 bits RGBA or RGB, no interlace
+        self.__chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 6 if alpha else 2, 0, 0, 0))
+
+    def __chunk(self, tag, data):
+        self.__f.write(struct.pack('>I', len(data)))
+        self.__f.write(tag)
+        self.__f.write(data)
+        self.__f.write(struct.pack('>I', zlib.crc32(data, zlib.crc32(tag)) & 0xffffffff))
+
+    def writeRows(self, buf):
+        """
+        Write the next rows of the image.
+        @param buf: rows, BGRA order
+        @type buf: ndarray, dtype np.uint8, shape (h, width, 4)
+        """
+        rgb = buf[..., [2, 1, 0, 3] if self.alpha else [2, 1, 0]]
+        h, bpp = rgb.shape[0], rgb.shape[2]
+        rows = rgb.reshape(h, -1)
+        # filter type 1 (Sub) : difference with the left pixel
+        filtered = np.empty((h, rows.shape[1] + 1), dtype=np.uint8)
+        filtered[:, 0] = 1
+        filtered[:, 1:bpp + 1] = rows[:, :bpp]
+        np.subtract(rows[:, bpp:], rows[:, :-bpp], out=filtered[:, bpp + 1:])
+        data = self.__z.compress(filtered.tobytes())
+        if data:
+            self.__chunk(b'IDAT', data)
+        self.rows += h
+
+    def close(self):
+        """
+        Terminate the file. Raise IOError if the image is not complete.
+        """
+        try:
+            if self.rows == self.height:
+                self.__chunk(b'IDAT', self.__z.flush())
+                self.__chunk(b'IEND', b'')
+        finally:
+            self.__f.close()
+        if self.rows != self.height:
+            raise IOError('PNGWriter : %d rows written, %d expected' % (self.rows, self.height))
+
+    def abort(self):
+        """
+        Close and remove the (incomplete) file.
+        """
+        self.__f.close()
+        if os.path.isfile(self.filename):
+            os.remove(self.filename)
+
+
+class ArrayWriter(object):
+    """
+    Writer for formats without streaming encoder (jpg, tif). Rows
+    are stored into a disk backed array and the file is written by
+    cv2.imwrite() when all rows are received.
+    """
+    def __init__(self, filename, width, height, params=()):
+        """
+        @param filename:
+        @type filename: str
+        @param width:
+        @type width: int
+        @param height:
+        @type height: int
+        @param params: cv2.imwrite() parameters
+        @type params: list
+        """
+        self.filename, self.params = filename, list(params)
+        self.height = height
+        self.rows = 0
+        self.__tmp = tempfile.TemporaryFile()
+        self.buf = np.memmap(self.__tmp, dtype=np.uint8, mode='w+', shape=(height, width, 3))
+
+    def writeRows(self, buf):
+        """
+        Write the next rows of the image.
+        @param buf: rows, BGRA order
+        @type buf: ndarray, dtype np.uint8, shape (h, width, 4)
+        """
+        h = buf.shape[0]
+        self.buf[self.rows:self.rows + h] = buf[..., :3]
+        self.rows += h
+
+    def close(self):
+        """
+        Write the file. Raise IOError on failure.
+        """
+        try:
+            if self.rows != self.height:
+                raise IOError('ArrayWriter : %d rows written, %d expected' % (self.rows, self.height))
+            if not cv2.imwrite(self.filename, self.buf, self.params):
+                raise IOError("Cannot write file %s " % self.filename)
+        finally:
+            self.abort()
+
+    def abort(self):
+        """
+        Release the temporary storage. The destination
+        file is not touched.
+        """
+        self.buf = None
+        self.__tmp.close()
+
+
+
+
+def getWriter(filename, width, height, quality=-1, alpha=True):
+    """
+    Return a writer for the file filename. The format is
+    given by the file extension (jpg, png or tif).
+    quality is the jpeg quality (0..100) or the png
+    compression level (0..9), -1 for default.
+    Raise IOError if the format is not supported.
+    @param filename:
+    @type filename: str
+    @param width:
+    @type width: int
+    @param height:
+    @type height: int
+    @param quality:
+    @type quality: int
+    @param alpha: write the alpha channel of png files
+    @type alpha: boolean
+    @return:
+    @rtype: PNGWriter or ArrayWriter
+    """
+    fileFormat = filename[-3:].upper()
+    if fileFormat == 'PNG':
+        return PNGWriter(filename, width, height, alpha=alpha, compression=quality)
+    if fileFormat == 'JPG':
+        params = [cv2.IMWRITE_JPEG_QUALITY, quality] if 0 <= quality <= 100 else []
+        return ArrayWriter(filename, width, height, params=params)
+    if fileFormat == 'TIF':
+        return ArrayWriter(filename, width, height)
+    raise IOError("Invalid File Format\nValid formats are jpg, png, tif ")
+
+
+class StackRenderer(object):
+    """
+    Evaluation of a list of layer parameters (cf. bLUeTop.pipeline.runStack())
+    tile by tile, at full resolution. Each tile is read from the source buffer, grown by
+    the sum of the halo radii of the layers (cf. pipeline.getHaloRadius()), the stack is run
+    on the grown tile and the inner part is kept. Bands of tiles are sent to a
+    writer when they are finished, so peak memory is the source buffer, plus a band
+    of tiles and the buffers of the layers for a single tile : it scales with the tile
+    size and the count of layers, not with the image size. The source buffer may be a
+    disk backed array (np.memmap).
+    Global statistics (cf. pipeline.needsGlobalStats()) are computed by a first pass over
+    a downsampled image, and imposed to the layers of all tiles.
+    Raw development is not supported (cf. pipeline.splitRaw()).
+    """
+    def __init__(self, stack, buf, tileSize=TILED_RENDER_SIZE, statsSize=TILED_STATS_SIZE, ctx=None):
+        """
+        Raise ValueError if a layer cannot be evaluated by tiles.
+        @param stack: layer parameters, from bottom to top
+        @type stack: list of dataclass
+        @param buf: source image
+        @type buf: ndarray, dtype uint8, shape (h, w, 4), BGRA order
+        @param tileSize: tile size, halo excluded
+        @type tileSize: int
+        @param statsSize: max size of the downsampled image
+        @type statsSize: int
+        @param ctx: environment
+        @type ctx: ApplyContext
+        """
+        self.stack, self.buf = stack, buf
+        self.tileSize, self.statsSize = tileSize, statsSize
+        self.ctx = pipeline.ApplyContext() if ctx is None else ctx
+        self.halo = 0
+        for params in stack:
+            if params.isNeutral():
+                continue
+            r = pipeline.getHaloRadius(params)
+            if r is None:
+                raise ValueError('Layer type %s cannot be rendered by tiles' % params.kind)
+            self.halo += r
+        self.stats = None
+        # downsampled rendering, computed by computeStats()
+        self.preview = None
+
+    def computeStats(self):
+        """
+        Run the stack on a downsampled image, recording
+        the global statistics of layers. The result is kept in self.preview.
+        """
+        h, w = self.buf.shape[:2]
+        r = min(1.0, self.statsSize / max(h, w))
+        small = cv2.resize(self.buf, (max(1, round(w * r)), max(1, round(h * r))), interpolation=cv2.INTER_AREA)
+        record = []
+        self.preview = pipeline.runStack(self.stack, small, ctx=self.ctx, record=record)
+        self.stats = record
+
+    def renderTile(self, x, y, w, h):
+        """
+        Run the stack inside the rectangle (x, y, w, h).
+        @param x:
+        @type x: int
+        @param y:
+        @type y: int
+        @param w:
+        @type w: int
+        @param h:
+        @type h: int
+        @return: tile, BGRA order
+        @rtype: ndarray, dtype np.uint8, shape (h, w, 4)
+        """
+        height, width = self.buf.shape[:2]
+        r = self.halo
+        x0, y0 = max(x - r, 0), max(y - r, 0)
+        x1, y1 = min(x + w + r, width), min(y + h + r, height)
+        ctx = replace(self.ctx, origin=(x0, y0), fullSize=(width, height))
+        out = pipeline.runStack(self.stack, np.ascontiguousarray(self.buf[y0:y1, x0:x1]), ctx=ctx, stats=self.stats)
+        return out[y - y0:y - y0 + h, x - x0:x - x0 + w]
+
+    def render(self, writer, rect=None):
+        """
+        Run the stack inside rect, and send the result to writer, band by band.
+        Global statistics are computed first, if needed.
+        @param writer: object with a method writeRows(buf), buf being a BGRA array
+        @type writer: PNGWriter or ArrayWriter
+        @param rect: region (x, y, w, h) to render (default whole image)
+        @type rect: 4-uple of int
+        """
+        if rect is None:
+            rect = (0, 0, self.buf.shape[1], self.buf.shape[0])
+        left, top, width, height = rect
+        if self.stats is None:
+            self.computeStats()
+        t = self.tileSize
+        for y in range(top, top + height, t):
+            th = min(t, top + height - y)
+            band = np.empty((th, width, 4), dtype=np.uint8)
+            for x in range(left, left + width, t):
+                tw = min(t, left + width - x)
+                band[:, x - left:x - left + tw] = self.renderTile(x, y, tw, th)
+            writer.writeRows(band)
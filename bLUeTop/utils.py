@@ -235,6 +235,17 @@ class UDict(object):
                 return self.__dictionaries[i][item]
         return None
 
+    def toDict(self):
+        """
+        Return the union as a new dict.
+        @return:
+        @rtype: dict
+        """
+        d = {}
+        for dic in reversed(self.__dictionaries):
+            d.update(dic)
+        return d
+
 
 class QbLUeColorDialog(QColorDialog):
 
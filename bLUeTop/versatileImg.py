@@ -24,6 +24,7 @@ from PySide2.QtCore import Qt, QRectF, QSize
 
 import cv2
 from copy import copy
+from dataclasses import replace
 
 from PySide2.QtGui import QImageReader, QTransform, QBitmap
 from PySide2.QtWidgets import QApplication, QSplitter
@@ -31,26 +32,25 @@ from PySide2.QtGui import QImage, QColor, QPainter
 from PySide2.QtCore import QRect
 
 from bLUeGui.bLUeImage import bImage, ndarrayToQImage
-from bLUeCore.multi import chosenInterp
+from bLUeCore.clahe import claheLUTs, claheApply
+from bLUeCore.multi import chosenInterp, interpArray
+from bLUeCore.tiles import tileEngine
 from bLUeTop.QtGui1 import app
 from bLUeTop.align import alignImages
 from bLUeTop.cloning import alphaBlend
 from bLUeTop.colorManagement import icc
 
-from bLUeTop.graphicsBlendFilter import blendFilterIndex
-
-from bLUeTop.graphicsFilter import filterIndex
 from bLUeGui.histogramWarping import warpHistogram
 from bLUeGui.bLUeImage import QImageBuffer
-from bLUeGui.colorCube import rgb2hspVec, hsp2rgbVec, hsv2rgbVec
-from bLUeGui.blend import blendLuminosity, blendLuminosityBuf
-from bLUeGui.colorCIE import sRGB2LabVec, Lab2sRGBVec, rgb2rgbLinear, \
-    rgbLinear2rgb, RGB2XYZ, sRGB_lin2XYZInverse, bbTemperature2RGB, sRGB_lin2XYZ
-from bLUeGui.multiplier import temperatureAndTint2Multipliers
+from bLUeGui.memory import memoryManager, MemoryManager
+from bLUeGui.colorCube import hsp2rgbVec
+from bLUeGui.colorCIE import Lab2sRGBVec, sRGB_lin2XYZInverse, sRGB_lin2XYZ
 from bLUeGui.dialog import dlgWarn
-from bLUeCore.kernel import getKernel
 from bLUeTop.lutUtils import LUT3DIdentity
+from bLUeTop import pipeline
 from bLUeTop.rawProcessing import rawPostProcess
+from bLUeTop.settings import WORKING_DTYPE
+from bLUeTop.stackWorker import deferToGui
 from bLUeTop.utils import UDict
 from bLUeCore.dwtDenoising import dwtDenoiseChan
 from bLUeTop.mergeImages import expFusion
@@ -331,6 +331,9 @@ class vImage(bImage):
             rawMetadata = {}
         self.isModified = False
         self.rect, self.marker = None, None  # selection rectangle, marker
+        # region of the output to recompute (full size image coordinates), None for the whole image.
+        # It is set by the stack evaluation and honored by some apply methods only (cf. QLayer.evaluateStack())
+        self.dirtyRect = None
         self.isCropped = False
         self.cropTop, self.cropBottom, self.cropLeft, self.cropRight = (0,) * 4
         self.isRuled = False
@@ -396,6 +399,20 @@ class vImage(bImage):
         if self.depth() != 32:
             raise ValueError('vImage : should be a 8 bits/channel color image')
         self.filename = filename if filename is not None else ''
+        # the image data is accounted, but never evicted : Qt may
+        # share it implicitly with copies (cf. MemoryManager)
+        memoryManager.register(self, 'image', self, policy=MemoryManager.KEEP)
+
+    @property
+    def thumb(self):
+        return self.__thumb
+
+    @thumb.setter
+    def thumb(self, img):
+        self.__thumb = img
+        # accounted only : layer thumbs hold evaluated previews.
+        # A thumbnail aliasing the image (pyramid level 0) uses no memory.
+        memoryManager.register(self, 'thumb', None if img is self else img, policy=MemoryManager.KEEP)
 
     def setProfile(self, profile):
         """
@@ -545,43 +562,27 @@ class vImage(bImage):
             y = (y * self.height()) / currentImg.height()
         return int(x), int(y)
 
-    def getHspbBuffer(self):
-        """
-        return the image buffer in color mode HSpB.
-        The buffer is recalculated when needed.
-        @return: HSPB buffer
-        @rtype: ndarray
-        """
-        # inputImage = self.inputImgFull().getCurrentImage()
-        if self.hspbBuffer is None or not self.cachesEnabled:
-            currentImage = self.getCurrentImage()
-            self.hspbBuffer = rgb2hspVec(QImageBuffer(currentImage)[:, :, :3][:, :, ::-1])
-        return self.hspbBuffer
-
-    def getLabBuffer(self):
+    def getColorImage(self):
         """
-        return the image buffer in color mode Lab.
-        The buffer is recalculated when needed.
-        @return: Lab buffer, L range is 0..1, a, b ranges are -128..+128
-        @rtype: numpy ndarray, dtype np.float
+        Color space buffers (cf. bImage.getColorBuffer())
+        are computed from the current image.
+        @return:
+        @rtype: QImage
         """
-        if self.LabBuffer is None or not self.cachesEnabled:
-            currentImage = self.getCurrentImage()
-            self.LabBuffer = sRGB2LabVec(QImageBuffer(currentImage)[:, :, :3][:, :, ::-1])
-        return self.LabBuffer
+        return self.getCurrentImage()
 
-    def getHSVBuffer(self):
+    def getVersion(self):
         """
-        return the image buffer in color mode HSV.
-        The buffer is calculated if needed and cached.
-        H,S,V ranges are 0..255 (opencv convention for 8 bits images)
-        @return: HSV buffer
-        @rtype: numpy ndarray, dtype np.float
+        Color space buffers are cached until the next call to
+        cacheInvalidate() (cf. applyToStack()). The token
+        identifies the current image (full size or thumbnail).
+        @return:
+        @rtype: hashable
         """
-        if self.HSVBuffer is None or not self.cachesEnabled:
-            currentImage = self.getCurrentImage()
-            self.HSVBuffer = cv2.cvtColor(QImageBuffer(currentImage)[:, :, :3], cv2.COLOR_BGR2HSV)
-        return self.HSVBuffer
+        if not self.cachesEnabled:
+            return None
+        currentImage = self.getCurrentImage()
+        return currentImage.width(), currentImage.height()
 
     def setModified(self, b):
         """
@@ -690,6 +691,98 @@ class vImage(bImage):
         img.useHald = self.useHald
         return img
 
+    def getImposedStat(self, key):
+        """
+        Return the value of the global statistic key imposed
+        by tiled rendering, or None (cf. mImage.statsMode).
+        @param key:
+        @type key: str
+        @return:
+        @rtype: object
+        """
+        if self.parentImage.statsMode == 'use' and self.stats is not None:
+            return self.stats.get(key)
+        return None
+
+    def recordStat(self, key, value):
+        """
+        Record the value of the global statistic key,
+        if required by tiled rendering (cf. mImage.statsMode).
+        @param key:
+        @type key: str
+        @param value:
+        @type value: object
+        """
+        if self.parentImage.statsMode == 'record':
+            if self.stats is None:
+                self.stats = {}
+            self.stats[key] = value
+
+    def getApplyContext(self, **kwargs):
+        """
+        Return the environment of the headless transformations
+        (cf. bLUeTop.pipeline) applied to the layer : working color
+        space, global statistics (cf. getImposedStat() and recordStat())
+        and position of tiles (cf. mImage.tileOrigin).
+        Keyword arguments are passed to the ApplyContext constructor.
+        @return:
+        @rtype: ApplyContext
+        """
+        img = self.parentImage
+        if img.statsMode == 'record':
+            if self.stats is None:
+                self.stats = {}
+            recorded = self.stats
+        else:
+            recorded = {}
+        return pipeline.ApplyContext(RGB_lin2XYZ=img.RGB_lin2XYZ, RGB_lin2XYZInverse=img.RGB_lin2XYZInverse,
+                                     stats=self.stats if img.statsMode == 'use' else None,
+                                     recorded=recorded, origin=img.tileOrigin, fullSize=img.fullSize, **kwargs)
+
+    def applyCLAHE(self, channel, clipLimit):
+        """
+        Contrast Limited Adaptive Histogram Equalization
+        of a single channel, using a grid of 8x8 cells. The cell LUTs
+        are global statistics (cf. bLUeCore.clahe).
+        @param channel:
+        @type channel: ndarray, dtype np.uint8, shape (h, w)
+        @param clipLimit:
+        @type clipLimit: float
+        @return:
+        @rtype: ndarray, dtype np.uint8, shape (h, w)
+        """
+        luts = self.getImposedStat('clahe')
+        if luts is not None:
+            img = self.parentImage
+            return claheApply(channel, luts, origin=img.tileOrigin, fullSize=img.fullSize)
+        if self.parentImage.statsMode == 'record':
+            luts = claheLUTs(channel, clipLimit)
+            self.recordStat('clahe', luts)
+            return claheApply(channel, luts)
+        clahe = cv2.createCLAHE(clipLimit=clipLimit, tileGridSize=(8, 8))
+        clahe.setClipLimit(clipLimit)
+        return clahe.apply(channel)
+
+    def getDirtySlices(self, align=1):
+        """
+        Return the slices of the region of the output to recompute :
+        dirtyRect if it is not None, otherwise the whole image.
+        The left and right bounds of the region are rounded to multiples of align
+        (or to the image width). Opencv color conversions of 8 bits images
+        depend on the column of the pixels modulo the width of vectorized
+        blocks : regions aligned on 64 columns get the values of the whole image.
+        @param align:
+        @type align: int
+        @return:
+        @rtype: tuple of slice
+        """
+        r = self.dirtyRect
+        if r is None:
+            return np.s_[:, :]
+        left = (r.left() // align) * align
+        right = min(-(-(r.right() + 1) // align) * align, self.getCurrentImage().width())
+        return np.s_[r.top():r.bottom() + 1, left:right]
+
     def applyNone(self):
         """
         Pass through
@@ -697,7 +790,11 @@ class vImage(bImage):
         imgIn = self.inputImg()
         bufIn = QImageBuffer(imgIn)
         bufOut = QImageBuffer(self.getCurrentImage())
-        bufOut[:, :, :] = bufIn
+        if self.dirtyRect is not None:
+            r = self.dirtyRect
+            bufOut[r.top():r.bottom() + 1, r.left():r.right() + 1] = bufIn[r.top():r.bottom() + 1, r.left():r.right() + 1]
+        else:
+            bufOut[:, :, :] = bufIn
         self.updatePixmap()
 
     def applyCloning(self, seamless=True, showTranslated=False, moving=False):  # TODO remove parameter showTranslated
@@ -838,7 +935,7 @@ class vImage(bImage):
         @type mode:
         """
         invalid = vImage.defaultColor_Invalid.green()
-        form = self.getGraphicsForm()
+        form = self.getFormParams()
         # formOptions = form.listWidget1
         inputImg = self.inputImg()
         ##################################################################
@@ -951,27 +1048,12 @@ class vImage(bImage):
         """
         Invert an  image. Depending of the graphics form options,
         the orange mask is estimated automaically or set from
-        the graphic form parameters.
+        the graphic form parameters (cf. bLUeTop.pipeline.applyInvert()).
         """
-        adjustForm = self.getGraphicsForm()
-        options = adjustForm.options if adjustForm is not None else {'Auto': True}
-        bufIn = QImageBuffer(self.inputImg())[:, :, :3]
-        if options['Auto']:
-            # get orange mask from negative brightest (unexposed) pixels
-            temp = np.sum(bufIn, axis=2)
-            ind = np.argmax(temp)
-            ind = np.unravel_index(ind, (bufIn.shape[0], bufIn.shape[1]))
-            Mask0, Mask1, Mask2 = bufIn[ind]
-        else:
-            Mask0, Mask1, Mask2 = adjustForm.Bmask, adjustForm.Gmask, adjustForm.Rmask
-        currentImage = self.getCurrentImage()
-        bufOut = QImageBuffer(currentImage)
-        # eliminate mask
-        tmp = bufIn[:, :, :3] / [Mask0, Mask1, Mask2]
-        tmp *= 255  # TODO modified 23/01/20 validate
-        np.clip(tmp, 0, 255, out=tmp)
-        # invert
-        bufOut[:, :, :3] = 255.0 - tmp
+        adjustForm = self.getFormParams()
+        params = adjustForm.getParams() if adjustForm is not None else pipeline.InvertParams()
+        pipeline.applyInvert(params, QImageBuffer(self.inputImg()), QImageBuffer(self.getCurrentImage()),
+                             self.getApplyContext())
         self.updatePixmap()
 
     def applyHDRMerge(self, options):
@@ -1017,51 +1099,62 @@ class vImage(bImage):
         @param options:
         @type options:
         """
-        form = self.getGraphicsForm()
-        exposureCorrection = form.expCorrection
+        params = self.getFormParams().getParams()
         # neutral point
-        if abs(exposureCorrection) < 0.05:
-            buf0 = QImageBuffer(self.getCurrentImage())
-            buf1 = QImageBuffer(self.inputImg())
-            buf0[:, :, :] = buf1
-            self.updatePixmap()
+        if params.isNeutral():
+            inputImage = self.inputImg()
+            self.forwardInput(inputImage)
+            # forward the linear input too
+            self.setLinearOutput(self.getLinearInput(inputImage) if self.keepsLinearOutput() else None)
             return
-        bufIn = QImageBuffer(self.inputImg())
-        buf = bufIn[:, :, :3][:, :, ::-1]
-        # convert to linear
-        buf = rgb2rgbLinear(buf)
-        # apply correction
-        buf[:, :, :] = buf * (2 ** exposureCorrection)
-        np.clip(buf, 0.0, 1.0, out=buf)
-        # convert back to RGB
-        buf = rgbLinear2rgb(buf)
-        np.clip(buf, 0.0, 255.0, out=buf)
-        currentImage = self.getCurrentImage()
-        ndImg1a = QImageBuffer(currentImage)
-        ndImg1a[:, :, :3][:, :, ::-1] = buf
-        # forward the alpha channel
-        ndImg1a[:, :, 3] = bufIn[:, :, 3]
+        self.applyLinearLight(lambda bufIn, bufOut, ctx: pipeline.applyExposure(params, bufIn, bufOut, ctx))
+
+    def applyLinearLight(self, apply, inputLayer=None):
+        """
+        Apply a transformation of linear RGB values to the input
+        image of inputLayer (default self), and set the output of self.
+        apply(bufIn, bufOut, ctx) is a headless transformation (cf. bLUeTop.pipeline),
+        reading linear values from ctx.linearIn, if it is not None, and keeping them
+        in ctx.linearOut, if it is not None.
+        Linear values are read from, and kept for, adjacent linear light
+        layers, when possible (cf. QLayer.getLinearInput() and QLayer.keepsLinearOutput()).
+        Thus, only the last layer of a sequence of linear light layers is decoded from sRGB.
+        @param apply:
+        @type apply: function
+        @param inputLayer:
+        @type inputLayer: QLayer
+        """
+        if inputLayer is None:
+            inputLayer = self
+        inputImage = inputLayer.inputImg()
+        bufIn = QImageBuffer(inputImage)
+        linearOut = np.empty(bufIn.shape[:2] + (3,), dtype=WORKING_DTYPE) if self.keepsLinearOutput() else None
+        ctx = self.getApplyContext(linearIn=inputLayer.getLinearInput(inputImage), linearOut=linearOut)
+        apply(bufIn, QImageBuffer(self.getCurrentImage()), ctx)
         self.updatePixmap()
+        self.setLinearOutput(linearOut)
+
+    def applyLinearMatrix(self, M, inputLayer=None):
+        """
+        Multiply the linear RGB values v of the input
+        image of inputLayer (default self) by M (M @ v), and set the output
+        of self (cf. applyLinearLight()).
+        @param M:
+        @type M: ndarray, shape (3, 3)
+        @param inputLayer:
+        @type inputLayer: QLayer
+        """
+        transform = pipeline.matrixTransform(M)
+        self.applyLinearLight(lambda bufIn, bufOut, ctx: pipeline.applyLinearTransform(transform, bufIn, bufOut, ctx),
+                              inputLayer=inputLayer)
 
     def applyMixer(self, options):
-        form = self.getGraphicsForm()
-        bufIn = QImageBuffer(self.inputImg())
-        buf = bufIn[:, :, :3][:, :, ::-1]
-        # convert to linear
-        buf = rgb2rgbLinear(buf)
-        # mix channels
-        currentImage = self.getCurrentImage()
-        bufOut = QImageBuffer(currentImage)
-        buf = np.tensordot(buf, form.mixerMatrix, axes=(-1, -1))
-        np.clip(buf, 0, 1.0, out=buf)
-        # convert back to RGB
-        buf = rgbLinear2rgb(buf)
-        if form.options['Luminosity']:
-            bufOut[:, :, :3][:, :, ::-1] = blendLuminosityBuf(bufIn[:, :, :3][:, :, ::-1], buf)
-        else:
-            bufOut[:, :, :3][:, :, ::-1] = np.round(buf)  # truncation would be harmful here
-        # forward the alpha channel
-        bufOut[:, :, 3] = bufIn[:, :, 3]
+        params = self.getFormParams().getParams()
+        if not params.luminosity:
+            self.applyLinearMatrix(params.matrix)
+            return
+        pipeline.applyMixer(params, QImageBuffer(self.inputImg()), QImageBuffer(self.getCurrentImage()),
+                            self.getApplyContext())
         self.updatePixmap()
 
     def applyTransForm(self, options):
@@ -1093,9 +1186,7 @@ class vImage(bImage):
             return
         # neutral point
         if T.isIdentity():
-            buf1 = QImageBuffer(inImg)
-            buf0[:, :, :] = buf1
-            self.updatePixmap()
+            self.forwardInput(inImg)
             return
         # get the bounding rect of the transformed image (in the full size image coordinate system)
         # (Avoid the conversion of QTransforms to QMatrix4x4 and matrix product)
@@ -1130,7 +1221,7 @@ class vImage(bImage):
         """
         Wavelets, bilateral filtering, NLMeans
         """
-        adjustForm = self.getGraphicsForm()
+        adjustForm = self.getFormParams()
         noisecorr = adjustForm.noiseCorrection
         currentImage = self.getCurrentImage()
         inputImage = self.inputImg()
@@ -1139,8 +1230,7 @@ class vImage(bImage):
         ########################
         # hald pass through and neutral point
         if self.parentImage.isHald or noisecorr == 0:
-            buf1[...] = buf0
-            self.updatePixmap()
+            self.forwardInput(inputImage)
             return
         ########################
         w, h = self.width(), self.height()
@@ -1165,7 +1255,14 @@ class vImage(bImage):
         noisecorr *= currentImage.width() / self.width()
         if adjustForm.options['Wavelets']:
             noisecorr *= 100
-            bufLab = cv2.cvtColor(buf01, cv2.COLOR_RGB2Lab)
+            if self.rect is None:
+                # use the shared Lab buffer of the input image (cf. bImage.getLabBuffer()),
+                # scaled back to the opencv ranges for 8 bits images
+                bufLab = inputImage.getLabBuffer() * np.array([255.0, 1.0, 1.0], dtype=WORKING_DTYPE)
+                bufLab[:, :, 1:] += 128.0
+                np.rint(bufLab[:, :, 0], out=bufLab[:, :, 0])
+            else:
+                bufLab = cv2.cvtColor(buf01, cv2.COLOR_RGB2Lab).astype(WORKING_DTYPE)
             L = dwtDenoiseChan(bufLab, chan=0, thr=noisecorr, thrmode='wiener')  # level=8 if self.parentImage.useThumb else 11)
             A = dwtDenoiseChan(bufLab, chan=1, thr=noisecorr, thrmode='wiener')  # level=8 if self.parentImage.useThumb else 11)
             B = dwtDenoiseChan(bufLab, chan=2, thr=noisecorr, thrmode='wiener')  # level=8 if self.parentImage.useThumb else 11)
@@ -1201,6 +1298,24 @@ class vImage(bImage):
 
         rawPostProcess(self, pool=pool)
 
+    def showContrastSpline(self, a, b, d, T):
+        """
+        Display the contrast spline viewer of the
+        layer form. The call is deferred to the GUI thread
+        if needed (cf. deferToGui()).
+        @param a: x_coordinates
+        @type a:
+        @param b: y-coordinates
+        @type b:
+        @param d: tangent slopes
+        @type d:
+        @param T: spline
+        @type T: ndarray dtype=float
+        """
+        form = self.getGraphicsForm(live=True)
+        if not deferToGui((id(form), 'setContrastSpline'), form.setContrastSpline, a, b, d, T):
+            form.setContrastSpline(a, b, d, T)
+
     def applyContrast(self, version='HSV'):
         """
         Apply contrast, saturation and brightness corrections.
@@ -1212,7 +1327,7 @@ class vImage(bImage):
         @param version:
         @type version: str
         """
-        adjustForm = self.getGraphicsForm()
+        adjustForm = self.getFormParams()
         options = adjustForm.options
         contrastCorrection = adjustForm.contrastCorrection
         satCorrection = adjustForm.satCorrection
@@ -1223,8 +1338,7 @@ class vImage(bImage):
         ndImg1a = QImageBuffer(currentImage)
         # neutral point : by pass
         if contrastCorrection == 0 and satCorrection == 0 and brightnessCorrection == 0:
-            ndImg1a[:, :, :] = tmpBuf
-            self.updatePixmap()
+            self.forwardInput(inputImage)
             return
         ##########################
         # Lab mode (slower than HSV)
@@ -1244,19 +1358,21 @@ class vImage(bImage):
                 if options['CLAHE']:
                     if self.parentImage.isHald:
                         raise ValueError('cannot build 3D LUT from CLAHE ')
-                    clahe = cv2.createCLAHE(clipLimit=contrastCorrection, tileGridSize=(8, 8))
-                    clahe.setClipLimit(contrastCorrection)
-                    res = clahe.apply((LBuf[:, :, 0] * 255.0).astype(np.uint8)) / 255.0
+                    res = self.applyCLAHE((LBuf[:, :, 0] * 255.0).astype(np.uint8), contrastCorrection) / 255.0
                 # warping
                 else:
                     if self.parentImage.isHald and not options['manualCurve']:
                         raise ValueError('A contrast curve was found.\nCheck the option Show Contrast Curve in Cont/Bright/Sat layer')
                     auto = self.autoSpline and not self.parentImage.isHald
+                    quadSpline = self.getImposedStat('warp')
+                    if quadSpline is None and not auto:
+                        quadSpline = self.getMmcSpline()
                     res, a, b, d, T = warpHistogram(LBuf[:, :, 0], warp=contrastCorrection, preserveHigh=options['High'],
-                                                spline=None if auto else self.getMmcSpline())
+                                                quadSpline=quadSpline)
+                    self.recordStat('warp', (a, b, d, T))
                     # show the spline viewer
-                    if self.autoSpline and options['manualCurve']:
-                        self.getGraphicsForm().setContrastSpline(a, b, d, T)
+                    if self.autoSpline and options['manualCurve'] and not self.parentImage.offscreen:
+                        self.showContrastSpline(a, b, d, T)
                         self.autoSpline = False
                 LBuf[:, :, 0] = res
             # saturation
@@ -1285,21 +1401,23 @@ class vImage(bImage):
                 if options['CLAHE']:
                     if self.parentImage.isHald:
                         raise ValueError('cannot build 3D LUT from CLAHE ')
-                    clahe = cv2.createCLAHE(clipLimit=contrastCorrection, tileGridSize=(8, 8))
-                    clahe.setClipLimit(contrastCorrection)
-                    res = clahe.apply((HSVBuf[:, :, 2]))
+                    res = self.applyCLAHE(HSVBuf[:, :, 2], contrastCorrection)
                 # warping
                 else:
                     if self.parentImage.isHald and not options['manualCurve']:
                         raise ValueError('A contrast curve was found.\nCheck the option Show Contrast Curve in Cont/Bright/Sat layer')
-                    buf32 = HSVBuf[:, :, 2].astype(np.float) / 255
+                    buf32 = HSVBuf[:, :, 2].astype(WORKING_DTYPE) / 255
                     auto = self.autoSpline and not self.parentImage.isHald  # flag for manual/auto spline
+                    quadSpline = self.getImposedStat('warp')
+                    if quadSpline is None and not auto:
+                        quadSpline = self.getMmcSpline()
                     res, a, b, d, T = warpHistogram(buf32, warp=contrastCorrection, preserveHigh=options['High'],
-                                                    spline=None if auto else self.getMmcSpline())
+                                                    quadSpline=quadSpline)
+                    self.recordStat('warp', (a, b, d, T))
                     res = (res*255.0).astype(np.uint8)
                     # show the spline viewer
-                    if self.autoSpline and options['manualCurve']:
-                        self.getGraphicsForm().setContrastSpline(a, b, d, T)
+                    if self.autoSpline and options['manualCurve'] and not self.parentImage.offscreen:
+                        self.showContrastSpline(a, b, d, T)
                         self.autoSpline = False
                 HSVBuf[:, :, 2] = res
             if satCorrection != 0:
@@ -1322,89 +1440,37 @@ class vImage(bImage):
         @param stackedLUT: array of color values (in range 0..255) : a row for each R, G, B channel
         @type stackedLUT : ndarray, shape=(3, 256), dtype=int
         """
+        adjustForm = self.getFormParams()
+        params = pipeline.RGBCurvesParams(lut=stackedLUT, luminosity=adjustForm.getSceneOptions()['Luminosity'])
         # neutral point: by pass
-        if not np.any(stackedLUT - np.arange(256)):  # last dims are equal : broadcast works
-            buf1 = QImageBuffer(self.inputImg())
-            buf2 = QImageBuffer(self.getCurrentImage())
-            buf2[:, :, :] = buf1
-            self.updatePixmap()
+        if params.isNeutral():
+            self.forwardInput()
             return
-        adjustForm = self.getGraphicsForm()
-        options = adjustForm.graphicsScene.options
-        inputImage = self.inputImg()
-        currentImage = self.getCurrentImage()
-        # get image buffers
-        ndImg0a = QImageBuffer(inputImage)
-        ndImg1a = QImageBuffer(currentImage)
-        ndImg0 = ndImg0a[:, :, :3]
-        ndImg1 = ndImg1a[:, :, :3]
-        # apply LUTS to channels
-        s = ndImg0[:, :, 0].shape
-        if options['Luminosity']:
-            buf = np.empty_like(ndImg1)
-            for c in range(3):  # 0.36s for 15Mpx
-                buf[:, :, c] = np.take(stackedLUT[2-c, :], ndImg0[:, :, c].reshape((-1,))).reshape(s)
-            ndImg1[..., :: -1] = blendLuminosityBuf(ndImg0[..., ::-1], buf[..., ::-1])
-        else:
-            for c in range(3):  # 0.36s for 15Mpx
-                ndImg1[:, :, c] = np.take(stackedLUT[2-c, :], ndImg0[:, :, c].reshape((-1,))).reshape(s)
-
-        # rList = np.array([2,1,0])  # B, G, R
-        # ndImg1[:, :, :] = stackedLUT[rList, ndImg0]  # last dims of index arrays are equal : broadcast works. slower 0.66s for 15Mpx
-        # forward alpha channel
-        ndImg1a[:, :, 3] = ndImg0a[:, :, 3]
+        # compute the dirty region only, if any
+        s = self.getDirtySlices()
+        pipeline.applyRGBCurves(params, QImageBuffer(self.inputImg())[s], QImageBuffer(self.getCurrentImage())[s],
+                                self.getApplyContext())
         self.updatePixmap()
 
     def applyLab1DLUT(self, stackedLUT, options=None):
         """
         Applies 1D LUTS (one row for each L,a,b channel)
+        (cf. bLUeTop.pipeline.applyLabCurves()).
         @param stackedLUT: array of color values (in range 0..255). Shape must be (3, 255) : a row for each channel
         @type stackedLUT: ndarray shape=(3,256) dtype=int or float
         @param options: not used yet
         """
-        if options is None:
-            options = UDict()
+        params = pipeline.LabCurvesParams(lut=stackedLUT)
         # neutral point
-        if not np.any(stackedLUT - np.arange(256)):  # last dims are equal : broadcast is working
-            buf1 = QImageBuffer(self.inputImg())
-            buf2 = QImageBuffer(self.getCurrentImage())
-            buf2[:, :, :] = buf1
-            self.updatePixmap()
+        if params.isNeutral():
+            self.forwardInput()
             return
-        # convert LUT to float to speed up  buffer conversions
-        stackedLUT = stackedLUT.astype(np.float)
-        # get the Lab input buffer
         Img0 = self.inputImg()
-        ndLabImg0 = Img0.getLabBuffer()  # copy()
-        # conversion functions
-
-        def scaleLabBuf(buf):
-            buf = buf + [0.0, 128.0, 128.0]  # copy is mandatory here to avoid the corruption of the cached Lab buffer
-            buf[:, :, 0] *= 255.0
-            return buf
-
-        def scaleBackLabBuf(buf):
-            buf = buf - [0.0, 128.0, 128.0]  # no copy needed here, but seems faster than in place operation!
-            buf[:, :, 0] /= 255.0
-            return buf
-        ndLImg0 = scaleLabBuf(ndLabImg0).astype(np.uint8)
-        # apply LUTS to channels
-        s = ndLImg0[:, :, 0].shape
-        ndLabImg1 = np.zeros(ndLImg0.shape, dtype=np.uint8)
-        for c in range(3):  # 0.43s for 15Mpx
-            ndLabImg1[:, :, c] = np.take(stackedLUT[c, :], ndLImg0[:, :, c].reshape((-1,))).reshape(s)
-        # ndLabImg1 = stackedLUT[rList, ndLImg0] # last dims are equal : broadcast works
-        ndLabImg1 = scaleBackLabBuf(ndLabImg1)
-        # back sRGB conversion
-        ndsRGBImg1 = Lab2sRGBVec(ndLabImg1)
-        # in place clipping
-        np.clip(ndsRGBImg1, 0, 255, out=ndsRGBImg1)  # mandatory
-        currentImage = self.getCurrentImage()
-        ndImg1 = QImageBuffer(currentImage)
-        ndImg1[:, :, :3][:, :, ::-1] = ndsRGBImg1
-        # forward the alpha channel
-        ndImg0 = QImageBuffer(Img0)
-        ndImg1[:, :, 3] = ndImg0[:, :, 3]
+        # the cached Lab input buffer is shared. A dirty region, if
+        # any, is converted and computed alone
+        s = self.getDirtySlices(align=64)
+        pipeline.applyLabCurves(params, QImageBuffer(Img0)[s], QImageBuffer(self.getCurrentImage())[s],
+                                self.getApplyContext(), labBuf=Img0.getLabBuffer() if self.dirtyRect is None else None)
         # update
         self.updatePixmap()
 
@@ -1422,29 +1488,34 @@ class vImage(bImage):
             options = UDict()
         # neutral point
         if not np.any(stackedLUT - np.arange(256)):  # last dims are equal : broadcast is working
-            buf1 = QImageBuffer(self.inputImg())
-            buf2 = QImageBuffer(self.getCurrentImage())
-            buf2[:, :, :] = buf1
-            self.updatePixmap()
+            self.forwardInput()
             return
         Img0 = self.inputImg()
         ndHSPBImg0 = Img0.getHspbBuffer()   # time 2s with cache disabled for 15 Mpx
-        # apply LUTS to normalized channels (range 0..255)
-        ndLImg0 = (ndHSPBImg0 * [255.0/360.0, 255.0, 255.0]).astype(np.uint8)
-        # rList = np.array([0,1,2]) # H,S,B
-        ndHSBPImg1 = np.zeros(ndLImg0.shape, dtype=np.uint8)
-        s = ndLImg0[:, :, 0].shape
-        for c in range(3):  # 0.36s for 15Mpx
-            ndHSBPImg1[:, :, c] = np.take(stackedLUT[c, :], ndLImg0[:, :, c].reshape((-1,))).reshape(s)
-        # ndHSBPImg1 = stackedLUT[rList, ndLImg0] * [360.0/255.0, 1/255.0, 1/255.0]
-        # back to sRGB
-        ndRGBImg1 = hsp2rgbVec(ndHSBPImg1)  # time 4s for 15 Mpx
-        # in place clipping
-        np.clip(ndRGBImg1, 0, 255, out=ndRGBImg1)  # mandatory
+
+        def kernel(ndHSPBImg0, ndImg1a):
+            # apply LUTS to normalized channels (range 0..255)
+            ndLImg0 = (ndHSPBImg0 * np.array([255.0/360.0, 255.0, 255.0], dtype=WORKING_DTYPE)).astype(np.uint8)
+            # rList = np.array([0,1,2]) # H,S,B
+            # hsp2rgbVec() is ill-conditioned for saturated colors : float64
+            # is kept, whatever the working float type
+            ndHSBPImg1 = np.empty(ndLImg0.shape, dtype=np.float64)
+            s = ndLImg0[:, :, 0].shape
+            for c in range(3):  # 0.36s for 15Mpx
+                ndHSBPImg1[:, :, c] = np.take(stackedLUT[c, :], ndLImg0[:, :, c].reshape((-1,))).reshape(s)
+            # ndHSBPImg1 = stackedLUT[rList, ndLImg0] * [360.0/255.0, 1/255.0, 1/255.0]
+            # scale back to H:0..360, S:0..1, pB:0..1 (cf. hsp2rgbVec())
+            ndHSBPImg1 *= [360.0/255.0, 1/255.0, 1/255.0]
+            # back to sRGB
+            ndRGBImg1 = hsp2rgbVec(ndHSBPImg1)  # time 4s for 15 Mpx
+            # in place clipping
+            np.clip(ndRGBImg1, 0, 255, out=ndRGBImg1)  # mandatory
+            ndImg1a[:, :, :3][:, :, ::-1] = ndRGBImg1
+
         # set current image to modified image
         currentImage = self.getCurrentImage()
         ndImg1a = QImageBuffer(currentImage)
-        ndImg1a[:, :, :3][:, :, ::-1] = ndRGBImg1
+        tileEngine.run(kernel, ndHSPBImg0, ndImg1a)
         # forward the alpha channel
         ndImg0 = QImageBuffer(Img0)
         ndImg1a[:, :, 3] = ndImg0[:, :, 3]
@@ -1453,7 +1524,8 @@ class vImage(bImage):
 
     def applyHSV1DLUT(self, stackedLUT, options=None, pool=None):
         """
-        Applies 1D LUTS to hue, sat and brightness channels.
+        Applies 1D LUTS to hue, sat and brightness channels
+        (cf. bLUeTop.pipeline.applyHSVCurves()).
         @param stackedLUT: array of color values (in range 0..255), a row for each channel
         @type stackedLUT : ndarray shape=(3,256) dtype=int or float
         @param options: not used yet
@@ -1461,37 +1533,17 @@ class vImage(bImage):
         @param pool: multiprocessing pool : unused
         @type pool: muliprocessing.Pool
         """
+        params = pipeline.HSVCurvesParams(lut=stackedLUT)
         # neutral point
-        if options is None:
-            options = UDict()
-        if not np.any(stackedLUT - np.arange(256)):  # last dims are equal : broadcast is working
-            buf1 = QImageBuffer(self.inputImg())
-            buf2 = QImageBuffer(self.getCurrentImage())
-            buf2[:, :, :] = buf1
-            self.updatePixmap()
+        if params.isNeutral():
+            self.forwardInput()
             return
-        # convert LUT to float to speed up  buffer conversions
-        stackedLUT = stackedLUT.astype(np.float)
-        # get HSV buffer, range H: 0..180, S:0..255 V:0..255
         Img0 = self.inputImg()
-        HSVImg0 = Img0.getHSVBuffer()
-        HSVImg0 = HSVImg0.astype(np.uint8)
-        # apply LUTS
-        HSVImg1 = np.zeros(HSVImg0.shape, dtype=np.uint8)
-        s = HSVImg0[:, :, 0].shape
-        for c in range(3):  # 0.43s for 15Mpx
-            HSVImg1[:, :, c] = np.take(stackedLUT[c, :], HSVImg0[:, :, c].reshape((-1,))).reshape(s)
-        # back to sRGB
-        RGBImg1 = hsv2rgbVec(HSVImg1, cvRange=True)
-        # in place clipping
-        np.clip(RGBImg1, 0, 255, out=RGBImg1)  # mandatory
-        # set current image to modified image
-        currentImage = self.getCurrentImage()
-        ndImg1a = QImageBuffer(currentImage)
-        ndImg1a[:, :, :3][:, :, ::-1] = RGBImg1
-        # forward the alpha channel
-        ndImg0 = QImageBuffer(Img0)
-        ndImg1a[:, :, 3] = ndImg0[:, :, 3]
+        # the cached HSV input buffer is shared, range H: 0..180, S:0..255 V:0..255.
+        # A dirty region, if any, is converted and computed alone
+        s = self.getDirtySlices(align=64)
+        pipeline.applyHSVCurves(params, QImageBuffer(Img0)[s], QImageBuffer(self.getCurrentImage())[s],
+                                self.getApplyContext(), hsvBuf=Img0.getHSVBuffer() if self.dirtyRect is None else None)
         # update
         self.updatePixmap()
 
@@ -1519,16 +1571,18 @@ class vImage(bImage):
             bufOut[:, :, :] = QImageBuffer(inputImage)
         else:
             w1, w2, h1, h2 = 0, self.inputImg().width(), 0, self.inputImg().height()
-        # get HSV buffer, range H: 0..180, S:0..255 V:0..255  (opencv convention for 8 bits images)
-        HSVImg0 = inputImage.getHSVBuffer()
-        HSVImg0 = HSVImg0.astype(np.float)
-        HSVImg0[:, :, 0] *= 2
-        bufHSV_CV32 = HSVImg0[h1:h2 + 1, w1:w2 + 1, :]
+        # get the shared HSV buffer, range H: 0..180, S:0..255 V:0..255  (opencv convention for 8 bits images)
+        # and convert the selected region only
+        HSVImg0 = inputImage.getHSVBuffer()[h1:h2 + 1, w1:w2 + 1, :]
+        # interpolation input, allocated in shared memory for parallel interpolation
+        bufHSV_CV32 = interpArray(HSVImg0.shape, WORKING_DTYPE, pool=pool)
+        bufHSV_CV32[...] = HSVImg0
+        bufHSV_CV32[:, :, 0] *= 2
 
         divs = LUT.divs
         steps = tuple([360 / divs[0], 255.0 / divs[1], 255.0 / divs[2]])
         interp = chosenInterp(pool, (w2 - w1) * (h2 - h1))
-        coeffs = interp(LUT.data, steps, bufHSV_CV32, convert=False)
+        coeffs = interp(LUT.getPreparedLUT(steps), steps, bufHSV_CV32, convert=False)
         bufHSV_CV32[:, :, 0] = np.mod(bufHSV_CV32[:, :, 0] + coeffs[:, :, 0], 360)
         bufHSV_CV32[:, :, 1:] = bufHSV_CV32[:, :, 1:] * coeffs[:, :, 1:]
         np.clip(bufHSV_CV32, (0, 0, 0), (360, 255, 255), out=bufHSV_CV32)
@@ -1539,12 +1593,14 @@ class vImage(bImage):
         bufOut[h1:h2 + 1, w1:w2 + 1, :3] = bufpostF32_1[:, :, ::-1]
         self.updatePixmap()
 
-    def apply3DLUT(self, lut3D, options=None, pool=None):
+    def apply3DLUT(self, lut3D, options=None, pool=None, inputImage=None):
         """
         Apply a 3D LUT to the current view of the image (self or self.thumb).
         If pool is not None and the size of the current view is > 3000000,
         parallel interpolation on image slices is used.
         If options['keep alpha'] is False, alpha channel is interpolated too.
+        When the LUT is applied repeatedly, it is baked into a dense
+        table (cf. bLUeCore.bakedLUT) and the interpolation is skipped.
         LUT axes, LUT channels and image channels must be in BGR order.
         @param lut3D: LUT3D
         @type lut3D: LUT3D
@@ -1552,13 +1608,14 @@ class vImage(bImage):
         @type options: UDict
         @param pool:
         @type pool:
+        @param inputImage: input image, default self.inputImg()
+        @type inputImage: bImage
         """
-        LUT = lut3D.LUT3DArray
-        LUTSTEP = lut3D.step
         if options is None:
             options = UDict()
         # get buffers
-        inputImage = self.inputImg()
+        if inputImage is None:
+            inputImage = self.inputImg()
         currentImage = self.getCurrentImage()
         # get selection
         w1, w2, h1, h2 = (0.0,) * 4
@@ -1576,8 +1633,11 @@ class vImage(bImage):
             if w1 >= w2 or h1 >= h2:
                 dlgWarn("Empty selection\nSelect a region with the marquee tool")
                 return
+        elif self.dirtyRect is not None:
+            # recompute the dirty region only
+            w1, w2, h1, h2 = self.dirtyRect.left(), self.dirtyRect.right(), self.dirtyRect.top(), self.dirtyRect.bottom()
         else:
-            w1, w2, h1, h2 = 0, self.inputImg().width(), 0, self.inputImg().height()
+            w1, w2, h1, h2 = 0, inputImage.width(), 0, inputImage.height()
         inputBuffer0 = QImageBuffer(inputImage)
         inputBuffer = inputBuffer0[h1:h2 + 1, w1:w2 + 1, :]
         imgBuffer = QImageBuffer(currentImage)[:, :, :]
@@ -1589,14 +1649,11 @@ class vImage(bImage):
         else:
             ndImg0 = inputBuffer[:, :, :3]
             ndImg1 = imgBuffer[:, :, :3]
-            LUT = np.ascontiguousarray(LUT[..., :3])
-        # choose the right interpolation method
-        interp = chosenInterp(pool, (w2 - w1) * (h2 - h1))
         # apply LUT
         if useSelection:
             # need to reset the outside of the current selection
             ndImg1[:, :, :] = inputBuffer0
-        ndImg1[h1:h2 + 1, w1:w2 + 1, :] = interp(LUT, LUTSTEP, ndImg0)
+        ndImg1[h1:h2 + 1, w1:w2 + 1, :] = pipeline.interpLUT3D(lut3D, ndImg0, pool=pool)
         if not interpAlpha:
             # forward the alpha channel
             imgBuffer[h1:h2 + 1, w1:w2 + 1, 3] = inputBuffer[:, :, 3]
@@ -1604,9 +1661,9 @@ class vImage(bImage):
 
     def applyFilter2D(self, options=None):
         """
-        Apply 2D kernel.
+        Apply 2D kernel (cf. bLUeTop.pipeline.filter2D()).
         """
-        adjustForm = self.getGraphicsForm()
+        params = self.getFormParams().getParams()
         inputImage = self.inputImg()
         currentImage = self.getCurrentImage()
         buf0 = QImageBuffer(inputImage)
@@ -1633,22 +1690,22 @@ class vImage(bImage):
             # reset output image
             buf1[:, :, :] = buf0
             ROI1 = buf1[slices]
+        elif self.dirtyRect is not None:
+            # recompute the dirty region only : filter the region grown
+            # by the kernel radius, and keep the inner part.
+            d = self.dirtyRect
+            halo = params.radius + 1
+            g = d.adjusted(-halo, -halo, halo, halo).intersected(QRect(0, 0, w, h))
+            ROI0 = buf0[g.top():g.bottom() + 1, g.left():g.right() + 1, :3]
+            ROI1 = np.empty_like(ROI0)
         else:
             ROI0 = buf0[:, :, :3]
             ROI1 = buf1[:, :, :3]
-        # kernel based filtering
-        if adjustForm.kernelCategory in [filterIndex.IDENTITY, filterIndex.UNSHARP,
-                                         filterIndex.SHARPEN, filterIndex.BLUR1, filterIndex.BLUR2]:
-            # correct radius for preview if needed
-            radius = int(adjustForm.radius * r)
-            kernel = getKernel(adjustForm.kernelCategory, radius, adjustForm.amount)
-            ROI1[:, :, :] = cv2.filter2D(ROI0, -1, kernel)
-        else:
-            # bilateral filtering
-            radius = int(adjustForm.radius * r)
-            sigmaColor = 2 * adjustForm.tone
-            sigmaSpace = sigmaColor
-            ROI1[:, :, ::-1] = cv2.bilateralFilter(ROI0[:, :, ::-1], radius, sigmaColor, sigmaSpace)
+        # correct radius for preview if needed
+        ROI1[...] = pipeline.filter2D(replace(params, radius=int(params.radius * r)), ROI0)
+        if self.rect is None and self.dirtyRect is not None:
+            top, left = d.top() - g.top(), d.left() - g.left()
+            buf1[d.top():d.bottom() + 1, d.left():d.right() + 1, :3] = ROI1[top:top + d.height(), left:left + d.width()]
         # forward the alpha channel
         buf1[:, :, 3] = buf0[:, :, 3]
         self.updatePixmap()
@@ -1656,8 +1713,9 @@ class vImage(bImage):
     def applyBlendFilter(self):
         """
         Apply a gradual neutral density filter
+        (cf. bLUeTop.pipeline.applyGradualFilter()).
         """
-        adjustForm = self.getGraphicsForm()
+        params = self.getFormParams().getParams()
         inputImage = self.inputImg()
         currentImage = self.getCurrentImage()
         buf0 = QImageBuffer(inputImage)
@@ -1669,130 +1727,35 @@ class vImage(bImage):
             self.updatePixmap()
             return
         ########################
-
-        # We blend a neutral filter with density range 0.5*s...0.5 with the image b,
-        # using blending mode overlay : f(a,b) = 2*a*b if b < 0.5 else f(a,b) = 1 - 2*(1-a)(1-b)
-
-        buf32Lab = cv2.cvtColor(((buf0.astype(np.float32)) / 256).astype(np.float32), cv2.COLOR_BGR2Lab)
-        # get height of current image
-        h = buf0.shape[0]
-        """
-        rect = getattr(self, 'rect', None)
-        if rect is not None:
-            rect = rect.intersected(QRect(0, 0, buf0.shape[1], buf0.shape[0]))
-            adjustForm.filterStart = int((rect.top() / h) * 100.0)
-            adjustForm.filterEnd = int((rect.bottom() / h) * 100.0)
-            adjustForm.sliderFilterRange.setStart(adjustForm.filterStart)
-            adjustForm.sliderFilterRange.setEnd(adjustForm.filterEnd)
-        """
-        if adjustForm.filterEnd > 4:
-            # build the filter as a 1D array of size h
-            s = 0  # strongest 0
-            opacity = 1 - s
-            if adjustForm.kernelCategory == blendFilterIndex.GRADUALNONE:
-                start, end = 0, h - 1
-            else:
-                start = int(h * adjustForm.filterStart / 100.0)
-                end = int(h * adjustForm.filterEnd / 100.0)
-            test = np.arange(end - start) * opacity / (
-                        2.0 * max(end - start - 1, 1)) + 0.5 * s  # range 0.5*s...0.5
-            test = np.concatenate((np.zeros(start) + 0.5 * s, test, np.zeros(h - end) + 0.5))
-            if adjustForm.kernelCategory == blendFilterIndex.GRADUALBT:
-                # rotate filter 180°
-                test = test[::-1]
-            # blend the filter with the image
-            Lchan = buf32Lab[:, :, 0]
-            test1 = test[:, np.newaxis] + np.zeros(Lchan.shape)
-            buf32Lab[:, :, 0] = np.where(Lchan < 50, Lchan * (test1 * 2.0),
-                                         100.0 - 2.0 * (1.0 - test1) * (100.0 - Lchan))
-            # luminosity correction
-            # buf32Lab[:,:,0] = buf32Lab[:,:,0]*(1.0+0.1)
-            bufRGB32 = cv2.cvtColor(buf32Lab, cv2.COLOR_Lab2RGB)
-            buf1[:, :, :3][:, :, ::-1] = (bufRGB32 * 255.0).astype(np.uint8)
-        # forward the alpha channel
-        buf1[:, :, 3] = buf0[:, :, 3]
+        pipeline.applyGradualFilter(params, buf0, buf1, self.getApplyContext())
         self.updatePixmap()
 
     def applyTemperature(self):
         """
         Warming/cooling filter.
-        The method implements two algorithms.
+        The method implements two algorithms (cf. bLUeTop.pipeline.applyTemperature()).
         - Photo/Color filter : Blending using mode multiply, plus correction of luminosity
             by blending the output image with the inputImage, using mode luminosity.
         - Chromatic adaptation : multipliers in linear sRGB.
         """
-        adjustForm = self.getGraphicsForm()
-        options = adjustForm.options
-        temperature = adjustForm.tempCorrection
-        tint = adjustForm.tintCorrection  # range -1..1
+        params = self.getFormParams().getParams()
+        adaptation = params.mode == 'Chromatic Adaptation'
         inputImage = self.inputImg()
-        buf1 = QImageBuffer(inputImage)
-        currentImage = self.getCurrentImage()
-        if not options['Color Filter']:
-            # neutral point : forward input image and return
-            if abs(temperature - 6500) < 200 and tint == 0:
-                buf0 = QImageBuffer(currentImage)
-                buf0[:, :, :] = buf1
-                self.updatePixmap()
-                return
-        ################
-        # photo filter
-        ################
-        if options['Photo Filter'] or options['Color Filter']:
-            if options['Photo Filter']:
-                # get black body color
-                r, g, b = bbTemperature2RGB(temperature)
-            else:
-                # get current color from color chooser dialog
-                # parent() is a dockWidget, parent().parent() is the main window
-                r, g, b = adjustForm.filterColor.getRgb()[:3]
-            filter = QImage(inputImage.size(), inputImage.format())
-            filter.fill(QColor(r, g, b, 255))
-            # draw image on filter using mode multiply
-            qp = QPainter(filter)
-            qp.setCompositionMode(QPainter.CompositionMode_Multiply)
-            qp.drawImage(0, 0, inputImage)
-            qp.end()
-            # correct the luminosity of the resulting image,
-            # by blending it with the inputImage, using mode luminosity.
-            # Note that using perceptual brightness gives better results, unfortunately slower
-            resImg = blendLuminosity(filter, inputImage)
-            bufOutRGB = QImageBuffer(resImg)[:, :, :3][:, :, ::-1]
-        #####################
-        # Chromatic adaptation
-        #####################
-        elif options['Chromatic Adaptation']:
-            """
-            tint = 2**tint
-            m1, m2, m3 = (1.0, tint, 1.0,) if tint >=1 else (1.0/tint, 1.0, 1.0/tint,)
-            # get conversion matrix in XYZ color space
-            M = conversionMatrix(temperature, sRGBWP)  # source is input image : sRGB, ref WP D65
-            buf = QImageBuffer(inputImage)[:, :, :3]
-            # convert to XYZ
-            bufXYZ = sRGB2XYZVec(buf[:,:,::-1])             #np.tensordot(bufLinear, sRGB_lin2XYZ, axes=(-1, -1))
-            # apply conversion matrix
-            bufXYZ = np.tensordot(bufXYZ, M, axes=(-1, -1))
-            """
-            # get RGB multipliers
-            m1, m2, m3, _ = temperatureAndTint2Multipliers(temperature, 2 ** tint, self.parentImage.RGB_lin2XYZInverse)  # TODO modified 24/02/20 validate
-            buf = QImageBuffer(inputImage)[:, :, :3]
-            bufXYZ = RGB2XYZ(buf[:, :, ::-1], RGB_lin2XYZ=self.parentImage.RGB_lin2XYZ)  # TODO modified 02/03/20 validate
-            bufsRGBLinear = np.tensordot(bufXYZ, self.parentImage.RGB_lin2XYZInverse, axes=(-1, -1))  # TODO modified 24/02/20 validate
-            # apply multipliers
-            bufsRGBLinear *= [m1, m2, m3]
-            # brightness correction
-            M = np.max(bufsRGBLinear)
-            bufsRGBLinear /= M
-            bufOutRGB = rgbLinear2rgb(bufsRGBLinear)
-            np.clip(bufOutRGB, 0, 255, out=bufOutRGB)
-            bufOutRGB = np.round(bufOutRGB).astype(np.uint8)  # TODO np.round added 18/04/20 validate
+        # neutral point : forward input image and return
+        if params.isNeutral():
+            self.forwardInput(inputImage)
+            if adaptation:
+                # forward the linear input too
+                self.setLinearOutput(self.getLinearInput(inputImage) if self.keepsLinearOutput() else None)
+            return
+        bufIn = QImageBuffer(inputImage)
+        if adaptation:
+            linearOut = np.empty(bufIn.shape[:2] + (3,), dtype=WORKING_DTYPE) if self.keepsLinearOutput() else None
+            ctx = self.getApplyContext(linearIn=self.getLinearInput(inputImage), linearOut=linearOut)
         else:
-            raise ValueError('applyTemperature : wrong option')
-        # set output image
-        bufOut0 = QImageBuffer(currentImage)
-        bufOut = bufOut0[:, :, :3]
-        bufOut[:, :, ::-1] = bufOutRGB
-        # forward the alpha channel
-        bufOut0[:, :, 3] = buf1[:, :, 3]
+            ctx = self.getApplyContext()
+        pipeline.applyTemperature(params, bufIn, QImageBuffer(self.getCurrentImage()), ctx)
         self.updatePixmap()
+        if adaptation:
+            self.setLinearOutput(linearOut)
 
@@ -0,0 +1,103 @@
+"""
+This File is part of bLUe software.
+
+Copyright (C) 2017  Bernard Virot <bernard.virot@libertysurf.fr>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Lesser General Public License as
+published by the Free Software Foundation, version 3.
+
+This program is distributed in the hope that it will be useful, but
+WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+Lesser General Lesser Public License for more details.
+
+You should have received a copy of the GNU Lesser General Public License
+along with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+#####################################################################
+# Precision of the working float type (cf. bLUeTop.settings.WORKING_DTYPE) :
+# the functions computing in the working float type are run in float32
+# and float64 on fixed random images, and the results are compared.
+#
+# usage (from the bLUe directory, which holds config.json) : python -m pytest tests
+#####################################################################
+import numpy as np
+import pytest
+
+pytest.importorskip('cv2')
+
+from bLUeGui import blendBuf, colorCIE
+from bLUeGui.histogramWarping import warpHistogram
+
+SHAPE = (300, 400)
+
+
+@pytest.fixture
+def rng():
+    return np.random.default_rng(12345)
+
+
+def gammaTables(monkeypatch, dtype):
+    """
+    Build the gamma tables in float type dtype, and make
+    them the tables used by the conversion functions.
+    """
+    monkeypatch.setattr(colorCIE, 'WORKING_DTYPE', dtype)
+    monkeypatch.setattr(colorCIE.gammaTables, 'instance', None, raising=False)
+    return colorCIE.gammaTables.getInstance()
+
+
+def test_gamma_tables(monkeypatch, rng):
+    rgb = rng.integers(0, 256, SHAPE + (3,))
+    lin = rng.random(SHAPE + (3,))
+    results = {}
+    for dtype in (np.float64, np.float32):
+        gt = gammaTables(monkeypatch, dtype)
+        assert gt.table3.dtype == dtype and gt.table5.dtype == dtype
+        results[dtype] = (colorCIE.rgb2rgbLinear(rgb), colorCIE.rgbLinear2rgb(lin.astype(dtype)))
+    (lin64, rgb64), (lin32, rgb32) = results[np.float64], results[np.float32]
+    assert lin32.dtype == np.float32 and rgb32.dtype == np.float32
+    # linearization : table values are rounded to float32
+    assert np.abs(lin32 - lin64).max() < 1e-6
+    # gamma adaptation : rounding of the float32 input may select the
+    # next table entry (< 0.1 level), for a few values only (about 0.02 %)
+    diff = np.abs(rgb32 - rgb64)
+    assert diff.max() < 0.1
+    assert np.count_nonzero(diff > 1e-3) < 1e-3 * diff.size
+
+
+def test_warpHistogram(rng):
+    # smooth channel with a bimodal histogram
+    img = np.clip(np.concatenate((rng.normal(0.3, 0.08, SHAPE[0] * SHAPE[1] // 2),
+                                  rng.normal(0.7, 0.1, SHAPE[0] * SHAPE[1] // 2))), 0, 1).reshape(SHAPE)
+    out64, *spline = warpHistogram(img)
+    out32, *_ = warpHistogram(img.astype(np.float32), quadSpline=spline)
+    assert out32.dtype == np.float32 and out64.dtype == np.float64
+    assert np.abs(out32 - out64).max() < 1e-5
+
+
+def test_blend(monkeypatch, rng):
+    dest = rng.integers(0, 256, SHAPE + (3,), dtype=np.uint8)
+    source = rng.integers(0, 256, SHAPE + (3,), dtype=np.uint8)
+    for f in (blendBuf.blendLuminosityBuf, blendBuf.blendColorBuf):
+        results = {}
+        for dtype in (np.float64, np.float32):
+            monkeypatch.setattr(blendBuf, 'WORKING_DTYPE', dtype)
+            results[dtype] = f(dest, source).astype(int)
+        diff = np.abs(results[np.float32] - results[np.float64])
+        # outputs are 8 bits : float32 rounding may change a level, rarely
+        assert diff.max() <= 1
+        assert np.count_nonzero(diff) < 0.01 * diff.size
+
+
+def test_dwtDenoiseChan(rng):
+    pytest.importorskip('pywt')
+    from bLUeCore.dwtDenoising import dwtDenoiseChan
+    img = rng.random(SHAPE + (3,)) * 100
+    for thrmode in ('hard', 'soft', 'wiener'):
+        out64 = dwtDenoiseChan(img, chan=0, thr=10.0, thrmode=thrmode, level=3)
+        out32 = dwtDenoiseChan(img.astype(np.float32), chan=0, thr=10.0, thrmode=thrmode, level=3)
+        assert out32.dtype == np.float32
+        # relative to the channel range (0..100)
+        assert np.abs(out32 - out64).max() < 5e-4